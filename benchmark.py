@@ -0,0 +1,123 @@
+"""Benchmark de carga del bot: actualizaciones por segundo antes y después
+del acceso asíncrono a la base de datos.
+
+Simula ráfagas de /misplanes + /mispuntos ejecutando las mismas consultas que
+los handlers y una espera configurable que representa la respuesta a Telegram.
+
+  * antes:   psycopg síncrono con una conexión nueva por actualización
+             (bloquea el event loop, como hacía get_db_connection()).
+  * despues: pool asíncrono de main.py (db_connection) con actualizaciones
+             concurrentes, como corre el bot con concurrent_updates(True).
+
+Uso:
+    DATABASE_URL=postgres://... python benchmark.py --updates 500 --concurrencia 50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import psycopg
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import main as bot
+
+# Consultas típicas de una actualización de /misplanes y /mispuntos
+CONSULTAS = [
+    "SELECT * FROM usuarios WHERE user_id = %s",
+    """
+        SELECT productos_json, total, semanas, pago_semanal, semanas_completadas
+        FROM planes_pago
+        WHERE user_id = %s AND estado = 'activo'
+    """,
+    "SELECT puntos_totales, puntos_disponibles FROM usuarios_puntos WHERE user_id = %s",
+]
+
+
+async def obtener_ids_usuarios(limite: int) -> list:
+    async with bot.db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("SELECT user_id FROM usuarios ORDER BY user_id LIMIT %s", (limite,))
+        filas = await cursor.fetchall()
+    return [fila[0] for fila in filas] or [0]
+
+
+async def actualizacion_antes(user_id: int, latencia_api: float):
+    """Una actualización con conexión síncrona nueva (bloquea el loop)"""
+    conn = psycopg.connect(bot.DATABASE_URL)
+    try:
+        cursor = conn.cursor()
+        for consulta in CONSULTAS:
+            cursor.execute(consulta, (user_id,))
+            cursor.fetchall()
+    finally:
+        conn.close()
+    await asyncio.sleep(latencia_api)
+
+
+async def actualizacion_despues(user_id: int, latencia_api: float):
+    """Una actualización usando el pool asíncrono del bot"""
+    async with bot.db_connection() as conn:
+        cursor = conn.cursor()
+        for consulta in CONSULTAS:
+            await cursor.execute(consulta, (user_id,))
+            await cursor.fetchall()
+    await asyncio.sleep(latencia_api)
+
+
+async def ejecutar_escenario(nombre, funcion, ids, total, concurrencia, latencia_api):
+    semaforo = asyncio.Semaphore(concurrencia)
+    latencias = []
+
+    async def una(i):
+        async with semaforo:
+            inicio = time.perf_counter()
+            await funcion(ids[i % len(ids)], latencia_api)
+            latencias.append(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(una(i) for i in range(total)))
+    duracion = time.perf_counter() - inicio
+
+    latencias.sort()
+    p95 = latencias[int(len(latencias) * 0.95) - 1] if latencias else 0
+    print(f"📊 {nombre:<8} {total / duracion:8.1f} updates/s | "
+          f"p50 {statistics.median(latencias) * 1000:7.1f} ms | p95 {p95 * 1000:7.1f} ms | "
+          f"total {duracion:.2f} s")
+    return total / duracion
+
+
+async def principal(args):
+    await bot.iniciar_pool()
+    try:
+        ids = await obtener_ids_usuarios(args.usuarios)
+        latencia_api = args.latencia_api / 1000
+        print(f"🚀 {args.updates} actualizaciones, concurrencia {args.concurrencia}, "
+              f"latencia API simulada {args.latencia_api} ms\n")
+
+        antes = await ejecutar_escenario("antes", actualizacion_antes, ids,
+                                         args.updates, args.concurrencia, latencia_api)
+        despues = await ejecutar_escenario("despues", actualizacion_despues, ids,
+                                           args.updates, args.concurrencia, latencia_api)
+
+        print(f"\n⚡ Mejora: x{despues / antes:.1f}")
+        print(f"🗄️ Pool: {bot.obtener_estadisticas_pool()}")
+    finally:
+        await bot.cerrar_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de actualizaciones por segundo")
+    parser.add_argument("--updates", type=int, default=300)
+    parser.add_argument("--concurrencia", type=int, default=50)
+    parser.add_argument("--usuarios", type=int, default=100, help="Usuarios distintos a consultar")
+    parser.add_argument("--latencia-api", type=float, default=50, help="ms simulados por respuesta a Telegram")
+    args = parser.parse_args()
+
+    if not os.getenv('DATABASE_URL'):
+        raise SystemExit("❌ Define DATABASE_URL para ejecutar el benchmark")
+
+    asyncio.run(principal(args))
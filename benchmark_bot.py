@@ -0,0 +1,441 @@
+"""Benchmark de extremo a extremo: la Application real de main.py contra un
+servidor falso de la Bot API y una base de datos PostgreSQL de pruebas.
+
+El servidor falso registra sendMessage / editMessageText / sendPhoto, agrega
+una latencia fija por llamada y puede responder 429 (RetryAfter) con cierta
+probabilidad. Los escenarios se reproducen como updates de Telegram pasados
+a Application.process_update() y se mide:
+
+  * updates/s de cada escenario
+  * latencia del handler p50 / p95 / p99
+  * consultas SQL por update
+
+Escenarios:
+  registro   /start + teléfono de cada usuario
+  pago       /pagarealizado + datos del pago + foto del comprobante
+  saturacion una ráfaga de updates de un solo chat no debe demorar a otro
+             chat (main.ProcesadorPorChat); no usa la base ni la Bot API
+  avanzar    /avanzartodos del admin sobre los N usuarios con plan activo,
+             incluyendo los avisos que envía despachar_notificaciones desde
+             la bandeja de salida (DIFUSION_MENSAJES_POR_SEGUNDO)
+
+Todo corre en un esquema temporal que se borra al terminar.
+
+Uso (contra una base de datos de pruebas, NO producción):
+    DATABASE_URL=postgres://... python benchmark_bot.py --usuarios 500 --latencia-api 40 --prob-429 0.01
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import random
+import socket
+import time
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+import psycopg
+import uvicorn
+from dotenv import load_dotenv
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from telegram import Update
+
+load_dotenv()
+
+# El bot del benchmark no persiste estado ni usa webhook (antes de importar main)
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARK')
+os.environ['PERSISTENCIA'] = 'ninguna'
+os.environ['WEBHOOK_URL'] = ''
+
+import main as bot
+
+ESQUEMA = "benchmark_bot"
+PRIMER_USUARIO = 900_000_000
+METODOS_CON_LIMITE = {'sendMessage', 'sendPhoto', 'editMessageText'}
+
+# =============================================
+# 🔢 CONTEO DE CONSULTAS POR UPDATE
+# =============================================
+
+consultas_update = contextvars.ContextVar('consultas_update', default=None)
+
+class CursorContador(psycopg.AsyncCursor):
+    """Cursor que suma cada consulta al contador del update en curso"""
+
+    def _contar(self):
+        contador = consultas_update.get()
+        if contador is not None:
+            contador[0] += 1
+
+    async def execute(self, query, params=None, **kwargs):
+        self._contar()
+        return await super().execute(query, params, **kwargs)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        self._contar()
+        return await super().executemany(query, params_seq, **kwargs)
+
+async def configurar_conexion(conn):
+    conn.cursor_factory = CursorContador
+
+# =============================================
+# 🤖 SERVIDOR FALSO DE LA BOT API
+# =============================================
+
+class BotApiFalsa:
+    """Responde como api.telegram.org y registra las llamadas recibidas"""
+
+    def __init__(self, latencia: float, prob_429: float, retry_after: int):
+        self.latencia = latencia
+        self.prob_429 = prob_429
+        self.retry_after = retry_after
+        self.llamadas = Counter()
+        self.errores_429 = 0
+        self.ids_mensaje = itertools.count(1)
+
+    def _mensaje(self, parametros: dict) -> dict:
+        return {
+            'message_id': next(self.ids_mensaje),
+            'date': int(time.time()),
+            'chat': {'id': int(parametros.get('chat_id') or 0), 'type': 'private'},
+            'text': parametros.get('text') or parametros.get('caption') or '',
+        }
+
+    async def atender(self, request: Request):
+        metodo = request.path_params['metodo']
+        cuerpo = await request.body()
+        if request.headers.get('content-type', '').startswith('application/json'):
+            parametros = json.loads(cuerpo or b'{}')
+        else:
+            parametros = {clave: valores[0] for clave, valores in parse_qs(cuerpo.decode()).items()}
+
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+
+        if metodo in METODOS_CON_LIMITE and random.random() < self.prob_429:
+            self.errores_429 += 1
+            return JSONResponse({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status_code=429)
+
+        self.llamadas[metodo] += 1
+        if metodo == 'getMe':
+            resultado = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif metodo in METODOS_CON_LIMITE:
+            resultado = self._mensaje(parametros)
+        else:
+            resultado = True
+        return JSONResponse({'ok': True, 'result': resultado})
+
+    def app(self) -> Starlette:
+        return Starlette(routes=[Route('/bot{token}/{metodo}', self.atender, methods=['GET', 'POST'])])
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# =============================================
+# 📨 UPDATES SIMULADOS
+# =============================================
+
+class GeneradorUpdates:
+    """Construye updates de Telegram como los que envía un usuario real"""
+
+    def __init__(self, telegram_bot):
+        self.bot = telegram_bot
+        self.ids = itertools.count(1)
+
+    def _mensaje(self, user_id: int) -> dict:
+        return {
+            'message_id': next(self.ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Usuario{user_id}'},
+        }
+
+    def _update(self, mensaje: dict) -> Update:
+        return Update.de_json({'update_id': next(self.ids), 'message': mensaje}, self.bot)
+
+    def texto(self, user_id: int, texto: str) -> Update:
+        mensaje = self._mensaje(user_id)
+        mensaje['text'] = texto
+        if texto.startswith('/'):
+            comando = texto.split()[0]
+            mensaje['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(comando)}]
+        return self._update(mensaje)
+
+    def foto(self, user_id: int) -> Update:
+        mensaje = self._mensaje(user_id)
+        numero = mensaje['message_id']
+        mensaje['photo'] = [{'file_id': f'foto{numero}', 'file_unique_id': f'u{numero}', 'width': 800, 'height': 600}]
+        return self._update(mensaje)
+
+# =============================================
+# 📊 MEDICIÓN
+# =============================================
+
+def percentil(ordenados: list, p: float) -> float:
+    if not ordenados:
+        return 0.0
+    indice = min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+class Medicion:
+    def __init__(self, nombre: str):
+        self.nombre = nombre
+        self.latencias = []
+        self.consultas = []
+        self.duracion = 0.0
+
+    async def procesar(self, application, update: Update):
+        """Procesar un update midiendo su latencia y las consultas que hizo"""
+        contador = [0]
+        token = consultas_update.set(contador)
+        inicio = time.perf_counter()
+        try:
+            await application.process_update(update)
+        finally:
+            self.latencias.append(time.perf_counter() - inicio)
+            consultas_update.reset(token)
+            self.consultas.append(contador[0])
+
+    def reportar(self):
+        total = len(self.latencias)
+        ordenados = sorted(self.latencias)
+        por_segundo = total / self.duracion if self.duracion else 0.0
+        consultas = sum(self.consultas) / total if total else 0.0
+        print(f"📊 {self.nombre:<9} {total:6d} updates {por_segundo:8.1f} updates/s | "
+              f"p50 {percentil(ordenados, 50) * 1000:7.1f} ms | "
+              f"p95 {percentil(ordenados, 95) * 1000:7.1f} ms | "
+              f"p99 {percentil(ordenados, 99) * 1000:7.1f} ms | "
+              f"{consultas:5.1f} consultas/update")
+
+async def ejecutar_secuencias(nombre, application, secuencias, concurrencia) -> Medicion:
+    """Cada secuencia es la conversación de un usuario: sus updates van en
+    orden y los usuarios corren en paralelo, como los reparte
+    main.ProcesadorPorChat (process_update no pasa por el procesador)"""
+    medicion = Medicion(nombre)
+    semaforo = asyncio.Semaphore(concurrencia)
+
+    async def conversacion(updates):
+        async with semaforo:
+            for update in updates:
+                await medicion.procesar(application, update)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(conversacion(updates) for updates in secuencias))
+    medicion.duracion = time.perf_counter() - inicio
+    medicion.reportar()
+    return medicion
+
+# =============================================
+# 🎬 ESCENARIOS
+# =============================================
+
+async def escenario_registro(application, generador, ids, concurrencia):
+    secuencias = [
+        [generador.texto(uid, '/start'), generador.texto(uid, f'+58412{uid % 10_000_000:07d}')]
+        for uid in ids
+    ]
+    await ejecutar_secuencias("registro", application, secuencias, concurrencia)
+
+async def escenario_pago(application, generador, ids, concurrencia):
+    secuencias = [
+        [
+            generador.texto(uid, '/pagarealizado'),
+            generador.texto(uid, f'Nombre: Usuario {uid}\nReferencia: REF{uid}\nMonto: 10'),
+            generador.foto(uid),
+        ]
+        for uid in ids
+    ]
+    await ejecutar_secuencias("pago", application, secuencias, concurrencia)
+
+async def escenario_avanzar(application, generador, ids, espera_maxima):
+    """Un /avanzartodos sobre len(ids) planes activos y los avisos resultantes"""
+    async with bot.db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            INSERT INTO planes_pago (user_id, productos_json, total, semanas, pago_semanal, semanas_completadas, estado)
+            SELECT user_id, '{}'::jsonb, 100, 10, 10, 0, 'activo'
+            FROM usuarios
+            WHERE user_id = ANY(%s)
+            AND NOT EXISTS (SELECT 1 FROM planes_pago p WHERE p.user_id = usuarios.user_id AND p.estado = 'activo')
+        """, (list(ids),))
+        await cursor.execute("SELECT COALESCE(MAX(id), 0) FROM avances")
+        ultimo_avance = (await cursor.fetchone())[0]
+
+    medicion = Medicion("avanzar")
+    inicio = time.perf_counter()
+    await medicion.procesar(application, generador.texto(bot.ADMIN_IDS[0], '/avanzartodos'))
+    medicion.duracion = time.perf_counter() - inicio
+    medicion.reportar()
+
+    # Los avisos salen en segundo plano desde la bandeja de salida: esperar a que terminen
+    estado = None
+    while time.perf_counter() - inicio < espera_maxima:
+        async with bot.db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("""
+                SELECT COUNT(*) FILTER (WHERE NOT notificado),
+                       COUNT(*) FILTER (WHERE resultado = 'enviado'),
+                       COUNT(*) FILTER (WHERE resultado = 'bloqueado'),
+                       COUNT(*) FILTER (WHERE resultado = 'fallido')
+                FROM avances
+                WHERE id > %s
+            """, (ultimo_avance,))
+            estado = await cursor.fetchone()
+        if estado[0] == 0 and sum(estado[1:]):
+            break
+        await asyncio.sleep(0.5)
+    duracion = time.perf_counter() - inicio
+
+    if estado and estado[0] == 0 and sum(estado[1:]):
+        print(f"📣 Avisos: {estado[1]} enviados, {estado[2]} bloqueados, {estado[3]} fallidos "
+              f"en {duracion:.2f} s ({estado[1] / duracion:.1f} mensajes/s)")
+    else:
+        print(f"⚠️ Los avisos no terminaron en {espera_maxima:.0f} s")
+
+async def escenario_saturacion(cupos: int, duracion: float = 0.2) -> bool:
+    """Una ráfaga de 5 × cupos updates del chat 1 y, detrás, un update del
+    chat 2: el del chat 2 debe atenderse enseguida y los del chat 1 de a uno"""
+    procesador = bot.ProcesadorPorChat(cupos)
+    en_curso = 0
+    maximo_en_curso = 0
+
+    def update_de(chat_id):
+        return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_user=None)
+
+    async def handler_lento():
+        nonlocal en_curso, maximo_en_curso
+        en_curso += 1
+        maximo_en_curso = max(maximo_en_curso, en_curso)
+        await asyncio.sleep(duracion)
+        en_curso -= 1
+
+    rafaga = [asyncio.create_task(procesador.process_update(update_de(1), handler_lento()))
+              for _ in range(cupos * 5)]
+    await asyncio.sleep(0)  # la ráfaga ya está esperando su turno
+
+    inicio = time.perf_counter()
+    await procesador.process_update(update_de(2), asyncio.sleep(duracion))
+    espera_otro_chat = time.perf_counter() - inicio
+    await asyncio.gather(*rafaga)
+
+    correcto = espera_otro_chat < duracion * 2 and maximo_en_curso == 1
+    print(f"{'✅' if correcto else '❌'} saturacion: otro chat atendido en {espera_otro_chat * 1000:.0f} ms "
+          f"con {len(rafaga)} updates de un chat en cola; máximo en paralelo del mismo chat: {maximo_en_curso}")
+    return correcto
+
+async def asegurar_usuarios(ids):
+    """Registrar por SQL a los usuarios si no se corrió el escenario de registro"""
+    async with bot.db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            INSERT INTO usuarios (user_id, first_name, phone)
+            SELECT g, 'Usuario' || g, '+58' || g FROM unnest(%s::bigint[]) g
+            ON CONFLICT (user_id) DO NOTHING
+        """, (list(ids),))
+
+# =============================================
+# 🚀 PRINCIPAL
+# =============================================
+
+async def principal(args):
+    api = BotApiFalsa(args.latencia_api / 1000, args.prob_429, args.retry_after)
+    puerto = puerto_libre()
+    servidor = uvicorn.Server(uvicorn.Config(api.app(), host='127.0.0.1', port=puerto, log_level='warning'))
+    tarea_servidor = asyncio.create_task(servidor.serve())
+    while not servidor.started:
+        await asyncio.sleep(0.05)
+
+    # Pool propio del benchmark: esquema temporal y cursores que cuentan consultas
+    bot.db_pool = AsyncConnectionPool(
+        bot.DATABASE_URL,
+        min_size=bot.DB_POOL_MIN_SIZE,
+        max_size=bot.DB_POOL_MAX_SIZE,
+        timeout=bot.DB_POOL_TIMEOUT,
+        kwargs={'options': f'-c search_path={ESQUEMA}'},
+        configure=configurar_conexion,
+        name="benchmark",
+        open=False,
+    )
+    await bot.db_pool.open(wait=True)
+
+    application = bot.construir_aplicacion(base_url=f"http://127.0.0.1:{puerto}/bot")
+    tarea_avisos = None
+    try:
+        await bot.init_db()
+        await application.initialize()
+        await application.start()
+        # Sin post_init: el despachador de la bandeja de salida se arranca aquí
+        tarea_avisos = asyncio.create_task(bot.despachar_notificaciones(application.bot))
+
+        ids = range(PRIMER_USUARIO, PRIMER_USUARIO + args.usuarios)
+        generador = GeneradorUpdates(application.bot)
+        escenarios = args.escenarios.split(',')
+        print(f"🚀 {args.usuarios} usuarios, concurrencia {args.concurrencia}, "
+              f"latencia API {args.latencia_api} ms, 429 con probabilidad {args.prob_429}\n")
+
+        if 'saturacion' in escenarios:
+            await escenario_saturacion(min(args.concurrencia, 8))
+        if 'registro' in escenarios:
+            await escenario_registro(application, generador, ids, args.concurrencia)
+        else:
+            await asegurar_usuarios(ids)
+        if 'pago' in escenarios:
+            await escenario_pago(application, generador, ids, args.concurrencia)
+        if 'avanzar' in escenarios:
+            await escenario_avanzar(application, generador, ids, args.espera_difusion)
+
+        print(f"\n🤖 Llamadas a la Bot API: {dict(api.llamadas)}")
+        print(f"⏳ Respuestas 429 simuladas: {api.errores_429}")
+        print(f"🗄️ Pool: {bot.obtener_estadisticas_pool()}")
+    finally:
+        if tarea_avisos:
+            tarea_avisos.cancel()
+            await asyncio.gather(tarea_avisos, return_exceptions=True)
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await bot.cerrar_pool()
+        servidor.should_exit = True
+        await tarea_servidor
+
+def preparar_esquema(database_url: str, borrar: bool = False):
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        conn.execute(f"DROP SCHEMA IF EXISTS {ESQUEMA} CASCADE")
+        if not borrar:
+            conn.execute(f"CREATE SCHEMA {ESQUEMA}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de extremo a extremo del bot")
+    parser.add_argument("--usuarios", type=int, default=200)
+    parser.add_argument("--concurrencia", type=int, default=50, help="Usuarios conversando a la vez")
+    parser.add_argument("--escenarios", default="saturacion,registro,pago,avanzar")
+    parser.add_argument("--latencia-api", type=float, default=40, help="ms por llamada a la Bot API falsa")
+    parser.add_argument("--prob-429", type=float, default=0.0, help="Probabilidad de responder 429 a un envío")
+    parser.add_argument("--retry-after", type=int, default=1, help="Segundos indicados en cada 429")
+    parser.add_argument("--espera-difusion", type=float, default=300, help="Segundos máximos esperando la difusión")
+    parser.add_argument("--conservar", action="store_true", help="No borrar el esquema de prueba al terminar")
+    args = parser.parse_args()
+
+    if not os.getenv('DATABASE_URL'):
+        raise SystemExit("❌ Define DATABASE_URL (base de datos de pruebas)")
+
+    preparar_esquema(bot.DATABASE_URL)
+    try:
+        asyncio.run(principal(args))
+    finally:
+        if not args.conservar:
+            preparar_esquema(bot.DATABASE_URL, borrar=True)
@@ -1,21 +1,36 @@
 import os
-import threading
-from flask import Flask  # ← AGREGAR ESTE IMPORT
+import sys
+import re
+import csv
+import gzip
+import queue
+import tempfile
+import random
+import asyncio
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
+from telegram.request import HTTPXRequest
+from telegram.ext import (Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler,
+                          BasePersistence, PersistenceInput, PicklePersistence, BaseUpdateProcessor)
 import psycopg
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 import pytz
 from datetime import datetime, timedelta, timezone
 import json
+import time
+import contextvars
+import uuid
+from collections import Counter
+from enum import Enum
+from contextlib import asynccontextmanager, nullcontext
 import telegram
 from dotenv import load_dotenv
-
-app = Flask(__name__)
-
-@app.route('/')
-def health_check():
-    return "Bot is running", 200
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
 
 # Configuración
 # Cargar variables de entorno
@@ -24,6 +39,12 @@ load_dotenv()
 # Configuración desde variables de entorno
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 DATABASE_URL = os.getenv('DATABASE_URL')
+PORT = int(os.getenv('PORT', '10000'))
+# Modo webhook: si WEBHOOK_URL está definido Telegram envía los updates a WEBHOOK_URL + WEBHOOK_PATH;
+# si no, el bot usa polling. En ambos modos el mismo servidor web atiende / y /ready.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
 # IDs de administrador actualizados
 ADMIN_IDS = [5908252094, 7228946245, 1074083869]  # ← IDs ACTUALIZADOS
 
@@ -31,362 +52,1963 @@ ADMIN_IDS = [5908252094, 7228946245, 1074083869]  # ← IDs ACTUALIZADOS
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
-# Conexión a la base de datos - CAMBIO PARA PSYCOPG3
-def get_db_connection():
-    return psycopg.connect(DATABASE_URL)
+# =============================================
+# 📜 REGISTRO DE EVENTOS (LOGGING)
+# =============================================
+
+LOG_NIVEL = os.getenv('LOG_NIVEL', 'INFO').upper()
+LOG_FORMATO = os.getenv('LOG_FORMATO', 'json').lower()  # 'json' o 'texto'
+# Fracción de eventos DEBUG que se conservan (son los más frecuentes)
+LOG_MUESTREO_DEBUG = float(os.getenv('LOG_MUESTREO_DEBUG', '0.1'))
+
+logger = logging.getLogger('sususemanal')
+
+# Teléfonos (+58 412 1234567, 04121234567) y referencias de pago ("Referencia: 123456")
+PATRON_TELEFONO = re.compile(r'\+\d[\d\s-]{7,}\d|\b0\d{10}\b')
+PATRON_REFERENCIA = re.compile(r'(\breferencia\b\W{0,4})([^\s,;\'"]+)', re.IGNORECASE)
+CAMPOS_SENSIBLES = {'phone', 'telefono', 'referencia'}
+
+def redactar(texto: str) -> str:
+    """Ocultar teléfonos y referencias de pago dejando los últimos 2 caracteres"""
+    texto = PATRON_REFERENCIA.sub(lambda m: m.group(1) + '***' + m.group(2)[-2:], texto)
+    return PATRON_TELEFONO.sub(lambda m: '***' + m.group(0)[-2:], texto)
 
-def reparar_tablas():
-    """Reparar tablas existentes agregando columnas faltantes"""
-    print("🔧 Verificando y reparando columnas faltantes...")
+class FormatoJSON(logging.Formatter):
+    """Una línea JSON por evento, con los campos de `extra` y ya redactada"""
+
+    CAMPOS_RECORD = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record: logging.LogRecord) -> str:
+        evento = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'mensaje': redactar(record.getMessage()),
+        }
+        for clave, valor in vars(record).items():
+            if clave not in self.CAMPOS_RECORD:
+                evento[clave] = '***' if clave in CAMPOS_SENSIBLES else valor
+        if record.exc_info:
+            evento['excepcion'] = redactar(self.formatException(record.exc_info))
+        return json.dumps(evento, ensure_ascii=False, default=str)
+
+class FormatoTexto(logging.Formatter):
+    """Formato legible para desarrollo local, también redactado"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return redactar(super().format(record))
+
+class FiltroMuestreo(logging.Filter):
+    """Deja pasar solo una fracción de los eventos DEBUG"""
+
+    def __init__(self, fraccion: float):
+        super().__init__()
+        self.fraccion = fraccion
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.fraccion
+
+class ColaLogging(QueueHandler):
+    """Encola el evento sin formatearlo: formato, redacción y escritura corren
+    en el hilo del QueueListener, nunca en el event loop"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Fijar el mensaje ahora por si los argumentos cambian después
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def configurar_logging() -> QueueListener:
+    """Enviar todos los logs a stdout a través de una cola; devuelve el listener"""
+    cola = queue.SimpleQueue()
+    salida = logging.StreamHandler(sys.stdout)
+    if LOG_FORMATO == 'json':
+        salida.setFormatter(FormatoJSON())
+    else:
+        salida.setFormatter(FormatoTexto('%(asctime)s %(levelname)s %(name)s: %(message)s'))
     
-    # Verificar y agregar columna 'descripcion' en productos
+    manejador = ColaLogging(cola)
+    manejador.addFilter(FiltroMuestreo(LOG_MUESTREO_DEBUG))
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [manejador]
+    raiz.setLevel(LOG_NIVEL)
+    # httpx registra cada petición a Telegram en INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    
+    listener = QueueListener(cola, salida, respect_handler_level=True)
+    listener.start()
+    return listener
+
+# =============================================
+# 🗄️ POOL DE CONEXIONES A LA BASE DE DATOS
+# =============================================
+
+# Tamaño y tiempos del pool configurables desde variables de entorno
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))  # segundos
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))  # segundos para obtener conexión
+
+db_pool = None
+
+class EstadisticasPool:
+    """Acumula la latencia de obtención de conexiones del pool"""
+
+    def __init__(self):
+        self.solicitudes = 0
+        self.tiempo_total = 0.0
+        self.tiempo_maximo = 0.0
+        self.timeouts = 0
+
+    def registrar(self, segundos: float):
+        self.solicitudes += 1
+        self.tiempo_total += segundos
+        if segundos > self.tiempo_maximo:
+            self.tiempo_maximo = segundos
+
+    def registrar_timeout(self):
+        self.timeouts += 1
+
+    def resumen(self) -> dict:
+        promedio = self.tiempo_total / self.solicitudes if self.solicitudes else 0.0
+        return {
+            'solicitudes': self.solicitudes,
+            'promedio_ms': promedio * 1000,
+            'maximo_ms': self.tiempo_maximo * 1000,
+            'timeouts': self.timeouts,
+        }
+
+estadisticas_pool = EstadisticasPool()
+
+async def iniciar_pool():
+    """Crear y abrir el pool de conexiones (una sola vez por proceso)"""
+    global db_pool
+    if db_pool is not None:
+        return db_pool
+    db_pool = AsyncConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_lifetime=DB_POOL_MAX_LIFETIME,
+        timeout=DB_POOL_TIMEOUT,
+        check=AsyncConnectionPool.check_connection,  # Verifica la conexión antes de entregarla
+        name="sususemanal",
+        kwargs={'cursor_factory': CursorInstrumentado},  # Métricas por consulta
+        open=False,
+    )
+    await db_pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+    logger.info(f"✅ Pool de conexiones abierto (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+    return db_pool
+
+async def cerrar_pool():
+    """Cerrar el pool liberando todas las conexiones"""
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+        logger.info("🔌 Pool de conexiones cerrado")
+
+@asynccontextmanager
+async def db_connection():
+    """Obtener una conexión del pool; siempre se devuelve al salir del bloque.
+
+    Al salir sin errores se hace commit de la transacción abierta y, si hay
+    una excepción, rollback.
+    """
+    pool = db_pool or await iniciar_pool()
+    inicio = time.perf_counter()
     try:
-        conn = get_db_connection()
+        async with pool.connection(timeout=DB_POOL_TIMEOUT) as conn:
+            estadisticas_pool.registrar(time.perf_counter() - inicio)
+            yield conn
+    except PoolTimeout:
+        estadisticas_pool.registrar_timeout()
+        logger.error(f"❌ Timeout esperando conexión del pool ({DB_POOL_TIMEOUT}s)")
+        raise
+
+def obtener_estadisticas_pool() -> dict:
+    """Estadísticas actuales del pool: en uso, en espera y latencia de obtención"""
+    datos = estadisticas_pool.resumen()
+    if db_pool is None:
+        datos.update({'tamano': 0, 'en_uso': 0, 'disponibles': 0, 'en_espera': 0})
+        return datos
+    stats = db_pool.get_stats()
+    tamano = stats.get('pool_size', 0)
+    disponibles = stats.get('pool_available', 0)
+    datos.update({
+        'tamano': tamano,
+        'en_uso': tamano - disponibles,
+        'disponibles': disponibles,
+        'en_espera': stats.get('requests_waiting', 0),
+        'errores': stats.get('connections_errors', 0),
+        'perdidas': stats.get('connections_lost', 0),
+    })
+    return datos
+
+# =============================================
+# 🗄️ MIGRACIONES DE ESQUEMA VERSIONADAS
+# =============================================
+
+def particionar_por_mes(tabla: str, indices: list) -> list:
+    """Sentencias para convertir ``tabla`` en una tabla particionada por mes
+    de ``fecha``: copia los datos a las particiones y recrea sus índices.
+    La PK pasa a ser (id, fecha) porque debe incluir la clave de partición."""
+    anterior = f"{tabla}_sin_particionar"
+    return [
+        f"ALTER TABLE {tabla} RENAME TO {anterior}",
+        f"UPDATE {anterior} SET fecha = CURRENT_TIMESTAMP WHERE fecha IS NULL",
+        f"CREATE TABLE {tabla} (LIKE {anterior} INCLUDING DEFAULTS) PARTITION BY RANGE (fecha)",
+        f"ALTER TABLE {tabla} ALTER COLUMN fecha SET NOT NULL",
+        f"""
+        SELECT crear_particiones_mensuales('{tabla}',
+            (SELECT MIN(fecha) FROM {anterior})::date,
+            (CURRENT_DATE + INTERVAL '3 months')::date)
+        """,
+        # Red de seguridad para fechas fuera de las particiones creadas
+        f"CREATE TABLE IF NOT EXISTS {tabla}_default PARTITION OF {tabla} DEFAULT",
+        f"INSERT INTO {tabla} SELECT * FROM {anterior}",
+        # La secuencia del id sigue siendo la misma
+        f"ALTER SEQUENCE {tabla}_id_seq OWNED BY NONE",
+        f"DROP TABLE {anterior}",
+        f"ALTER SEQUENCE {tabla}_id_seq OWNED BY {tabla}.id",
+        f"ALTER TABLE {tabla} ADD PRIMARY KEY (id, fecha)",
+    ] + indices
+
+# Cada migración: (versión, descripción, sentencias). Se aplican en orden,
+# todas las pendientes en una sola transacción y con una sola conexión.
+# Nunca modificar una migración ya publicada: agregar una nueva al final.
+MIGRACIONES = [
+    (1, "Esquema base con semanas individuales", [
+        # Tabla de usuarios
+        '''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT UNIQUE,
+            user_name VARCHAR(255),
+            first_name VARCHAR(255),
+            last_name VARCHAR(255),
+            phone VARCHAR(50),
+            fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            estado VARCHAR(50) DEFAULT 'activo'
+        )
+        ''',
+        # Tabla de pagos
+        '''
+        CREATE TABLE IF NOT EXISTS pagos (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            user_name VARCHAR(255),
+            referencia VARCHAR(100),
+            file_id VARCHAR(255),
+            monto DECIMAL(10,2),
+            estado VARCHAR(50) DEFAULT 'pendiente',
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Tabla de productos
+        '''
+        CREATE TABLE IF NOT EXISTS productos (
+            id SERIAL PRIMARY KEY,
+            nombre VARCHAR(255),
+            descripcion TEXT,
+            precio DECIMAL(10,2),
+            categoria VARCHAR(100),
+            estado VARCHAR(50) DEFAULT 'activo',
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Tabla de configuración (SOLO VALOR POR DEFECTO)
+        '''
+        CREATE TABLE IF NOT EXISTS config_pagos (
+            id SERIAL PRIMARY KEY,
+            semanas_default INT DEFAULT 10,  -- ← Solo valor por defecto
+            fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Tabla de planes de pago - semanas individuales
+        '''
+        CREATE TABLE IF NOT EXISTS planes_pago (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            productos_json JSONB,
+            total DECIMAL(10,2),
+            semanas INT DEFAULT 10,  -- ← SEMANAS INDIVIDUALES
+            pago_semanal DECIMAL(10,2),
+            semanas_completadas INT DEFAULT 0,
+            estado VARCHAR(50) DEFAULT 'activo',
+            contador_pausado BOOLEAN DEFAULT FALSE,
+            fecha_inicio TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fecha_ultimo_pago TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fecha_configuracion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Tabla de puntos de usuarios
+        '''
+        CREATE TABLE IF NOT EXISTS usuarios_puntos (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT UNIQUE,
+            puntos_totales INT DEFAULT 0,
+            puntos_disponibles INT DEFAULT 0,
+            fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Tabla de referidos
+        '''
+        CREATE TABLE IF NOT EXISTS referidos (
+            id SERIAL PRIMARY KEY,
+            user_id_referidor BIGINT,
+            user_id_referido BIGINT,
+            nombre_referido VARCHAR(255),
+            telefono_referido VARCHAR(50),
+            estado VARCHAR(50) DEFAULT 'pendiente',
+            puntos_otorgados BOOLEAN DEFAULT FALSE,
+            fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Tabla de historial de puntos
+        '''
+        CREATE TABLE IF NOT EXISTS puntos_historial (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            tipo VARCHAR(50),
+            puntos INT,
+            descripcion TEXT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, "Columnas agregadas antes por reparar_tablas()", [
+        "ALTER TABLE productos ADD COLUMN IF NOT EXISTS descripcion TEXT",
+        "ALTER TABLE productos ADD COLUMN IF NOT EXISTS categoria VARCHAR(100)",
+        "ALTER TABLE planes_pago ADD COLUMN IF NOT EXISTS contador_pausado BOOLEAN DEFAULT FALSE",
+        "ALTER TABLE planes_pago ADD COLUMN IF NOT EXISTS fecha_ultimo_pago TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+        "ALTER TABLE planes_pago ADD COLUMN IF NOT EXISTS fecha_configuracion TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+        "ALTER TABLE config_pagos ADD COLUMN IF NOT EXISTS semanas_default INT DEFAULT 10",
+    ]),
+    (3, "Columnas usadas por los handlers que el esquema no creaba", [
+        "ALTER TABLE config_pagos ADD COLUMN IF NOT EXISTS semanas INT DEFAULT 10",
+        "ALTER TABLE config_pagos ADD COLUMN IF NOT EXISTS contador_activo BOOLEAN DEFAULT TRUE",
+        "ALTER TABLE planes_pago ADD COLUMN IF NOT EXISTS fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+    ]),
+    (4, "Configuración por defecto", [
+        '''
+        INSERT INTO config_pagos (semanas_default)
+        SELECT 10
+        WHERE NOT EXISTS (SELECT 1 FROM config_pagos)
+        ''',
+    ]),
+    (5, "Índices para las consultas más frecuentes", [
+        # Plan activo de un usuario (/misplanes, contadores, asignaciones)
+        "CREATE INDEX IF NOT EXISTS idx_planes_pago_user_estado ON planes_pago (user_id, estado)",
+        # Pagos pendientes (/verpagos) y todos los pagos por fecha (/verpagostodos)
+        "CREATE INDEX IF NOT EXISTS idx_pagos_pendientes ON pagos (fecha DESC) WHERE estado = 'pendiente'",
+        "CREATE INDEX IF NOT EXISTS idx_pagos_estado_fecha ON pagos (estado, fecha DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_pagos_fecha ON pagos (fecha DESC)",
+        # Pagos de un usuario (/mistatus, /miperfil)
+        "CREATE INDEX IF NOT EXISTS idx_pagos_user_fecha ON pagos (user_id, fecha DESC)",
+        # Historial de puntos de un usuario (/mispuntos)
+        "CREATE INDEX IF NOT EXISTS idx_puntos_historial_user_fecha ON puntos_historial (user_id, fecha DESC)",
+        # Referidos de un usuario y referidos pendientes (/referidos, /verreferidos)
+        "CREATE INDEX IF NOT EXISTS idx_referidos_referidor_estado ON referidos (user_id_referidor, estado)",
+        "CREATE INDEX IF NOT EXISTS idx_referidos_referido ON referidos (user_id_referido)",
+        "CREATE INDEX IF NOT EXISTS idx_referidos_pendientes ON referidos (fecha_registro DESC) WHERE estado = 'pendiente'",
+    ]),
+    # La 6 (tablas de difusiones) se retiró antes de publicarse: los avisos
+    # masivos pasan por la bandeja de salida (migración 12)
+    (7, "Persistencia de user_data y chat_data del bot", [
+        '''
+        CREATE TABLE IF NOT EXISTS persistencia_bot (
+            tipo VARCHAR(10),
+            clave BIGINT,
+            datos JSONB NOT NULL,
+            fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (tipo, clave)
+        )
+        ''',
+    ]),
+    (8, "Índices para la paginación por keyset de los listados de admin", [
+        # Cada página filtra por (clave_orden, id) < (última fila mostrada)
+        "CREATE INDEX IF NOT EXISTS idx_pagos_fecha_id ON pagos (fecha DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_pagos_pendientes_fecha_id ON pagos (fecha DESC, id DESC) WHERE estado = 'pendiente'",
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_fecha_registro ON usuarios (fecha_registro DESC, user_id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_usuarios_puntos_ranking ON usuarios_puntos (puntos_disponibles DESC, user_id DESC)",
+    ]),
+    (9, "Índices para los filtros de /verpagostodos", [
+        # Filtros por estado o usuario manteniendo el orden (fecha, id) de la paginación
+        "CREATE INDEX IF NOT EXISTS idx_pagos_estado_fecha_id ON pagos (estado, fecha DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_pagos_user_fecha_id ON pagos (user_id, fecha DESC, id DESC)",
+        # Búsqueda por prefijo de referencia (LIKE 'abc%')
+        "CREATE INDEX IF NOT EXISTS idx_pagos_referencia_prefijo ON pagos (referencia text_pattern_ops)",
+        # Reemplazados por los índices (…, fecha, id) de las migraciones 8 y 9
+        "DROP INDEX IF EXISTS idx_pagos_estado_fecha",
+        "DROP INDEX IF EXISTS idx_pagos_user_fecha",
+        "DROP INDEX IF EXISTS idx_pagos_fecha",
+        "DROP INDEX IF EXISTS idx_pagos_pendientes",
+    ]),
+    (10, "Índice para el avance automático por aniversario", [
+        # Planes que pueden avanzar, ordenados por su último avance
+        '''
+        CREATE INDEX IF NOT EXISTS idx_planes_pago_aniversario
+        ON planes_pago ((COALESCE(fecha_ultimo_pago, fecha_inicio)))
+        WHERE estado = 'activo' AND contador_pausado = FALSE
+        ''',
+    ]),
+    (11, "Registro de avances de semana y sus avisos", [
+        '''
+        CREATE TABLE IF NOT EXISTS avances (
+            id BIGSERIAL PRIMARY KEY,
+            run_id VARCHAR(64) NOT NULL,
+            plan_id INT NOT NULL,
+            user_id BIGINT NOT NULL,
+            semana INT NOT NULL,
+            semanas INT NOT NULL,
+            tipo VARCHAR(20) NOT NULL,
+            notificado BOOLEAN DEFAULT FALSE,
+            resultado VARCHAR(20),
+            intentos INT DEFAULT 0,
+            reservado_hasta TIMESTAMP,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fecha_notificado TIMESTAMP,
+            UNIQUE (run_id, plan_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_avances_pendientes ON avances (id) WHERE notificado = FALSE",
+    ]),
+    (12, "Bandeja de salida de notificaciones", [
+        '''
+        CREATE TABLE IF NOT EXISTS notificaciones (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            texto TEXT,  -- NULL: aviso del registro de avances, se arma al enviar
+            origen VARCHAR(50),
+            avance_id BIGINT REFERENCES avances(id) ON DELETE CASCADE,
+            estado VARCHAR(20) DEFAULT 'pendiente',  -- pendiente, enviado, bloqueado, descartado
+            intentos INT DEFAULT 0,
+            proximo_intento TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            error TEXT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fecha_envio TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_notificaciones_pendientes ON notificaciones (proximo_intento) WHERE estado = 'pendiente'",
+        "CREATE INDEX IF NOT EXISTS idx_notificaciones_descartadas ON notificaciones (fecha DESC) WHERE estado = 'descartado'",
+        # Los avisos de avances pendientes pasan a la bandeja; la reserva ahora vive allí
+        '''
+        INSERT INTO notificaciones (user_id, origen, avance_id)
+        SELECT user_id, 'avance_' || tipo, id
+        FROM avances
+        WHERE notificado = FALSE
+        ''',
+        "ALTER TABLE avances DROP COLUMN IF EXISTS reservado_hasta",
+        "ALTER TABLE avances DROP COLUMN IF EXISTS intentos",
+    ]),
+    (13, "Niveles de beneficios por puntos y beneficios desbloqueados", [
+        '''
+        CREATE TABLE IF NOT EXISTS beneficios (
+            id SERIAL PRIMARY KEY,
+            puntos INT NOT NULL UNIQUE,
+            nombre VARCHAR(255) NOT NULL,
+            mensaje TEXT NOT NULL,
+            activo BOOLEAN DEFAULT TRUE,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS beneficios_usuarios (
+            user_id BIGINT NOT NULL,
+            beneficio_id INT NOT NULL REFERENCES beneficios(id) ON DELETE CASCADE,
+            puntos INT,  -- saldo con el que se desbloqueó
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, beneficio_id)
+        )
+        ''',
+        # Los dos beneficios que estaban fijos en el código
+        '''
+        INSERT INTO beneficios (puntos, nombre, mensaje) VALUES
+            (100, '1 semana gratis en gym 🏋️‍♂️', '🎉 ¡FELICIDADES! Has ganado 1 SEMANA GRATIS en el gym 🏋️‍♂️'),
+            (200, '15% descuento en todo 🛍️', '🎉 ¡INCREÍBLE! Has ganado 15% DE DESCUENTO en todo 🛍️')
+        ON CONFLICT (puntos) DO NOTHING
+        ''',
+        # Quien ya superaba un umbral lo tiene desbloqueado (sin aviso retroactivo)
+        '''
+        INSERT INTO beneficios_usuarios (user_id, beneficio_id, puntos)
+        SELECT up.user_id, b.id, up.puntos_disponibles
+        FROM usuarios_puntos up
+        JOIN beneficios b ON up.puntos_disponibles >= b.puntos
+        ON CONFLICT DO NOTHING
+        ''',
+    ]),
+    (14, "Conteo de usuarios por saldo para el ranking de puntos", [
+        # Una fila por saldo distinto: la posición y las estadísticas del
+        # ranking se suman sobre saldos, no sobre usuarios
+        '''
+        CREATE TABLE IF NOT EXISTS ranking_puntos (
+            puntos INT PRIMARY KEY,
+            usuarios INT NOT NULL DEFAULT 0
+        )
+        ''',
+        # La mantiene un trigger, así cualquier escritura de usuarios_puntos
+        # (agregar, establecer, quitar, eliminar usuario) la deja al día
+        '''
+        CREATE OR REPLACE FUNCTION ranking_puntos_actualizar() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE ranking_puntos SET usuarios = usuarios - 1
+                WHERE puntos = COALESCE(OLD.puntos_disponibles, 0);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO ranking_puntos (puntos, usuarios)
+                VALUES (COALESCE(NEW.puntos_disponibles, 0), 1)
+                ON CONFLICT (puntos) DO UPDATE SET usuarios = ranking_puntos.usuarios + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS trg_ranking_puntos_alta ON usuarios_puntos",
+        "DROP TRIGGER IF EXISTS trg_ranking_puntos_cambio ON usuarios_puntos",
+        '''
+        CREATE TRIGGER trg_ranking_puntos_alta
+        AFTER INSERT OR DELETE ON usuarios_puntos
+        FOR EACH ROW EXECUTE FUNCTION ranking_puntos_actualizar()
+        ''',
+        '''
+        CREATE TRIGGER trg_ranking_puntos_cambio
+        AFTER UPDATE OF puntos_disponibles ON usuarios_puntos
+        FOR EACH ROW
+        WHEN (OLD.puntos_disponibles IS DISTINCT FROM NEW.puntos_disponibles)
+        EXECUTE FUNCTION ranking_puntos_actualizar()
+        ''',
+        # Carga inicial (el trigger ya bloquea usuarios_puntos hasta el commit)
+        "DELETE FROM ranking_puntos",
+        '''
+        INSERT INTO ranking_puntos (puntos, usuarios)
+        SELECT COALESCE(puntos_disponibles, 0), COUNT(*)
+        FROM usuarios_puntos
+        GROUP BY 1
+        ''',
+    ]),
+    (15, "Particiones mensuales de pagos y puntos_historial, esquema de archivo", [
+        "CREATE SCHEMA IF NOT EXISTS archivo",
+        # Crea las particiones mensuales que falten entre dos fechas
+        # (las ya archivadas no se recrean)
+        '''
+        CREATE OR REPLACE FUNCTION crear_particiones_mensuales(tabla TEXT, desde DATE, hasta DATE)
+        RETURNS INT AS $$
+        DECLARE
+            mes DATE := date_trunc('month', COALESCE(desde, CURRENT_DATE))::date;
+            nombre TEXT;
+            creadas INT := 0;
+        BEGIN
+            WHILE mes <= hasta LOOP
+                nombre := tabla || '_' || to_char(mes, 'YYYY_MM');
+                IF to_regclass(nombre) IS NULL AND to_regclass('archivo.' || nombre) IS NULL THEN
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                        nombre, tabla, mes, (mes + INTERVAL '1 month')::date
+                    );
+                    creadas := creadas + 1;
+                END IF;
+                mes := (mes + INTERVAL '1 month')::date;
+            END LOOP;
+            RETURN creadas;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+    ] + particionar_por_mes('pagos', [
+        "CREATE INDEX IF NOT EXISTS idx_pagos_fecha_id ON pagos (fecha DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_pagos_pendientes_fecha_id ON pagos (fecha DESC, id DESC) WHERE estado = 'pendiente'",
+        "CREATE INDEX IF NOT EXISTS idx_pagos_estado_fecha_id ON pagos (estado, fecha DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_pagos_user_fecha_id ON pagos (user_id, fecha DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_pagos_referencia_prefijo ON pagos (referencia text_pattern_ops)",
+    ]) + particionar_por_mes('puntos_historial', [
+        "CREATE INDEX IF NOT EXISTS idx_puntos_historial_user_fecha ON puntos_historial (user_id, fecha DESC)",
+    ])),
+    (16, "Ranking de puntos sin bloqueos cruzados ni filas calientes", [
+        # El conteo de cada saldo se reparte en 16 franjas (user_id % 16):
+        # dos asignaciones a usuarios distintos con el mismo saldo casi nunca
+        # esperan por la misma fila. Las sumas del ranking no cambian, pero
+        # la posición en /mispuntos pasa a recorrer saldos distintos × 16
+        # filas: no es O(log n), aunque sigue sin depender de cuántos
+        # usuarios haya (unos cientos de saldos en la práctica).
+        #
+        # Sin triggers no hay carrera con la carga de abajo: DROP TRIGGER
+        # espera a las escrituras de usuarios_puntos en curso (que aún usan
+        # la función vieja) y bloquea las nuevas hasta el commit, igual que
+        # el CREATE TRIGGER de la versión 14. Se vuelven a crear al final.
+        "DROP TRIGGER IF EXISTS trg_ranking_puntos_alta ON usuarios_puntos",
+        "DROP TRIGGER IF EXISTS trg_ranking_puntos_cambio ON usuarios_puntos",
+        "ALTER TABLE ranking_puntos ADD COLUMN IF NOT EXISTS franja SMALLINT NOT NULL DEFAULT 0",
+        "ALTER TABLE ranking_puntos DROP CONSTRAINT IF EXISTS ranking_puntos_pkey",
+        "ALTER TABLE ranking_puntos ADD PRIMARY KEY (puntos, franja)",
+        # Las dos filas de un cambio de saldo se tocan en una sola sentencia
+        # y siempre en orden de puntos, así dos movimientos en sentidos
+        # opuestos no se bloquean mutuamente; la fila que queda en cero se borra
+        '''
+        CREATE OR REPLACE FUNCTION ranking_puntos_actualizar() RETURNS trigger AS $$
+        DECLARE
+            anterior INT;
+            nuevo INT;
+            franja_usuario SMALLINT;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                anterior := COALESCE(OLD.puntos_disponibles, 0);
+                franja_usuario := OLD.user_id % 16;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                nuevo := COALESCE(NEW.puntos_disponibles, 0);
+                franja_usuario := NEW.user_id % 16;
+            END IF;
+            IF anterior = nuevo THEN
+                RETURN NULL;
+            END IF;
+            INSERT INTO ranking_puntos (puntos, franja, usuarios)
+            SELECT v.puntos, franja_usuario, v.delta
+            FROM (VALUES (anterior, -1), (nuevo, 1)) AS v(puntos, delta)
+            WHERE v.puntos IS NOT NULL
+            ORDER BY v.puntos
+            ON CONFLICT (puntos, franja) DO UPDATE SET usuarios = ranking_puntos.usuarios + EXCLUDED.usuarios;
+            IF anterior IS NOT NULL THEN
+                DELETE FROM ranking_puntos
+                WHERE puntos = anterior AND franja = franja_usuario AND usuarios = 0;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        # Reparto inicial por franja y sin saldos vacíos, antes de reactivar los triggers
+        "DELETE FROM ranking_puntos",
+        '''
+        INSERT INTO ranking_puntos (puntos, franja, usuarios)
+        SELECT COALESCE(puntos_disponibles, 0), user_id % 16, COUNT(*)
+        FROM usuarios_puntos
+        GROUP BY 1, 2
+        ''',
+        '''
+        CREATE TRIGGER trg_ranking_puntos_alta
+        AFTER INSERT OR DELETE ON usuarios_puntos
+        FOR EACH ROW EXECUTE FUNCTION ranking_puntos_actualizar()
+        ''',
+        '''
+        CREATE TRIGGER trg_ranking_puntos_cambio
+        AFTER UPDATE OF puntos_disponibles ON usuarios_puntos
+        FOR EACH ROW
+        WHEN (OLD.puntos_disponibles IS DISTINCT FROM NEW.puntos_disponibles)
+        EXECUTE FUNCTION ranking_puntos_actualizar()
+        ''',
+    ]),
+    (17, "Fecha de pausa del contador", [
+        # Al reanudar, el aniversario se corre lo que duró la pausa
+        "ALTER TABLE planes_pago ADD COLUMN IF NOT EXISTS fecha_pausa TIMESTAMP",
+    ]),
+]
+
+# Clave del advisory lock para que dos instancias no migren a la vez
+MIGRACIONES_LOCK_ID = 7_424_001
+
+async def aplicar_migraciones() -> int:
+    """Aplicar las migraciones pendientes y devolver la versión final del esquema.
+
+    En un arranque en caliente solo se ejecuta una consulta de versión.
+    """
+    async with db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT descripcion FROM productos LIMIT 1")
-        conn.close()
-        print("✅ Columna 'descripcion' existe")
-    except Exception:
-        print("⚠️ Agregando columna 'descripcion'...")
+        
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("ALTER TABLE productos ADD COLUMN descripcion TEXT")
-            conn.commit()
-            conn.close()
-            print("✅ Columna 'descripcion' agregada")
-        except Exception as e:
-            print(f"❌ Error al agregar 'descripcion': {e}")
+            await cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            version_actual = (await cursor.fetchone())[0]
+        except psycopg.errors.UndefinedTable:
+            # Primer arranque con el sistema de migraciones
+            await conn.rollback()
+            version_actual = 0
+        
+        version_objetivo = MIGRACIONES[-1][0]
+        if version_actual >= version_objetivo:
+            logger.info(f"✅ Esquema al día (versión {version_actual})")
+            return version_actual
+        
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                descripcion TEXT,
+                fecha_aplicada TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Serializar con otras instancias y releer la versión dentro del lock
+        await cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRACIONES_LOCK_ID,))
+        await cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        version_actual = (await cursor.fetchone())[0]
+        
+        for version, descripcion, sentencias in MIGRACIONES:
+            if version <= version_actual:
+                continue
+            logger.info(f"🔧 Aplicando migración {version}: {descripcion}")
+            for sentencia in sentencias:
+                await cursor.execute(sentencia)
+            await cursor.execute(
+                "INSERT INTO schema_version (version, descripcion) VALUES (%s, %s)",
+                (version, descripcion)
+            )
+        
+        await conn.commit()
     
-    # Verificar y agregar columna 'categoria' en productos
+    logger.info(f"✅ Esquema migrado a la versión {version_objetivo}")
+    return version_objetivo
+
+async def init_db():
+    """Inicializar base de datos aplicando las migraciones pendientes"""
+    inicio = time.perf_counter()
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT categoria FROM productos LIMIT 1")
-        conn.close()
-        print("✅ Columna 'categoria' existe")
-    except Exception:
-        print("⚠️ Agregando columna 'categoria'...")
-        try:
-            conn = get_db_connection()
+        await aplicar_migraciones()
+        logger.info(f"✅ Base de datos inicializada en {(time.perf_counter() - inicio) * 1000:.0f} ms")
+    except Exception as e:
+        logger.error(f"❌ Error al inicializar BD: {e}")
+        raise
+
+async def verificar_base_datos():
+    """Verificar base de datos"""
+    try:
+        async with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("ALTER TABLE productos ADD COLUMN categoria VARCHAR(100)")
-            conn.commit()
-            conn.close()
-            print("✅ Columna 'categoria' agregada")
-        except Exception as e:
-            print(f"❌ Error al agregar 'categoria': {e}")
+            await cursor.execute("SELECT COUNT(*) as total FROM pagos")
+            resultado_pagos = await cursor.fetchone()
+            await cursor.execute("SELECT COUNT(*) as total FROM usuarios")
+            resultado_usuarios = await cursor.fetchone()
+            await cursor.execute("SELECT COUNT(*) as total FROM productos")
+            resultado_productos = await cursor.fetchone()
+            await cursor.execute("SELECT COUNT(*) as total FROM planes_pago WHERE estado = 'activo'")
+            resultado_planes = await cursor.fetchone()
+        
+            # 🆕 Verificar sistema de puntos
+            await cursor.execute("SELECT COUNT(*) as total FROM usuarios_puntos")
+            resultado_puntos = await cursor.fetchone()
+            await cursor.execute("SELECT COUNT(*) as total FROM referidos")
+            resultado_referidos = await cursor.fetchone()
+        
+        
+        # Deja la configuración de pagos cargada en memoria desde el arranque
+        semanas_config = await configuracion_pagos.semanas()
+        logger.info(f"📊 TOTAL en BD - ... Semanas por defecto: {semanas_config}")
+        return resultado_pagos[0], resultado_usuarios[0], resultado_productos[0], resultado_planes[0], semanas_config
+    except Exception as e:
+        logger.error(f"❌ Error al verificar BD: {e}")
+        return 0, 0, 0, 0, SEMANAS_POR_DEFECTO
     
-    # Verificar y agregar columna 'contador_pausado' en planes_pago
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT contador_pausado FROM planes_pago LIMIT 1")
-        conn.close()
-        print("✅ Columna 'contador_pausado' existe")
-    except Exception:
-        print("⚠️ Agregando columna 'contador_pausado'...")
+
+# =============================================
+# 📣 SISTEMA DE DIFUSIÓN DE MENSAJES
+# =============================================
+
+# Límites de Telegram: ~30 mensajes/s en total y ~1 mensaje/s por chat
+DIFUSION_MENSAJES_POR_SEGUNDO = float(os.getenv('DIFUSION_MENSAJES_POR_SEGUNDO', '25'))
+DIFUSION_INTERVALO_POR_CHAT = float(os.getenv('DIFUSION_INTERVALO_POR_CHAT', '1.0'))
+DIFUSION_CONCURRENCIA = int(os.getenv('DIFUSION_CONCURRENCIA', '8'))
+DIFUSION_MAX_INTENTOS = int(os.getenv('DIFUSION_MAX_INTENTOS', '5'))
+
+class LimitadorEnvios:
+    """Token bucket global más una separación mínima entre mensajes al mismo chat"""
+
+    def __init__(self, por_segundo: float, intervalo_por_chat: float):
+        self.por_segundo = por_segundo
+        self.capacidad = max(1.0, por_segundo)
+        self.tokens = self.capacidad
+        self.intervalo_por_chat = intervalo_por_chat
+        self.ultimo_rellenado = time.monotonic()
+        self.ultimo_envio_chat = {}
+        self.pausado_hasta = 0.0
+        self._lock = asyncio.Lock()
+
+    def pausar(self, segundos: float):
+        """Detener todos los envíos (Telegram respondió RetryAfter)"""
+        self.pausado_hasta = max(self.pausado_hasta, time.monotonic() + segundos)
+
+    async def esperar_turno(self, chat_id: int):
+        while True:
+            async with self._lock:
+                ahora = time.monotonic()
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo_rellenado) * self.por_segundo)
+                self.ultimo_rellenado = ahora
+                
+                espera = self.pausado_hasta - ahora
+                espera = max(espera, self.ultimo_envio_chat.get(chat_id, 0.0) + self.intervalo_por_chat - ahora)
+                if self.tokens < 1:
+                    espera = max(espera, (1 - self.tokens) / self.por_segundo)
+                
+                if espera <= 0:
+                    self.tokens -= 1
+                    self.ultimo_envio_chat[chat_id] = ahora
+                    if len(self.ultimo_envio_chat) > 10000:
+                        limite = ahora - self.intervalo_por_chat
+                        self.ultimo_envio_chat = {c: t for c, t in self.ultimo_envio_chat.items() if t > limite}
+                    return
+            await asyncio.sleep(espera)
+
+limitador_envios = LimitadorEnvios(DIFUSION_MENSAJES_POR_SEGUNDO, DIFUSION_INTERVALO_POR_CHAT)
+
+async def enviar_con_reintentos(bot, chat_id: int, texto: str, max_intentos: int = DIFUSION_MAX_INTENTOS, **kwargs):
+    """Enviar un mensaje respetando los límites y reintentando errores temporales.
+
+    Devuelve (estado, intentos, error) con estado 'enviado', 'bloqueado' o 'fallido'.
+    """
+    error = None
+    for intento in range(1, max_intentos + 1):
+        await limitador_envios.esperar_turno(chat_id)
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("ALTER TABLE planes_pago ADD COLUMN contador_pausado BOOLEAN DEFAULT FALSE")
-            conn.commit()
-            conn.close()
-            print("✅ Columna 'contador_pausado' agregada")
-        except Exception as e:
-            print(f"❌ Error al agregar 'contador_pausado': {e}")
+            await bot.send_message(chat_id=chat_id, text=texto, **kwargs)
+            return 'enviado', intento, None
+        except telegram.error.RetryAfter as e:
+            espera = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            logger.warning(f"⏳ Límite de Telegram alcanzado, esperando {espera:.0f}s")
+            limitador_envios.pausar(espera + 1)
+            error = f"RetryAfter {espera:.0f}s"
+        except telegram.error.Forbidden as e:
+            # El usuario bloqueó el bot o eliminó la cuenta: no reintentar
+            return 'bloqueado', intento, str(e)
+        except telegram.error.BadRequest as e:
+            return 'fallido', intento, str(e)
+        except (telegram.error.TimedOut, telegram.error.NetworkError) as e:
+            error = str(e)
+            await asyncio.sleep(min(30, 2 ** intento))
+    return 'fallido', max_intentos, error
+
+# =============================================
+# 📮 BANDEJA DE SALIDA DE NOTIFICACIONES
+# =============================================
+
+# Los handlers guardan el aviso en `notificaciones` dentro de la misma
+# transacción que el cambio de estado; despachar_notificaciones lo envía
+# después, con lotes, límites de Telegram, reintentos y descarte final.
+NOTIF_LOTE = int(os.getenv('NOTIF_LOTE', '100'))
+NOTIF_MAX_INTENTOS = int(os.getenv('NOTIF_MAX_INTENTOS', '6'))
+NOTIF_RESERVA_SEGUNDOS = 300  # si el proceso muere, el aviso vuelve a la cola pasado este tiempo
+NOTIF_REVISION_SEGUNDOS = 10  # revisión periódica de reintentos y avisos de otras réplicas
+
+aviso_notificaciones = asyncio.Event()
+
+def despertar_notificaciones():
+    """Avisar al despachador de que hay notificaciones nuevas (llamar tras el commit)"""
+    aviso_notificaciones.set()
+
+async def encolar_notificacion(cursor, user_id: int, texto: str, origen: str):
+    """Guardar un aviso en la bandeja de salida con el cursor (y la transacción) del llamador"""
+    await cursor.execute("""
+        INSERT INTO notificaciones (user_id, texto, origen)
+        VALUES (%s, %s, %s)
+    """, (user_id, texto, origen))
+
+def espera_reintento(intentos: int) -> int:
+    """Backoff exponencial entre intentos: 30 s, 1 min, 2 min... hasta 1 hora"""
+    return min(3600, 30 * 2 ** (intentos - 1))
+
+CONSULTA_RESERVAR_NOTIFICACIONES = """
+    WITH reservadas AS (
+        UPDATE notificaciones
+        SET proximo_intento = CURRENT_TIMESTAMP + %s * INTERVAL '1 second',
+            intentos = intentos + 1
+        WHERE id IN (
+            SELECT id FROM notificaciones
+            WHERE estado = 'pendiente'
+            AND proximo_intento <= CURRENT_TIMESTAMP
+            ORDER BY proximo_intento
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, user_id, texto, avance_id, intentos
+    )
+    SELECT r.id, r.user_id, r.texto, r.intentos, a.semana, a.semanas, a.tipo
+    FROM reservadas r
+    LEFT JOIN avances a ON a.id = r.avance_id
+"""
+
+async def reservar_notificaciones() -> list:
+    """Tomar un lote de avisos vencidos; correr proximo_intento hace de reserva"""
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute(CONSULTA_RESERVAR_NOTIFICACIONES, (NOTIF_RESERVA_SEGUNDOS, NOTIF_LOTE))
+        return await cursor.fetchall()
+
+async def registrar_resultado_notificacion(notificacion_id: int, resultado: str, intentos: int, error: str):
+    """Marcar el aviso como enviado, bloqueado, reprogramado o descartado
+    (y su fila del registro de avances, si viene de uno)"""
+    if resultado == 'fallido' and intentos < NOTIF_MAX_INTENTOS:
+        estado, espera = 'pendiente', espera_reintento(intentos)
+    else:
+        estado, espera = ('descartado' if resultado == 'fallido' else resultado), 0
     
-    # ✅ Verificar y agregar columna 'fecha_ultimo_pago' en planes_pago
-    try:
-        conn = get_db_connection()
+    async with db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT fecha_ultimo_pago FROM planes_pago LIMIT 1")
-        conn.close()
-        print("✅ Columna 'fecha_ultimo_pago' existe")
-    except Exception:
-        print("⚠️ Agregando columna 'fecha_ultimo_pago'...")
+        await cursor.execute("""
+            WITH actualizada AS (
+                UPDATE notificaciones
+                SET estado = %s, error = %s,
+                    proximo_intento = CURRENT_TIMESTAMP + %s * INTERVAL '1 second',
+                    fecha_envio = CASE WHEN %s = 'enviado' THEN CURRENT_TIMESTAMP END
+                WHERE id = %s
+                RETURNING avance_id
+            )
+            UPDATE avances a
+            SET notificado = TRUE, resultado = %s, fecha_notificado = CURRENT_TIMESTAMP
+            FROM actualizada n
+            WHERE a.id = n.avance_id AND %s <> 'pendiente'
+        """, (estado, error, espera, estado, notificacion_id, resultado, estado))
+    
+    if estado == 'descartado':
+        logger.error(f"❌ Notificación {notificacion_id} descartada tras {intentos} intentos: {error}")
+
+async def enviar_notificacion(bot, pendiente):
+    """Armar y enviar un aviso reservado y registrar su resultado.
+
+    Cualquier error (un tipo de avance inesperado, un TelegramError no
+    previsto) cuenta como intento fallido: el aviso se reprograma con
+    backoff en vez de tumbar al despachador.
+    """
+    notificacion_id, user_id, texto, intentos, semana, semanas, tipo = pendiente
+    try:
+        if texto is None:
+            # Avisos del registro de avances: el texto se arma al enviar
+            texto = mensaje_avance(semana, semanas, tipo)
+        # Pocos intentos inmediatos: los demás se reprograman con backoff
+        resultado, _, error = await enviar_con_reintentos(bot, user_id, texto, max_intentos=2)
+    except Exception as e:
+        logger.exception("❌ Error al enviar la notificación %s: %s", notificacion_id, e)
+        resultado, error = 'fallido', f"{type(e).__name__}: {e}"
+    try:
+        await registrar_resultado_notificacion(notificacion_id, resultado, intentos, error)
+    except Exception as e:
+        # La reserva vence y el aviso se reintenta más tarde
+        logger.error(f"❌ No se pudo registrar la notificación {notificacion_id}: {e}")
+
+NOTIF_INTERVALO_PROGRESO = 5  # segundos entre reportes de progreso al admin
+
+def texto_progreso_notificaciones(titulo: str, total: int, conteo: dict, finalizada: bool) -> str:
+    texto = f"{'✅' if finalizada else '📣'} **{titulo}**\n\n"
+    texto += f"📊 Progreso: {total - conteo.get('pendiente', 0)}/{total}\n"
+    texto += f"📨 Enviados: {conteo.get('enviado', 0)}\n"
+    texto += f"🚫 Bloqueados: {conteo.get('bloqueado', 0)}\n"
+    texto += f"❌ Fallidos: {conteo.get('descartado', 0)}"
+    return texto
+
+async def seguir_progreso_notificaciones(bot, chat_id: int, titulo: str, ids: list):
+    """Reportar al admin el avance de un aviso masivo: cuenta por estado sus
+    filas de la bandeja de salida y edita un mismo mensaje hasta que no
+    quede ninguna pendiente"""
+    mensaje = None
+    while True:
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("ALTER TABLE planes_pago ADD COLUMN fecha_ultimo_pago TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-            conn.commit()
-            conn.close()
-            print("✅ Columna 'fecha_ultimo_pago' agregada")
+            async with db_connection() as conn:
+                cursor = conn.cursor()
+                await cursor.execute("""
+                    SELECT estado, COUNT(*) FROM notificaciones
+                    WHERE id = ANY(%s)
+                    GROUP BY estado
+                """, (ids,))
+                conteo = dict(await cursor.fetchall())
         except Exception as e:
-            print(f"❌ Error al agregar 'fecha_ultimo_pago': {e}")
-    
-    # ✅ Verificar y agregar columna 'fecha_configuracion' en planes_pago
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT fecha_configuracion FROM planes_pago LIMIT 1")
-        conn.close()
-        print("✅ Columna 'fecha_configuracion' existe")
-    except Exception:
-        print("⚠️ Agregando columna 'fecha_configuracion'...")
+            logger.warning(f"⚠️ No se pudo leer el progreso de «{titulo}»: {e}")
+            await asyncio.sleep(NOTIF_INTERVALO_PROGRESO)
+            continue
+        
+        finalizada = not conteo.get('pendiente')
+        texto = texto_progreso_notificaciones(titulo, len(ids), conteo, finalizada)
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("ALTER TABLE planes_pago ADD COLUMN fecha_configuracion TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-            conn.commit()
-            conn.close()
-            print("✅ Columna 'fecha_configuracion' agregada")
+            if mensaje is None:
+                mensaje = await bot.send_message(chat_id=chat_id, text=texto)
+            else:
+                await mensaje.edit_text(texto)
+        except telegram.error.BadRequest:
+            pass  # El texto no cambió desde el último reporte
         except Exception as e:
-            print(f"❌ Error al agregar 'fecha_configuracion': {e}")
-    
-    # ✅ Verificar y agregar columna 'semanas_default' en config_pagos
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT semanas_default FROM config_pagos LIMIT 1")
-        conn.close()
-        print("✅ Columna 'semanas_default' existe")
-    except Exception:
-        print("⚠️ Agregando columna 'semanas_default'...")
+            logger.warning(f"⚠️ No se pudo actualizar el progreso: {e}")
+        if finalizada:
+            return
+        await asyncio.sleep(NOTIF_INTERVALO_PROGRESO)
+
+async def despachar_notificaciones(bot):
+    """Tarea de fondo: vaciar la bandeja de salida.
+
+    Cada aviso se marca apenas sale, así que tras una caída solo puede
+    repetirse el que estaba en vuelo. Es la única tarea que vacía la
+    bandeja: ningún error termina el ciclo.
+    """
+    while True:
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("ALTER TABLE config_pagos ADD COLUMN semanas_default INT DEFAULT 10")
-            conn.commit()
-            conn.close()
-            print("✅ Columna 'semanas_default' agregada")
+            aviso_notificaciones.clear()
+            try:
+                pendientes = await reservar_notificaciones()
+            except Exception as e:
+                logger.error(f"❌ Error al leer la bandeja de salida: {e}")
+                pendientes = []
+            
+            if not pendientes:
+                try:
+                    await asyncio.wait_for(aviso_notificaciones.wait(), NOTIF_REVISION_SEGUNDOS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            cola = asyncio.Queue()
+            for pendiente in pendientes:
+                cola.put_nowait(pendiente)
+            
+            async def trabajador():
+                while True:
+                    try:
+                        pendiente = cola.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    await enviar_notificacion(bot, pendiente)
+            
+            await asyncio.gather(*(trabajador() for _ in range(min(DIFUSION_CONCURRENCIA, len(pendientes)))))
+            logger.debug("📮 %d notificaciones procesadas", len(pendientes))
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"❌ Error al agregar 'semanas_default': {e}")
-    
-    print("🎉 Verificación de columnas completada")
+            # Los avisos reservados vuelven a la cola cuando vence la reserva
+            logger.exception("❌ Error en el despachador de notificaciones: %s", e)
+            await asyncio.sleep(NOTIF_REVISION_SEGUNDOS)
 
-def init_db():
-    """Inicializar base de datos con semanas individuales"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Tabla de usuarios
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuarios (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT UNIQUE,
-                user_name VARCHAR(255),
-                first_name VARCHAR(255),
-                last_name VARCHAR(255),
-                phone VARCHAR(50),
-                fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                estado VARCHAR(50) DEFAULT 'activo'
-            )
-        ''')
-        
-        # Tabla de pagos
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pagos (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                user_name VARCHAR(255),
-                referencia VARCHAR(100),
-                file_id VARCHAR(255),
-                monto DECIMAL(10,2),
-                estado VARCHAR(50) DEFAULT 'pendiente',
-                fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de productos
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS productos (
-                id SERIAL PRIMARY KEY,
-                nombre VARCHAR(255),
-                descripcion TEXT,
-                precio DECIMAL(10,2),
-                categoria VARCHAR(100),
-                estado VARCHAR(50) DEFAULT 'activo',
-                fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de configuración (SOLO VALOR POR DEFECTO)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS config_pagos (
-                id SERIAL PRIMARY KEY,
-                semanas_default INT DEFAULT 10,  -- ← Solo valor por defecto
-                fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de planes de pago - MODIFICADA para semanas individuales
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS planes_pago (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                productos_json JSONB,
-                total DECIMAL(10,2),
-                semanas INT DEFAULT 10,  -- ← SEMANAS INDIVIDUALES
-                pago_semanal DECIMAL(10,2),
-                semanas_completadas INT DEFAULT 0,
-                estado VARCHAR(50) DEFAULT 'activo',
-                contador_pausado BOOLEAN DEFAULT FALSE,
-                fecha_inicio TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                fecha_ultimo_pago TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                fecha_configuracion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de puntos de usuarios
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuarios_puntos (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT UNIQUE,
-                puntos_totales INT DEFAULT 0,
-                puntos_disponibles INT DEFAULT 0,
-                fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de referidos
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS referidos (
-                id SERIAL PRIMARY KEY,
-                user_id_referidor BIGINT,
-                user_id_referido BIGINT,
-                nombre_referido VARCHAR(255),
-                telefono_referido VARCHAR(50),
-                estado VARCHAR(50) DEFAULT 'pendiente',
-                puntos_otorgados BOOLEAN DEFAULT FALSE,
-                fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de historial de puntos
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS puntos_historial (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                tipo VARCHAR(50),
-                puntos INT,
-                descripcion TEXT,
-                fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+# =============================================
+# 🛍️ CACHÉ DEL CATÁLOGO DE PRODUCTOS
+# =============================================
+
+CANAL_CATALOGO = 'catalogo_productos'  # Canal LISTEN/NOTIFY entre réplicas
+CATALOGO_TTL = float(os.getenv('CATALOGO_TTL', '300'))  # segundos; recarga de seguridad
+# CATALOGO_LISTEN activa también los avisos de cambios de config_pagos
+CATALOGO_LISTEN = os.getenv('CATALOGO_LISTEN', 'false').lower() in ('1', 'true', 'si', 'sí')
+# Si una invalidación llega mientras se recarga, la lectura puede ser previa
+# al commit que la provocó: se descarta y se vuelve a leer (hasta N veces)
+CACHE_REINTENTOS_CARGA = 3
+
+class CatalogoCache:
+    """Productos activos en memoria: id → (nombre, precio, descripcion, categoria)
+    y la agrupación por categoría. Se recarga al invalidarse o al vencer el TTL."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.productos = {}
+        self.por_nombre = []
+        self.por_categoria = {}
+        self.cargado_en = None
+        self.generacion = 0  # sube en cada invalidar()
+        self._lock = asyncio.Lock()
+
+    def invalidar(self):
+        self.generacion += 1
+        self.cargado_en = None
+
+    def vigente(self) -> bool:
+        return self.cargado_en is not None and time.monotonic() - self.cargado_en < self.ttl
+
+    async def asegurar_cargado(self):
+        if self.vigente():
+            return
+        async with self._lock:
+            if self.vigente():
+                return
+            for _ in range(CACHE_REINTENTOS_CARGA):
+                generacion = self.generacion
+                async with db_connection() as conn:
+                    cursor = conn.cursor()
+                    await cursor.execute("""
+                        SELECT id, nombre, precio, descripcion, categoria 
+                        FROM productos 
+                        WHERE estado = 'activo' 
+                        ORDER BY categoria, id
+                    """)
+                    filas = await cursor.fetchall()
+                if self.generacion == generacion:
+                    break
+            
+            productos = {}
+            por_categoria = {}
+            for id_prod, nombre, precio, descripcion, categoria in filas:
+                productos[id_prod] = (nombre, precio, descripcion, categoria)
+                por_categoria.setdefault(categoria or "General", []).append((id_prod, nombre, precio, descripcion))
+            
+            self.productos = productos
+            self.por_categoria = por_categoria
+            self.por_nombre = sorted(
+                ((id_prod, nombre, precio, descripcion) for id_prod, (nombre, precio, descripcion, _) in productos.items()),
+                key=lambda p: p[1]
             )
-        ''')
-        
-        conn.commit()
-        conn.close()
+            # Si siguió invalidándose, se sirve lo leído pero sin darlo por vigente
+            if self.generacion == generacion:
+                self.cargado_en = time.monotonic()
+            logger.info(f"🛍️ Catálogo cargado en caché: {len(productos)} productos")
+
+    async def activos_por_nombre(self) -> list:
+        """[(id, nombre, precio, descripcion)] ordenados por nombre (teclado de asignación)"""
+        await self.asegurar_cargado()
+        return self.por_nombre
+
+    async def activos_por_categoria(self) -> dict:
+        """{categoria: [(id, nombre, precio, descripcion)]} (catálogo para usuarios)"""
+        await self.asegurar_cargado()
+        return self.por_categoria
+
+    async def obtener(self, producto_id):
+        """(nombre, precio, descripcion, categoria) de un producto activo, o None"""
+        await self.asegurar_cargado()
+        return self.productos.get(int(producto_id))
+
+catalogo_cache = CatalogoCache(CATALOGO_TTL)
+
+async def avisar_cambio_catalogo(cursor):
+    """Avisar a las demás réplicas (se entrega al hacer commit)"""
+    await cursor.execute(f"NOTIFY {CANAL_CATALOGO}")
+
+# =============================================
+# ⚙️ CONFIGURACIÓN DE PAGOS EN MEMORIA
+# =============================================
+
+CANAL_CONFIG = 'config_pagos'  # Canal LISTEN/NOTIFY entre réplicas
+SEMANAS_POR_DEFECTO = 10
+
+class ConfiguracionPagos:
+    """Fila de config_pagos cargada una sola vez y recargada solo cuando se
+    modifica (guardar() / invalidar()).
+
+    Historia de columnas: la tabla nació con semanas_default y luego se usó
+    semanas para el plazo vigente. Si una de las dos está vacía se usa la otra,
+    y si faltan ambas SEMANAS_POR_DEFECTO.
+    """
+
+    COLUMNAS = ('semanas', 'semanas_default', 'contador_activo')
+
+    def __init__(self):
+        self.valores = None
+        self.generacion = 0  # sube en cada invalidar()
+        self._lock = asyncio.Lock()
+
+    def invalidar(self):
+        self.generacion += 1
+        self.valores = None
+
+    async def asegurar_cargado(self) -> dict:
+        valores = self.valores
+        if valores is not None:
+            return valores
+        async with self._lock:
+            if self.valores is not None:
+                return self.valores
+            for _ in range(CACHE_REINTENTOS_CARGA):
+                generacion = self.generacion
+                async with db_connection() as conn:
+                    cursor = conn.cursor()
+                    await cursor.execute(
+                        "SELECT semanas, semanas_default, contador_activo FROM config_pagos ORDER BY id LIMIT 1"
+                    )
+                    fila = await cursor.fetchone()
+                if self.generacion == generacion:
+                    break
+            semanas, semanas_default, contador_activo = fila or (None, None, None)
+            valores = {
+                'semanas': semanas or semanas_default or SEMANAS_POR_DEFECTO,
+                'semanas_default': semanas_default or semanas or SEMANAS_POR_DEFECTO,
+                'contador_activo': True if contador_activo is None else contador_activo,
+            }
+            # Si siguió invalidándose, se usa lo leído pero sin guardarlo
+            if self.generacion == generacion:
+                self.valores = valores
+            logger.info(f"⚙️ Configuración de pagos cargada: {valores}")
+            return valores
+
+    async def semanas(self) -> int:
+        """Plazo en semanas con el que se calculan los planes"""
+        return (await self.asegurar_cargado())['semanas']
+
+    async def semanas_default(self) -> int:
+        """Plazo que se ofrece a los usuarios nuevos"""
+        return (await self.asegurar_cargado())['semanas_default']
+
+    async def contador_activo(self) -> bool:
+        return (await self.asegurar_cargado())['contador_activo']
+
+    async def guardar(self, cursor, **cambios):
+        """Actualizar columnas dentro de la transacción del llamador y avisar
+        a las réplicas. Llamar a invalidar() después del commit."""
+        for columna in cambios:
+            if columna not in self.COLUMNAS:
+                raise ValueError(f"Columna de configuración desconocida: {columna}")
+        asignaciones = ", ".join(f"{columna} = %s" for columna in cambios)
+        await cursor.execute(
+            f"UPDATE config_pagos SET {asignaciones}, fecha_actualizacion = CURRENT_TIMESTAMP",
+            tuple(cambios.values())
+        )
+        await cursor.execute(f"NOTIFY {CANAL_CONFIG}")
+
+configuracion_pagos = ConfiguracionPagos()
+
+# =============================================
+# 🎁 NIVELES DE BENEFICIOS EN MEMORIA
+# =============================================
 
-        # Primero reparar tablas para asegurar que la columna existe
-        reparar_tablas()
+CANAL_BENEFICIOS = 'beneficios'  # Canal LISTEN/NOTIFY entre réplicas
+
+class NivelesBeneficios:
+    """Beneficios activos ordenados por puntos: [(id, puntos, nombre, mensaje)].
+
+    Se cargan una vez y se recargan solo al invalidarse. Con el saldo
+    anterior y el nuevo de un movimiento alcanza para saber qué umbrales
+    se cruzaron, sin leer la base en cada asignación.
+    """
+
+    def __init__(self):
+        self.niveles = None
+        self.generacion = 0  # sube en cada invalidar()
+        self._lock = asyncio.Lock()
+
+    def invalidar(self):
+        self.generacion += 1
+        self.niveles = None
+
+    async def asegurar_cargado(self, cursor=None) -> list:
+        """Con ``cursor`` se carga en la transacción del llamador (sin pedir
+        otra conexión al pool)."""
+        niveles = self.niveles
+        if niveles is not None:
+            return niveles
+        async with self._lock:
+            if self.niveles is not None:
+                return self.niveles
+            consulta = "SELECT id, puntos, nombre, mensaje FROM beneficios WHERE activo ORDER BY puntos"
+            for _ in range(CACHE_REINTENTOS_CARGA):
+                generacion = self.generacion
+                if cursor is None:
+                    async with db_connection() as conn:
+                        cursor_propio = conn.cursor()
+                        await cursor_propio.execute(consulta)
+                        filas = await cursor_propio.fetchall()
+                else:
+                    await cursor.execute(consulta)
+                    filas = await cursor.fetchall()
+                if self.generacion == generacion:
+                    break
+            niveles = [tuple(fila) for fila in filas]
+            # Si siguió invalidándose, se usa lo leído pero sin guardarlo
+            if self.generacion == generacion:
+                self.niveles = niveles
+            logger.info(f"🎁 Niveles de beneficios cargados: {[n[1] for n in niveles]}")
+            return niveles
+
+    async def cruzados(self, puntos_anteriores: int, puntos_nuevos: int, cursor=None) -> list:
+        """Niveles cuyo umbral quedó entre el saldo anterior (excluido) y el nuevo"""
+        if puntos_nuevos <= puntos_anteriores:
+            return []
+        niveles = await self.asegurar_cargado(cursor)
+        return [n for n in niveles if puntos_anteriores < n[1] <= puntos_nuevos]
+
+    async def siguiente(self, puntos: int):
+        """Primer nivel todavía no alcanzado con ``puntos``, o None"""
+        niveles = await self.asegurar_cargado()
+        return next((n for n in niveles if n[1] > puntos), None)
+
+niveles_beneficios = NivelesBeneficios()
+
+async def escuchar_invalidaciones():
+    """Invalidar las cachés cuando otra réplica modifica productos, la
+    configuración o los beneficios (LISTEN/NOTIFY)"""
+    caches = {
+        CANAL_CATALOGO: catalogo_cache,
+        CANAL_CONFIG: configuracion_pagos,
+        CANAL_BENEFICIOS: niveles_beneficios,
+    }
+    espera = 1
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True) as conn:
+                for canal in caches:
+                    await conn.execute(f"LISTEN {canal}")
+                logger.info(f"👂 Escuchando cambios en {', '.join(caches)}")
+                espera = 1
+                async for aviso in conn.notifies():
+                    cache = caches.get(aviso.channel)
+                    if cache:
+                        cache.invalidar()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Sin conexión no llegan avisos: invalidar para no servir datos viejos
+            for cache in caches.values():
+                cache.invalidar()
+            logger.warning(f"⚠️ Escucha de cambios interrumpida: {e}. Reintentando en {espera}s")
+            await asyncio.sleep(espera)
+            espera = min(60, espera * 2)
+
+# =============================================
+# ⏱️ MÉTRICAS DE LATENCIA, CONSULTAS Y BOT API (/metrics)
+# =============================================
+
+class HistogramaLatencia:
+    """Histograma con buckets fijos (ms por defecto); percentiles aproximados"""
+
+    LIMITES_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, limites: tuple = None):
+        self.limites = limites or self.LIMITES_MS
+        self.conteos = [0] * (len(self.limites) + 1)
+        self.total = 0
+        self.suma_ms = 0.0
+        self.maximo_ms = 0.0
+
+    def registrar(self, ms: float):
+        for i, limite in enumerate(self.limites):
+            if ms <= limite:
+                self.conteos[i] += 1
+                break
+        else:
+            self.conteos[-1] += 1
+        self.total += 1
+        self.suma_ms += ms
+        self.maximo_ms = max(self.maximo_ms, ms)
+
+    def percentil(self, p: float) -> float:
+        """Percentil interpolado linealmente dentro del bucket que lo contiene"""
+        if not self.total:
+            return 0.0
+        objetivo = self.total * p / 100
+        acumulado = 0
+        for i, conteo in enumerate(self.conteos):
+            if conteo and acumulado + conteo >= objetivo:
+                inferior = self.limites[i - 1] if i > 0 else 0
+                superior = self.limites[i] if i < len(self.limites) else self.maximo_ms
+                return min(inferior + (superior - inferior) * (objetivo - acumulado) / conteo, self.maximo_ms)
+            acumulado += conteo
+        return self.maximo_ms
+
+# Duración por handler: '/comando' para CommandHandler, nombre de la función para el resto
+latencias_comandos = {}
+
+LIMITES_CONSULTAS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Consultas y tiempo de base de datos del update en curso ({'consultas', 'db_ms'})
+metricas_update = contextvars.ContextVar('metricas_update', default=None)
+
+class Metricas:
+    """Contadores globales que se exponen en /metrics"""
+
+    def __init__(self):
+        self.consultas_por_update = HistogramaLatencia(LIMITES_CONSULTAS)
+        self.db_ms_por_update = HistogramaLatencia()
+        self.consultas_db = HistogramaLatencia()
+        self.errores_handler = Counter()  # (handler, clase) -> veces
+        self.api_telegram = {}            # método -> HistogramaLatencia
+        self.errores_api = Counter()      # (método, clase) -> veces
+
+    def registrar_consulta(self, ms: float):
+        self.consultas_db.registrar(ms)
+        actual = metricas_update.get()
+        if actual is not None:
+            actual['consultas'] += 1
+            actual['db_ms'] += ms
+
+    def registrar_api(self, metodo: str, ms: float, error: str = None):
+        self.api_telegram.setdefault(metodo, HistogramaLatencia()).registrar(ms)
+        if error:
+            self.errores_api[(metodo, error)] += 1
+
+metricas = Metricas()
+
+class CursorInstrumentado(psycopg.AsyncCursor):
+    """Cursor del pool que mide cada consulta"""
+
+    async def execute(self, query, params=None, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            metricas.registrar_consulta((time.perf_counter() - inicio) * 1000)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            metricas.registrar_consulta((time.perf_counter() - inicio) * 1000)
+
+class RequestInstrumentado(HTTPXRequest):
+    """Cliente HTTP del bot que mide cada llamada a la Bot API por método"""
+
+    async def post(self, url: str, *args, **kwargs):
+        metodo = url.rsplit('/', 1)[-1]
+        inicio = time.perf_counter()
+        error = None
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            metricas.registrar_api(metodo, (time.perf_counter() - inicio) * 1000, error)
+
+def instrumentar(nombre: str, callback):
+    """Envolver un handler: duración, consultas y tiempo de BD del update y errores"""
+    async def envoltura(update, context):
+        actual = {'consultas': 0, 'db_ms': 0.0}
+        token = metricas_update.set(actual)
+        inicio = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            metricas.errores_handler[(nombre, type(e).__name__)] += 1
+            raise
+        finally:
+            metricas_update.reset(token)
+            histograma = latencias_comandos.setdefault(nombre, HistogramaLatencia())
+            histograma.registrar((time.perf_counter() - inicio) * 1000)
+            metricas.consultas_por_update.registrar(actual['consultas'])
+            metricas.db_ms_por_update.registrar(actual['db_ms'])
+    envoltura.__name__ = callback.__name__
+    envoltura.__doc__ = callback.__doc__
+    return envoltura
+
+def instrumentar_handlers(application: Application):
+    """Instrumentar todos los handlers registrados en la aplicación"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CommandHandler):
+                nombre = '/' + sorted(handler.commands)[0]
+            else:
+                nombre = handler.callback.__name__
+            handler.callback = instrumentar(nombre, handler.callback)
+
+def _escapar_etiqueta(valor) -> str:
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"')
+
+def _etiquetas(**valores) -> str:
+    if not valores:
+        return ''
+    return '{' + ','.join(f'{clave}="{_escapar_etiqueta(valor)}"' for clave, valor in valores.items()) + '}'
+
+def _histograma_prometheus(nombre: str, histograma: HistogramaLatencia, **etiquetas) -> list:
+    lineas = []
+    acumulado = 0
+    for limite, conteo in zip(histograma.limites, histograma.conteos):
+        acumulado += conteo
+        lineas.append(f"{nombre}_bucket{_etiquetas(**etiquetas, le=limite)} {acumulado}")
+    lineas.append(f"{nombre}_bucket{_etiquetas(**etiquetas, le='+Inf')} {histograma.total}")
+    lineas.append(f"{nombre}_sum{_etiquetas(**etiquetas)} {histograma.suma_ms}")
+    lineas.append(f"{nombre}_count{_etiquetas(**etiquetas)} {histograma.total}")
+    return lineas
+
+def exportar_metricas() -> str:
+    """Todas las métricas en formato de texto de Prometheus"""
+    lineas = [
+        "# HELP bot_handler_duracion_ms Duración de cada handler",
+        "# TYPE bot_handler_duracion_ms histogram",
+    ]
+    for nombre, histograma in sorted(latencias_comandos.items()):
+        lineas += _histograma_prometheus("bot_handler_duracion_ms", histograma, handler=nombre)
+    
+    lineas += [
+        "# HELP bot_handler_errores_total Excepciones lanzadas por handler y clase",
+        "# TYPE bot_handler_errores_total counter",
+    ]
+    for (nombre, clase), veces in sorted(metricas.errores_handler.items()):
+        lineas.append(f"bot_handler_errores_total{_etiquetas(handler=nombre, clase=clase)} {veces}")
+    
+    lineas += [
+        "# HELP bot_db_consultas_por_update Consultas SQL ejecutadas por update",
+        "# TYPE bot_db_consultas_por_update histogram",
+        *_histograma_prometheus("bot_db_consultas_por_update", metricas.consultas_por_update),
+        "# HELP bot_db_tiempo_por_update_ms Tiempo total en la base de datos por update",
+        "# TYPE bot_db_tiempo_por_update_ms histogram",
+        *_histograma_prometheus("bot_db_tiempo_por_update_ms", metricas.db_ms_por_update),
+        "# HELP bot_db_consulta_duracion_ms Duración de cada consulta SQL",
+        "# TYPE bot_db_consulta_duracion_ms histogram",
+        *_histograma_prometheus("bot_db_consulta_duracion_ms", metricas.consultas_db),
+        "# HELP bot_telegram_api_duracion_ms Duración de las llamadas a la Bot API",
+        "# TYPE bot_telegram_api_duracion_ms histogram",
+    ]
+    for metodo, histograma in sorted(metricas.api_telegram.items()):
+        lineas += _histograma_prometheus("bot_telegram_api_duracion_ms", histograma, metodo=metodo)
+    
+    lineas += [
+        "# HELP bot_telegram_api_errores_total Errores de la Bot API por método y clase",
+        "# TYPE bot_telegram_api_errores_total counter",
+    ]
+    for (metodo, clase), veces in sorted(metricas.errores_api.items()):
+        lineas.append(f"bot_telegram_api_errores_total{_etiquetas(metodo=metodo, clase=clase)} {veces}")
+    
+    pool = obtener_estadisticas_pool()
+    lineas += [
+        "# HELP bot_db_pool_conexiones Conexiones del pool por estado",
+        "# TYPE bot_db_pool_conexiones gauge",
+        f"bot_db_pool_conexiones{_etiquetas(estado='en_uso')} {pool['en_uso']}",
+        f"bot_db_pool_conexiones{_etiquetas(estado='disponibles')} {pool['disponibles']}",
+        f"bot_db_pool_conexiones{_etiquetas(estado='en_espera')} {pool['en_espera']}",
+        "# HELP bot_db_pool_timeouts_total Esperas del pool que vencieron",
+        "# TYPE bot_db_pool_timeouts_total counter",
+        f"bot_db_pool_timeouts_total {pool['timeouts']}",
+    ]
+    return "\n".join(lineas) + "\n"
+
+# =============================================
+# 💬 ESTADO DE CONVERSACIÓN Y PERSISTENCIA
+# =============================================
+
+# PERSISTENCIA: 'postgres' (tabla persistencia_bot), 'archivo' (pickle local) o 'ninguna'
+PERSISTENCIA = os.getenv('PERSISTENCIA', 'postgres').lower()
+PERSISTENCIA_ARCHIVO = os.getenv('PERSISTENCIA_ARCHIVO', 'estado_bot.pickle')
+# Cada cuántos segundos la Application vuelca los datos modificados
+PERSISTENCIA_INTERVALO = float(os.getenv('PERSISTENCIA_INTERVALO', '10'))
+# Updates atendidos a la vez (de chats distintos)
+UPDATES_CONCURRENTES = int(os.getenv('UPDATES_CONCURRENTES', '256'))
+
+class ProcesadorPorChat(BaseUpdateProcessor):
+    """Atiende en paralelo los updates de chats distintos y en orden los del mismo chat.
+
+    El estado de la conversación (chat_data['estado'], pago_aprobado_*,
+    asignacion_temp_*) se lee y se escribe a través de varios await: dos
+    mensajes seguidos o un botón pulsado dos veces no deben intercalarse.
+
+    Primero se espera el turno del chat y recién después un cupo global:
+    una ráfaga de un solo chat ocupa como mucho un cupo y no deja sin
+    atención a los demás chats.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._cupos = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._candados = {}  # chat_id -> [Lock, updates en espera o en curso]
+
+    @asynccontextmanager
+    async def turno_del_chat(self, update):
+        chat = getattr(update, 'effective_chat', None)
+        usuario = getattr(update, 'effective_user', None)
+        clave = chat.id if chat else (usuario.id if usuario else None)
+        if clave is None:
+            yield
+            return
         
-        # Ahora intentar insertar configuración por defecto
+        entrada = self._candados.setdefault(clave, [asyncio.Lock(), 0])
+        entrada[1] += 1
         try:
-            conn = get_db_connection()
+            async with entrada[0]:
+                yield
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._candados[clave]
+
+    async def process_update(self, update, coroutine):
+        # Reemplaza al de la clase base, que toma el cupo global antes de
+        # llamar a do_process_update (y así un chat podía acapararlos todos)
+        async with self.turno_del_chat(update):
+            async with self._cupos:
+                await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class EstadoChat(str, Enum):
+    """Qué espera el bot del próximo mensaje de texto de un chat"""
+    NINGUNO = 'ninguno'
+    REGISTRANDO_USUARIO = 'registrando_usuario'
+    ESPERANDO_DATOS_PAGO = 'esperando_datos_pago'
+    ESPERANDO_IMAGEN = 'esperando_imagen'
+    AGREGANDO_PRODUCTO = 'agregando_producto'
+    EDITANDO_PRODUCTO = 'editando_producto'
+    CONFIGURANDO_SEMANAS = 'configurando_semanas'
+    RECHAZANDO_PAGO = 'rechazando_pago'
+    PUNTOS_PERSONALIZADOS = 'puntos_personalizados'
+    SEMANAS_PERSONALIZADAS = 'semanas_personalizadas'
+
+def obtener_estado(context) -> tuple:
+    """(estado, datos) actuales del chat; NINGUNO si no hay nada pendiente"""
+    actual = context.chat_data.get('estado') if context.chat_data is not None else None
+    if not actual:
+        return EstadoChat.NINGUNO, {}
+    try:
+        return EstadoChat(actual['nombre']), actual['datos']
+    except (KeyError, ValueError):
+        # Estado guardado por una versión anterior del bot
+        return EstadoChat.NINGUNO, {}
+
+def fijar_estado(context, estado: EstadoChat, **datos):
+    """Reemplazar el estado del chat. Los datos deben poder guardarse como JSON."""
+    context.chat_data['estado'] = {'nombre': estado.value, 'datos': datos}
+
+def limpiar_estado(context):
+    context.chat_data.pop('estado', None)
+
+def _a_json(datos) -> str:
+    # Decimal y datetime se guardan como texto
+    return json.dumps(datos, default=str)
+
+class PersistenciaPostgres(BasePersistence):
+    """Persistencia de user_data y chat_data en la tabla persistencia_bot.
+
+    La Application llama a update_* cada PERSISTENCIA_INTERVALO segundos solo
+    para los chats/usuarios que cambiaron; aquí además se agrupan en un búfer y
+    se escriben en una sola transacción en segundo plano, así que responder a
+    un mensaje nunca espera a la base de datos.
+    """
+
+    def __init__(self, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._pendientes = {}  # (tipo, clave) -> JSON o None para borrar
+        self._escritura = None
+
+    async def _cargar(self, tipo: str) -> dict:
+        async with db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO config_pagos (semanas_default) 
-                SELECT 10 
-                WHERE NOT EXISTS (SELECT 1 FROM config_pagos)
-            ''')
-            conn.commit()
-            conn.close()
-            print("✅ Configuración por defecto insertada")
-        except Exception as insert_error:
-            print(f"⚠️ Error al insertar configuración: {insert_error}")
-            # Si falla, probablemente ya existe un registro
-        
-        print("✅ Base de datos inicializada con semanas individuales")
-        
-    except Exception as e:
-        print(f"❌ Error al inicializar BD: {e}")
-        reparar_tablas()
+            await cursor.execute("SELECT clave, datos FROM persistencia_bot WHERE tipo = %s", (tipo,))
+            filas = await cursor.fetchall()
+        logger.info(f"💾 Persistencia: {len(filas)} registros de {tipo} cargados")
+        return {clave: datos for clave, datos in filas}
 
-def verificar_base_datos():
-    """Verificar base de datos"""
-    try:
-        conn = get_db_connection()
+    async def get_user_data(self) -> dict:
+        return await self._cargar('user')
+
+    async def get_chat_data(self) -> dict:
+        return await self._cargar('chat')
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    def _encolar(self, tipo: str, clave: int, datos):
+        # Un dict vacío no aporta nada: se borra la fila en vez de guardarla
+        self._pendientes[(tipo, clave)] = _a_json(datos) if datos else None
+        if self._escritura is None or self._escritura.done():
+            self._escritura = asyncio.create_task(self._escribir_pendientes())
+
+    async def _escribir_pendientes(self):
+        while self._pendientes:
+            lote, self._pendientes = self._pendientes, {}
+            guardar = [(tipo, clave, datos) for (tipo, clave), datos in lote.items() if datos is not None]
+            borrar = [(tipo, clave) for (tipo, clave), datos in lote.items() if datos is None]
+            try:
+                async with db_connection() as conn:
+                    cursor = conn.cursor()
+                    if guardar:
+                        await cursor.executemany("""
+                            INSERT INTO persistencia_bot (tipo, clave, datos)
+                            VALUES (%s, %s, %s::jsonb)
+                            ON CONFLICT (tipo, clave) DO UPDATE
+                            SET datos = EXCLUDED.datos, fecha_actualizacion = CURRENT_TIMESTAMP
+                        """, guardar)
+                    if borrar:
+                        await cursor.executemany(
+                            "DELETE FROM persistencia_bot WHERE tipo = %s AND clave = %s", borrar
+                        )
+                    await conn.commit()
+            except Exception as e:
+                # Reintentar en el próximo ciclo sin pisar cambios más nuevos
+                for clave, datos in lote.items():
+                    self._pendientes.setdefault(clave, datos)
+                logger.error(f"❌ Error al guardar persistencia ({len(lote)} registros): {e}")
+                return
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._encolar('user', user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        self._encolar('chat', chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        self._encolar('user', user_id, None)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._encolar('chat', chat_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass  # Una sola instancia escribe: la copia en memoria es la vigente
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Escribir lo pendiente al detener el bot"""
+        if self._escritura is not None:
+            await self._escritura
+        await self._escribir_pendientes()
+
+def crear_persistencia():
+    """Backend de persistencia según PERSISTENCIA, o None para no persistir"""
+    if PERSISTENCIA == 'postgres':
+        return PersistenciaPostgres(update_interval=PERSISTENCIA_INTERVALO)
+    if PERSISTENCIA == 'archivo':
+        return PicklePersistence(
+            filepath=PERSISTENCIA_ARCHIVO,
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=PERSISTENCIA_INTERVALO,
+        )
+    return None
+
+# =============================================
+# 📄 PAGINACIÓN DE LISTADOS (ADMIN)
+# =============================================
+
+# Telegram corta en 4096 unidades UTF-16 (cada emoji cuenta doble); dejamos margen
+LIMITE_MENSAJE = 4000
+# Filas que se consultan por página; si las entradas son largas se muestran menos
+FILAS_POR_PAGINA = int(os.getenv('FILAS_POR_PAGINA', '10'))
+# Listados abiertos por chat que conservan sus botones ◀ / ▶
+MAX_LISTADOS_ABIERTOS = 10
+
+LISTADOS = {}
+
+class Listado:
+    """Listado paginado por keyset: cada página continúa desde la clave de orden
+    de la última fila mostrada, sin OFFSET, así que cuesta lo mismo la página 1
+    que la 500"""
+
+    def __init__(self, nombre: str, titulo: str, consulta: str, orden: tuple, clave, formatear,
+                 vacio: str, condiciones: tuple = (), descendente: bool = True, pie: str = '', resumen=None,
+                 filtrar=None):
+        self.nombre = nombre
+        self.titulo = titulo
+        self.consulta = consulta          # SELECT ... FROM ... {donde} [GROUP BY ...]
+        self.orden = orden                # expresiones SQL de la clave de orden (única)
+        self.clave = clave                # fila -> valores de la clave de orden
+        self.formatear = formatear        # (fila, posición) -> texto de la entrada
+        self.vacio = vacio
+        self.condiciones = condiciones
+        self.descendente = descendente
+        self.pie = pie                    # texto fijo al final de cada página
+        self.resumen = resumen            # async () -> texto, solo en la primera página
+        self.filtrar = filtrar            # filtros -> (condiciones SQL, parámetros)
+        LISTADOS[nombre] = self
+
+    def sql(self, desde, filtros: dict = None) -> tuple:
+        """Consulta y parámetros de la página posterior a `desde`
+        (también la usa verificar_indices.py para revisar el plan)"""
+        condiciones = list(self.condiciones)
+        parametros = []
+        if filtros and self.filtrar:
+            condiciones_filtro, parametros_filtro = self.filtrar(filtros)
+            condiciones.extend(condiciones_filtro)
+            parametros.extend(parametros_filtro)
+        if desde is not None:
+            columnas = ', '.join(self.orden)
+            marcadores = ', '.join(['%s'] * len(self.orden))
+            condiciones.append(f"({columnas}) {'<' if self.descendente else '>'} ({marcadores})")
+            parametros.extend(desde)
+        
+        donde = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        direccion = 'DESC' if self.descendente else 'ASC'
+        orden = ', '.join(f"{columna} {direccion}" for columna in self.orden)
+        return (
+            f"{self.consulta.replace('{donde}', donde)} ORDER BY {orden} LIMIT %s",
+            (*parametros, FILAS_POR_PAGINA + 1)
+        )
+
+    async def pagina(self, cursor, desde, filtros: dict = None) -> list:
+        """Consultar hasta FILAS_POR_PAGINA + 1 filas posteriores a `desde`
+        (la fila extra solo indica si hay página siguiente)"""
+        await cursor.execute(*self.sql(desde, filtros))
+        return await cursor.fetchall()
+
+def largo_telegram(texto: str) -> int:
+    """Longitud como la cuenta Telegram (unidades UTF-16)"""
+    return len(texto.encode('utf-16-le')) // 2
+
+def componer_pagina(encabezado: str, entradas: list, pie: str = '', limite: int = LIMITE_MENSAJE) -> tuple:
+    """Unir entradas completas mientras quepan en un mensaje.
+    Devuelve (texto, entradas usadas); solo recorta si una entrada sola no cabe."""
+    disponible = limite - largo_telegram(encabezado) - largo_telegram(pie)
+    cuerpo = []
+    usado = 0
+    for entrada in entradas:
+        largo = largo_telegram(entrada)
+        if usado + largo > disponible:
+            break
+        cuerpo.append(entrada)
+        usado += largo
+    
+    if not cuerpo and entradas:
+        largo = 0
+        for fin, caracter in enumerate(entradas[0]):
+            largo += 2 if ord(caracter) > 0xFFFF else 1
+            if largo > disponible - 1:
+                break
+        cuerpo.append(entradas[0][:fin] + "…")
+    
+    return encabezado + ''.join(cuerpo) + pie, len(cuerpo)
+
+async def renderizar_pagina(listado: Listado, estado: dict, numero: int, token: str) -> tuple:
+    """Consultar y armar la página `numero`; devuelve (texto, teclado) o (None, None) si no hay filas"""
+    desde, posicion = estado['paginas'][numero]
+    async with db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) as total FROM pagos")
-        resultado_pagos = cursor.fetchone()
-        cursor.execute("SELECT COUNT(*) as total FROM usuarios")
-        resultado_usuarios = cursor.fetchone()
-        cursor.execute("SELECT COUNT(*) as total FROM productos")
-        resultado_productos = cursor.fetchone()
-        cursor.execute("SELECT COUNT(*) as total FROM planes_pago WHERE estado = 'activo'")
-        resultado_planes = cursor.fetchone()
-        cursor.execute("SELECT semanas, contador_activo FROM config_pagos LIMIT 1")
-        config = cursor.fetchone()
-        
-        # 🆕 Verificar sistema de puntos
-        cursor.execute("SELECT COUNT(*) as total FROM usuarios_puntos")
-        resultado_puntos = cursor.fetchone()
-        cursor.execute("SELECT COUNT(*) as total FROM referidos")
-        resultado_referidos = cursor.fetchone()
-        
-        conn.close()
-        
-        semanas_config = config[0] if config else 10
-        print(f"📊 TOTAL en BD - ... Semanas por defecto: {semanas_config}")
-        return resultado_pagos[0], resultado_usuarios[0], resultado_productos[0], resultado_planes[0], semanas_config
-    except Exception as e:
-        print(f"❌ Error al verificar BD: {e}")
-        return 0, 0, 0, 0, 10
+        filas = await listado.pagina(cursor, desde, estado.get('filtros'))
+    
+    if not filas and numero == 0:
+        return None, None
+    
+    resumen = await listado.resumen() if listado.resumen and numero == 0 else ''
+    entradas = [listado.formatear(fila, posicion + i + 1) for i, fila in enumerate(filas[:FILAS_POR_PAGINA])]
+    encabezado = f"{listado.titulo}\n"
+    if estado.get('filtros'):
+        encabezado += "🔎 " + ", ".join(f"{clave}={valor}" for clave, valor in estado['filtros'].items()) + "\n"
+    encabezado += f"📄 Página {numero + 1}\n\n"
+    if not entradas:
+        encabezado += "📭 No hay más resultados\n\n"
+    texto, mostradas = componer_pagina(encabezado, entradas, resumen + listado.pie)
+    
+    # La siguiente página empieza después de la última fila que realmente se mostró
+    del estado['paginas'][numero + 1:]
+    hay_siguiente = mostradas < len(filas)
+    if hay_siguiente:
+        estado['paginas'].append([listado.clave(filas[mostradas - 1]), posicion + mostradas])
+    
+    botones = []
+    if numero > 0:
+        botones.append(InlineKeyboardButton("◀ Anterior", callback_data=f"pag_{token}_{numero - 1}"))
+    if hay_siguiente:
+        botones.append(InlineKeyboardButton("Siguiente ▶", callback_data=f"pag_{token}_{numero + 1}"))
+    return texto, InlineKeyboardMarkup([botones]) if botones else None
+
+async def abrir_listado(update: Update, context: ContextTypes.DEFAULT_TYPE, listado: Listado, filtros: dict = None):
+    """Enviar la primera página y guardar en chat_data las claves (y filtros) para ◀ / ▶"""
+    abiertos = context.chat_data.setdefault('listados', {})
+    secuencia = context.chat_data.get('listados_secuencia', 0) + 1
+    context.chat_data['listados_secuencia'] = secuencia
+    token = str(secuencia)
+    
+    estado = {'listado': listado.nombre, 'paginas': [[None, 0]]}
+    if filtros:
+        estado['filtros'] = filtros
+    texto, teclado = await renderizar_pagina(listado, estado, 0, token)
+    if texto is None:
+        await update.message.reply_text("🔎 No hay resultados con esos filtros" if filtros else listado.vacio)
+        return
+    
+    abiertos[token] = estado
+    # Olvidar los listados más viejos (las claves llegan como str si vienen de la persistencia)
+    while len(abiertos) > MAX_LISTADOS_ABIERTOS:
+        abiertos.pop(min(abiertos, key=int))
     
+    await update.message.reply_text(texto, reply_markup=teclado)
+
+async def navegar_listado(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Botones ◀ / ▶: vuelve a consultar solo la página pedida"""
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        await query.answer("❌ No tienes permisos", show_alert=True)
+        return
+    
+    _, token, numero = query.data.split('_')
+    numero = int(numero)
+    estado = context.chat_data.get('listados', {}).get(token)
+    if not estado or numero >= len(estado['paginas']) or estado['listado'] not in LISTADOS:
+        await query.answer("⌛ Este listado expiró, vuelve a ejecutar el comando", show_alert=True)
+        return
+    
+    await query.answer()
+    listado = LISTADOS[estado['listado']]
+    texto, teclado = await renderizar_pagina(listado, estado, numero, token)
+    try:
+        await query.edit_message_text(texto or listado.vacio, reply_markup=teclado)
+    except telegram.error.BadRequest as e:
+        if 'not modified' not in str(e):
+            raise
 
 # =============================================
 # 🔄 SISTEMA DE CONTADORES INDIVIDUALES POR USUARIO
 # =============================================
 
-async def control_contador_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Menú principal para controlar contadores individuales (solo admin)"""
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("❌ No tienes permisos de administrador")
-        return
+# SET de UPDATE planes_pago para pausar y reanudar un contador. El avance
+# automático cuenta las semanas vencidas desde fecha_ultimo_pago: al reanudar
+# se corre esa fecha lo que duró la pausa, así que un plan pausado 5 semanas
+# y reanudado hoy no recibe 5 semanas de golpe en la próxima revisión, sino
+# que sigue donde estaba al pausarse (sin fecha_pausa, pausas previas a la
+# migración 17, el aniversario se cuenta desde hoy).
+PAUSAR_CONTADOR = "contador_pausado = TRUE, fecha_pausa = CURRENT_TIMESTAMP"
+REANUDAR_CONTADOR = """
+    contador_pausado = FALSE,
+    fecha_ultimo_pago = CASE
+        WHEN fecha_pausa IS NULL THEN CURRENT_TIMESTAMP
+        ELSE COALESCE(fecha_ultimo_pago, fecha_inicio) + (CURRENT_TIMESTAMP - fecha_pausa)
+    END,
+    fecha_pausa = NULL
+"""
+
+def formatear_contador(fila, posicion: int) -> str:
+    user_id, first_name, last_name, semanas_comp, semanas_tot, contador_pausado, fecha_ultimo = fila[:7]
+    nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+    
+    estado = "⏸️ PAUSADO" if contador_pausado else "🟢 ACTIVO"
+    progreso = f"{semanas_comp}/{semanas_tot}"
     
-    # Obtener usuarios con planes activos
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    entrada = f"👤 **{nombre_completo}** (ID: {user_id})\n"
+    entrada += f"   📊 Progreso: {progreso}\n"
+    entrada += f"   ⏰ Estado: {estado}\n"
     
-    cursor.execute("""
-        SELECT p.user_id, u.first_name, u.last_name, 
+    # Mostrar días desde último pago
+    if fecha_ultimo:
+        fecha_ultimo_dt = fecha_ultimo if isinstance(fecha_ultimo, datetime) else datetime.fromisoformat(str(fecha_ultimo))
+        dias_desde_ultimo = (datetime.now() - fecha_ultimo_dt).days
+        entrada += f"   📅 Último avance: {dias_desde_ultimo} días\n"
+    
+    # Comandos de control
+    entrada += f"   🔼 /avanzar_{user_id} | ⏸️ /pausar_{user_id} | ▶️ /reanudar_{user_id}\n"
+    entrada += "   ━━━━━━━━━━━━━━━━━━━━\n\n"
+    return entrada
+
+LISTADO_CONTADORES = Listado(
+    nombre='contadores',
+    titulo="⚙️ **CONTROL DE CONTADORES INDIVIDUALES**",
+    consulta="""
+        SELECT p.user_id, u.first_name, u.last_name,
                p.semanas_completadas, p.semanas,
-               p.contador_pausado, p.fecha_ultimo_pago
+               p.contador_pausado, p.fecha_ultimo_pago, COALESCE(u.first_name, ''), p.id
         FROM planes_pago p
         LEFT JOIN usuarios u ON p.user_id = u.user_id
-        WHERE p.estado = 'activo'
-        ORDER BY u.first_name
-    """)
-    usuarios = cursor.fetchall()
-    
-    conn.close()
-    
-    if not usuarios:
-        await update.message.reply_text("📭 No hay usuarios con planes activos")
+        {donde}
+    """,
+    condiciones=("p.estado = 'activo'",),
+    orden=("COALESCE(u.first_name, '')", "p.id"),
+    clave=lambda fila: (fila[7], fila[8]),
+    formatear=formatear_contador,
+    descendente=False,
+    vacio="📭 No hay usuarios con planes activos",
+    pie=(
+        "📋 **COMANDOS DE CONTROL:**\n"
+        "• /avanzartodos - Avanzar a TODOS los usuarios\n"
+        "• /pausartodos - Pausar a TODOS los usuarios\n"
+        "• /reanudartodos - Reanudar a TODOS los usuarios\n"
+        "• /vercontadores - Ver esta lista\n"
+        "• /avanzargrupo - Avanzar grupo específico"
+    ),
+)
+
+async def control_contador_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Menú principal para controlar contadores individuales (solo admin)"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ No tienes permisos de administrador")
         return
     
-    mensaje = "⚙️ **CONTROL DE CONTADORES INDIVIDUALES**\n\n"
-    
-    for user_id, first_name, last_name, semanas_comp, semanas_tot, contador_pausado, fecha_ultimo in usuarios:
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
-        
-        estado = "⏸️ PAUSADO" if contador_pausado else "🟢 ACTIVO"
-        progreso = f"{semanas_comp}/{semanas_tot}"
-        
-        mensaje += f"👤 **{nombre_completo}** (ID: {user_id})\n"
-        mensaje += f"   📊 Progreso: {progreso}\n"
-        mensaje += f"   ⏰ Estado: {estado}\n"
-        
-        # Mostrar días desde último pago
-        if fecha_ultimo:
-            fecha_ultimo_dt = fecha_ultimo if isinstance(fecha_ultimo, datetime) else datetime.fromisoformat(str(fecha_ultimo))
-            dias_desde_ultimo = (datetime.now() - fecha_ultimo_dt).days
-            mensaje += f"   📅 Último avance: {dias_desde_ultimo} días\n"
-        
-        # Comandos de control
-        mensaje += f"   🔼 /avanzar_{user_id} | ⏸️ /pausar_{user_id} | ▶️ /reanudar_{user_id}\n"
-        mensaje += "   ━━━━━━━━━━━━━━━━━━━━\n\n"
-    
-    mensaje += "📋 **COMANDOS DE CONTROL:**\n"
-    mensaje += "• /avanzartodos - Avanzar a TODOS los usuarios\n"
-    mensaje += "• /pausartodos - Pausar a TODOS los usuarios\n"
-    mensaje += "• /reanudartodos - Reanudar a TODOS los usuarios\n"
-    mensaje += "• /vercontadores - Ver esta lista\n"
-    mensaje += "• /avanzargrupo - Avanzar grupo específico"
-    
-    await update.message.reply_text(mensaje)
+    await abrir_listado(update, context, LISTADO_CONTADORES)
 
 async def avanzar_contador_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Avanza el contador de un usuario específico"""
@@ -399,88 +2021,82 @@ async def avanzar_contador_usuario(update: Update, context: ContextTypes.DEFAULT
         command_text = update.message.text
         user_id = int(command_text.split('_')[1])
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Verificar que el usuario tiene plan activo
-        cursor.execute("""
-            SELECT p.id, p.semanas_completadas, p.semanas, p.contador_pausado,
-                   u.first_name, u.last_name
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
+            # Verificar que el usuario tiene plan activo
+            await cursor.execute("""
+                SELECT p.id, p.semanas_completadas, p.semanas, p.contador_pausado,
+                       u.first_name, u.last_name
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        plan = cursor.fetchone()
+            plan = await cursor.fetchone()
         
-        if not plan:
-            await update.message.reply_text("❌ Usuario no tiene plan activo")
-            conn.close()
-            return
+            if not plan:
+                await update.message.reply_text("❌ Usuario no tiene plan activo")
+                return
         
-        plan_id, semanas_comp, semanas_tot, contador_pausado, first_name, last_name = plan
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            plan_id, semanas_comp, semanas_tot, contador_pausado, first_name, last_name = plan
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Verificar si el contador está pausado
-        if contador_pausado:
-            keyboard = [
-                [InlineKeyboardButton("✅ Avanzar igualmente", callback_data=f"avanzar_forzar_{user_id}")],
-                [InlineKeyboardButton("⏸️ Reanudar y avanzar", callback_data=f"reanudar_y_avanzar_{user_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            # Verificar si el contador está pausado
+            if contador_pausado:
+                keyboard = [
+                    [InlineKeyboardButton("✅ Avanzar igualmente", callback_data=f"avanzar_forzar_{user_id}")],
+                    [InlineKeyboardButton("⏸️ Reanudar y avanzar", callback_data=f"reanudar_y_avanzar_{user_id}")]
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await update.message.reply_text(
-                f"⚠️ **CONTADOR PAUSADO**\n\n"
-                f"El contador de {nombre_completo} está pausado.\n\n"
-                f"¿Qué deseas hacer?",
-                reply_markup=reply_markup
-            )
-            conn.close()
-            return
-        
-        # Verificar si ya completó todas las semanas
-        if semanas_comp >= semanas_tot:
-            await update.message.reply_text(
-                f"✅ **PLAN COMPLETADO**\n\n"
-                f"{nombre_completo} ya completó todas las semanas ({semanas_tot}).\n\n"
-                f"📞 Contacta al usuario para finalizar el proceso."
-            )
-            conn.close()
-            return
-        
-        # Avanzar el contador
-        nuevas_semanas = semanas_comp + 1
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET semanas_completadas = %s,
-                fecha_ultimo_pago = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (nuevas_semanas, plan_id))
+                await update.message.reply_text(
+                    f"⚠️ **CONTADOR PAUSADO**\n\n"
+                    f"El contador de {nombre_completo} está pausado.\n\n"
+                    f"¿Qué deseas hacer?",
+                    reply_markup=reply_markup
+                )
+                return
+        
+            # Verificar si ya completó todas las semanas
+            if semanas_comp >= semanas_tot:
+                await update.message.reply_text(
+                    f"✅ **PLAN COMPLETADO**\n\n"
+                    f"{nombre_completo} ya completó todas las semanas ({semanas_tot}).\n\n"
+                    f"📞 Contacta al usuario para finalizar el proceso."
+                )
+                return
         
-        conn.commit()
-        conn.close()
+            # Avanzar el contador
+            nuevas_semanas = semanas_comp + 1
+            await cursor.execute("""
+                UPDATE planes_pago 
+                SET semanas_completadas = %s,
+                    fecha_ultimo_pago = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (nuevas_semanas, plan_id))
         
-        # Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"📅 **¡AVANCE DE SEMANA!**\n\n"
-                     f"✅ Tu plan ha avanzado a la semana {nuevas_semanas}/{semanas_tot}\n\n"
-                     f"💳 Recuerda realizar tu pago semanal.\n"
-                     f"📋 Ver progreso: /misplanes"
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"📅 **¡AVANCE DE SEMANA!**\n\n"
+                f"✅ Tu plan ha avanzado a la semana {nuevas_semanas}/{semanas_tot}\n\n"
+                f"💳 Recuerda realizar tu pago semanal.\n"
+                f"📋 Ver progreso: /misplanes",
+                'avanzar_contador'
             )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
+            await conn.commit()
+        despertar_notificaciones()
         
         await update.message.reply_text(
             f"✅ **Contador avanzado**\n\n"
             f"👤 Usuario: {nombre_completo}\n"
             f"📊 Nuevo progreso: {nuevas_semanas}/{semanas_tot}\n\n"
-            f"✅ El usuario ha sido notificado."
+            f"📣 El usuario será notificado."
         )
         
     except Exception as e:
-        print(f"❌ Error al avanzar contador: {e}")
+        logger.error(f"❌ Error al avanzar contador: {e}")
         await update.message.reply_text("❌ Error al avanzar el contador")
 
 async def pausar_contador_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -493,50 +2109,46 @@ async def pausar_contador_usuario(update: Update, context: ContextTypes.DEFAULT_
         command_text = update.message.text
         user_id = int(command_text.split('_')[1])
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Verificar que el usuario tiene plan activo
-        cursor.execute("""
-            SELECT p.id, u.first_name, u.last_name, p.contador_pausado
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
-        
-        plan = cursor.fetchone()
-        
-        if not plan:
-            await update.message.reply_text("❌ Usuario no tiene plan activo")
-            conn.close()
-            return
-        
-        plan_id, first_name, last_name, ya_pausado = plan
-        
-        if ya_pausado:
-            await update.message.reply_text("⚠️ El contador de este usuario ya está pausado")
-            conn.close()
-            return
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Pausar contador
-        cursor.execute("UPDATE planes_pago SET contador_pausado = TRUE WHERE id = %s", (plan_id,))
-        conn.commit()
-        conn.close()
+            # Verificar que el usuario tiene plan activo
+            await cursor.execute("""
+                SELECT p.id, u.first_name, u.last_name, p.contador_pausado
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
+        
+            plan = await cursor.fetchone()
+        
+            if not plan:
+                await update.message.reply_text("❌ Usuario no tiene plan activo")
+                return
+        
+            plan_id, first_name, last_name, ya_pausado = plan
+        
+            if ya_pausado:
+                await update.message.reply_text("⚠️ El contador de este usuario ya está pausado")
+                return
+        
+            # Pausar contador
+            await cursor.execute(f"UPDATE planes_pago SET {PAUSAR_CONTADOR} WHERE id = %s", (plan_id,))
+        
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"⏸️ **CONTADOR PAUSADO**\n\n"
+                f"El administrador ha pausado tu contador de semanas.\n\n"
+                f"📞 Contacta al administrador para más información.\n"
+                f"📋 Estado actual: /misplanes",
+                'pausar_contador'
+            )
+            await conn.commit()
+        despertar_notificaciones()
         
         nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"⏸️ **CONTADOR PAUSADO**\n\n"
-                     f"El administrador ha pausado tu contador de semanas.\n\n"
-                     f"📞 Contacta al administrador para más información.\n"
-                     f"📋 Estado actual: /misplanes"
-            )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
-        
         await update.message.reply_text(
             f"⏸️ **Contador pausado**\n\n"
             f"👤 Usuario: {nombre_completo}\n"
@@ -545,7 +2157,7 @@ async def pausar_contador_usuario(update: Update, context: ContextTypes.DEFAULT_
         )
         
     except Exception as e:
-        print(f"❌ Error al pausar contador: {e}")
+        logger.error(f"❌ Error al pausar contador: {e}")
         await update.message.reply_text("❌ Error al pausar el contador")
 
 async def reanudar_contador_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -558,50 +2170,46 @@ async def reanudar_contador_usuario(update: Update, context: ContextTypes.DEFAUL
         command_text = update.message.text
         user_id = int(command_text.split('_')[1])
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Verificar que el usuario tiene plan activo
-        cursor.execute("""
-            SELECT p.id, u.first_name, u.last_name, p.contador_pausado
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
-        
-        plan = cursor.fetchone()
-        
-        if not plan:
-            await update.message.reply_text("❌ Usuario no tiene plan activo")
-            conn.close()
-            return
-        
-        plan_id, first_name, last_name, ya_pausado = plan
-        
-        if not ya_pausado:
-            await update.message.reply_text("⚠️ El contador de este usuario no está pausado")
-            conn.close()
-            return
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Reanudar contador
-        cursor.execute("UPDATE planes_pago SET contador_pausado = FALSE WHERE id = %s", (plan_id,))
-        conn.commit()
-        conn.close()
+            # Verificar que el usuario tiene plan activo
+            await cursor.execute("""
+                SELECT p.id, u.first_name, u.last_name, p.contador_pausado
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
+        
+            plan = await cursor.fetchone()
+        
+            if not plan:
+                await update.message.reply_text("❌ Usuario no tiene plan activo")
+                return
+        
+            plan_id, first_name, last_name, ya_pausado = plan
+        
+            if not ya_pausado:
+                await update.message.reply_text("⚠️ El contador de este usuario no está pausado")
+                return
+        
+            # Reanudar contador
+            await cursor.execute(f"UPDATE planes_pago SET {REANUDAR_CONTADOR} WHERE id = %s", (plan_id,))
+        
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"▶️ **CONTADOR REANUDADO**\n\n"
+                f"El administrador ha reanudado tu contador de semanas.\n\n"
+                f"📋 Tu progreso continúa normalmente.\n"
+                f"📊 Estado actual: /misplanes",
+                'reanudar_contador'
+            )
+            await conn.commit()
+        despertar_notificaciones()
         
         nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"▶️ **CONTADOR REANUDADO**\n\n"
-                     f"El administrador ha reanudado tu contador de semanas.\n\n"
-                     f"📋 Tu progreso continúa normalmente.\n"
-                     f"📊 Estado actual: /misplanes"
-            )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
-        
         await update.message.reply_text(
             f"▶️ **Contador reanudado**\n\n"
             f"👤 Usuario: {nombre_completo}\n"
@@ -610,7 +2218,7 @@ async def reanudar_contador_usuario(update: Update, context: ContextTypes.DEFAUL
         )
         
     except Exception as e:
-        print(f"❌ Error al reanudar contador: {e}")
+        logger.error(f"❌ Error al reanudar contador: {e}")
         await update.message.reply_text("❌ Error al reanudar el contador")
 
 async def avanzar_todos_usuarios(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -620,63 +2228,74 @@ async def avanzar_todos_usuarios(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        # El update_id identifica la corrida: si Telegram reenvía el mismo
+        # update tras un reinicio, UNIQUE (run_id, plan_id) impide avanzar dos veces
+        run_id = f"manual-{update.update_id}"
         
-        # Obtener todos los planes activos NO pausados
-        cursor.execute("""
-            SELECT p.id, p.user_id, p.semanas_completadas, p.semanas,
-                   u.first_name, u.last_name
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.estado = 'activo' 
-            AND p.contador_pausado = FALSE
-            AND p.semanas_completadas < p.semanas
-        """)
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        planes = cursor.fetchall()
+            # Avanzar todos los planes activos NO pausados y registrar cada avance
+            # y su aviso en la bandeja de salida, todo en la misma transacción
+            await cursor.execute("""
+                WITH candidatos AS (
+                    SELECT id, user_id, semanas_completadas + 1 AS semana, semanas
+                    FROM planes_pago
+                    WHERE estado = 'activo' 
+                    AND contador_pausado = FALSE
+                    AND semanas_completadas < semanas
+                    FOR UPDATE
+                ), registrados AS (
+                    INSERT INTO avances (run_id, plan_id, user_id, semana, semanas, tipo)
+                    SELECT %s, id, user_id, semana, semanas, 'manual'
+                    FROM candidatos
+                    ON CONFLICT (run_id, plan_id) DO NOTHING
+                    RETURNING id, plan_id, user_id, semana
+                ), encolados AS (
+                    INSERT INTO notificaciones (user_id, origen, avance_id)
+                    SELECT user_id, 'avance_manual', id
+                    FROM registrados
+                ), avanzados AS (
+                    UPDATE planes_pago p
+                    SET semanas_completadas = r.semana,
+                        fecha_ultimo_pago = CURRENT_TIMESTAMP
+                    FROM registrados r
+                    WHERE p.id = r.plan_id
+                    RETURNING p.user_id, p.semanas_completadas, p.semanas
+                )
+                SELECT a.user_id, a.semanas_completadas, a.semanas,
+                       u.first_name, u.last_name
+                FROM avanzados a
+                LEFT JOIN usuarios u ON a.user_id = u.user_id
+            """, (run_id,))
+            planes = await cursor.fetchall()
+        
+            # Avisos de esta corrida, para el reporte de progreso
+            await cursor.execute("""
+                SELECT n.id
+                FROM notificaciones n
+                JOIN avances a ON a.id = n.avance_id
+                WHERE a.run_id = %s
+            """, (run_id,))
+            ids_avisos = [fila[0] for fila in await cursor.fetchall()]
+            await conn.commit()
         
         if not planes:
             await update.message.reply_text("📭 No hay usuarios con contadores activos para avanzar")
-            conn.close()
             return
         
-        planes_avanzados = 0
-        planes_completados = 0
+        despertar_notificaciones()
+        
+        planes_avanzados = len(planes)
         usuarios_completados = []
         
-        for plan_id, user_id, semanas_comp, semanas_tot, first_name, last_name in planes:
-            nuevas_semanas = semanas_comp + 1
-            
-            # Actualizar contador
-            cursor.execute("""
-                UPDATE planes_pago 
-                SET semanas_completadas = %s,
-                    fecha_ultimo_pago = CURRENT_TIMESTAMP
-                WHERE id = %s
-            """, (nuevas_semanas, plan_id))
-            
-            planes_avanzados += 1
-            
+        for user_id, nuevas_semanas, semanas_tot, first_name, last_name in planes:
             # Verificar si completó el plan
             if nuevas_semanas >= semanas_tot:
-                planes_completados += 1
                 nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
                 usuarios_completados.append((user_id, nombre_completo, semanas_tot))
-            
-            # Notificar al usuario
-            try:
-                if nuevas_semanas >= semanas_tot:
-                    mensaje = f"🎉 **¡PLAN COMPLETADO!**\n\nHas terminado las {semanas_tot} semanas.\n📞 Contacta al administrador."
-                else:
-                    mensaje = f"📅 **AVANCE DE SEMANA**\n\nTu plan: {nuevas_semanas}/{semanas_tot}\n💳 Recuerda tu pago semanal."
-                
-                await context.bot.send_message(chat_id=user_id, text=mensaje)
-            except Exception as e:
-                print(f"❌ No se pudo notificar a usuario {user_id}: {e}")
         
-        conn.commit()
-        conn.close()
+        planes_completados = len(usuarios_completados)
         
         # Construir mensaje de resumen
         mensaje_resumen = f"✅ **CONTADORES AVANZADOS**\n\n"
@@ -691,11 +2310,15 @@ async def avanzar_todos_usuarios(update: Update, context: ContextTypes.DEFAULT_T
             mensaje_resumen += "📭 No se completaron planes esta vez\n"
         
         mensaje_resumen += f"\n⏸️ **Nota:** Los contadores pausados no fueron afectados."
+        mensaje_resumen += f"\n📣 Notificando a {planes_avanzados} usuarios en segundo plano..."
         
         await update.message.reply_text(mensaje_resumen)
+        context.application.create_task(seguir_progreso_notificaciones(
+            context.bot, update.effective_chat.id, "NOTIFICACIONES DE AVANCE", ids_avisos
+        ))
         
     except Exception as e:
-        print(f"❌ Error al avanzar todos: {e}")
+        logger.error(f"❌ Error al avanzar todos: {e}")
         await update.message.reply_text("❌ Error al avanzar contadores")
 
 async def pausar_todos_usuarios(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -705,37 +2328,49 @@ async def pausar_todos_usuarios(update: Update, context: ContextTypes.DEFAULT_TY
         return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Contar planes que serán pausados
-        cursor.execute("SELECT COUNT(*) FROM planes_pago WHERE estado = 'activo' AND contador_pausado = FALSE")
-        total_pausables = cursor.fetchone()[0]
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        if total_pausables == 0:
+            # Pausar todos los contadores y encolar cada aviso en la misma sentencia
+            await cursor.execute(f"""
+                WITH pausados AS (
+                    UPDATE planes_pago 
+                    SET {PAUSAR_CONTADOR}
+                    WHERE estado = 'activo' AND contador_pausado = FALSE
+                    RETURNING user_id
+                )
+                INSERT INTO notificaciones (user_id, texto, origen)
+                SELECT user_id, %s, 'pausa_general'
+                FROM pausados
+                RETURNING id
+            """, (
+                f"⏸️ **CONTADOR PAUSADO**\n\n"
+                f"El administrador ha pausado tu contador de semanas.\n\n"
+                f"📞 Contacta al administrador para más información.\n"
+                f"📋 Estado actual: /misplanes",
+            ))
+        
+            ids_avisos = [fila[0] for fila in await cursor.fetchall()]
+            pausados = len(ids_avisos)
+            await conn.commit()
+        
+        if not pausados:
             await update.message.reply_text("✅ Todos los contadores ya están pausados")
-            conn.close()
             return
         
-        # Pausar todos los contadores
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET contador_pausado = TRUE 
-            WHERE estado = 'activo' AND contador_pausado = FALSE
-        """)
-        
-        planes_pausados = cursor.rowcount
-        conn.commit()
-        conn.close()
+        despertar_notificaciones()
         
         await update.message.reply_text(
             f"⏸️ **TODOS LOS CONTADORES PAUSADOS**\n\n"
-            f"📊 Contadores pausados: {planes_pausados}\n\n"
-            f"📞 Los usuarios han sido notificados."
+            f"📊 Contadores pausados: {pausados}\n\n"
+            f"📣 Notificando a los usuarios en segundo plano..."
         )
+        context.application.create_task(seguir_progreso_notificaciones(
+            context.bot, update.effective_chat.id, "NOTIFICACIONES DE PAUSA", ids_avisos
+        ))
         
     except Exception as e:
-        print(f"❌ Error al pausar todos: {e}")
+        logger.error(f"❌ Error al pausar todos: {e}")
         await update.message.reply_text("❌ Error al pausar contadores")
 
 async def reanudar_todos_usuarios(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -745,157 +2380,174 @@ async def reanudar_todos_usuarios(update: Update, context: ContextTypes.DEFAULT_
         return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Contar planes que serán reanudados
-        cursor.execute("SELECT COUNT(*) FROM planes_pago WHERE estado = 'activo' AND contador_pausado = TRUE")
-        total_reanudables = cursor.fetchone()[0]
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        if total_reanudables == 0:
+            # Reanudar todos los contadores y encolar cada aviso en la misma sentencia
+            await cursor.execute(f"""
+                WITH reanudados AS (
+                    UPDATE planes_pago 
+                    SET {REANUDAR_CONTADOR}
+                    WHERE estado = 'activo' AND contador_pausado = TRUE
+                    RETURNING user_id
+                )
+                INSERT INTO notificaciones (user_id, texto, origen)
+                SELECT user_id, %s, 'reanudacion_general'
+                FROM reanudados
+                RETURNING id
+            """, (
+                f"▶️ **CONTADOR REANUDADO**\n\n"
+                f"El administrador ha reanudado tu contador de semanas.\n\n"
+                f"📋 Tu progreso continúa normalmente.\n"
+                f"📊 Estado actual: /misplanes",
+            ))
+        
+            ids_avisos = [fila[0] for fila in await cursor.fetchall()]
+            reanudados = len(ids_avisos)
+            await conn.commit()
+        
+        if not reanudados:
             await update.message.reply_text("✅ Todos los contadores ya están activos")
-            conn.close()
             return
         
-        # Reanudar todos los contadores
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET contador_pausado = FALSE 
-            WHERE estado = 'activo' AND contador_pausado = TRUE
-        """)
-        
-        planes_reanudados = cursor.rowcount
-        conn.commit()
-        conn.close()
+        despertar_notificaciones()
         
         await update.message.reply_text(
             f"▶️ **TODOS LOS CONTADORES REANUDADOS**\n\n"
-            f"📊 Contadores reanudados: {planes_reanudados}\n\n"
-            f"📞 Los usuarios han sido notificados."
+            f"📊 Contadores reanudados: {reanudados}\n\n"
+            f"📣 Notificando a los usuarios en segundo plano..."
         )
+        context.application.create_task(seguir_progreso_notificaciones(
+            context.bot, update.effective_chat.id, "NOTIFICACIONES DE REANUDACIÓN", ids_avisos
+        ))
         
     except Exception as e:
-        print(f"❌ Error al reanudar todos: {e}")
+        logger.error(f"❌ Error al reanudar todos: {e}")
         await update.message.reply_text("❌ Error al reanudar contadores")
 
 # =============================================
 # 🆕 SISTEMA DE PUNTOS Y REFERIDOS
 # =============================================
 
-async def agregar_puntos(user_id: int, puntos: int, tipo: str, descripcion: str):
-    """Agrega puntos a un usuario y registra en el historial"""
+async def agregar_puntos(user_id: int, puntos: int, tipo: str, descripcion: str, conn=None):
+    """Agrega puntos a un usuario y registra en el historial
+
+    Todo va en una sola sentencia (upsert + historial): un viaje a la base
+    y sin carreras entre dos asignaciones simultáneas al mismo usuario.
+    Con el saldo anterior y el nuevo se registran los beneficios
+    desbloqueados (registrar_beneficios) en la misma transacción.
+    Devuelve ``(puntos_anteriores, puntos_nuevos)`` o ``None`` si falla.
+
+    Si se pasa ``conn`` se usa la transacción del llamador (sin pedir otra
+    conexión al pool) y el commit queda a cargo de quien llama. En ese caso
+    un error se propaga en vez de devolver ``None``: la transacción del
+    llamador queda inválida y debe deshacerse entera.
+    """
+    conexion_propia = conn is None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Verificar si el usuario existe en la tabla de puntos
-        cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-        usuario_puntos = cursor.fetchone()
-        
-        if usuario_puntos:
-            # Actualizar puntos existentes
-            nuevos_puntos = usuario_puntos[0] + puntos
-            cursor.execute("""
-                UPDATE usuarios_puntos 
-                SET puntos_totales = puntos_totales + %s, 
-                    puntos_disponibles = %s,
-                    fecha_actualizacion = CURRENT_TIMESTAMP
-                WHERE user_id = %s
-            """, (puntos, nuevos_puntos, user_id))
-        else:
-            # Crear nuevo registro de puntos
-            cursor.execute("""
-                INSERT INTO usuarios_puntos (user_id, puntos_totales, puntos_disponibles)
-                VALUES (%s, %s, %s)
-            """, (user_id, puntos, puntos))
-        
-        # Registrar en historial
-        cursor.execute("""
-            INSERT INTO puntos_historial (user_id, tipo, puntos, descripcion)
-            VALUES (%s, %s, %s, %s)
-        """, (user_id, tipo, puntos, descripcion))
-        
-        conn.commit()
-        conn.close()
-        
-        print(f"✅ {puntos} puntos agregados a usuario {user_id} - {descripcion}")
-        return True
-        
-    except Exception as e:
-        print(f"❌ Error al agregar puntos: {e}")
-        return False
-
-async def verificar_beneficios_puntos(user_id: int):
-    """Verifica si el usuario alcanzó algún beneficio por puntos"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-        resultado = cursor.fetchone()
-        conn.close()
-        
-        if not resultado:
-            return
+        async with (db_connection() if conexion_propia else nullcontext(conn)) as conn:
+            cursor = conn.cursor()
         
-        puntos_actuales = resultado[0]
+            await cursor.execute("""
+                WITH saldo AS (
+                    INSERT INTO usuarios_puntos (user_id, puntos_totales, puntos_disponibles)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET puntos_totales = usuarios_puntos.puntos_totales + EXCLUDED.puntos_totales,
+                        puntos_disponibles = usuarios_puntos.puntos_disponibles + EXCLUDED.puntos_disponibles,
+                        fecha_actualizacion = CURRENT_TIMESTAMP
+                    RETURNING puntos_disponibles
+                ), historial AS (
+                    INSERT INTO puntos_historial (user_id, tipo, puntos, descripcion)
+                    VALUES (%s, %s, %s, %s)
+                )
+                SELECT puntos_disponibles - %s, puntos_disponibles FROM saldo
+            """, (user_id, puntos, puntos, user_id, tipo, puntos, descripcion, puntos))
+            puntos_anteriores, puntos_nuevos = await cursor.fetchone()
         
-        # Verificar beneficios
-        if puntos_actuales >= 100:
-            await notificar_beneficio(user_id, 100, "🎉 ¡FELICIDADES! Has ganado 1 SEMANA GRATIS en el gym 🏋️‍♂️")
+            # Beneficios cuyo umbral se cruzó con este movimiento
+            await registrar_beneficios(cursor, user_id, puntos_anteriores, puntos_nuevos)
         
-        if puntos_actuales >= 200:
-            await notificar_beneficio(user_id, 200, "🎉 ¡INCREÍBLE! Has ganado 15% DE DESCUENTO en todo 🛍️")
-            
-    except Exception as e:
-        print(f"❌ Error al verificar beneficios: {e}")
-
-async def notificar_beneficio(user_id: int, puntos_requeridos: int, mensaje: str):
-    """Notifica un beneficio al usuario"""
-    try:
-        # Aquí deberías enviar un mensaje al usuario
-        # Por ahora solo imprimimos el log
-        print(f"🎁 Usuario {user_id} alcanzó {puntos_requeridos} puntos - {mensaje}")
+            if conexion_propia:
+                await conn.commit()
         
-        # En un futuro, podrías enviar un mensaje al usuario:
-        # await context.bot.send_message(chat_id=user_id, text=mensaje)
+        if conexion_propia:
+            despertar_notificaciones()
+        logger.info(f"✅ {puntos} puntos agregados a usuario {user_id} - {descripcion}")
+        return puntos_anteriores, puntos_nuevos
         
     except Exception as e:
-        print(f"❌ Error al notificar beneficio: {e}")
+        logger.error(f"❌ Error al agregar puntos: {e}")
+        if not conexion_propia:
+            raise
+        return None
+
+async def registrar_beneficios(cursor, user_id: int, puntos_anteriores: int, puntos_nuevos: int) -> int:
+    """Desbloquear los beneficios cuyo umbral cruzó este movimiento y encolar
+    su aviso, en la transacción del llamador.
+
+    Cada beneficio se registra una sola vez por usuario (PK en
+    beneficios_usuarios): volver a cruzar un umbral no repite el aviso.
+    Si el movimiento no cruza ningún umbral no se toca la base.
+    Devuelve cuántos beneficios se desbloquearon.
+    """
+    cruzados = await niveles_beneficios.cruzados(puntos_anteriores, puntos_nuevos, cursor)
+    if not cruzados:
+        return 0
+    
+    await cursor.execute("""
+        WITH desbloqueados AS (
+            INSERT INTO beneficios_usuarios (user_id, beneficio_id, puntos)
+            SELECT %s, unnest(%s::int[]), %s
+            ON CONFLICT (user_id, beneficio_id) DO NOTHING
+            RETURNING beneficio_id
+        )
+        INSERT INTO notificaciones (user_id, texto, origen)
+        SELECT %s, b.mensaje || %s, 'beneficio'
+        FROM desbloqueados d
+        JOIN beneficios b ON b.id = d.beneficio_id
+        ORDER BY b.puntos
+    """, (user_id, [n[0] for n in cruzados], puntos_nuevos,
+          user_id, "\n\n⭐ Ver tus puntos y beneficios: /mispuntos"))
+    desbloqueados = cursor.rowcount
+    
+    if desbloqueados:
+        logger.info(f"🎁 Usuario {user_id} desbloqueó {desbloqueados} beneficio(s) con {puntos_nuevos} puntos")
+    return desbloqueados
+
+CONSULTA_REFERIDOS_USUARIO = """
+    SELECT r.nombre_referido, r.telefono_referido, r.estado, r.fecha_registro
+    FROM referidos r
+    WHERE r.user_id_referidor = %s
+    ORDER BY r.fecha_registro DESC
+"""
 
 async def referidos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra el panel de referidos del usuario"""
     user_id = update.effective_user.id
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    # Obtener información del usuario
-    cursor.execute("SELECT first_name, user_name FROM usuarios WHERE user_id = %s", (user_id,))
-    usuario = cursor.fetchone()
+        # Obtener información del usuario
+        await cursor.execute("SELECT first_name, user_name FROM usuarios WHERE user_id = %s", (user_id,))
+        usuario = await cursor.fetchone()
     
-    if not usuario:
-        await update.message.reply_text("❌ Debes registrarte con /start primero")
-        conn.close()
-        return
+        if not usuario:
+            await update.message.reply_text("❌ Debes registrarte con /start primero")
+            return
     
-    first_name, user_name = usuario
+        first_name, user_name = usuario
     
-    # Obtener referidos del usuario
-    cursor.execute("""
-        SELECT r.nombre_referido, r.telefono_referido, r.estado, r.fecha_registro
-        FROM referidos r
-        WHERE r.user_id_referidor = %s
-        ORDER BY r.fecha_registro DESC
-    """, (user_id,))
-    referidos_lista = cursor.fetchall()
+        # Obtener referidos del usuario
+        await cursor.execute(CONSULTA_REFERIDOS_USUARIO, (user_id,))
+        referidos_lista = await cursor.fetchall()
     
-    # Obtener puntos del usuario
-    cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-    puntos_result = cursor.fetchone()
-    puntos_actuales = puntos_result[0] if puntos_result else 0
+        # Obtener puntos del usuario
+        await cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
+        puntos_result = await cursor.fetchone()
+        puntos_actuales = puntos_result[0] if puntos_result else 0
     
-    conn.close()
     
     # Crear código de referido único
     codigo_referido = f"REF{user_id}"
@@ -921,8 +2573,8 @@ async def referidos(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mensaje += "📭 **Aún no tienes referidos**\n"
     
     mensaje += f"\n💎 **Beneficios por puntos:**\n"
-    mensaje += f"• 100 puntos → 1 semana gratis en gym\n"
-    mensaje += f"• 200 puntos → 15% descuento en todo\n"
+    for _, umbral, nombre, _ in await niveles_beneficios.asegurar_cargado():
+        mensaje += f"• {umbral} puntos → {nombre}\n"
     
     keyboard = [
         [InlineKeyboardButton("📤 Compartir código", callback_data="compartir_codigo")],
@@ -932,59 +2584,70 @@ async def referidos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(mensaje, reply_markup=reply_markup)
 
+CONSULTA_PUNTOS_Y_POSICION = """
+    SELECT up.puntos_totales, up.puntos_disponibles,
+           1 + COALESCE(SUM(r.usuarios) FILTER (WHERE r.puntos > up.puntos_disponibles), 0),
+           COALESCE(SUM(r.usuarios), 0)
+    FROM usuarios_puntos up
+    CROSS JOIN ranking_puntos r
+    WHERE up.user_id = %s
+    GROUP BY up.puntos_totales, up.puntos_disponibles
+"""
+
+CONSULTA_HISTORIAL_PUNTOS = """
+    SELECT tipo, puntos, descripcion, fecha
+    FROM puntos_historial
+    WHERE user_id = %s
+    ORDER BY fecha DESC
+    LIMIT 10
+"""
+
 async def mispuntos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra los puntos y historial del usuario"""
     user_id = update.effective_user.id
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    # Obtener puntos del usuario
-    cursor.execute("SELECT puntos_totales, puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-    puntos_result = cursor.fetchone()
+        # Obtener puntos del usuario y su posición en el ranking
+        # (usuarios con más puntos, sumados sobre el conteo por saldo)
+        await cursor.execute(CONSULTA_PUNTOS_Y_POSICION, (user_id,))
+        puntos_result = await cursor.fetchone()
     
-    if not puntos_result:
-        await update.message.reply_text(
-            "⭐ **TU SISTEMA DE PUNTOS**\n\n"
-            "Aún no tienes puntos acumulados.\n\n"
-            "💡 **Cómo ganar puntos:**\n"
-            "• 2 puntos por pago puntual\n"
-            "• 5 puntos por pago adelantado\n"
-            "• 7 puntos por referido verificado\n\n"
-            "👥 **Para referir amigos usa:** /referidos"
-        )
-        conn.close()
-        return
+        if not puntos_result:
+            await update.message.reply_text(
+                "⭐ **TU SISTEMA DE PUNTOS**\n\n"
+                "Aún no tienes puntos acumulados.\n\n"
+                "💡 **Cómo ganar puntos:**\n"
+                "• 2 puntos por pago puntual\n"
+                "• 5 puntos por pago adelantado\n"
+                "• 7 puntos por referido verificado\n\n"
+                "👥 **Para referir amigos usa:** /referidos"
+            )
+            return
     
-    puntos_totales, puntos_disponibles = puntos_result
+        puntos_totales, puntos_disponibles, posicion, usuarios_con_puntos = puntos_result
     
-    # Obtener historial reciente
-    cursor.execute("""
-        SELECT tipo, puntos, descripcion, fecha 
-        FROM puntos_historial 
-        WHERE user_id = %s 
-        ORDER BY fecha DESC 
-        LIMIT 10
-    """, (user_id,))
-    historial = cursor.fetchall()
+        # Obtener historial reciente
+        await cursor.execute(CONSULTA_HISTORIAL_PUNTOS, (user_id,))
+        historial = await cursor.fetchall()
     
-    conn.close()
     
     mensaje = f"⭐ **TU SISTEMA DE PUNTOS**\n\n"
     mensaje += f"🏆 **Puntos totales:** {puntos_totales}\n"
-    mensaje += f"💎 **Puntos disponibles:** {puntos_disponibles}\n\n"
+    mensaje += f"💎 **Puntos disponibles:** {puntos_disponibles}\n"
+    mensaje += f"🏅 **Tu posición:** #{posicion} de {usuarios_con_puntos}\n\n"
     
     # Mostrar progreso hacia beneficios
     mensaje += "🎯 **TUS BENEFICIOS:**\n"
-    if puntos_disponibles >= 200:
-        mensaje += "✅ **200 puntos** - 15% descuento en todo 🛍️\n"
-        mensaje += "✅ **100 puntos** - 1 semana gratis en gym 🏋️‍♂️\n"
-    elif puntos_disponibles >= 100:
-        mensaje += "✅ **100 puntos** - 1 semana gratis en gym 🏋️‍♂️\n"
-        mensaje += f"⏳ **200 puntos** - 15% descuento ({puntos_disponibles}/200)\n"
-    else:
-        mensaje += f"⏳ **100 puntos** - 1 semana gratis ({puntos_disponibles}/100)\n"
-        mensaje += f"⏳ **200 puntos** - 15% descuento ({puntos_disponibles}/200)\n"
+    niveles = await niveles_beneficios.asegurar_cargado()
+    for _, umbral, nombre, _ in niveles:
+        if puntos_disponibles >= umbral:
+            mensaje += f"✅ **{umbral} puntos** - {nombre}\n"
+        else:
+            mensaje += f"⏳ **{umbral} puntos** - {nombre} ({puntos_disponibles}/{umbral})\n"
+    if not niveles:
+        mensaje += "📭 No hay beneficios disponibles por ahora\n"
     
     mensaje += f"\n📊 **HISTORIAL RECIENTE:**\n"
     
@@ -997,10 +2660,9 @@ async def mispuntos(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mensaje += "📭 No hay historial de puntos\n"
     
     mensaje += f"\n💡 **Siguiente beneficio:** "
-    if puntos_disponibles < 100:
-        mensaje += f"{100 - puntos_disponibles} pts para 1 semana gratis"
-    elif puntos_disponibles < 200:
-        mensaje += f"{200 - puntos_disponibles} pts para 15% descuento"
+    siguiente = await niveles_beneficios.siguiente(puntos_disponibles)
+    if siguiente:
+        mensaje += f"{siguiente[1] - puntos_disponibles} pts para {siguiente[2]}"
     else:
         mensaje += "¡Tienes todos los beneficios!"
     
@@ -1011,66 +2673,77 @@ async def mispuntos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text(mensaje, reply_markup=reply_markup)
-
-async def ranking_puntos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Muestra el ranking de puntos (solo admin)"""
-    if not is_admin(update.effective_user.id):  # ← ACTUALIZADO
-        await update.message.reply_text("❌ No tienes permisos de administrador")
-        return
-        
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Obtener ranking de puntos
-    cursor.execute("""
-        SELECT up.user_id, u.first_name, u.last_name, up.puntos_totales, up.puntos_disponibles
-        FROM usuarios_puntos up
-        LEFT JOIN usuarios u ON up.user_id = u.user_id
-        ORDER BY up.puntos_disponibles DESC
-        LIMIT 20
-    """)
-    ranking = cursor.fetchall()
-    
-    # Obtener estadísticas generales
-    cursor.execute("SELECT COUNT(*) FROM usuarios_puntos")
-    total_usuarios_puntos = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT SUM(puntos_disponibles) FROM usuarios_puntos")
-    total_puntos = cursor.fetchone()[0] or 0
-    
-    cursor.execute("SELECT COUNT(*) FROM referidos WHERE estado = 'aprobado'")
-    referidos_aprobados = cursor.fetchone()[0]
-    
-    conn.close()
-    
-    mensaje = "🏆 **RANKING DE PUNTOS - ADMIN**\n\n"
-    
-    if ranking:
-        posicion = 1
-        for user_id, first_name, last_name, puntos_totales, puntos_disponibles in ranking:
-            nombre_completo = f"{first_name or ''} {last_name or ''}".strip() or f"Usuario {user_id}"
-            medalla = "🥇" if posicion == 1 else "🥈" if posicion == 2 else "🥉" if posicion == 3 else f"{posicion}."
-            
-            mensaje += f"{medalla} **{nombre_completo}**\n"
-            mensaje += f"   🆔 ID: {user_id}\n"
-            mensaje += f"   ⭐ Puntos: {puntos_disponibles} (Total: {puntos_totales})\n"
-            mensaje += f"   ✏️ /asignar_{user_id}\n"
-            mensaje += "━━━━━━━━━━━━━━━━━━━━\n\n"
-            posicion += 1
-    else:
-        mensaje += "📭 No hay usuarios con puntos aún\n\n"
-    
-    mensaje += f"📊 **ESTADÍSTICAS GENERALES:**\n"
-    mensaje += f"• 👥 Usuarios con puntos: {total_usuarios_puntos}\n"
-    mensaje += f"• ⭐ Total puntos en sistema: {total_puntos}\n"
-    mensaje += f"• 👥 Referidos aprobados: {referidos_aprobados}\n"
-    mensaje += f"• 💰 Valor estimado: ${total_puntos * 0.1:.2f}\n\n"
-    
-    mensaje += "🛠️ **Acciones:**\n"
-    mensaje += "/verreferidos - Ver todos los referidos pendientes\n"
-    mensaje += "/verpuntosusuario_ID - Ver puntos de usuario específico"
+
+def formatear_ranking(fila, posicion: int) -> str:
+    user_id, first_name, last_name, puntos_totales, puntos_disponibles = fila
+    nombre_completo = f"{first_name or ''} {last_name or ''}".strip() or f"Usuario {user_id}"
+    medalla = "🥇" if posicion == 1 else "🥈" if posicion == 2 else "🥉" if posicion == 3 else f"{posicion}."
+    
+    entrada = f"{medalla} **{nombre_completo}**\n"
+    entrada += f"   🆔 ID: {user_id}\n"
+    entrada += f"   ⭐ Puntos: {puntos_disponibles} (Total: {puntos_totales})\n"
+    entrada += f"   ✏️ /asignar_{user_id}\n"
+    entrada += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    return entrada
+
+async def resumen_ranking() -> str:
+    # Totales desde el conteo por saldo (una fila por saldo, no por usuario)
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            SELECT COALESCE(SUM(usuarios), 0),
+                   COALESCE(SUM(puntos::BIGINT * usuarios), 0),
+                   (SELECT COUNT(*) FROM referidos WHERE estado = 'aprobado')
+            FROM ranking_puntos
+        """)
+        total_usuarios_puntos, total_puntos, referidos_aprobados = await cursor.fetchone()
+    
+    resumen = f"📊 **ESTADÍSTICAS GENERALES:**\n"
+    resumen += f"• 👥 Usuarios con puntos: {total_usuarios_puntos}\n"
+    resumen += f"• ⭐ Total puntos en sistema: {total_puntos}\n"
+    resumen += f"• 👥 Referidos aprobados: {referidos_aprobados}\n"
+    resumen += f"• 💰 Valor estimado: ${total_puntos * 0.1:.2f}\n\n"
+    return resumen
+
+LISTADO_RANKING = Listado(
+    nombre='ranking',
+    titulo="🏆 **RANKING DE PUNTOS - ADMIN**",
+    consulta="""
+        SELECT up.user_id, u.first_name, u.last_name, up.puntos_totales, up.puntos_disponibles
+        FROM usuarios_puntos up
+        LEFT JOIN usuarios u ON up.user_id = u.user_id
+        {donde}
+    """,
+    orden=("up.puntos_disponibles", "up.user_id"),
+    clave=lambda fila: (fila[4], fila[0]),
+    formatear=formatear_ranking,
+    vacio="📭 No hay usuarios con puntos aún",
+    resumen=resumen_ranking,
+    pie=(
+        "🛠️ **Acciones:**\n"
+        "/verreferidos - Ver todos los referidos pendientes\n"
+        "/verpuntosusuario_ID - Ver puntos de usuario específico"
+    ),
+)
+
+async def ranking_puntos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra el ranking de puntos (solo admin)"""
+    if not is_admin(update.effective_user.id):  # ← ACTUALIZADO
+        await update.message.reply_text("❌ No tienes permisos de administrador")
+        return
     
-    await update.message.reply_text(mensaje)
+    await abrir_listado(update, context, LISTADO_RANKING)
+
+CONSULTA_REFERIDOS_PENDIENTES = """
+    SELECT r.id, r.user_id_referidor, u1.first_name as nombre_referidor,
+           r.user_id_referido, u2.first_name as nombre_referido,
+           r.nombre_referido, r.telefono_referido, r.fecha_registro
+    FROM referidos r
+    LEFT JOIN usuarios u1 ON r.user_id_referidor = u1.user_id
+    LEFT JOIN usuarios u2 ON r.user_id_referido = u2.user_id
+    WHERE r.estado = 'pendiente'
+    ORDER BY r.fecha_registro DESC
+"""
 
 async def ver_referidos_pendientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra todos los referidos pendientes de verificación (solo admin)"""
@@ -1078,22 +2751,12 @@ async def ver_referidos_pendientes(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text("❌ No tienes permisos de administrador")
         return
         
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute("""
-        SELECT r.id, r.user_id_referidor, u1.first_name as nombre_referidor, 
-               r.user_id_referido, u2.first_name as nombre_referido,
-               r.nombre_referido, r.telefono_referido, r.fecha_registro
-        FROM referidos r
-        LEFT JOIN usuarios u1 ON r.user_id_referidor = u1.user_id
-        LEFT JOIN usuarios u2 ON r.user_id_referido = u2.user_id
-        WHERE r.estado = 'pendiente'
-        ORDER BY r.fecha_registro DESC
-    """)
-    referidos_pendientes = cursor.fetchall()
+        await cursor.execute(CONSULTA_REFERIDOS_PENDIENTES)
+        referidos_pendientes = await cursor.fetchall()
     
-    conn.close()
     
     if not referidos_pendientes:
         await update.message.reply_text("✅ No hay referidos pendientes de verificación")
@@ -1131,64 +2794,61 @@ async def verificar_referido(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         referido_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Obtener información del referido
-        cursor.execute("""
-            SELECT user_id_referidor, user_id_referido, nombre_referido
-            FROM referidos 
-            WHERE id = %s AND estado = 'pendiente'
-        """, (referido_id,))
-        referido = cursor.fetchone()
-        
-        if not referido:
-            await update.message.reply_text("❌ Referido no encontrado o ya verificado")
-            conn.close()
-            return
-        
-        user_id_referidor, user_id_referido, nombre_referido = referido
-        
-        # Actualizar estado del referido
-        cursor.execute("UPDATE referidos SET estado = 'aprobado' WHERE id = %s", (referido_id,))
-        
-        # Otorgar puntos al referidor
-        puntos_otorgados = 7
-        descripcion = f"Referido aprobado: {nombre_referido}"
-        
-        # Usar la función agregar_puntos
-        success = await agregar_puntos(user_id_referidor, puntos_otorgados, "referido", descripcion)
-        
-        if success:
-            # Marcar como puntos otorgados
-            cursor.execute("UPDATE referidos SET puntos_otorgados = TRUE WHERE id = %s", (referido_id,))
-        
-        conn.commit()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Notificar al referidor
-        try:
-            await context.bot.send_message(
-                chat_id=user_id_referidor,
-                text=f"🎉 **¡REFERIDO APROBADO!**\n\n"
-                     f"Tu referido **{nombre_referido}** ha sido aprobado.\n\n"
-                     f"⭐ **+7 puntos** han sido agregados a tu cuenta.\n"
-                     f"🏆 **Total de puntos:** (Ver en /mispuntos)\n\n"
-                     f"¡Sigue invitando amigos para ganar más puntos!"
-            )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al referidor: {e}")
+            # Obtener información del referido
+            await cursor.execute("""
+                SELECT user_id_referidor, user_id_referido, nombre_referido
+                FROM referidos 
+                WHERE id = %s AND estado = 'pendiente'
+            """, (referido_id,))
+            referido = await cursor.fetchone()
+        
+            if not referido:
+                await update.message.reply_text("❌ Referido no encontrado o ya verificado")
+                return
+        
+            user_id_referidor, user_id_referido, nombre_referido = referido
+        
+            # Actualizar estado del referido
+            await cursor.execute("UPDATE referidos SET estado = 'aprobado' WHERE id = %s", (referido_id,))
+        
+            # Otorgar puntos al referidor
+            puntos_otorgados = 7
+            descripcion = f"Referido aprobado: {nombre_referido}"
+        
+            # Usar la función agregar_puntos; si falla, se propaga y la
+            # aprobación del referido se deshace junto con los puntos
+            saldo = await agregar_puntos(user_id_referidor, puntos_otorgados, "referido", descripcion, conn=conn)
+        
+            if saldo:
+                # Marcar como puntos otorgados
+                await cursor.execute("UPDATE referidos SET puntos_otorgados = TRUE WHERE id = %s", (referido_id,))
+        
+                # Notificar al referidor (bandeja de salida, misma transacción)
+                await encolar_notificacion(
+                    cursor, user_id_referidor,
+                    f"🎉 **¡REFERIDO APROBADO!**\n\n"
+                    f"Tu referido **{nombre_referido}** ha sido aprobado.\n\n"
+                    f"⭐ **+7 puntos** han sido agregados a tu cuenta.\n"
+                    f"🏆 **Total de puntos:** {saldo[1]}\n\n"
+                    f"¡Sigue invitando amigos para ganar más puntos!",
+                    'referido_aprobado'
+                )
+            await conn.commit()
+        despertar_notificaciones()
         
         await update.message.reply_text(
             f"✅ **Referido aprobado exitosamente**\n\n"
             f"👤 **Referidor:** {user_id_referidor}\n"
             f"👥 **Referido:** {nombre_referido}\n"
             f"⭐ **Puntos otorgados:** 7\n\n"
-            f"El referidor ha sido notificado."
+            f"📣 El referidor será notificado."
         )
         
     except Exception as e:
-        print(f"❌ Error al verificar referido: {e}")
+        logger.error(f"❌ Error al verificar referido: {e}")
         await update.message.reply_text("❌ Error al verificar el referido")
 
 async def rechazar_referido(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1201,53 +2861,50 @@ async def rechazar_referido(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         referido_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Obtener información del referido
-        cursor.execute("""
-            SELECT user_id_referidor, nombre_referido
-            FROM referidos 
-            WHERE id = %s AND estado = 'pendiente'
-        """, (referido_id,))
-        referido = cursor.fetchone()
-        
-        if not referido:
-            await update.message.reply_text("❌ Referido no encontrado o ya procesado")
-            conn.close()
-            return
-        
-        user_id_referidor, nombre_referido = referido
-        
-        # Actualizar estado del referido a rechazado
-        cursor.execute("UPDATE referidos SET estado = 'rechazado' WHERE id = %s", (referido_id,))
-        conn.commit()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Notificar al referidor
-        try:
-            await context.bot.send_message(
-                chat_id=user_id_referidor,
-                text=f"❌ **REFERIDO RECHAZADO**\n\n"
-                     f"Tu referido **{nombre_referido}** ha sido rechazado.\n\n"
-                     f"💡 **Posibles razones:**\n"
-                     f"• El usuario no se registró correctamente\n"
-                     f"• Información incompleta o incorrecta\n"
-                     f"• Ya estaba registrado en el sistema\n\n"
-                     f"Puedes intentar con otro referido usando /referidos"
+            # Obtener información del referido
+            await cursor.execute("""
+                SELECT user_id_referidor, nombre_referido
+                FROM referidos 
+                WHERE id = %s AND estado = 'pendiente'
+            """, (referido_id,))
+            referido = await cursor.fetchone()
+        
+            if not referido:
+                await update.message.reply_text("❌ Referido no encontrado o ya procesado")
+                return
+        
+            user_id_referidor, nombre_referido = referido
+        
+            # Actualizar estado del referido a rechazado
+            await cursor.execute("UPDATE referidos SET estado = 'rechazado' WHERE id = %s", (referido_id,))
+        
+            # Notificar al referidor (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id_referidor,
+                f"❌ **REFERIDO RECHAZADO**\n\n"
+                f"Tu referido **{nombre_referido}** ha sido rechazado.\n\n"
+                f"💡 **Posibles razones:**\n"
+                f"• El usuario no se registró correctamente\n"
+                f"• Información incompleta o incorrecta\n"
+                f"• Ya estaba registrado en el sistema\n\n"
+                f"Puedes intentar con otro referido usando /referidos",
+                'referido_rechazado'
             )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al referidor: {e}")
+            await conn.commit()
+        despertar_notificaciones()
         
         await update.message.reply_text(
             f"✅ **Referido rechazado**\n\n"
             f"👤 **Referidor:** {user_id_referidor}\n"
             f"👥 **Referido:** {nombre_referido}\n\n"
-            f"El referidor ha sido notificado."
+            f"📣 El referidor será notificado."
         )
         
     except Exception as e:
-        print(f"❌ Error al rechazar referido: {e}")
+        logger.error(f"❌ Error al rechazar referido: {e}")
         await update.message.reply_text("❌ Error al rechazar el referido")
         
         
@@ -1284,69 +2941,55 @@ async def agregar_puntos_admin(update: Update, context: ContextTypes.DEFAULT_TYP
             await update.message.reply_text("❌ La cantidad debe ser mayor a 0")
             return
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Verificar si el usuario existe
-        cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-        usuario = cursor.fetchone()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        if not usuario:
-            await update.message.reply_text("❌ Usuario no encontrado")
-            conn.close()
-            return
+            # Verificar si el usuario existe
+            await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+            usuario = await cursor.fetchone()
         
-        first_name, last_name = usuario
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            if not usuario:
+                await update.message.reply_text("❌ Usuario no encontrado")
+                return
         
-        # Agregar puntos usando la función existente
-        descripcion = f"Puntos asignados por administrador"
-        success = await agregar_puntos(user_id, puntos, "admin", descripcion)
+            first_name, last_name = usuario
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        conn.close()
+            # Agregar puntos usando la función existente, en esta misma transacción
+            descripcion = f"Puntos asignados por administrador"
+            saldo = await agregar_puntos(user_id, puntos, "admin", descripcion, conn=conn)
         
-        if success:
-            # Obtener nuevos puntos para mostrar
-            conn_temp = get_db_connection()
-            cursor_temp = conn_temp.cursor()
-            cursor_temp.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-            nuevos_puntos = cursor_temp.fetchone()
-            conn_temp.close()
-            
-            puntos_actuales = nuevos_puntos[0] if nuevos_puntos else puntos
+            if saldo:
+                puntos_actuales = saldo[1]
             
+                # Notificar al usuario (bandeja de salida, misma transacción)
+                await encolar_notificacion(
+                    cursor, user_id,
+                    f"🎉 **¡HAS RECIBIDO PUNTOS!**\n\n"
+                    f"El administrador te ha asignado {puntos} puntos.\n\n"
+                    f"⭐ **Puntos actuales:** {puntos_actuales}\n"
+                    f"📝 **Razón:** {descripcion}\n\n"
+                    f"Ver tus puntos: /mispuntos",
+                    'puntos_agregados'
+                )
+        
+        if saldo:
+            despertar_notificaciones()
             await update.message.reply_text(
                 f"✅ **Puntos agregados exitosamente**\n\n"
                 f"👤 **Usuario:** {nombre_completo}\n"
                 f"🆔 **ID:** {user_id}\n"
                 f"⭐ **Puntos agregados:** +{puntos}\n"
                 f"🏆 **Puntos actuales:** {puntos_actuales}\n\n"
-                f"El usuario ha sido notificado automáticamente."
+                f"📣 El usuario será notificado automáticamente."
             )
-            
-            # Notificar al usuario
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"🎉 **¡HAS RECIBIDO PUNTOS!**\n\n"
-                         f"El administrador te ha asignado {puntos} puntos.\n\n"
-                         f"⭐ **Puntos actuales:** {puntos_actuales}\n"
-                         f"📝 **Razón:** {descripcion}\n\n"
-                         f"Ver tus puntos: /mispuntos"
-                )
-                
-                # Verificar beneficios
-                await verificar_beneficios_puntos(user_id)
-                
-            except Exception as e:
-                print(f"❌ No se pudo notificar al usuario: {e}")
         else:
             await update.message.reply_text("❌ Error al agregar puntos")
             
     except ValueError:
         await update.message.reply_text("❌ Formato incorrecto. Usa: /agregarpuntos_ID cantidad")
     except Exception as e:
-        print(f"❌ Error en agregar_puntos_admin: {e}")
+        logger.error(f"❌ Error en agregar_puntos_admin: {e}")
         await update.message.reply_text("❌ Error al procesar la solicitud")
 
 async def quitar_puntos_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1376,78 +3019,67 @@ async def quitar_puntos_admin(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ La cantidad debe ser mayor a 0")
             return
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Verificar si el usuario existe
-        cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-        usuario = cursor.fetchone()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        if not usuario:
-            await update.message.reply_text("❌ Usuario no encontrado")
-            conn.close()
-            return
+            # Verificar si el usuario existe
+            await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+            usuario = await cursor.fetchone()
         
-        first_name, last_name = usuario
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            if not usuario:
+                await update.message.reply_text("❌ Usuario no encontrado")
+                return
         
-        # Verificar puntos actuales
-        cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-        puntos_actuales = cursor.fetchone()
+            first_name, last_name = usuario
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        if not puntos_actuales or puntos_actuales[0] < puntos:
-            await update.message.reply_text(
-                f"❌ **No hay suficientes puntos**\n\n"
-                f"El usuario tiene {puntos_actuales[0] if puntos_actuales else 0} puntos\n"
-                f"Intentas quitar: {puntos} puntos"
-            )
-            conn.close()
-            return
+            # Verificar puntos actuales (bloqueando la fila hasta el commit)
+            await cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s FOR UPDATE", (user_id,))
+            puntos_actuales = await cursor.fetchone()
         
-        # Quitar puntos (agregar puntos negativos)
-        descripcion = f"Puntos removidos por administrador"
-        success = await agregar_puntos(user_id, -puntos, "admin", descripcion)
+            if not puntos_actuales or puntos_actuales[0] < puntos:
+                await update.message.reply_text(
+                    f"❌ **No hay suficientes puntos**\n\n"
+                    f"El usuario tiene {puntos_actuales[0] if puntos_actuales else 0} puntos\n"
+                    f"Intentas quitar: {puntos} puntos"
+                )
+                return
         
-        conn.close()
+            # Quitar puntos (agregar puntos negativos) en esta misma transacción
+            descripcion = f"Puntos removidos por administrador"
+            saldo = await agregar_puntos(user_id, -puntos, "admin", descripcion, conn=conn)
         
-        if success:
-            # Obtener nuevos puntos para mostrar
-            conn_temp = get_db_connection()
-            cursor_temp = conn_temp.cursor()
-            cursor_temp.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-            nuevos_puntos = cursor_temp.fetchone()
-            conn_temp.close()
-            
-            puntos_finales = nuevos_puntos[0] if nuevos_puntos else 0
+            if saldo:
+                puntos_finales = saldo[1]
             
+                # Notificar al usuario (bandeja de salida, misma transacción)
+                await encolar_notificacion(
+                    cursor, user_id,
+                    f"ℹ️ **AJUSTE DE PUNTOS**\n\n"
+                    f"El administrador ha removido {puntos} puntos de tu cuenta.\n\n"
+                    f"⭐ **Puntos actuales:** {puntos_finales}\n"
+                    f"📝 **Razón:** {descripcion}\n\n"
+                    f"Ver tus puntos: /mispuntos",
+                    'puntos_quitados'
+                )
+        
+        if saldo:
+            despertar_notificaciones()
             await update.message.reply_text(
                 f"✅ **Puntos quitados exitosamente**\n\n"
                 f"👤 **Usuario:** {nombre_completo}\n"
                 f"🆔 **ID:** {user_id}\n"
                 f"⭐ **Puntos quitados:** -{puntos}\n"
                 f"🏆 **Puntos actuales:** {puntos_finales}\n\n"
-                f"El usuario ha sido notificado."
+                f"📣 El usuario será notificado."
             )
-            
-            # Notificar al usuario
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"ℹ️ **AJUSTE DE PUNTOS**\n\n"
-                         f"El administrador ha removido {puntos} puntos de tu cuenta.\n\n"
-                         f"⭐ **Puntos actuales:** {puntos_finales}\n"
-                         f"📝 **Razón:** {descripcion}\n\n"
-                         f"Ver tus puntos: /mispuntos"
-                )
-            except Exception as e:
-                print(f"❌ No se pudo notificar al usuario: {e}")
         else:
             await update.message.reply_text("❌ Error al quitar puntos")
             
     except ValueError:
         await update.message.reply_text("❌ Formato incorrecto. Usa: /quitarpuntos_ID cantidad")
     except Exception as e:
-        print(f"❌ Error en quitar_puntos_admin: {e}")
+        logger.error(f"❌ Error en quitar_puntos_admin: {e}")
         await update.message.reply_text("❌ Error al procesar la solicitud")
 
 async def establecer_puntos_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1477,54 +3109,67 @@ async def establecer_puntos_admin(update: Update, context: ContextTypes.DEFAULT_
             await update.message.reply_text("❌ La cantidad no puede ser negativa")
             return
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Verificar si el usuario existe
-        cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-        usuario = cursor.fetchone()
+            # Verificar si el usuario existe
+            await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+            usuario = await cursor.fetchone()
         
-        if not usuario:
-            await update.message.reply_text("❌ Usuario no encontrado")
-            conn.close()
-            return
+            if not usuario:
+                await update.message.reply_text("❌ Usuario no encontrado")
+                return
         
-        first_name, last_name = usuario
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            first_name, last_name = usuario
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Obtener puntos actuales para calcular diferencia
-        cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-        puntos_actuales = cursor.fetchone()
-        
-        puntos_anteriores = puntos_actuales[0] if puntos_actuales else 0
-        diferencia = puntos - puntos_anteriores
-        
-        # Actualizar puntos directamente
-        if puntos_actuales:
-            # Usuario ya existe en tabla de puntos, actualizar
-            cursor.execute("""
-                UPDATE usuarios_puntos 
-                SET puntos_disponibles = %s, 
-                    puntos_totales = puntos_totales + %s,
-                    fecha_actualizacion = CURRENT_TIMESTAMP
-                WHERE user_id = %s
-            """, (puntos, diferencia, user_id))
-        else:
-            # Crear nuevo registro
-            cursor.execute("""
-                INSERT INTO usuarios_puntos (user_id, puntos_totales, puntos_disponibles)
-                VALUES (%s, %s, %s)
-            """, (user_id, puntos, puntos))
-        
-        # Registrar en historial
-        descripcion = f"Puntos establecidos por administrador (antes: {puntos_anteriores})"
-        cursor.execute("""
-            INSERT INTO puntos_historial (user_id, tipo, puntos, descripcion)
-            VALUES (%s, %s, %s, %s)
-        """, (user_id, "admin", diferencia, descripcion))
-        
-        conn.commit()
-        conn.close()
+            # Obtener puntos actuales para calcular diferencia (bloqueando la fila hasta el commit)
+            await cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s FOR UPDATE", (user_id,))
+            puntos_actuales = await cursor.fetchone()
+        
+            puntos_anteriores = puntos_actuales[0] if puntos_actuales else 0
+            diferencia = puntos - puntos_anteriores
+        
+            # Actualizar puntos directamente
+            if puntos_actuales:
+                # Usuario ya existe en tabla de puntos, actualizar
+                await cursor.execute("""
+                    UPDATE usuarios_puntos 
+                    SET puntos_disponibles = %s, 
+                        puntos_totales = puntos_totales + %s,
+                        fecha_actualizacion = CURRENT_TIMESTAMP
+                    WHERE user_id = %s
+                """, (puntos, diferencia, user_id))
+            else:
+                # Crear nuevo registro
+                await cursor.execute("""
+                    INSERT INTO usuarios_puntos (user_id, puntos_totales, puntos_disponibles)
+                    VALUES (%s, %s, %s)
+                """, (user_id, puntos, puntos))
+        
+            # Registrar en historial
+            descripcion = f"Puntos establecidos por administrador (antes: {puntos_anteriores})"
+            await cursor.execute("""
+                INSERT INTO puntos_historial (user_id, tipo, puntos, descripcion)
+                VALUES (%s, %s, %s, %s)
+            """, (user_id, "admin", diferencia, descripcion))
+        
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"ℹ️ **AJUSTE DE PUNTOS**\n\n"
+                f"El administrador ha establecido tus puntos a {puntos}.\n\n"
+                f"📊 **Puntos anteriores:** {puntos_anteriores}\n"
+                f"⭐ **Puntos actuales:** {puntos}\n"
+                f"📝 **Razón:** {descripcion}\n\n"
+                f"Ver tus puntos: /mispuntos",
+                'puntos_establecidos'
+            )
+        
+            # Beneficios cuyo umbral se cruzó con el ajuste
+            await registrar_beneficios(cursor, user_id, puntos_anteriores, puntos)
+            await conn.commit()
+        despertar_notificaciones()
         
         await update.message.reply_text(
             f"✅ **Puntos establecidos exitosamente**\n\n"
@@ -1533,34 +3178,123 @@ async def establecer_puntos_admin(update: Update, context: ContextTypes.DEFAULT_
             f"📊 **Puntos anteriores:** {puntos_anteriores}\n"
             f"⭐ **Puntos establecidos:** {puntos}\n"
             f"🔢 **Diferencia:** {diferencia:+}\n\n"
-            f"El usuario ha sido notificado."
+            f"📣 El usuario será notificado."
         )
-        
-        # Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"ℹ️ **AJUSTE DE PUNTOS**\n\n"
-                     f"El administrador ha establecido tus puntos a {puntos}.\n\n"
-                     f"📊 **Puntos anteriores:** {puntos_anteriores}\n"
-                     f"⭐ **Puntos actuales:** {puntos}\n"
-                     f"📝 **Razón:** {descripcion}\n\n"
-                     f"Ver tus puntos: /mispuntos"
-            )
-            
-            # Verificar beneficios
-            await verificar_beneficios_puntos(user_id)
-            
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
             
     except ValueError:
         await update.message.reply_text("❌ Formato incorrecto. Usa: /establecerpuntos_ID cantidad")
     except Exception as e:
-        print(f"❌ Error en establecer_puntos_admin: {e}")
+        logger.error(f"❌ Error en establecer_puntos_admin: {e}")
         await update.message.reply_text("❌ Error al procesar la solicitud")       
        
         
+# =============================================
+# 🎁 NIVELES DE BENEFICIOS (ADMIN)
+# =============================================
+
+async def ver_beneficios(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lista los niveles de beneficios y cuántos usuarios desbloquearon cada uno (admin)"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ No tienes permisos de administrador")
+        return
+    
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            SELECT b.puntos, b.nombre, b.activo, COUNT(bu.user_id)
+            FROM beneficios b
+            LEFT JOIN beneficios_usuarios bu ON bu.beneficio_id = b.id
+            GROUP BY b.id
+            ORDER BY b.puntos
+        """)
+        beneficios = await cursor.fetchall()
+    
+    mensaje = "🎁 **NIVELES DE BENEFICIOS**\n\n"
+    if beneficios:
+        for puntos, nombre, activo, desbloqueados in beneficios:
+            icono = "🟢" if activo else "⚪"
+            mensaje += f"{icono} **{puntos} puntos** - {nombre}\n"
+            mensaje += f"   👥 Desbloqueado por {desbloqueados} usuario(s)\n"
+    else:
+        mensaje += "📭 No hay beneficios configurados\n"
+    
+    mensaje += (
+        "\n📝 **Crear o editar:**\n"
+        "/guardarbeneficio puntos | nombre | mensaje\n"
+        "🚫 **Desactivar:** /quitarbeneficio puntos"
+    )
+    await update.message.reply_text(mensaje)
+
+async def guardar_beneficio(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Crea o actualiza el beneficio de un umbral de puntos (admin)"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ No tienes permisos de administrador")
+        return
+    
+    partes = [parte.strip() for parte in ' '.join(context.args or []).split('|')]
+    if len(partes) != 3 or not all(partes):
+        await update.message.reply_text(
+            "📝 **GUARDAR BENEFICIO**\n\n"
+            "Uso: /guardarbeneficio puntos | nombre | mensaje\n\n"
+            "Ejemplo:\n"
+            "/guardarbeneficio 300 | 1 mes gratis 🏋️ | 🎉 ¡Has ganado 1 MES GRATIS en el gym!"
+        )
+        return
+    
+    try:
+        puntos = int(partes[0])
+    except ValueError:
+        await update.message.reply_text("❌ Los puntos deben ser un número entero")
+        return
+    if puntos <= 0:
+        await update.message.reply_text("❌ Los puntos deben ser mayores a 0")
+        return
+    
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            INSERT INTO beneficios (puntos, nombre, mensaje)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (puntos) DO UPDATE
+            SET nombre = EXCLUDED.nombre, mensaje = EXCLUDED.mensaje, activo = TRUE
+        """, (puntos, partes[1], partes[2]))
+        await cursor.execute(f"NOTIFY {CANAL_BENEFICIOS}")
+        await conn.commit()
+    niveles_beneficios.invalidar()
+    
+    await update.message.reply_text(
+        f"✅ **Beneficio guardado**\n\n"
+        f"⭐ **Puntos:** {puntos}\n"
+        f"🎁 **Nombre:** {partes[1]}\n"
+        f"💬 **Mensaje:** {partes[2]}\n\n"
+        f"Se avisará a cada usuario la primera vez que alcance este umbral."
+    )
+
+async def quitar_beneficio(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Desactiva el beneficio de un umbral de puntos (admin)"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ No tienes permisos de administrador")
+        return
+    
+    try:
+        puntos = int(context.args[0])
+    except (IndexError, TypeError, ValueError):
+        await update.message.reply_text("📝 Uso: /quitarbeneficio puntos\n\nEjemplo: /quitarbeneficio 200")
+        return
+    
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("UPDATE beneficios SET activo = FALSE WHERE puntos = %s AND activo", (puntos,))
+        desactivado = cursor.rowcount
+        await cursor.execute(f"NOTIFY {CANAL_BENEFICIOS}")
+        await conn.commit()
+    niveles_beneficios.invalidar()
+    
+    if desactivado:
+        await update.message.reply_text(f"🚫 Beneficio de {puntos} puntos desactivado")
+    else:
+        await update.message.reply_text(f"❌ No hay un beneficio activo de {puntos} puntos")
+
 # =============================================
 # 🆕 FUNCIÓN PARA VACIAR RANKING DE PUNTOS
 # =============================================
@@ -1579,29 +3313,28 @@ async def vaciar_ranking_puntos(update: Update, context: ContextTypes.DEFAULT_TY
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     # Obtener estadísticas actuales
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute("SELECT COUNT(*) FROM usuarios_puntos")
-    total_usuarios = cursor.fetchone()[0]
+        await cursor.execute("SELECT COUNT(*) FROM usuarios_puntos")
+        total_usuarios = (await cursor.fetchone())[0]
     
-    cursor.execute("SELECT SUM(puntos_totales) FROM usuarios_puntos")
-    total_puntos = cursor.fetchone()[0] or 0
+        await cursor.execute("SELECT SUM(puntos_totales) FROM usuarios_puntos")
+        total_puntos = (await cursor.fetchone())[0] or 0
     
-    cursor.execute("SELECT COUNT(*) FROM puntos_historial")
-    total_historial = cursor.fetchone()[0]
+        # El historial puede ser enorme: estimación en lugar de COUNT(*)
+        total_historial = await filas_estimadas(cursor, 'puntos_historial')
     
-    cursor.execute("SELECT COUNT(*) FROM referidos")
-    total_referidos = cursor.fetchone()[0]
+        await cursor.execute("SELECT COUNT(*) FROM referidos")
+        total_referidos = (await cursor.fetchone())[0]
     
-    conn.close()
     
     mensaje = (
         "🗑️ **VACIAR SISTEMA DE PUNTOS - CONFIRMACIÓN**\n\n"
         "⚠️ **ESTA ACCIÓN ELIMINARÁ:**\n"
         f"• 👥 {total_usuarios} usuarios de la tabla de puntos\n"
         f"• ⭐ {total_puntos} puntos totales en el sistema\n"
-        f"• 📊 {total_historial} registros del historial de puntos\n"
+        f"• 📊 ~{total_historial} registros del historial de puntos\n"
         f"• 👥 {total_referidos} registros de referidos\n\n"
         "❌ **ESTA ACCIÓN NO SE PUEDE DESHACER**\n\n"
         "¿Estás completamente seguro de vaciar todo el sistema de puntos?"
@@ -1619,47 +3352,45 @@ async def ver_puntos_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         user_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Obtener información del usuario
-        cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-        usuario = cursor.fetchone()
+            # Obtener información del usuario
+            await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+            usuario = await cursor.fetchone()
         
-        if not usuario:
-            await update.message.reply_text("❌ Usuario no encontrado")
-            conn.close()
-            return
+            if not usuario:
+                await update.message.reply_text("❌ Usuario no encontrado")
+                return
         
-        first_name, last_name = usuario
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            first_name, last_name = usuario
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Obtener puntos del usuario
-        cursor.execute("""
-            SELECT puntos_totales, puntos_disponibles, fecha_actualizacion
-            FROM usuarios_puntos 
-            WHERE user_id = %s
-        """, (user_id,))
-        puntos = cursor.fetchone()
-        
-        # Obtener historial de puntos
-        cursor.execute("""
-            SELECT tipo, puntos, descripcion, fecha
-            FROM puntos_historial
-            WHERE user_id = %s
-            ORDER BY fecha DESC
-            LIMIT 10
-        """, (user_id,))
-        historial = cursor.fetchall()
+            # Obtener puntos del usuario
+            await cursor.execute("""
+                SELECT puntos_totales, puntos_disponibles, fecha_actualizacion
+                FROM usuarios_puntos 
+                WHERE user_id = %s
+            """, (user_id,))
+            puntos = await cursor.fetchone()
         
-        # Obtener referidos del usuario
-        cursor.execute("""
-            SELECT COUNT(*) FROM referidos 
-            WHERE user_id_referidor = %s AND estado = 'aprobado'
-        """, (user_id,))
-        referidos_aprobados = cursor.fetchone()[0]
+            # Obtener historial de puntos
+            await cursor.execute("""
+                SELECT tipo, puntos, descripcion, fecha
+                FROM puntos_historial
+                WHERE user_id = %s
+                ORDER BY fecha DESC
+                LIMIT 10
+            """, (user_id,))
+            historial = await cursor.fetchall()
+        
+            # Obtener referidos del usuario
+            await cursor.execute("""
+                SELECT COUNT(*) FROM referidos 
+                WHERE user_id_referidor = %s AND estado = 'aprobado'
+            """, (user_id,))
+            referidos_aprobados = (await cursor.fetchone())[0]
         
-        conn.close()
         
         mensaje = f"⭐ **PUNTOS DE USUARIO - ADMIN**\n\n"
         mensaje += f"👤 **Usuario:** {nombre_completo}\n"
@@ -1686,7 +3417,7 @@ async def ver_puntos_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text(mensaje)
         
     except Exception as e:
-        print(f"❌ Error al ver puntos de usuario: {e}")
+        logger.error(f"❌ Error al ver puntos de usuario: {e}")
         await update.message.reply_text("❌ Error al obtener información del usuario")
 
 # =============================================
@@ -1695,44 +3426,291 @@ async def ver_puntos_usuario(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 
-async def notificar_usuarios_incremento(context: ContextTypes.DEFAULT_TYPE, tipo: str):
-    """Notifica a los usuarios sobre el incremento de semanas"""
-    try:
-        conn = get_db_connection()
+# AVANCE_AUTOMATICO: avanzar cada plan en su aniversario semanal sin /avanzartodos
+AVANCE_AUTOMATICO = os.getenv('AVANCE_AUTOMATICO', 'false').lower() in ('1', 'true', 'si', 'sí')
+AVANCE_INTERVALO = float(os.getenv('AVANCE_INTERVALO', '300'))  # segundos entre revisiones
+AVANCE_LOTE = int(os.getenv('AVANCE_LOTE', '200'))  # planes por transacción
+AVANCE_PAUSA_LOTES = float(os.getenv('AVANCE_PAUSA_LOTES', '30'))  # segundos entre lotes de una revisión
+
+def mensaje_avance(semanas_comp: int, semanas_tot: int, tipo: str) -> str:
+    """Texto para el usuario cuando su plan avanza ('manual' o 'automatico')"""
+    if semanas_comp >= semanas_tot:
+        return ("🎉 **¡PLAN COMPLETADO!**\n\n"
+                f"✅ Has terminado las {semanas_tot} semanas.\n\n"
+                "📞 Contacta al administrador.")
+    
+    mensaje = "📅 **AVANCE DE SEMANA**\n\n" if tipo == "manual" else "📅 **AVANCE AUTOMÁTICO**\n\n"
+    mensaje += f"✅ Tu plan ha avanzado a la semana {semanas_comp}/{semanas_tot}\n\n"
+    mensaje += "💳 Recuerda realizar tu pago semanal.\n"
+    mensaje += "📋 Ver progreso: /misplanes"
+    return mensaje
+
+# Registro de avances: cada avance masivo deja una fila por plan (y su aviso en
+# la bandeja de salida) en la misma transacción que lo aplica, así que un
+# reinicio a mitad de una corrida no repite avances ni pierde avisos.
+
+CONSULTA_AVANCE_VENCIDO = """
+    WITH vencidos AS (
+        SELECT id,
+               FLOOR(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - COALESCE(fecha_ultimo_pago, fecha_inicio))
+                     / 604800)::int AS semanas_vencidas
+        FROM planes_pago
+        WHERE estado = 'activo'
+        AND contador_pausado = FALSE
+        AND semanas_completadas < semanas
+        AND COALESCE(fecha_ultimo_pago, fecha_inicio) <= CURRENT_TIMESTAMP - INTERVAL '7 days'
+        ORDER BY COALESCE(fecha_ultimo_pago, fecha_inicio)
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ), avanzados AS (
+        UPDATE planes_pago p
+        SET semanas_completadas = LEAST(p.semanas, p.semanas_completadas + v.semanas_vencidas),
+            fecha_ultimo_pago = COALESCE(p.fecha_ultimo_pago, p.fecha_inicio) + v.semanas_vencidas * INTERVAL '7 days'
+        FROM vencidos v
+        WHERE p.id = v.id
+        RETURNING p.id, p.user_id, p.semanas_completadas, p.semanas
+    ), registrados AS (
+        INSERT INTO avances (run_id, plan_id, user_id, semana, semanas, tipo)
+        SELECT %s, id, user_id, semanas_completadas, semanas, 'automatico'
+        FROM avanzados
+        RETURNING id, user_id
+    )
+    INSERT INTO notificaciones (user_id, origen, avance_id)
+    SELECT user_id, 'avance_automatico', id
+    FROM registrados
+"""
+
+async def avanzar_lote_vencido() -> int:
+    """Avanzar en una transacción hasta AVANCE_LOTE planes cuyo aniversario ya pasó.
+
+    El aniversario es fecha_ultimo_pago (o fecha_inicio) + 7 días y se corre
+    exactamente las semanas vencidas, así que repetir la revisión tras un
+    reinicio no vuelve a avanzar el mismo plan. El tiempo en pausa no cuenta:
+    REANUDAR_CONTADOR corre fecha_ultimo_pago lo que duró la pausa.
+    FOR UPDATE SKIP LOCKED deja que varias réplicas revisen a la vez sin
+    tomar los mismos planes. Devuelve cuántos planes avanzó; sus avisos
+    quedan en la bandeja de salida.
+    """
+    run_id = f"auto-{uuid.uuid4().hex}"
+    async with db_connection() as conn:
         cursor = conn.cursor()
+        await cursor.execute(CONSULTA_AVANCE_VENCIDO, (AVANCE_LOTE, run_id))
+        return cursor.rowcount
+
+async def avance_automatico(context: ContextTypes.DEFAULT_TYPE):
+    """Tarea del JobQueue: avanzar por lotes los planes vencidos; los avisos
+    de cada lote los envía despachar_notificaciones al ritmo del limitador"""
+    if not await configuracion_pagos.contador_activo():
+        logger.info("⏸️ Avance automático omitido: contador global desactivado")
+        return
+    
+    total = 0
+    while True:
+        try:
+            avanzados = await avanzar_lote_vencido()
+        except Exception as e:
+            logger.error(f"❌ Error en el avance automático: {e}")
+            return
+        if not avanzados:
+            break
         
-        cursor.execute("""
-            SELECT user_id, semanas_completadas, semanas 
-            FROM planes_pago 
-            WHERE estado = 'activo' 
-            AND contador_pausado = FALSE
-        """)
-        planes = cursor.fetchall()
-        
-        for user_id, semanas_comp, semanas_tot in planes:
-            try:
-                if semanas_comp >= semanas_tot:
-                    # Plan completado
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="🎉 **¡PLAN COMPLETADO!**\n\n"
-                             f"✅ Has terminado las {semanas_tot} semanas.\n\n"
-                             "📞 Contacta al administrador."
-                    )
-                else:
-                    # Avance normal
-                    mensaje = "📅 **AVANCE DE SEMANA**\n\n" if tipo == "manual" else "📅 **AVANCE AUTOMÁTICO**\n\n"
-                    mensaje += f"✅ Tu plan ha avanzado a la semana {semanas_comp}/{semanas_tot}\n\n"
-                    mensaje += "💳 Recuerda realizar tu pago semanal.\n"
-                    mensaje += "📋 Ver progreso: /misplanes"
-                    
-                    await context.bot.send_message(chat_id=user_id, text=mensaje)
-            except Exception as e:
-                print(f"❌ No se pudo notificar a usuario {user_id}: {e}")
+        total += avanzados
+        despertar_notificaciones()
         
-        conn.close()
+        if avanzados < AVANCE_LOTE:
+            break
+        await asyncio.sleep(AVANCE_PAUSA_LOTES)
+    
+    if total:
+        logger.info("📅 Avance automático: %d planes avanzados", total)
+
+def programar_avance_automatico(application: Application):
+    """Registrar la revisión periódica en el JobQueue de la aplicación"""
+    application.job_queue.run_repeating(
+        avance_automatico,
+        interval=AVANCE_INTERVALO,
+        first=60,
+        name="avance_automatico",
+        # Nunca dos revisiones a la vez en este proceso; las atrasadas se juntan en una
+        job_kwargs={'max_instances': 1, 'coalesce': True},
+    )
+    logger.info(f"📅 Avance automático cada {AVANCE_INTERVALO:.0f}s (lotes de {AVANCE_LOTE})")
+
+# =============================================
+# 🗃️ PARTICIONES MENSUALES Y ARCHIVO
+# =============================================
+
+# pagos y puntos_historial están particionadas por mes de `fecha` (migración
+# 15). Las consultas frecuentes solo recorren las particiones adjuntas; las
+# de más de N meses se separan y pasan al esquema `archivo`, donde siguen
+# consultables junto con las activas en la vista archivo.<tabla>_completo.
+# 0 meses = no archivar esa tabla.
+MESES_ACTIVOS = {
+    'pagos': int(os.getenv('PAGOS_MESES_ACTIVOS', '24')),
+    'puntos_historial': int(os.getenv('HISTORIAL_MESES_ACTIVOS', '12')),
+}
+PARTICIONES_ADELANTO = 3  # meses futuros con su partición ya creada
+ARCHIVO_TABLESPACE = os.getenv('ARCHIVO_TABLESPACE')  # p. ej. un disco más barato
+ARCHIVO_INTERVALO = float(os.getenv('ARCHIVO_INTERVALO', str(24 * 3600)))  # segundos
+PARTICIONES_LOCK_ID = 7_424_002  # una sola réplica mantiene las particiones a la vez
+
+async def mantener_particiones() -> list:
+    """Crear las particiones de los próximos meses, vaciar la partición por
+    defecto y archivar las vencidas. Devuelve los nombres de las particiones
+    archivadas."""
+    archivadas = []
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (PARTICIONES_LOCK_ID,))
+        if not (await cursor.fetchone())[0]:
+            return archivadas
+        
+        for tabla, meses in MESES_ACTIVOS.items():
+            await cursor.execute(
+                "SELECT crear_particiones_mensuales(%s, CURRENT_DATE, (CURRENT_DATE + %s * INTERVAL '1 month')::date)",
+                (tabla, PARTICIONES_ADELANTO)
+            )
+            creadas = (await cursor.fetchone())[0]
+            if creadas:
+                logger.info(f"🗃️ {creadas} partición(es) nuevas en {tabla}")
+            reubicadas = await reubicar_default(cursor, tabla)
+            if reubicadas:
+                logger.info(f"🗃️ {reubicadas} fila(s) de {tabla}_default pasadas a su partición mensual")
+            if meses <= 0:
+                continue
+            
+            # Particiones <tabla>_AAAA_MM cuyo mes quedó fuera de la ventana activa
+            await cursor.execute("""
+                SELECT c.relname
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = %s::regclass
+                AND c.relname ~ %s
+                AND to_date(right(c.relname, 7), 'YYYY_MM')
+                    < date_trunc('month', CURRENT_DATE) - %s * INTERVAL '1 month'
+                ORDER BY c.relname
+            """, (tabla, rf'^{tabla}_\d{{4}}_\d{{2}}$', meses))
+            for (particion,) in await cursor.fetchall():
+                await cursor.execute(f'ALTER TABLE {tabla} DETACH PARTITION "{particion}"')
+                await cursor.execute(f'ALTER TABLE "{particion}" SET SCHEMA archivo')
+                if ARCHIVO_TABLESPACE:
+                    await cursor.execute(f'ALTER TABLE archivo."{particion}" SET TABLESPACE "{ARCHIVO_TABLESPACE}"')
+                archivadas.append(particion)
+            
+        for tabla in MESES_ACTIVOS:
+            await rehacer_vista_completa(cursor, tabla)
+    
+    if archivadas:
+        logger.info(f"📦 Particiones archivadas: {', '.join(archivadas)}")
+    return archivadas
+
+async def reubicar_default(cursor, tabla: str) -> int:
+    """Pasar las filas de <tabla>_default a particiones mensuales (creándolas)
+    y devolver cuántas se movieron.
+
+    Con filas en la partición por defecto el planner ya no puede leer las
+    particiones en orden (Append ordenado), y la paginación por keyset de
+    pagos vuelve a ordenar todo. Las filas de meses ya archivados se quedan
+    en el default: su partición está en el esquema archivo."""
+    await cursor.execute(f"SELECT MIN(fecha)::date, MAX(fecha)::date FROM {tabla}_default")
+    desde, hasta = await cursor.fetchone()
+    corte = await corte_archivo(cursor, tabla)
+    if desde is None or (corte and hasta < corte):
+        return 0
+    
+    # No se puede crear una partición con filas de su rango en el default:
+    # se separa el default mientras tanto (la transacción bloquea la tabla)
+    await cursor.execute(f"ALTER TABLE {tabla} DETACH PARTITION {tabla}_default")
+    await cursor.execute(
+        "SELECT crear_particiones_mensuales(%s, %s, %s)",
+        (tabla, max(desde, corte) if corte else desde, hasta)
+    )
+    await cursor.execute(f"""
+        WITH movidas AS (
+            DELETE FROM {tabla}_default
+            WHERE fecha >= COALESCE(%s::timestamp, '-infinity')
+            RETURNING *
+        )
+        INSERT INTO {tabla} SELECT * FROM movidas
+    """, (corte,))
+    movidas = cursor.rowcount
+    await cursor.execute(f"ALTER TABLE {tabla} ATTACH PARTITION {tabla}_default DEFAULT")
+    return movidas
+
+async def rehacer_vista_completa(cursor, tabla: str):
+    """Vista archivo.<tabla>_completo: las particiones activas más las
+    archivadas, con las columnas actuales de la tabla nombradas una a una.
+    Una columna agregada después de archivar un mes sale como NULL en ese
+    mes en vez de romper el UNION ALL."""
+    await cursor.execute("""
+        SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+    """, (tabla,))
+    columnas = await cursor.fetchall()
+    await cursor.execute("""
+        SELECT c.relname, array_agg(a.attname::text)
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        WHERE n.nspname = 'archivo' AND c.relkind = 'r' AND c.relname ~ %s
+        GROUP BY c.relname
+        ORDER BY c.relname
+    """, (rf'^{tabla}_\d{{4}}_\d{{2}}$',))
+    archivadas = await cursor.fetchall()
+    
+    lista = ', '.join(f'"{nombre}"' for nombre, _ in columnas)
+    partes = [f"SELECT {lista} FROM {tabla}"]
+    for particion, presentes in archivadas:
+        seleccion = ', '.join(
+            f'"{nombre}"' if nombre in presentes else f'NULL::{tipo} AS "{nombre}"'
+            for nombre, tipo in columnas
+        )
+        partes.append(f'SELECT {seleccion} FROM archivo."{particion}"')
+    # DROP + CREATE: CREATE OR REPLACE no admite quitar ni reordenar columnas
+    await cursor.execute(f'DROP VIEW IF EXISTS archivo."{tabla}_completo"')
+    await cursor.execute(f'CREATE VIEW archivo."{tabla}_completo" AS ' + " UNION ALL ".join(partes))
+
+async def archivo_automatico(context: ContextTypes.DEFAULT_TYPE):
+    """Tarea del JobQueue: mantener particiones y archivo"""
+    try:
+        await mantener_particiones()
     except Exception as e:
-        print(f"❌ Error en notificación: {e}")
+        logger.error(f"❌ Error al mantener las particiones: {e}")
+
+def programar_archivo(application: Application):
+    """Registrar el mantenimiento de particiones en el JobQueue (primera vez al arrancar)"""
+    application.job_queue.run_repeating(
+        archivo_automatico,
+        interval=ARCHIVO_INTERVALO,
+        first=5,
+        name="archivo_particiones",
+        job_kwargs={'max_instances': 1, 'coalesce': True},
+    )
+
+async def corte_archivo(cursor, tabla: str):
+    """Primer día que sigue en las particiones activas de `tabla`, o None si
+    todavía no se archivó nada (lo anterior solo está en el esquema archivo)"""
+    await cursor.execute("""
+        SELECT (MAX(to_date(right(c.relname, 7), 'YYYY_MM')) + INTERVAL '1 month')::date
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'archivo' AND c.relkind = 'r' AND c.relname ~ %s
+    """, (rf'^{tabla}_\d{{4}}_\d{{2}}$',))
+    return (await cursor.fetchone())[0]
+
+async def filas_estimadas(cursor, tabla: str) -> int:
+    """Filas de una tabla (y sus particiones) según las estadísticas de
+    Postgres, sin recorrerla con COUNT(*)"""
+    await cursor.execute("""
+        SELECT COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)::BIGINT
+        FROM pg_class c
+        WHERE c.oid = %s::regclass
+        OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)
+    """, (tabla, tabla))
+    return (await cursor.fetchone())[0]
+
 # =============================================
 # 🆕 MODIFICACIONES A FUNCIONES EXISTENTES
 # =============================================
@@ -1748,15 +3726,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     codigo_referido = args[0] if args else None
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    # Verificar si el usuario ya existe
-    cursor.execute("SELECT * FROM usuarios WHERE user_id = %s", (user_id,))
-    usuario_existente = cursor.fetchone()
+        # Verificar si el usuario ya existe
+        await cursor.execute("SELECT * FROM usuarios WHERE user_id = %s", (user_id,))
+        usuario_existente = await cursor.fetchone()
     
     if usuario_existente:
-        conn.close()
         await update.message.reply_text(
             f"👋 ¡Hola de nuevo {first_name}!\n\n"
             f"Ya estás registrado en el sistema.\n\n"
@@ -1769,15 +3746,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     else:
         # Proceso de registro nuevo
-        context.user_data['registrando_usuario'] = True
-        context.user_data['datos_usuario'] = {
+        fijar_estado(context, EstadoChat.REGISTRANDO_USUARIO, datos_usuario={
             'user_id': user_id,
             'user_name': user_name,
             'first_name': first_name,
             'last_name': last_name,
             'codigo_referido': codigo_referido  # 🆕 Guardar código de referido
-        }
-        conn.close()
+        })
         
         keyboard = [
             [InlineKeyboardButton("📱 Compartir teléfono", callback_data="compartir_telefono")]
@@ -1793,11 +3768,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 if codigo_referido.startswith('REF'):
                     referidor_id = int(codigo_referido[3:])
-                    conn_temp = get_db_connection()
-                    cursor_temp = conn_temp.cursor()
-                    cursor_temp.execute("SELECT first_name FROM usuarios WHERE user_id = %s", (referidor_id,))
-                    referidor = cursor_temp.fetchone()
-                    conn_temp.close()
+                    async with db_connection() as conn_temp:
+                        cursor_temp = conn_temp.cursor()
+                        await cursor_temp.execute("SELECT first_name FROM usuarios WHERE user_id = %s", (referidor_id,))
+                        referidor = await cursor_temp.fetchone()
                     
                     if referidor:
                         mensaje_bienvenida += f"\nTe está refiriendo: {referidor[0]}"
@@ -1810,55 +3784,54 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_phone_registration(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja el registro del teléfono del usuario - ACTUALIZADO CON SISTEMA DE REFERIDOS"""
-    if not context.user_data.get('registrando_usuario'):
+    estado, datos_estado = obtener_estado(context)
+    if estado != EstadoChat.REGISTRANDO_USUARIO:
         return
-    
+
     # Si el usuario presionó el botón de compartir teléfono
     if update.message.contact:
         phone = update.message.contact.phone_number
     else:
         # Si el usuario escribió el teléfono manualmente
         phone = update.message.text.strip()
-    
-    datos_usuario = context.user_data['datos_usuario']
+
+    datos_usuario = datos_estado['datos_usuario']
     codigo_referido = datos_usuario.get('codigo_referido')
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Registrar usuario
-        cursor.execute(
-            "INSERT INTO usuarios (user_id, user_name, first_name, last_name, phone) VALUES (%s, %s, %s, %s, %s)",
-            (datos_usuario['user_id'], datos_usuario['user_name'], datos_usuario['first_name'], 
-             datos_usuario['last_name'], phone)
-        )
+            # Registrar usuario
+            await cursor.execute(
+                "INSERT INTO usuarios (user_id, user_name, first_name, last_name, phone) VALUES (%s, %s, %s, %s, %s)",
+                (datos_usuario['user_id'], datos_usuario['user_name'], datos_usuario['first_name'], 
+                 datos_usuario['last_name'], phone)
+            )
         
-        # 🆕 Procesar referido si existe código
-        if codigo_referido and codigo_referido.startswith('REF'):
-            try:
-                referidor_id = int(codigo_referido[3:])
+            # 🆕 Procesar referido si existe código
+            if codigo_referido and codigo_referido.startswith('REF'):
+                try:
+                    referidor_id = int(codigo_referido[3:])
                 
-                # Verificar que el referidor existe
-                cursor.execute("SELECT first_name FROM usuarios WHERE user_id = %s", (referidor_id,))
-                referidor = cursor.fetchone()
+                    # Verificar que el referidor existe
+                    await cursor.execute("SELECT first_name FROM usuarios WHERE user_id = %s", (referidor_id,))
+                    referidor = await cursor.fetchone()
                 
-                if referidor:
-                    # Registrar referido
-                    cursor.execute("""
-                        INSERT INTO referidos (user_id_referidor, user_id_referido, nombre_referido, telefono_referido)
-                        VALUES (%s, %s, %s, %s)
-                    """, (referidor_id, datos_usuario['user_id'], datos_usuario['first_name'], phone))
+                    if referidor:
+                        # Registrar referido
+                        await cursor.execute("""
+                            INSERT INTO referidos (user_id_referidor, user_id_referido, nombre_referido, telefono_referido)
+                            VALUES (%s, %s, %s, %s)
+                        """, (referidor_id, datos_usuario['user_id'], datos_usuario['first_name'], phone))
                     
-                    print(f"✅ Referido registrado: {referidor_id} -> {datos_usuario['user_id']}")
-            except Exception as e:
-                print(f"❌ Error al procesar referido: {e}")
+                        logger.info(f"✅ Referido registrado: {referidor_id} -> {datos_usuario['user_id']}")
+                except Exception as e:
+                    logger.error(f"❌ Error al procesar referido: {e}")
         
-        conn.commit()
-        conn.close()
+            await conn.commit()
         
-        context.user_data['registrando_usuario'] = False
-        context.user_data['datos_usuario'] = None
+        limpiar_estado(context)
         
         mensaje_exito = (
             f"✅ **¡Registro completado!** 🎉\n\n"
@@ -1884,43 +3857,43 @@ async def handle_phone_registration(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text(mensaje_exito)
         
     except Exception as e:
-        print(f"❌ Error en registro: {e}")
+        logger.error(f"❌ Error en registro: {e}")
         await update.message.reply_text("❌ Error en el registro. Intenta nuevamente.")
 
+CONSULTA_REFERIDOS_APROBADOS = "SELECT COUNT(*) FROM referidos WHERE user_id_referidor = %s AND estado = 'aprobado'"
+
 async def miperfil(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra el perfil del usuario - ACTUALIZADO CON PUNTOS"""
     user_id = update.effective_user.id
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT first_name, last_name, user_name, phone, fecha_registro FROM usuarios WHERE user_id = %s", (user_id,))
-    usuario = cursor.fetchone()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("SELECT first_name, last_name, user_name, phone, fecha_registro FROM usuarios WHERE user_id = %s", (user_id,))
+        usuario = await cursor.fetchone()
     
-    if not usuario:
-        await update.message.reply_text("❌ Debes registrarte con /start primero")
-        conn.close()
-        return
+        if not usuario:
+            await update.message.reply_text("❌ Debes registrarte con /start primero")
+            return
     
-    first_name, last_name, user_name, phone, fecha_registro = usuario
+        first_name, last_name, user_name, phone, fecha_registro = usuario
     
-    # Contar planes activos
-    cursor.execute("SELECT COUNT(*) FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
-    planes_activos = cursor.fetchone()[0]
+        # Contar planes activos
+        await cursor.execute("SELECT COUNT(*) FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
+        planes_activos = (await cursor.fetchone())[0]
     
-    # Contar pagos realizados
-    cursor.execute("SELECT COUNT(*) FROM pagos WHERE user_id = %s", (user_id,))
-    total_pagos = cursor.fetchone()[0]
+        # Contar pagos realizados
+        await cursor.execute("SELECT COUNT(*) FROM pagos WHERE user_id = %s", (user_id,))
+        total_pagos = (await cursor.fetchone())[0]
     
-    # 🆕 Obtener puntos
-    cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-    puntos_result = cursor.fetchone()
-    puntos_actuales = puntos_result[0] if puntos_result else 0
+        # 🆕 Obtener puntos
+        await cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
+        puntos_result = await cursor.fetchone()
+        puntos_actuales = puntos_result[0] if puntos_result else 0
     
-    # 🆕 Contar referidos aprobados
-    cursor.execute("SELECT COUNT(*) FROM referidos WHERE user_id_referidor = %s AND estado = 'aprobado'", (user_id,))
-    referidos_aprobados = cursor.fetchone()[0]
+        # 🆕 Contar referidos aprobados
+        await cursor.execute(CONSULTA_REFERIDOS_APROBADOS, (user_id,))
+        referidos_aprobados = (await cursor.fetchone())[0]
     
-    conn.close()
     
     mensaje = (
         f"👤 **TU PERFIL**\n\n"
@@ -1953,35 +3926,54 @@ async def confirmar_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         pago_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Obtener información del pago
-        cursor.execute("SELECT user_id, monto, fecha, referencia FROM pagos WHERE id = %s", (pago_id,))
-        pago_info = cursor.fetchone()
+            # Obtener información del pago
+            await cursor.execute("SELECT user_id, monto, fecha, referencia FROM pagos WHERE id = %s", (pago_id,))
+            pago_info = await cursor.fetchone()
         
-        if not pago_info:
-            await update.message.reply_text("❌ Pago no encontrado")
-            conn.close()
-            return
+            if not pago_info:
+                await update.message.reply_text("❌ Pago no encontrado")
+                return
         
-        user_id, monto, fecha_pago, referencia = pago_info
+            user_id, monto, fecha_pago, referencia = pago_info
         
-        # Actualizar estado del pago a "aprobado" INMEDIATAMENTE
-        cursor.execute("UPDATE pagos SET estado = 'aprobado' WHERE id = %s", (pago_id,))
-        conn.commit()
+            # Formatear fecha para mostrar
+            if isinstance(fecha_pago, str):
+                fecha_mostrar = fecha_pago[:10]  # Tomar solo la parte de fecha
+            else:
+                fecha_mostrar = fecha_pago.strftime('%d/%m/%Y')
         
-        # Obtener información del usuario para mostrar
-        cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-        usuario_info = cursor.fetchone()
+            # Actualizar estado del pago a "aprobado" INMEDIATAMENTE
+            await cursor.execute("UPDATE pagos SET estado = 'aprobado' WHERE id = %s", (pago_id,))
         
-        if usuario_info:
-            first_name, last_name = usuario_info
-            nombre_usuario = f"{first_name or ''} {last_name or ''}".strip()
-        else:
-            nombre_usuario = f"Usuario {user_id}"
+            # Notificar al usuario que su pago fue aprobado (sin puntos todavía)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"✅ **¡Tu pago ha sido aprobado!**\n\n"
+                f"📄 **ID Pago:** {pago_id}\n"
+                f"💰 **Monto:** ${float(monto):.2f}\n"
+                f"🔢 **Referencia:** {referencia}\n"
+                f"📅 **Fecha:** {fecha_mostrar}\n\n"
+                f"📋 **Estado:** Aprobado\n"
+                f"⭐ **Puntos:** Pendientes de asignación\n\n"
+                f"El administrador asignará los puntos correspondientes.",
+                'pago_aprobado'
+            )
+            await conn.commit()
+        
+            # Obtener información del usuario para mostrar
+            await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+            usuario_info = await cursor.fetchone()
+        
+            if usuario_info:
+                first_name, last_name = usuario_info
+                nombre_usuario = f"{first_name or ''} {last_name or ''}".strip()
+            else:
+                nombre_usuario = f"Usuario {user_id}"
         
-        conn.close()
+        despertar_notificaciones()
         
         # Guardar información del pago en context para usarla después
         context.user_data[f'pago_aprobado_{pago_id}'] = {
@@ -1994,12 +3986,6 @@ async def confirmar_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'admin_id': update.effective_user.id
         }
         
-        # Formatear fecha para mostrar
-        if isinstance(fecha_pago, str):
-            fecha_mostrar = fecha_pago[:10]  # Tomar solo la parte de fecha
-        else:
-            fecha_mostrar = fecha_pago.strftime('%d/%m/%Y')
-        
         # Mostrar mensaje de confirmación con botones para asignar puntos
         mensaje = (
             f"✅ **PAGO APROBADO**\n\n"
@@ -2023,32 +4009,14 @@ async def confirmar_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
              InlineKeyboardButton("2 Puntos", callback_data=f"puntos_2_{pago_id}"),
              InlineKeyboardButton("5 Puntos", callback_data=f"puntos_5_{pago_id}")],
             [InlineKeyboardButton("✏️ Personalizado", callback_data=f"puntos_personalizado_{pago_id}")],
-            [InlineKeyboardButton("❌ Saltar asignación", callback_data=f"puntos_saltar_{pago_id}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(mensaje, reply_markup=reply_markup)
-        
-        # Notificar al usuario que su pago fue aprobado (sin puntos todavía)
-        try:
-            mensaje_usuario = (
-                f"✅ **¡Tu pago ha sido aprobado!**\n\n"
-                f"📄 **ID Pago:** {pago_id}\n"
-                f"💰 **Monto:** ${float(monto):.2f}\n"
-                f"🔢 **Referencia:** {referencia}\n"
-                f"📅 **Fecha:** {fecha_mostrar}\n\n"
-                f"📋 **Estado:** Aprobado\n"
-                f"⭐ **Puntos:** Pendientes de asignación\n\n"
-                f"El administrador asignará los puntos correspondientes."
-            )
-            
-            await context.bot.send_message(chat_id=user_id, text=mensaje_usuario)
-            
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
+            [InlineKeyboardButton("❌ Saltar asignación", callback_data=f"puntos_saltar_{pago_id}")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await update.message.reply_text(mensaje, reply_markup=reply_markup)
         
     except Exception as e:
-        print(f"❌ Error en confirmar_pago: {e}")
+        logger.error(f"❌ Error en confirmar_pago: {e}")
         await update.message.reply_text("❌ Error al confirmar el pago")
 
 # =============================================
@@ -2065,7 +4033,7 @@ async def handle_asignacion_puntos(update: Update, context: ContextTypes.DEFAULT
         return
     
     data = query.data
-    print(f"🟡 BOTÓN PUNTOS: {data}")
+    logger.debug("Botón de puntos: %s", data)
     
     # Extraer información del callback_data
     # Formato: puntos_0_123, puntos_2_123, puntos_personalizado_123, puntos_saltar_123
@@ -2100,7 +4068,7 @@ async def handle_asignacion_puntos(update: Update, context: ContextTypes.DEFAULT
     
     elif accion == 'personalizado':
         # Pedir al admin que ingrese la cantidad personalizada
-        context.user_data[f'esperando_puntos_personalizado_{pago_id}'] = pago_info
+        fijar_estado(context, EstadoChat.PUNTOS_PERSONALIZADOS, pago_id=pago_id)
         
         await query.edit_message_text(
             f"✏️ **ASIGNAR PUNTOS PERSONALIZADOS**\n\n"
@@ -2118,17 +4086,34 @@ async def handle_asignacion_puntos(update: Update, context: ContextTypes.DEFAULT
         
         # Asignar los puntos usando la función existente
         descripcion = f"Puntos por pago aprobado #{pago_id} - ${float(monto):.2f}"
-        success = await agregar_puntos(user_id, puntos, "pago_manual", descripcion)
+        try:
+            async with db_connection() as conn:
+                saldo = await agregar_puntos(user_id, puntos, "pago_manual", descripcion, conn=conn)
+                
+                if saldo:
+                    # El saldo nuevo viene de agregar_puntos, sin otra consulta
+                    cursor = conn.cursor()
+                    puntos_totales = saldo[1]
+                    
+                    # Notificar al usuario (bandeja de salida, misma transacción)
+                    await encolar_notificacion(
+                        cursor, user_id,
+                        f"⭐ **¡Has recibido puntos por tu pago!**\n\n"
+                        f"💰 **Pago:** ${float(monto):.2f}\n"
+                        f"🔢 **Referencia:** {referencia}\n"
+                        f"✅ **Estado:** Aprobado\n\n"
+                        f"🎁 **Puntos recibidos:** +{puntos}\n"
+                        f"🏆 **Total puntos:** {puntos_totales}\n"
+                        f"📝 **Motivo:** Pago verificado por administrador\n\n"
+                        f"Ver tus puntos: /mispuntos",
+                        'puntos_pago'
+                    )
+        except Exception:
+            # agregar_puntos ya registró el error; la transacción se deshizo entera
+            saldo = None
         
-        if success:
-            # Obtener puntos actuales del usuario para mostrar
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-            puntos_actuales = cursor.fetchone()
-            conn.close()
-            
-            puntos_totales = puntos_actuales[0] if puntos_actuales else puntos
+        if saldo:
+            despertar_notificaciones()
             
             mensaje_exito = (
                 f"✅ **Puntos asignados correctamente**\n\n"
@@ -2138,32 +4123,11 @@ async def handle_asignacion_puntos(update: Update, context: ContextTypes.DEFAULT
                 f"⭐ **Puntos otorgados:** +{puntos}\n"
                 f"🏆 **Puntos actuales:** {puntos_totales}\n"
                 f"📝 **Razón:** Pago aprobado manualmente\n\n"
-                f"📨 El usuario ha sido notificado."
+                f"📣 El usuario será notificado."
             )
             
             await query.edit_message_text(mensaje_exito)
             
-            # Notificar al usuario
-            try:
-                mensaje_usuario = (
-                    f"⭐ **¡Has recibido puntos por tu pago!**\n\n"
-                    f"💰 **Pago:** ${float(monto):.2f}\n"
-                    f"🔢 **Referencia:** {referencia}\n"
-                    f"✅ **Estado:** Aprobado\n\n"
-                    f"🎁 **Puntos recibidos:** +{puntos}\n"
-                    f"🏆 **Total puntos:** {puntos_totales}\n"
-                    f"📝 **Motivo:** Pago verificado por administrador\n\n"
-                    f"Ver tus puntos: /mispuntos"
-                )
-                
-                await context.bot.send_message(chat_id=user_id, text=mensaje_usuario)
-                
-                # Verificar si alcanzó algún beneficio
-                await verificar_beneficios_puntos(user_id)
-                
-            except Exception as e:
-                print(f"❌ No se pudo notificar al usuario: {e}")
-            
         else:
             await query.edit_message_text("❌ Error al asignar puntos. Intenta nuevamente.")
         
@@ -2181,26 +4145,12 @@ async def handle_puntos_personalizados(update: Update, context: ContextTypes.DEF
         return  # No es admin, ignorar
     
     # Verificar si hay solicitud pendiente
-    tiene_solicitud = False
-    for key in context.user_data.keys():
-        if key.startswith('esperando_puntos_personalizado_'):
-            tiene_solicitud = True
-            break
-    
-    if not tiene_solicitud:
+    estado, datos_estado = obtener_estado(context)
+    if estado != EstadoChat.PUNTOS_PERSONALIZADOS:
         return  # No hay solicitud, pasar al siguiente handler
-    
-    # Buscar si hay alguna solicitud pendiente de puntos personalizados
-    pago_id = None
-    for key in context.user_data.keys():
-        if key.startswith('esperando_puntos_personalizado_'):
-            pago_id = key.split('_')[-1]
-            break
-    
-    if not pago_id:
-        await update.message.reply_text("❌ No hay solicitud pendiente de puntos personalizados")
-        return
-    
+
+    pago_id = datos_estado['pago_id']
+
     try:
         puntos = int(update.message.text.strip())
         
@@ -2238,17 +4188,32 @@ async def handle_puntos_personalizados(update: Update, context: ContextTypes.DEF
         
         # Asignar puntos
         descripcion = f"Puntos personalizados por pago #{pago_id} - ${float(monto):.2f}"
-        success = await agregar_puntos(user_id_pago, puntos, "pago_manual", descripcion)
+        try:
+            async with db_connection() as conn:
+                saldo = await agregar_puntos(user_id_pago, puntos, "pago_manual", descripcion, conn=conn)
+                
+                if saldo:
+                    # El saldo nuevo viene de agregar_puntos, sin otra consulta
+                    cursor = conn.cursor()
+                    puntos_totales = saldo[1]
+                    
+                    # Notificar al usuario (bandeja de salida, misma transacción)
+                    await encolar_notificacion(
+                        cursor, user_id_pago,
+                        f"⭐ **¡Has recibido puntos personalizados!**\n\n"
+                        f"💰 **Pago:** ${float(monto):.2f}\n"
+                        f"🎁 **Puntos recibidos:** +{puntos}\n"
+                        f"🏆 **Total puntos:** {puntos_totales}\n"
+                        f"📝 **Motivo:** Asignación especial por administrador\n\n"
+                        f"Ver tus puntos: /mispuntos",
+                        'puntos_pago'
+                    )
+        except Exception:
+            # agregar_puntos ya registró el error; la transacción se deshizo entera
+            saldo = None
         
-        if success:
-            # Obtener puntos actuales
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT puntos_disponibles FROM usuarios_puntos WHERE user_id = %s", (user_id_pago,))
-            puntos_actuales = cursor.fetchone()
-            conn.close()
-            
-            puntos_totales = puntos_actuales[0] if puntos_actuales else puntos
+        if saldo:
+            despertar_notificaciones()
             
             mensaje_exito = (
                 f"✅ **Puntos personalizados asignados**\n\n"
@@ -2257,33 +4222,14 @@ async def handle_puntos_personalizados(update: Update, context: ContextTypes.DEF
                 f"⭐ **Puntos otorgados:** +{puntos}\n"
                 f"🏆 **Puntos actuales:** {puntos_totales}\n"
                 f"📝 **Razón:** Asignación manual por admin\n\n"
-                f"📨 El usuario ha sido notificado."
+                f"📣 El usuario será notificado."
             )
             
             await update.message.reply_text(mensaje_exito)
             
-            # Notificar al usuario
-            try:
-                mensaje_usuario = (
-                    f"⭐ **¡Has recibido puntos personalizados!**\n\n"
-                    f"💰 **Pago:** ${float(monto):.2f}\n"
-                    f"🎁 **Puntos recibidos:** +{puntos}\n"
-                    f"🏆 **Total puntos:** {puntos_totales}\n"
-                    f"📝 **Motivo:** Asignación especial por administrador\n\n"
-                    f"Ver tus puntos: /mispuntos"
-                )
-                
-                await context.bot.send_message(chat_id=user_id_pago, text=mensaje_usuario)
-                
-                # Verificar beneficios
-                await verificar_beneficios_puntos(user_id_pago)
-                
-            except Exception as e:
-                print(f"❌ No se pudo notificar al usuario: {e}")
-            
             # Limpiar datos temporales
             del context.user_data[pago_key]
-            del context.user_data[f'esperando_puntos_personalizado_{pago_id}']
+            limpiar_estado(context)
             
         else:
             await update.message.reply_text("❌ Error al asignar puntos")
@@ -2300,7 +4246,7 @@ async def button_handler_puntos(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = query.from_user.id
     data = query.data
     
-    print(f"🟡 BOTÓN PUNTOS: {data}")
+    logger.debug("Botón de puntos: %s", data)
     
     if data == "compartir_codigo":
         # Crear código de referido
@@ -2344,39 +4290,33 @@ async def asignar_productos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        # Productos activos desde la caché del catálogo
+        productos = await catalogo_cache.activos_por_nombre()
         
-        # Obtener información del usuario
-        cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-        usuario = cursor.fetchone()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        if not usuario:
-            await update.message.reply_text("❌ Usuario no encontrado")
-            conn.close()
-            return
-            
-        first_name, last_name = usuario
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            # Obtener información del usuario
+            await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+            usuario = await cursor.fetchone()
         
-        # Obtener productos activos
-        cursor.execute("SELECT id, nombre, precio, descripcion FROM productos WHERE estado = 'activo' ORDER BY nombre")
-        productos = cursor.fetchall()
+            if not usuario:
+                await update.message.reply_text("❌ Usuario no encontrado")
+                return
+            
+            first_name, last_name = usuario
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Obtener plan actual del usuario (si existe)
-        cursor.execute("SELECT productos_json FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
-        plan_actual = cursor.fetchone()
+            # Obtener plan actual del usuario (si existe)
+            await cursor.execute("SELECT productos_json FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
+            plan_actual = await cursor.fetchone()
         
-        productos_actuales = {}
-        if plan_actual and plan_actual[0]:
-            productos_actuales = plan_actual[0] if isinstance(plan_actual[0], dict) else json.loads(plan_actual[0])
+            productos_actuales = {}
+            if plan_actual and plan_actual[0]:
+                productos_actuales = plan_actual[0] if isinstance(plan_actual[0], dict) else json.loads(plan_actual[0])
         
-        # Obtener configuración de semanas ANTES de cerrar la conexión
-        cursor.execute("SELECT semanas FROM config_pagos LIMIT 1")
-        config = cursor.fetchone()
-        semanas = config[0] if config else 10
         
-        conn.close()  # ✅ Cerrar conexión aquí, después de obtener TODOS los datos
+        semanas = await configuracion_pagos.semanas()
         
         if not productos:
             await update.message.reply_text("❌ No hay productos disponibles en el catálogo")
@@ -2428,132 +4368,128 @@ async def asignar_productos(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(mensaje, reply_markup=reply_markup)
         
     except Exception as e:
-        print(f"❌ Error en asignar_productos: {e}")
+        logger.error(f"❌ Error en asignar_productos: {e}")
         await update.message.reply_text("❌ Error al procesar la asignación")
 
-async def ver_asignaciones(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Ver todas las asignaciones activas (solo admin)"""
-    if not is_admin(update.effective_user.id):  # ← ACTUALIZADO
-        await update.message.reply_text("❌ No tienes permisos de administrador")
-        return
-        
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Obtener todas las asignaciones activas
-    cursor.execute("""
-        SELECT p.user_id, u.first_name, u.last_name, p.productos_json, p.total, p.pago_semanal, p.semanas_completadas, p.semanas
-        FROM planes_pago p
-        LEFT JOIN usuarios u ON p.user_id = u.user_id
-        WHERE p.estado = 'activo'
-        ORDER BY u.first_name
-    """)
-    asignaciones = cursor.fetchall()
-    
-    # Obtener configuración
-    cursor.execute("SELECT semanas FROM config_pagos LIMIT 1")
-    config = cursor.fetchone()
-    semanas_config = config[0] if config else 10
-    
-    conn.close()
+def formatear_asignacion(fila, posicion: int) -> str:
+    user_id, first_name, last_name, total, pago_semanal, semanas_comp, semanas, productos = fila[:8]
+    nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
     
-    if not asignaciones:
-        await update.message.reply_text("📭 No hay asignaciones activas en el sistema")
-        return
+    entrada = f"👤 **{nombre_completo}** (ID: {user_id})\n"
     
-    # Calcular totales generales
-    total_general = 0
-    pago_semanal_total = 0
+    # Mostrar productos asignados
+    for nombre_producto, precio_producto, cantidad in productos:
+        entrada += f"   🛍️ {nombre_producto} x{cantidad} - ${precio_producto * cantidad:.2f}\n"
     
-    mensaje = "📊 **ASIGNACIONES ACTIVAS - ADMIN**\n\n"
+    entrada += f"   💰 **Total:** ${total:.2f}\n"
+    entrada += f"   💳 **Pago semanal:** ${pago_semanal:.2f}\n"
+    entrada += f"   📅 **Progreso:** {semanas_comp}/{semanas} semanas\n"
+    entrada += f"   ✏️ /asignar_{user_id}\n"
+    entrada += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    return entrada
+
+async def resumen_asignaciones() -> str:
+    semanas_config = await configuracion_pagos.semanas()
     
-    for user_id, first_name, last_name, productos_json, total, pago_semanal, semanas_comp, semanas in asignaciones:
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
-        
-        total_general += total
-        pago_semanal_total += pago_semanal
-        
-        mensaje += f"👤 **{nombre_completo}** (ID: {user_id})\n"
-        
-        # Mostrar productos asignados
-        if productos_json:
-            productos = productos_json if isinstance(productos_json, dict) else json.loads(productos_json)
-            for producto_id, cantidad in productos.items():
-                # Obtener nombre del producto
-                conn_temp = get_db_connection()
-                cursor_temp = conn_temp.cursor()
-                cursor_temp.execute("SELECT nombre, precio FROM productos WHERE id = %s", (int(producto_id),))
-                producto_info = cursor_temp.fetchone()
-                conn_temp.close()
-                
-                if producto_info:
-                    nombre_producto, precio_producto = producto_info
-                    mensaje += f"   🛍️ {nombre_producto} x{cantidad} - ${precio_producto * cantidad:.2f}\n"
-        
-        mensaje += f"   💰 **Total:** ${total:.2f}\n"
-        mensaje += f"   💳 **Pago semanal:** ${pago_semanal:.2f}\n"
-        mensaje += f"   📅 **Progreso:** {semanas_comp}/{semanas} semanas\n"
-        mensaje += f"   ✏️ /asignar_{user_id}\n"
-        mensaje += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    # Totales calculados en la base de datos en lugar de recorrer todas las asignaciones
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("""
+            SELECT COUNT(*), COALESCE(SUM(total), 0), COALESCE(SUM(pago_semanal), 0)
+            FROM planes_pago
+            WHERE estado = 'activo'
+        """)
+        total_usuarios, total_general, pago_semanal_total = await cursor.fetchone()
     
-    # Estadísticas generales
-    total_usuarios = len(asignaciones)
     promedio_usuario = total_general / total_usuarios if total_usuarios > 0 else 0
     
-    mensaje += f"📈 **ESTADÍSTICAS GENERALES:**\n"
-    mensaje += f"👥 **Usuarios activos:** {total_usuarios}\n"
-    mensaje += f"💰 **Total general:** ${total_general:.2f}\n"
-    mensaje += f"💳 **Pago semanal total:** ${pago_semanal_total:.2f}\n"
-    mensaje += f"📊 **Promedio por usuario:** ${promedio_usuario:.2f}\n"
-    mensaje += f"🔢 **Semanas configuradas:** {semanas_config}"
-    
-    await update.message.reply_text(mensaje)
+    resumen = f"📈 **ESTADÍSTICAS GENERALES:**\n"
+    resumen += f"👥 **Usuarios activos:** {total_usuarios}\n"
+    resumen += f"💰 **Total general:** ${total_general:.2f}\n"
+    resumen += f"💳 **Pago semanal total:** ${pago_semanal_total:.2f}\n"
+    resumen += f"📊 **Promedio por usuario:** ${promedio_usuario:.2f}\n"
+    resumen += f"🔢 **Semanas configuradas:** {semanas_config}"
+    return resumen
+
+# Asignaciones activas con sus productos en una sola consulta:
+# productos_json se expande con jsonb_each y se une a productos
+LISTADO_ASIGNACIONES = Listado(
+    nombre='asignaciones',
+    titulo="📊 **ASIGNACIONES ACTIVAS - ADMIN**",
+    consulta="""
+        SELECT p.user_id, u.first_name, u.last_name, p.total, p.pago_semanal,
+               p.semanas_completadas, p.semanas,
+               COALESCE(
+                   json_agg(json_build_array(pr.nombre, pr.precio, item.cantidad::int) ORDER BY pr.nombre)
+                       FILTER (WHERE pr.id IS NOT NULL),
+                   '[]'
+               ) AS productos,
+               COALESCE(u.first_name, ''), p.id
+        FROM planes_pago p
+        LEFT JOIN usuarios u ON p.user_id = u.user_id
+        LEFT JOIN LATERAL jsonb_each(
+            CASE WHEN jsonb_typeof(p.productos_json) = 'object' THEN p.productos_json ELSE '{}'::jsonb END
+        ) AS item(producto_id, cantidad) ON TRUE
+        LEFT JOIN productos pr ON pr.id = item.producto_id::int
+        {donde}
+        GROUP BY p.id, u.first_name, u.last_name
+    """,
+    condiciones=("p.estado = 'activo'",),
+    orden=("COALESCE(u.first_name, '')", "p.id"),
+    clave=lambda fila: (fila[8], fila[9]),
+    formatear=formatear_asignacion,
+    descendente=False,
+    vacio="📭 No hay asignaciones activas en el sistema",
+    resumen=resumen_asignaciones,
+)
+
+async def ver_asignaciones(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ver todas las asignaciones activas (solo admin)"""
+    if not is_admin(update.effective_user.id):  # ← ACTUALIZADO
+        await update.message.reply_text("❌ No tienes permisos de administrador")
+        return
     
+    await abrir_listado(update, context, LISTADO_ASIGNACIONES)
+    
+CONSULTA_PLAN_ACTIVO = """
+    SELECT p.semanas, p.pago_semanal, p.semanas_completadas, p.contador_pausado,
+           p.fecha_ultimo_pago, p.fecha_configuracion, prods.productos
+    FROM planes_pago p
+    LEFT JOIN LATERAL (
+        SELECT COALESCE(
+                   json_agg(json_build_array(pr.nombre, pr.precio, item.cantidad::int) ORDER BY pr.nombre),
+                   '[]'
+               ) AS productos
+        FROM jsonb_each(
+            CASE WHEN jsonb_typeof(p.productos_json) = 'object' THEN p.productos_json ELSE '{}'::jsonb END
+        ) AS item(producto_id, cantidad)
+        JOIN productos pr ON pr.id = item.producto_id::int
+    ) prods ON TRUE
+    WHERE p.user_id = %s AND p.estado = 'activo'
+    ORDER BY p.fecha_inicio DESC
+    LIMIT 1
+"""
+
 async def mis_planes_mejorado(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ver planes de pago activos del usuario con contador individual"""
     user_id = update.effective_user.id
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Primero verificar si la columna existe
-    try:
-        cursor.execute("""
-            SELECT id, productos_json, total, semanas, pago_semanal, 
-                   semanas_completadas, fecha_inicio, contador_pausado,
-                   fecha_ultimo_pago, fecha_configuracion
-            FROM planes_pago 
-            WHERE user_id = %s AND estado = 'activo'
-            ORDER BY fecha_inicio DESC
-        """, (user_id,))
-    except Exception as e:
-        # Si falla, usar consulta sin fecha_configuracion
-        print(f"⚠️ Columna fecha_configuracion no existe, usando consulta alternativa: {e}")
-        cursor.execute("""
-            SELECT id, productos_json, total, semanas, pago_semanal, 
-                   semanas_completadas, fecha_inicio, contador_pausado,
-                   fecha_ultimo_pago
-            FROM planes_pago 
-            WHERE user_id = %s AND estado = 'activo'
-            ORDER BY fecha_inicio DESC
-        """, (user_id,))
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    planes = cursor.fetchall()
+        # Plan activo con sus productos (jsonb_each + productos) en una sola consulta
+        await cursor.execute(CONSULTA_PLAN_ACTIVO, (user_id,))
+        plan = await cursor.fetchone()
     
-    if not planes:
+    if not plan:
         await update.message.reply_text(
             "📋 **TU PLAN DE PAGO**\n\n"
             "No tienes un plan de pago asignado.\n\n"
             "📞 Contacta al administrador para que te asigne productos."
         )
-        conn.close()
         return
     
-    plan_id, productos_json, total, semanas, pago_semanal, semanas_comp, fecha_inicio, contador_pausado, fecha_ultimo, fecha_config = planes[0]
-    
-    # Convertir productos_json si es necesario
-    if isinstance(productos_json, str):
-        productos_json = json.loads(productos_json)
+    semanas, pago_semanal, semanas_comp, contador_pausado, fecha_ultimo, fecha_config, productos = plan
     
     # Calcular días desde último avance
     dias_desde_ultimo = "N/A"
@@ -2566,17 +4502,10 @@ async def mis_planes_mejorado(update: Update, context: ContextTypes.DEFAULT_TYPE
     mensaje += "🛍️ **PRODUCTOS ASIGNADOS:**\n"
     
     total_calculado = 0
-    if productos_json:
-        for producto_id, cantidad in productos_json.items():
-            cursor.execute("SELECT nombre, precio FROM productos WHERE id = %s", (int(producto_id),))
-            producto_info = cursor.fetchone()
-            if producto_info:
-                nombre, precio = producto_info
-                subtotal = precio * cantidad
-                total_calculado += subtotal
-                mensaje += f"• {nombre} x{cantidad} - ${subtotal:.2f}\n"
-    
-    conn.close()
+    for nombre, precio, cantidad in productos:
+        subtotal = precio * cantidad
+        total_calculado += subtotal
+        mensaje += f"• {nombre} x{cantidad} - ${subtotal:.2f}\n"
     
     estado_contador = "⏸️ PAUSADO" if contador_pausado else "🟢 ACTIVO"
     
@@ -2610,49 +4539,25 @@ async def catalogo_solo_lectura(update: Update, context: ContextTypes.DEFAULT_TY
     """Catálogo completo para usuarios (SOLO LECTURA, sin comprar)"""
     user_id = update.effective_user.id
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    # Verificar si el usuario existe
-    cursor.execute("SELECT * FROM usuarios WHERE user_id = %s", (user_id,))
-    usuario = cursor.fetchone()
+        # Verificar si el usuario existe
+        await cursor.execute("SELECT * FROM usuarios WHERE user_id = %s", (user_id,))
+        usuario = await cursor.fetchone()
     
-    if not usuario:
-        await update.message.reply_text("❌ Debes registrarte con /start primero")
-        conn.close()
-        return
-        
-    # Obtener productos activos
-    cursor.execute("""
-        SELECT id, nombre, precio, descripcion, categoria 
-        FROM productos 
-        WHERE estado = 'activo' 
-        ORDER BY categoria, id
-    """)
-    productos = cursor.fetchall()
+        if not usuario:
+            await update.message.reply_text("❌ Debes registrarte con /start primero")
+            return
     
-    # Obtener configuración de semanas POR DEFECTO
-    try:
-        cursor.execute("SELECT semanas_default FROM config_pagos LIMIT 1")
-        config = cursor.fetchone()
-        conn.close()
-        semanas = config[0] if config else 10
-    except Exception:
-        # Si la columna no existe, usar valor por defecto
-        conn.close()
-        semanas = 10
-        print("⚠️ Usando semanas por defecto: 10 (columna semanas_default no existe)")
-    if not productos:
+    # Configuración de semanas POR DEFECTO (en memoria)
+    semanas = await configuracion_pagos.semanas_default()
+    
+    # Productos activos ya organizados por categorías (caché del catálogo)
+    categorias = await catalogo_cache.activos_por_categoria()
+    if not categorias:
         await update.message.reply_text("📭 El catálogo está vacío por ahora")
         return
-        
-    # Organizar por categorías
-    categorias = {}
-    for id_prod, nombre, precio, descripcion, categoria in productos:
-        cat = categoria or "General"
-        if cat not in categorias:
-            categorias[cat] = []
-        categorias[cat].append((id_prod, nombre, precio, descripcion))
     
     mensaje = f"🛍️ **CATÁLOGO DE PRODUCTOS**\n**Semanas por defecto: {semanas}**\n\n"
     mensaje += "📞 **Contacta al administrador para asignarte productos**\n\n"
@@ -2680,7 +4585,7 @@ async def button_handler_asignacion(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     await query.answer()
     
-    print(f"🟡 BOTÓN ASIGNACIÓN: {query.data}")
+    logger.debug("Botón de asignación: %s", query.data)
     
     if query.data.startswith("asignar_mas_") or query.data.startswith("asignar_menos_"):
         await manejar_cambio_cantidad(query, context)
@@ -2698,18 +4603,16 @@ async def manejar_cambio_cantidad(query, context):
     user_id = partes[2]
     producto_id = partes[3]
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Obtener productos disponibles
-    cursor.execute("SELECT id, nombre, precio, descripcion FROM productos WHERE estado = 'activo' ORDER BY nombre")
-    productos = cursor.fetchall()
+    # Obtener productos disponibles (caché del catálogo)
+    productos = await catalogo_cache.activos_por_nombre()
     
     # Obtener estado actual desde la base de datos o temporal
     productos_actuales = context.user_data.get(f'asignacion_temp_{user_id}', {})
     if not productos_actuales:
-        cursor.execute("SELECT productos_json FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
-        plan_actual = cursor.fetchone()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("SELECT productos_json FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
+            plan_actual = await cursor.fetchone()
         if plan_actual and plan_actual[0]:
             productos_actuales = plan_actual[0] if isinstance(plan_actual[0], dict) else json.loads(plan_actual[0])
     
@@ -2727,28 +4630,21 @@ async def manejar_cambio_cantidad(query, context):
     # Guardar estado temporal en context
     context.user_data[f'asignacion_temp_{user_id}'] = productos_actuales
     
-    conn.close()
-    
     # Recrear el mensaje con los nuevos valores
     await recrear_mensaje_asignacion(query, context, user_id, productos, productos_actuales)
 
 async def recrear_mensaje_asignacion(query, context, user_id, productos, productos_actuales):
     """Recrea el mensaje de asignación con los valores actualizados"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Obtener información del usuario
-    cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-    usuario = cursor.fetchone()
-    first_name, last_name = usuario
-    nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    # Obtener configuración de semanas
-    cursor.execute("SELECT semanas FROM config_pagos LIMIT 1")
-    config = cursor.fetchone()
-    semanas = config[0] if config else 10
+        # Obtener información del usuario
+        await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+        usuario = await cursor.fetchone()
+        first_name, last_name = usuario
+        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
     
-    conn.close()  # ✅ Cerrar conexión aquí
+    semanas = await configuracion_pagos.semanas()
     
     # Crear mensaje
     mensaje = f"🛍️ **ASIGNAR PRODUCTOS A USUARIO**\n\n"
@@ -2810,82 +4706,78 @@ async def confirmar_asignacion(query, context):
         await query.edit_message_text("❌ **No se pueden asignar 0 productos**\n\nLa asignación debe incluir al menos un producto.")
         return
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        # Calcular total
-        total = 0
-        for producto_id, cantidad in productos_finales.items():
-            cursor.execute("SELECT precio FROM productos WHERE id = %s", (int(producto_id),))
-            producto = cursor.fetchone()
-            if producto:
-                total += producto[0] * cantidad
-        
-        # Obtener configuración
-        cursor.execute("SELECT semanas FROM config_pagos LIMIT 1")
-        config = cursor.fetchone()
-        semanas = config[0] if config else 10
-        pago_semanal = total / semanas if semanas > 0 else 0
-        
-        # Verificar si ya existe un plan activo
-        cursor.execute("SELECT id FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
-        plan_existente = cursor.fetchone()
-        
-        if plan_existente:
-            # Actualizar plan existente (REINICIAR progreso)
-            cursor.execute("""
-                UPDATE planes_pago 
-                SET productos_json = %s, total = %s, semanas = %s, pago_semanal = %s, 
-                    semanas_completadas = 0, fecha_actualizacion = CURRENT_TIMESTAMP
-                WHERE user_id = %s AND estado = 'activo'
-            """, (json.dumps(productos_finales), total, semanas, pago_semanal, user_id))
-        else:
-            # Crear nuevo plan
-            cursor.execute("""
-                INSERT INTO planes_pago (user_id, productos_json, total, semanas, pago_semanal)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (user_id, json.dumps(productos_finales), total, semanas, pago_semanal))
+        semanas = await configuracion_pagos.semanas()
         
-        conn.commit()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Calcular total
+            total = 0
+            for producto_id, cantidad in productos_finales.items():
+                await cursor.execute("SELECT precio FROM productos WHERE id = %s", (int(producto_id),))
+                producto = await cursor.fetchone()
+                if producto:
+                    total += producto[0] * cantidad
         
-        # Obtener información del usuario para el mensaje
-        cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-        usuario = cursor.fetchone()
-        first_name, last_name = usuario
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            pago_semanal = total / semanas if semanas > 0 else 0
         
-        # Construir mensaje de confirmación
-        mensaje = f"✅ **ASIGNACIÓN CONFIRMADA**\n\n"
-        mensaje += f"👤 **Usuario:** {nombre_completo}\n"
-        mensaje += f"🆔 **ID:** {user_id}\n\n"
-        mensaje += "🛍️ **PRODUCTOS ASIGNADOS:**\n"
+            # Verificar si ya existe un plan activo
+            await cursor.execute("SELECT id FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
+            plan_existente = await cursor.fetchone()
+        
+            if plan_existente:
+                # Actualizar plan existente (REINICIAR progreso)
+                await cursor.execute("""
+                    UPDATE planes_pago 
+                    SET productos_json = %s, total = %s, semanas = %s, pago_semanal = %s, 
+                        semanas_completadas = 0, fecha_actualizacion = CURRENT_TIMESTAMP
+                    WHERE user_id = %s AND estado = 'activo'
+                """, (json.dumps(productos_finales), total, semanas, pago_semanal, user_id))
+            else:
+                # Crear nuevo plan
+                await cursor.execute("""
+                    INSERT INTO planes_pago (user_id, productos_json, total, semanas, pago_semanal)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, (user_id, json.dumps(productos_finales), total, semanas, pago_semanal))
+        
+            await conn.commit()
         
-        for producto_id, cantidad in productos_finales.items():
-            cursor.execute("SELECT nombre, precio FROM productos WHERE id = %s", (int(producto_id),))
-            producto = cursor.fetchone()
-            if producto:
-                nombre, precio = producto
-                mensaje += f"• {nombre} x{cantidad} - ${precio * cantidad:.2f}\n"
+            # Obtener información del usuario para el mensaje
+            await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+            usuario = await cursor.fetchone()
+            first_name, last_name = usuario
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+        
+            # Construir mensaje de confirmación
+            mensaje = f"✅ **ASIGNACIÓN CONFIRMADA**\n\n"
+            mensaje += f"👤 **Usuario:** {nombre_completo}\n"
+            mensaje += f"🆔 **ID:** {user_id}\n\n"
+            mensaje += "🛍️ **PRODUCTOS ASIGNADOS:**\n"
         
-        mensaje += f"\n💰 **TOTAL:** ${total:.2f}\n"
-        mensaje += f"📅 **SEMANAS:** {semanas}\n"
-        mensaje += f"💳 **PAGO SEMANAL:** ${pago_semanal:.2f}\n"
+            for producto_id, cantidad in productos_finales.items():
+                await cursor.execute("SELECT nombre, precio FROM productos WHERE id = %s", (int(producto_id),))
+                producto = await cursor.fetchone()
+                if producto:
+                    nombre, precio = producto
+                    mensaje += f"• {nombre} x{cantidad} - ${precio * cantidad:.2f}\n"
         
-        if plan_existente:
-            mensaje += f"\n⚠️ **El progreso anterior se reinició a 0 semanas**"
+            mensaje += f"\n💰 **TOTAL:** ${total:.2f}\n"
+            mensaje += f"📅 **SEMANAS:** {semanas}\n"
+            mensaje += f"💳 **PAGO SEMANAL:** ${pago_semanal:.2f}\n"
         
-        await query.edit_message_text(mensaje)
+            if plan_existente:
+                mensaje += f"\n⚠️ **El progreso anterior se reinició a 0 semanas**"
         
-        # Limpiar datos temporales
-        if f'asignacion_temp_{user_id}' in context.user_data:
-            del context.user_data[f'asignacion_temp_{user_id}']
+            await query.edit_message_text(mensaje)
+        
+            # Limpiar datos temporales
+            if f'asignacion_temp_{user_id}' in context.user_data:
+                del context.user_data[f'asignacion_temp_{user_id}']
             
     except Exception as e:
-        print(f"❌ Error al confirmar asignación: {e}")
+        logger.error(f"❌ Error al confirmar asignación: {e}")
         await query.edit_message_text("❌ Error al confirmar la asignación")
-    finally:
-        conn.close()
 
 async def reiniciar_asignacion(query, context):
     """Reinicia la asignación actual"""
@@ -2897,29 +4789,26 @@ async def reiniciar_asignacion(query, context):
         del context.user_data[f'asignacion_temp_{user_id}']
     
     # Volver a cargar la asignación
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    # Obtener información del usuario
-    cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-    usuario = cursor.fetchone()
+        # Obtener información del usuario
+        await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+        usuario = await cursor.fetchone()
     
-    if not usuario:
-        await query.edit_message_text("❌ Usuario no encontrado")
-        conn.close()
-        return
+        if not usuario:
+            await query.edit_message_text("❌ Usuario no encontrado")
+            return
         
-    first_name, last_name = usuario
-    nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+        first_name, last_name = usuario
+        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
     
-    # Obtener productos activos
-    cursor.execute("SELECT id, nombre, precio, descripcion FROM productos WHERE estado = 'activo' ORDER BY nombre")
-    productos = cursor.fetchall()
+        # Iniciar con productos vacíos
+        productos_actuales = {}
     
-    # Iniciar con productos vacíos
-    productos_actuales = {}
     
-    conn.close()
+    # Productos activos desde la caché del catálogo
+    productos = await catalogo_cache.activos_por_nombre()
     
     # Recrear mensaje
     await recrear_mensaje_asignacion(query, context, user_id, productos, productos_actuales)
@@ -2931,7 +4820,8 @@ async def reiniciar_asignacion(query, context):
 async def cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancela cualquier operación en curso"""
     context.user_data.clear()
-    
+    limpiar_estado(context)
+
     await update.message.reply_text(
         "🔄 **Operación cancelada**\n\n"
         "Todas las acciones en curso han sido canceladas.\n\n"
@@ -2943,18 +4833,16 @@ async def pagarealizado(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Verificar si el usuario está registrado
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM usuarios WHERE user_id = %s", (user_id,))
-    usuario = cursor.fetchone()
-    conn.close()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute("SELECT * FROM usuarios WHERE user_id = %s", (user_id,))
+        usuario = await cursor.fetchone()
     
     if not usuario:
         await update.message.reply_text("❌ Debes registrarte con /start primero")
         return
     
-    context.user_data['esperando_datos_pago'] = True
-    context.user_data['esperando_imagen'] = False
+    fijar_estado(context, EstadoChat.ESPERANDO_DATOS_PAGO)
     
     await update.message.reply_text(
         "💳 **REGISTRAR PAGO**\n\n"
@@ -2973,90 +4861,92 @@ async def pagarealizado(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Debe escribir cada campo y llenarlo con sus datos"
     )
 
+def formatear_pago_pendiente(fila, posicion: int) -> str:
+    pago_id, user_id, first_name, last_name, referencia, monto, fecha, estado = fila
+    nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+    entrada = f"🆔 **ID Pago:** {pago_id}\n"
+    entrada += f"👤 **Usuario:** {nombre_completo or 'N/A'} (ID: {user_id})\n"
+    entrada += f"💰 **Monto:** ${monto:.2f}\n"
+    entrada += f"🔢 **Referencia:** {referencia}\n"
+    entrada += f"📅 **Fecha:** {fecha.strftime('%d/%m/%Y %H:%M')}\n"
+    entrada += f"👁️ /verimagen_{pago_id} | ✅ /confirmar_{pago_id} | ❌ /rechazar_{pago_id} | 🗑️ /borrar_{pago_id}\n"
+    entrada += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    return entrada
+
+LISTADO_PAGOS_PENDIENTES = Listado(
+    nombre='pendientes',
+    titulo="📋 **PAGOS PENDIENTES**",
+    consulta="""
+        SELECT p.id, p.user_id, u.first_name, u.last_name, p.referencia, p.monto, p.fecha, p.estado
+        FROM pagos p
+        LEFT JOIN usuarios u ON p.user_id = u.user_id
+        {donde}
+    """,
+    condiciones=("p.estado = 'pendiente'",),
+    orden=("p.fecha", "p.id"),
+    clave=lambda fila: (fila[6], fila[0]),
+    formatear=formatear_pago_pendiente,
+    vacio="✅ No hay pagos pendientes por revisar",
+)
+
 async def verpagos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra los pagos pendientes (solo admin)"""
     if not is_admin(update.effective_user.id):  # ← ACTUALIZADO
         await update.message.reply_text("❌ No tienes permisos de administrador")
         return
-        
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT p.id, p.user_id, u.first_name, u.last_name, p.referencia, p.monto, p.fecha, p.estado 
-        FROM pagos p 
-        LEFT JOIN usuarios u ON p.user_id = u.user_id 
-        WHERE p.estado = 'pendiente'
-        ORDER BY p.fecha DESC
-    """)
-    pagos = cursor.fetchall()
-    conn.close()
-    
-    if not pagos:
-        await update.message.reply_text("✅ No hay pagos pendientes por revisar")
-        return
-    
-    mensaje = "📋 **PAGOS PENDIENTES**\n\n"
-    
-    for pago_id, user_id, first_name, last_name, referencia, monto, fecha, estado in pagos:
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
-        mensaje += f"🆔 **ID Pago:** {pago_id}\n"
-        mensaje += f"👤 **Usuario:** {nombre_completo or 'N/A'} (ID: {user_id})\n"
-        mensaje += f"💰 **Monto:** ${monto:.2f}\n"
-        mensaje += f"🔢 **Referencia:** {referencia}\n"
-        mensaje += f"📅 **Fecha:** {fecha.strftime('%d/%m/%Y %H:%M')}\n"
-        mensaje += f"👁️ /verimagen_{pago_id} | ✅ /confirmar_{pago_id} | ❌ /rechazar_{pago_id} | 🗑️ /borrar_{pago_id}\n"
-        mensaje += "━━━━━━━━━━━━━━━━━━━━\n\n"
     
-    await update.message.reply_text(mensaje)
+    await abrir_listado(update, context, LISTADO_PAGOS_PENDIENTES)
+
+def formatear_usuario(fila, posicion: int) -> str:
+    user_id, first_name, last_name, user_name, phone, fecha_registro, estado = fila
+    nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+    entrada = f"🆔 **ID:** {user_id}\n"
+    entrada += f"👤 **Nombre:** {nombre_completo or 'N/A'}\n"
+    entrada += f"📱 **Teléfono:** {phone or 'No registrado'}\n"
+    entrada += f"📅 **Registro:** {fecha_registro.strftime('%d/%m/%Y')}\n"
+    entrada += f"📊 **Estado:** {estado}\n"
+    entrada += f"🗑️ /borrarusuario_{user_id}\n"
+    entrada += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    return entrada
+
+LISTADO_USUARIOS = Listado(
+    nombre='usuarios',
+    titulo="👥 **USUARIOS REGISTRADOS**",
+    consulta="""
+        SELECT user_id, first_name, last_name, user_name, phone, fecha_registro, estado
+        FROM usuarios
+        {donde}
+    """,
+    orden=("fecha_registro", "user_id"),
+    clave=lambda fila: (fila[5], fila[0]),
+    formatear=formatear_usuario,
+    vacio="📭 No hay usuarios registrados",
+)
 
 async def verusuarios(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra todos los usuarios (solo admin)"""
     if not is_admin(update.effective_user.id):  # ← ACTUALIZADO
         await update.message.reply_text("❌ No tienes permisos de administrador")
         return
-        
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT user_id, first_name, last_name, user_name, phone, fecha_registro, estado 
-        FROM usuarios 
-        ORDER BY fecha_registro DESC
-    """)
-    usuarios = cursor.fetchall()
-    conn.close()
-    
-    if not usuarios:
-        await update.message.reply_text("📭 No hay usuarios registrados")
-        return
-    
-    mensaje = "👥 **USUARIOS REGISTRADOS**\n\n"
-    
-    for user_id, first_name, last_name, user_name, phone, fecha_registro, estado in usuarios:
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
-        mensaje += f"🆔 **ID:** {user_id}\n"
-        mensaje += f"👤 **Nombre:** {nombre_completo or 'N/A'}\n"
-        mensaje += f"📱 **Teléfono:** {phone or 'No registrado'}\n"
-        mensaje += f"📅 **Registro:** {fecha_registro.strftime('%d/%m/%Y')}\n"
-        mensaje += f"📊 **Estado:** {estado}\n"
-        mensaje += f"🗑️ /borrarusuario_{user_id}\n"
-        mensaje += "━━━━━━━━━━━━━━━━━━━━\n\n"
     
-    await update.message.reply_text(mensaje)
+    await abrir_listado(update, context, LISTADO_USUARIOS)
+
+CONSULTA_PAGOS_USUARIO = """
+    SELECT referencia, monto, estado, fecha
+    FROM pagos
+    WHERE user_id = %s
+    ORDER BY fecha DESC
+"""
 
 async def mistatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra el estado de los pagos del usuario"""
     user_id = update.effective_user.id
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT referencia, monto, estado, fecha 
-        FROM pagos 
-        WHERE user_id = %s 
-        ORDER BY fecha DESC
-    """, (user_id,))
-    pagos = cursor.fetchall()
-    conn.close()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute(CONSULTA_PAGOS_USUARIO, (user_id,))
+        pagos = await cursor.fetchall()
+        corte = await corte_archivo(cursor, 'pagos')
     
     if not pagos:
         await update.message.reply_text(
@@ -3077,6 +4967,9 @@ async def mistatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
         mensaje += f"📅 **Fecha:** {fecha.strftime('%d/%m/%Y %H:%M')}\n"
         mensaje += "━━━━━━━━━━━━━━━━━━━━\n\n"
     
+    if corte:
+        mensaje += f"📦 Los pagos anteriores al {corte.strftime('%d/%m/%Y')} están archivados; pídelos al administrador."
+    
     await update.message.reply_text(mensaje)
 
 # =============================================
@@ -3085,9 +4978,10 @@ async def mistatus(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja la recepción de imágenes/comprobantes"""
-    print(f"🟡 IMAGEN RECIBIDA - User data: {context.user_data}")
-    
-    if context.user_data.get('esperando_imagen'):
+    estado, datos_estado = obtener_estado(context)
+    logger.debug("Imagen de %s en estado %s", update.effective_user.id, estado.value)
+
+    if estado == EstadoChat.ESPERANDO_IMAGEN:
         user_id = update.effective_user.id
         
         # Obtener la imagen
@@ -3100,7 +4994,7 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Obtener datos del pago
-        datos_pago = context.user_data.get('datos_pago', {})
+        datos_pago = datos_estado.get('datos_pago', {})
         nombre = datos_pago.get('nombre', '')
         referencia = datos_pago.get('referencia', '')
         monto = datos_pago.get('monto', '0')
@@ -3111,18 +5005,16 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             monto_float = 0
         
         # Guardar en base de datos
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO pagos (user_id, user_name, referencia, file_id, monto) VALUES (%s, %s, %s, %s, %s)",
-            (user_id, nombre, referencia, file_id, monto_float)
-        )
-        conn.commit()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(
+                "INSERT INTO pagos (user_id, user_name, referencia, file_id, monto) VALUES (%s, %s, %s, %s, %s)",
+                (user_id, nombre, referencia, file_id, monto_float)
+            )
+            await conn.commit()
         
         # Limpiar estados
-        context.user_data['esperando_imagen'] = False
-        context.user_data['datos_pago'] = None
+        limpiar_estado(context)
         
         await update.message.reply_text(
             "✅ **¡Pago registrado exitosamente!**\n\n"
@@ -3134,7 +5026,7 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "El administrador revisará tu comprobante y actualizará el estado.\n"
             "Puedes ver el estado con /mistatus"
         )
-        print(f"✅ Pago registrado para usuario {user_id}")
+        logger.info(f"✅ Pago registrado para usuario {user_id}")
     else:
         await update.message.reply_text(
             "ℹ️ Para registrar un pago, usa el comando /pagarealizado primero"
@@ -3150,37 +5042,35 @@ async def handle_all_documents(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def handle_rechazo_motivo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja el motivo de rechazo de un pago"""
-    if not context.user_data.get('rechazando_pago'):
+    estado, datos_estado = obtener_estado(context)
+    if estado != EstadoChat.RECHAZANDO_PAGO:
         return
-    
+
     motivo = update.message.text
-    pago_id = context.user_data['rechazando_pago']
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE pagos SET estado = 'rechazado' WHERE id = %s", (pago_id,))
-    conn.commit()
+    pago_id = datos_estado['pago_id']
     
-    # Obtener user_id del pago rechazado
-    cursor.execute("SELECT user_id FROM pagos WHERE id = %s", (pago_id,))
-    resultado = cursor.fetchone()
-    conn.close()
-    
-    context.user_data['rechazando_pago'] = None
-    
-    if resultado:
-        user_id = resultado[0]
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"❌ **Tu pago ha sido rechazado**\n\n"
-                     f"**Motivo:** {motivo}\n\n"
-                     f"Por favor contacta al administrador para más información."
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+        # Rechazar y obtener el user_id del pago en una sola sentencia
+        await cursor.execute(
+            "UPDATE pagos SET estado = 'rechazado' WHERE id = %s RETURNING user_id", (pago_id,)
+        )
+        resultado = await cursor.fetchone()
+    
+        if resultado:
+            await encolar_notificacion(
+                cursor, resultado[0],
+                f"❌ **Tu pago ha sido rechazado**\n\n"
+                f"**Motivo:** {motivo}\n\n"
+                f"Por favor contacta al administrador para más información.",
+                'pago_rechazado'
             )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
+        await conn.commit()
+    despertar_notificaciones()
     
-    await update.message.reply_text("✅ Pago rechazado y usuario notificado")
+    limpiar_estado(context)
+    
+    await update.message.reply_text("✅ Pago rechazado. 📣 El usuario será notificado")
 
 # =============================================
 # FUNCIONES ADMIN PARA PAGOS
@@ -3196,11 +5086,10 @@ async def verimagen_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         pago_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT file_id, user_id, referencia, monto FROM pagos WHERE id = %s", (pago_id,))
-        pago = cursor.fetchone()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("SELECT file_id, user_id, referencia, monto FROM pagos WHERE id = %s", (pago_id,))
+            pago = await cursor.fetchone()
         
         if pago:
             file_id, user_id, referencia, monto = pago
@@ -3216,7 +5105,7 @@ async def verimagen_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Pago no encontrado")
             
     except Exception as e:
-        print(f"❌ Error en verimagen_admin: {e}")
+        logger.error(f"❌ Error en verimagen_admin: {e}")
         await update.message.reply_text("❌ Error al mostrar la imagen")
 
 async def rechazar_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3229,7 +5118,7 @@ async def rechazar_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         pago_id = command_text.split('_')[1]
         
-        context.user_data['rechazando_pago'] = pago_id
+        fijar_estado(context, EstadoChat.RECHAZANDO_PAGO, pago_id=pago_id)
         await update.message.reply_text(
             "❌ **RECHAZAR PAGO**\n\n"
             "Por favor envía el motivo del rechazo:\n"
@@ -3237,7 +5126,7 @@ async def rechazar_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
     except Exception as e:
-        print(f"❌ Error en rechazar_pago: {e}")
+        logger.error(f"❌ Error en rechazar_pago: {e}")
         await update.message.reply_text("❌ Error al procesar el rechazo")
 
 async def borrar_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3250,16 +5139,15 @@ async def borrar_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         pago_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM pagos WHERE id = %s", (pago_id,))
-        conn.commit()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("DELETE FROM pagos WHERE id = %s", (pago_id,))
+            await conn.commit()
         
         await update.message.reply_text("✅ Pago eliminado correctamente")
         
     except Exception as e:
-        print(f"❌ Error en borrar_pago: {e}")
+        logger.error(f"❌ Error en borrar_pago: {e}")
         await update.message.reply_text("❌ Error al eliminar el pago")
 
 async def borrarusuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3272,63 +5160,61 @@ async def borrarusuario(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # 1. Primero obtener información del usuario para confirmar
-        cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
-        usuario = cursor.fetchone()
+            # 1. Primero obtener información del usuario para confirmar
+            await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id,))
+            usuario = await cursor.fetchone()
         
-        if not usuario:
-            await update.message.reply_text("❌ Usuario no encontrado")
-            conn.close()
-            return
+            if not usuario:
+                await update.message.reply_text("❌ Usuario no encontrado")
+                return
         
-        first_name, last_name = usuario
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            first_name, last_name = usuario
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # 2. Contar datos relacionados para mostrar en confirmación
-        cursor.execute("SELECT COUNT(*) FROM planes_pago WHERE user_id = %s", (user_id,))
-        planes_count = cursor.fetchone()[0]
+            # 2. Contar datos relacionados para mostrar en confirmación
+            await cursor.execute("SELECT COUNT(*) FROM planes_pago WHERE user_id = %s", (user_id,))
+            planes_count = (await cursor.fetchone())[0]
         
-        cursor.execute("SELECT COUNT(*) FROM pagos WHERE user_id = %s", (user_id,))
-        pagos_count = cursor.fetchone()[0]
+            await cursor.execute("SELECT COUNT(*) FROM pagos WHERE user_id = %s", (user_id,))
+            pagos_count = (await cursor.fetchone())[0]
         
-        cursor.execute("SELECT COUNT(*) FROM usuarios_puntos WHERE user_id = %s", (user_id,))
-        puntos_count = cursor.fetchone()[0]
+            await cursor.execute("SELECT COUNT(*) FROM usuarios_puntos WHERE user_id = %s", (user_id,))
+            puntos_count = (await cursor.fetchone())[0]
         
-        cursor.execute("SELECT COUNT(*) FROM referidos WHERE user_id_referidor = %s OR user_id_referido = %s", (user_id, user_id))
-        referidos_count = cursor.fetchone()[0]
+            await cursor.execute("SELECT COUNT(*) FROM referidos WHERE user_id_referidor = %s OR user_id_referido = %s", (user_id, user_id))
+            referidos_count = (await cursor.fetchone())[0]
         
-        cursor.execute("SELECT COUNT(*) FROM puntos_historial WHERE user_id = %s", (user_id,))
-        historial_count = cursor.fetchone()[0]
+            await cursor.execute("SELECT COUNT(*) FROM puntos_historial WHERE user_id = %s", (user_id,))
+            historial_count = (await cursor.fetchone())[0]
         
-        # 3. Mostrar confirmación con advertencia
-        mensaje = (
-            f"🗑️ **ELIMINAR USUARIO - CONFIRMACIÓN**\n\n"
-            f"👤 **Usuario:** {nombre_completo}\n"
-            f"🆔 **ID:** {user_id}\n\n"
-            f"📊 **Datos a eliminar:**\n"
-            f"• 📋 Planes activos: {planes_count}\n"
-            f"• 💳 Pagos registrados: {pagos_count}\n"
-            f"• ⭐ Datos de puntos: {puntos_count}\n"
-            f"• 👥 Referidos: {referidos_count}\n"
-            f"• 📈 Historial puntos: {historial_count}\n\n"
-            f"⚠️ **Esta acción NO es reversible**\n\n"
-            f"¿Estás seguro de eliminar este usuario y TODOS sus datos?"
-        )
+            # 3. Mostrar confirmación con advertencia
+            mensaje = (
+                f"🗑️ **ELIMINAR USUARIO - CONFIRMACIÓN**\n\n"
+                f"👤 **Usuario:** {nombre_completo}\n"
+                f"🆔 **ID:** {user_id}\n\n"
+                f"📊 **Datos a eliminar:**\n"
+                f"• 📋 Planes activos: {planes_count}\n"
+                f"• 💳 Pagos registrados: {pagos_count}\n"
+                f"• ⭐ Datos de puntos: {puntos_count}\n"
+                f"• 👥 Referidos: {referidos_count}\n"
+                f"• 📈 Historial puntos: {historial_count}\n\n"
+                f"⚠️ **Esta acción NO es reversible**\n\n"
+                f"¿Estás seguro de eliminar este usuario y TODOS sus datos?"
+            )
         
-        keyboard = [
-            [InlineKeyboardButton("✅ SÍ, ELIMINAR TODO", callback_data=f"eliminar_usuario_si_{user_id}")],
-            [InlineKeyboardButton("❌ CANCELAR", callback_data=f"eliminar_usuario_no_{user_id}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+            keyboard = [
+                [InlineKeyboardButton("✅ SÍ, ELIMINAR TODO", callback_data=f"eliminar_usuario_si_{user_id}")],
+                [InlineKeyboardButton("❌ CANCELAR", callback_data=f"eliminar_usuario_no_{user_id}")]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(mensaje, reply_markup=reply_markup)
-        conn.close()
+            await update.message.reply_text(mensaje, reply_markup=reply_markup)
         
     except Exception as e:
-        print(f"❌ Error en borrarusuario: {e}")
+        logger.error(f"❌ Error en borrarusuario: {e}")
         await update.message.reply_text("❌ Error al procesar la eliminación")
 
 # =============================================
@@ -3341,24 +5227,19 @@ async def admin_ver_productos(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ No tienes permisos de administrador")
         return
         
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Obtener productos activos
-    cursor.execute("""
-        SELECT id, nombre, precio, descripcion, categoria 
-        FROM productos 
-        WHERE estado = 'activo' 
-        ORDER BY id
-    """)
-    productos = cursor.fetchall()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    # Obtener configuración
-    cursor.execute("SELECT semanas, contador_activo FROM config_pagos LIMIT 1")
-    config = cursor.fetchone()
-    conn.close()
+        # Obtener productos activos
+        await cursor.execute("""
+            SELECT id, nombre, precio, descripcion, categoria 
+            FROM productos 
+            WHERE estado = 'activo' 
+            ORDER BY id
+        """)
+        productos = await cursor.fetchall()
     
-    semanas = config[0] if config else 10
+    semanas = await configuracion_pagos.semanas()
     
     if not productos:
         await update.message.reply_text("📭 No hay productos en el catálogo")
@@ -3386,7 +5267,7 @@ async def admin_agregar_producto(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ No tienes permisos de administrador")
         return
         
-    context.user_data['agregando_producto'] = True
+    fijar_estado(context, EstadoChat.AGREGANDO_PRODUCTO)
     await update.message.reply_text(
         "🛍️ **AGREGAR PRODUCTO COMPLETO**\n\n"
         "Envía los datos en este formato:\n\n"
@@ -3415,11 +5296,10 @@ async def editar_producto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         producto_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT nombre, precio FROM productos WHERE id = %s", (producto_id,))
-        producto = cursor.fetchone()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("SELECT nombre, precio FROM productos WHERE id = %s", (producto_id,))
+            producto = await cursor.fetchone()
         
         if producto:
             nombre, precio = producto
@@ -3444,7 +5324,7 @@ async def editar_producto(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Producto no encontrado")
             
     except Exception as e:
-        print(f"❌ Error en editar_producto: {e}")
+        logger.error(f"❌ Error en editar_producto: {e}")
         await update.message.reply_text("❌ Error al procesar edición")
 
 async def eliminar_producto(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3461,11 +5341,10 @@ async def eliminar_producto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         producto_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT nombre, precio FROM productos WHERE id = %s", (producto_id,))
-        producto = cursor.fetchone()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("SELECT nombre, precio FROM productos WHERE id = %s", (producto_id,))
+            producto = await cursor.fetchone()
         
         if producto:
             nombre, precio = producto
@@ -3487,7 +5366,7 @@ async def eliminar_producto(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Producto no encontrado")
             
     except Exception as e:
-        print(f"❌ Error en eliminar_producto: {e}")
+        logger.error(f"❌ Error en eliminar_producto: {e}")
         await update.message.reply_text("❌ Error al procesar eliminación")
 
 # =============================================
@@ -3504,13 +5383,7 @@ async def configurar_semanas_default(update: Update, context: ContextTypes.DEFAU
 
     if not context.args:
         # Mostrar valor actual
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT semanas_default FROM config_pagos LIMIT 1")
-        config = cursor.fetchone()
-        conn.close()
-        
-        semanas_actuales = config[0] if config else 10
+        semanas_actuales = await configuracion_pagos.semanas_default()
         
         await update.message.reply_text(
             f"⚙️ **CONFIGURACIÓN DE SEMANAS POR DEFECTO**\n\n"
@@ -3528,13 +5401,13 @@ async def configurar_semanas_default(update: Update, context: ContextTypes.DEFAU
             await update.message.reply_text("❌ Las semanas deben estar entre 1 y 52")
             return
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Actualizar configuración por defecto
-        cursor.execute("UPDATE config_pagos SET semanas_default = %s", (nuevas_semanas,))
-        conn.commit()
-        conn.close()
+            # Actualizar configuración por defecto
+            await configuracion_pagos.guardar(cursor, semanas_default=nuevas_semanas)
+            await conn.commit()
+        configuracion_pagos.invalidar()
         
         await update.message.reply_text(
             f"✅ **Configuración por defecto actualizada**\n\n"
@@ -3550,111 +5423,151 @@ async def configurar_semanas_default(update: Update, context: ContextTypes.DEFAU
 # FUNCIONES ADICIONALES PARA PAGOS
 # =============================================
 
-async def verpagostodos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Muestra TODOS los pagos con opciones simplificadas (solo admin)"""
-    print(f"\n" + "="*60)
-    print(f"🚀 DEBUG: /verpagostodos EJECUTÁNDOSE")
-    print(f"🟡 Usuario ID: {update.effective_user.id}")
-    print(f"🟡 Es admin: {is_admin(update.effective_user.id)}")
+# Filtros de /verpagostodos (clave=valor); se aplican en el SQL, no en Python
+ESTADOS_PAGO = ('pendiente', 'aprobado', 'rechazado')
+AYUDA_FILTROS_PAGOS = (
+    "🔎 **FILTROS DE /verpagostodos**\n\n"
+    "Uso: /verpagostodos [filtro=valor ...]\n\n"
+    "• estado=pendiente|aprobado|rechazado\n"
+    "• usuario=ID de Telegram\n"
+    "• desde=DD/MM/AAAA | hasta=DD/MM/AAAA (incluido)\n"
+    "• min=monto | max=monto\n"
+    "• ref=inicio de la referencia\n\n"
+    "Ejemplo:\n"
+    "/verpagostodos estado=pendiente desde=01/10/2024 min=20"
+)
+
+def parsear_filtros_pagos(argumentos: list) -> dict:
+    """Validar los filtros del comando; lanza ValueError con un mensaje para el admin"""
+    filtros = {}
+    for argumento in argumentos:
+        clave, separador, valor = argumento.partition('=')
+        clave = clave.lower()
+        if not separador or not valor:
+            raise ValueError(f"Filtro inválido: {argumento}")
+        
+        if clave == 'estado':
+            if valor.lower() not in ESTADOS_PAGO:
+                raise ValueError(f"Estado desconocido: {valor}")
+            filtros[clave] = valor.lower()
+        elif clave == 'usuario':
+            if not valor.isdigit():
+                raise ValueError(f"El usuario debe ser un ID numérico: {valor}")
+            filtros[clave] = int(valor)
+        elif clave in ('desde', 'hasta'):
+            try:
+                fecha = datetime.strptime(valor, '%d/%m/%Y')
+            except ValueError:
+                raise ValueError(f"Fecha inválida (usa DD/MM/AAAA): {valor}") from None
+            filtros[clave] = fecha.strftime('%d/%m/%Y')
+        elif clave in ('min', 'max'):
+            try:
+                filtros[clave] = float(valor.replace(',', '.'))
+            except ValueError:
+                raise ValueError(f"Monto inválido: {valor}") from None
+        elif clave == 'ref':
+            filtros[clave] = valor
+        else:
+            raise ValueError(f"Filtro desconocido: {clave}")
+    return filtros
+
+def condiciones_pagos(filtros: dict) -> tuple:
+    """Traducir los filtros guardados a condiciones SQL con parámetros"""
+    condiciones = []
+    parametros = []
+    if 'estado' in filtros:
+        condiciones.append("p.estado = %s")
+        parametros.append(filtros['estado'])
+    if 'usuario' in filtros:
+        condiciones.append("p.user_id = %s")
+        parametros.append(filtros['usuario'])
+    if 'desde' in filtros:
+        condiciones.append("p.fecha >= %s")
+        parametros.append(datetime.strptime(filtros['desde'], '%d/%m/%Y'))
+    if 'hasta' in filtros:
+        condiciones.append("p.fecha < %s")
+        parametros.append(datetime.strptime(filtros['hasta'], '%d/%m/%Y') + timedelta(days=1))
+    if 'min' in filtros:
+        condiciones.append("p.monto >= %s")
+        parametros.append(filtros['min'])
+    if 'max' in filtros:
+        condiciones.append("p.monto <= %s")
+        parametros.append(filtros['max'])
+    if 'ref' in filtros:
+        # Prefijo literal: escapar los comodines de LIKE
+        prefijo = filtros['ref'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        condiciones.append("p.referencia LIKE %s")
+        parametros.append(prefijo + '%')
+    return condiciones, parametros
+
+def formatear_pago(fila, posicion: int) -> str:
+    pago_id, user_id, first_name, last_name, referencia, monto, fecha, estado = fila
+    nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
     
+    # Iconos según estado
+    icono = "✅" if estado == "aprobado" else "⏳" if estado == "pendiente" else "❌"
+    
+    entrada = f"{icono} **ID Pago:** {pago_id}\n"
+    entrada += f"👤 **Usuario:** {nombre_completo or 'N/A'} (ID: {user_id})\n"
+    entrada += f"💰 **Monto:** ${monto:.2f}\n"
+    entrada += f"🔢 **Referencia:** {referencia}\n"
+    entrada += f"📅 **Fecha:** {fecha.strftime('%d/%m/%Y %H:%M')}\n"
+    entrada += f"📊 **Estado:** {estado}\n"
+    entrada += f"👁️ /verpago_{pago_id} | 🗑️ /borrarpago_{pago_id}\n"
+    entrada += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    return entrada
+
+async def aviso_archivo_pagos() -> str:
+    # Los pagos de particiones archivadas no aparecen en el listado
+    async with db_connection() as conn:
+        corte = await corte_archivo(conn.cursor(), 'pagos')
+    if not corte:
+        return ''
+    return (f"📦 Pagos anteriores al {corte.strftime('%d/%m/%Y')} archivados: "
+            f"/exportarpagos archivados=si\n\n")
+
+LISTADO_PAGOS = Listado(
+    nombre='pagos',
+    titulo="📋 **TODOS LOS PAGOS - LISTA COMPLETA**",
+    consulta="""
+        SELECT p.id, p.user_id, u.first_name, u.last_name, p.referencia, p.monto, p.fecha, p.estado
+        FROM pagos p
+        LEFT JOIN usuarios u ON p.user_id = u.user_id
+        {donde}
+    """,
+    orden=("p.fecha", "p.id"),
+    clave=lambda fila: (fila[6], fila[0]),
+    formatear=formatear_pago,
+    filtrar=condiciones_pagos,
+    resumen=aviso_archivo_pagos,
+    vacio="📭 No hay pagos registrados en el sistema",
+    pie=(
+        "💡 **Leyenda:** ✅ Aprobado | ⏳ Pendiente | ❌ Rechazado\n"
+        "🔎 Filtros: /verpagostodos ayuda"
+    ),
+)
+
+async def verpagostodos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra TODOS los pagos, con filtros opcionales y paginación (solo admin)"""
     if not is_admin(update.effective_user.id):
-        print(f"❌ DEBUG: Usuario NO es admin")
         await update.message.reply_text("❌ No tienes permisos de administrador")
         return
     
-    print(f"✅ DEBUG: Usuario ES admin, procediendo...")
+    if context.args and context.args[0].lower() == 'ayuda':
+        await update.message.reply_text(AYUDA_FILTROS_PAGOS)
+        return
+    
+    try:
+        filtros = parsear_filtros_pagos(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{AYUDA_FILTROS_PAGOS}")
+        return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT p.id, p.user_id, u.first_name, u.last_name, p.referencia, p.monto, p.fecha, p.estado 
-            FROM pagos p 
-            LEFT JOIN usuarios u ON p.user_id = u.user_id 
-            ORDER BY p.fecha DESC
-            LIMIT 50
-        """)
-        pagos = cursor.fetchall()
-        conn.close()
-        
-        print(f"📊 DEBUG: Encontrados {len(pagos)} pagos")
-        
-        if not pagos:
-            print(f"📭 DEBUG: No hay pagos, enviando mensaje vacío")
-            await update.message.reply_text("📭 No hay pagos registrados en el sistema")
-            return
-        
-        # CONSTRUIR MENSAJE CON LÍMITES
-        mensaje = "📋 **TODOS LOS PAGOS - LISTA COMPLETA**\n\n"
-        
-        contador = 0
-        caracteres_totales = 0
-        
-        for pago_id, user_id, first_name, last_name, referencia, monto, fecha, estado in pagos:
-            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
-            
-            # Iconos según estado
-            icono = "✅" if estado == "aprobado" else "⏳" if estado == "pendiente" else "❌"
-            
-            # Formatear cada pago
-            entrada = f"{icono} **ID Pago:** {pago_id}\n"
-            entrada += f"👤 **Usuario:** {nombre_completo or 'N/A'} (ID: {user_id})\n"
-            entrada += f"💰 **Monto:** ${monto:.2f}\n"
-            entrada += f"🔢 **Referencia:** {referencia}\n"
-            entrada += f"📅 **Fecha:** {fecha.strftime('%d/%m/%Y %H:%M')}\n"
-            entrada += f"📊 **Estado:** {estado}\n"
-            entrada += f"👁️ /verpago_{pago_id} | 🗑️ /borrarpago_{pago_id}\n"
-            entrada += "━━━━━━━━━━━━━━━━━━━━\n\n"
-            
-            # Verificar límite de caracteres (Telegram: 4096 caracteres máximo)
-            if len(mensaje) + len(entrada) > 3900:  # Dejamos margen
-                print(f"⚠️ DEBUG: Límite de caracteres alcanzado en pago #{contador}")
-                mensaje += f"\n📢 **Mostrando primeros {contador} pagos de {len(pagos)}**\n"
-                mensaje += "💡 Use filtros más específicos para ver el resto."
-                break
-            
-            mensaje += entrada
-            caracteres_totales = len(mensaje)
-            contador += 1
-        
-        mensaje += f"\n📊 **Total mostrados:** {contador} de {len(pagos)} pagos\n"
-        mensaje += "💡 **Leyenda:** ✅ Aprobado | ⏳ Pendiente | ❌ Rechazado"
-        
-        print(f"📝 DEBUG: Mensaje construido - {caracteres_totales} caracteres, {contador} pagos")
-        print(f"📝 DEBUG: Primeros 200 caracteres del mensaje:\n{mensaje[:200]}...")
-        
-        # INTENTAR ENVIAR CON MANEJO DE ERRORES
-        try:
-            await update.message.reply_text(mensaje)
-            print(f"✅ DEBUG: Mensaje enviado exitosamente")
-        except Exception as e:
-            print(f"❌ DEBUG: Error al enviar mensaje: {e}")
-            print(f"❌ DEBUG: Tipo de error: {type(e).__name__}")
-            
-            # Intentar enviar en partes si es demasiado largo
-            if "Message is too long" in str(e) or len(mensaje) > 4000:
-                print(f"🔄 DEBUG: Intentando dividir mensaje...")
-                
-                # Dividir mensaje en partes
-                partes = [mensaje[i:i+4000] for i in range(0, len(mensaje), 4000)]
-                for i, parte in enumerate(partes):
-                    try:
-                        await update.message.reply_text(f"📋 **Parte {i+1}/{len(partes)}**\n\n{parte}")
-                        print(f"✅ DEBUG: Parte {i+1} enviada")
-                    except Exception as e2:
-                        print(f"❌ DEBUG: Error en parte {i+1}: {e2}")
-                        await update.message.reply_text(f"❌ Error al mostrar parte {i+1}")
-            else:
-                # Otro tipo de error
-                await update.message.reply_text(f"❌ Error al mostrar los pagos: {str(e)[:100]}")
-        
+        await abrir_listado(update, context, LISTADO_PAGOS, filtros)
     except Exception as e:
-        print(f"❌ DEBUG: Error general en verpagostodos: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Error general en verpagostodos: %s", e)
         await update.message.reply_text(f"❌ Error al obtener pagos: {str(e)[:100]}")
-    
-    print(f"="*60 + "\n")
 
 async def verpago_detalle(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ver detalles de un pago específico (admin)"""
@@ -3666,16 +5579,15 @@ async def verpago_detalle(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         pago_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT p.id, p.user_id, u.first_name, u.last_name, p.referencia, p.monto, p.fecha, p.estado, p.user_name, p.file_id
-            FROM pagos p 
-            LEFT JOIN usuarios u ON p.user_id = u.user_id 
-            WHERE p.id = %s
-        """, (pago_id,))
-        pago = cursor.fetchone()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("""
+                SELECT p.id, p.user_id, u.first_name, u.last_name, p.referencia, p.monto, p.fecha, p.estado, p.user_name, p.file_id
+                FROM pagos p 
+                LEFT JOIN usuarios u ON p.user_id = u.user_id 
+                WHERE p.id = %s
+            """, (pago_id,))
+            pago = await cursor.fetchone()
         
         if pago:
             pago_id, user_id, first_name, last_name, referencia, monto, fecha, estado, user_name, file_id = pago
@@ -3689,7 +5601,7 @@ async def verpago_detalle(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         caption=f"📸 **Comprobante de pago**\n🆔 ID Pago: {pago_id}"
                     )
                 except Exception as e:
-                    print(f"❌ Error al enviar imagen: {e}")
+                    logger.error(f"❌ Error al enviar imagen: {e}")
                     await update.message.reply_text("❌ No se pudo cargar la imagen del comprobante")
             
             # LUEGO enviar los detalles en texto
@@ -3714,7 +5626,7 @@ async def verpago_detalle(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Pago no encontrado")
             
     except Exception as e:
-        print(f"❌ Error en verpago_detalle: {e}")
+        logger.error(f"❌ Error en verpago_detalle: {e}")
         await update.message.reply_text("❌ Error al mostrar el pago")
 
 async def borrarpago_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3727,16 +5639,15 @@ async def borrarpago_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         pago_id = command_text.split('_')[1]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT p.id, p.user_id, u.first_name, u.last_name, p.referencia, p.monto, p.estado
-            FROM pagos p 
-            LEFT JOIN usuarios u ON p.user_id = u.user_id 
-            WHERE p.id = %s
-        """, (pago_id,))
-        pago = cursor.fetchone()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("""
+                SELECT p.id, p.user_id, u.first_name, u.last_name, p.referencia, p.monto, p.estado
+                FROM pagos p 
+                LEFT JOIN usuarios u ON p.user_id = u.user_id 
+                WHERE p.id = %s
+            """, (pago_id,))
+            pago = await cursor.fetchone()
         
         if pago:
             pago_id, user_id, first_name, last_name, referencia, monto, estado = pago
@@ -3764,7 +5675,7 @@ async def borrarpago_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Pago no encontrado")
             
     except Exception as e:
-        print(f"❌ Error en borrarpago_admin: {e}")
+        logger.error(f"❌ Error en borrarpago_admin: {e}")
         await update.message.reply_text("❌ Error al procesar la eliminación")
         
         
@@ -3789,21 +5700,20 @@ async def buscar_usuario_asignar(update: Update, context: ContextTypes.DEFAULT_T
 
     nombre_busqueda = ' '.join(context.args).lower()
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    # Buscar usuarios que coincidan con el nombre
-    cursor.execute("""
-        SELECT user_id, first_name, last_name, phone 
-        FROM usuarios 
-        WHERE LOWER(CONCAT(first_name, ' ', last_name)) LIKE %s 
-           OR LOWER(first_name) LIKE %s 
-           OR LOWER(last_name) LIKE %s
-        ORDER BY first_name, last_name
-    """, (f'%{nombre_busqueda}%', f'%{nombre_busqueda}%', f'%{nombre_busqueda}%'))
+        # Buscar usuarios que coincidan con el nombre
+        await cursor.execute("""
+            SELECT user_id, first_name, last_name, phone 
+            FROM usuarios 
+            WHERE LOWER(CONCAT(first_name, ' ', last_name)) LIKE %s 
+               OR LOWER(first_name) LIKE %s 
+               OR LOWER(last_name) LIKE %s
+            ORDER BY first_name, last_name
+        """, (f'%{nombre_busqueda}%', f'%{nombre_busqueda}%', f'%{nombre_busqueda}%'))
     
-    usuarios = cursor.fetchall()
-    conn.close()
+        usuarios = await cursor.fetchall()
 
     if not usuarios:
         await update.message.reply_text(
@@ -3848,27 +5758,21 @@ async def buscar_usuario_asignar(update: Update, context: ContextTypes.DEFAULT_T
 
 async def iniciar_asignacion_productos(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, nombre_completo: str):
     """Inicia el proceso de asignación de productos a un usuario específico"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Obtener productos activos (caché del catálogo)
+    productos = await catalogo_cache.activos_por_nombre()
     
-    # Obtener productos activos
-    cursor.execute("SELECT id, nombre, precio, descripcion FROM productos WHERE estado = 'activo' ORDER BY nombre")
-    productos = cursor.fetchall()
-    
-    # Obtener plan actual del usuario (si existe)
-    cursor.execute("SELECT productos_json FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
-    plan_actual = cursor.fetchone()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    productos_actuales = {}
-    if plan_actual and plan_actual[0]:
-        productos_actuales = plan_actual[0] if isinstance(plan_actual[0], dict) else json.loads(plan_actual[0])
+        # Obtener plan actual del usuario (si existe)
+        await cursor.execute("SELECT productos_json FROM planes_pago WHERE user_id = %s AND estado = 'activo'", (user_id,))
+        plan_actual = await cursor.fetchone()
     
-    # Obtener configuración de semanas
-    cursor.execute("SELECT semanas FROM config_pagos LIMIT 1")
-    config = cursor.fetchone()
-    semanas = config[0] if config else 10
+        productos_actuales = {}
+        if plan_actual and plan_actual[0]:
+            productos_actuales = plan_actual[0] if isinstance(plan_actual[0], dict) else json.loads(plan_actual[0])
     
-    conn.close()
+    semanas = await configuracion_pagos.semanas()
 
     if not productos:
         await update.message.reply_text("❌ No hay productos disponibles en el catálogo")
@@ -3968,81 +5872,91 @@ async def configurar_semanas_usuario(update: Update, context: ContextTypes.DEFAU
             await update.message.reply_text("❌ El número máximo de semanas es 52 (1 año)")
             return
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 1. Verificar si el usuario tiene plan activo
-        cursor.execute("""
-            SELECT p.id, p.semanas, p.semanas_completadas, p.total, p.productos_json,
-                   u.first_name, u.last_name
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        plan = cursor.fetchone()
+            # 1. Verificar si el usuario tiene plan activo
+            await cursor.execute("""
+                SELECT p.id, p.semanas, p.semanas_completadas, p.total, p.productos_json,
+                       u.first_name, u.last_name
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        if not plan:
-            await update.message.reply_text("❌ Usuario no tiene plan activo")
-            conn.close()
-            return
+            plan = await cursor.fetchone()
         
-        plan_id, semanas_actuales, semanas_comp, total_actual, productos_json, first_name, last_name = plan
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            if not plan:
+                await update.message.reply_text("❌ Usuario no tiene plan activo")
+                return
         
-        # 2. Calcular nuevo pago semanal
-        nuevo_pago_semanal = total_actual / nuevas_semanas if nuevas_semanas > 0 else 0
+            plan_id, semanas_actuales, semanas_comp, total_actual, productos_json, first_name, last_name = plan
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # 3. Verificar si las semanas completadas exceden las nuevas
-        if semanas_comp > nuevas_semanas:
-            keyboard = [
-                [InlineKeyboardButton("✅ Sí, reiniciar a 0", callback_data=f"reiniciar_semanas_{user_id}_{nuevas_semanas}")],
-                [InlineKeyboardButton("🔄 Mantener completadas", callback_data=f"mantener_semanas_{user_id}_{nuevas_semanas}_{semanas_comp}")],
-                [InlineKeyboardButton("❌ Cancelar", callback_data=f"cancelar_config_{user_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            # 2. Calcular nuevo pago semanal
+            nuevo_pago_semanal = total_actual / nuevas_semanas if nuevas_semanas > 0 else 0
+        
+            # 3. Verificar si las semanas completadas exceden las nuevas
+            if semanas_comp > nuevas_semanas:
+                keyboard = [
+                    [InlineKeyboardButton("✅ Sí, reiniciar a 0", callback_data=f"reiniciar_semanas_{user_id}_{nuevas_semanas}")],
+                    [InlineKeyboardButton("🔄 Mantener completadas", callback_data=f"mantener_semanas_{user_id}_{nuevas_semanas}_{semanas_comp}")],
+                    [InlineKeyboardButton("❌ Cancelar", callback_data=f"cancelar_config_{user_id}")]
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await update.message.reply_text(
-                f"⚠️ **CONFLICTO DE SEMANAS**\n\n"
-                f"👤 Usuario: {nombre_completo}\n"
-                f"📊 Semanas completadas: {semanas_comp}\n"
-                f"🔢 Nuevas semanas totales: {nuevas_semanas}\n\n"
-                f"❌ **El usuario ya completó más semanas de las que intentas configurar.**\n\n"
-                f"¿Qué deseas hacer?",
-                reply_markup=reply_markup
+                await update.message.reply_text(
+                    f"⚠️ **CONFLICTO DE SEMANAS**\n\n"
+                    f"👤 Usuario: {nombre_completo}\n"
+                    f"📊 Semanas completadas: {semanas_comp}\n"
+                    f"🔢 Nuevas semanas totales: {nuevas_semanas}\n\n"
+                    f"❌ **El usuario ya completó más semanas de las que intentas configurar.**\n\n"
+                    f"¿Qué deseas hacer?",
+                    reply_markup=reply_markup
+                )
+                return
+        
+            # 4. Actualizar las semanas del usuario
+            await cursor.execute("""
+                UPDATE planes_pago 
+                SET semanas = %s,
+                    pago_semanal = %s,
+                    fecha_configuracion = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
+        
+            # 5. Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\n"
+                f"El administrador ha modificado tu plan de pago:\n\n"
+                f"📅 **Nuevas semanas totales:** {nuevas_semanas}\n"
+                f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
+                f"📊 **Progreso actual:** {semanas_comp}/{nuevas_semanas}\n\n"
+                f"📋 Ver detalles: /misplanes\n"
+                f"❓ Consultas: Contacta al administrador",
+                'configurar_semanas'
             )
-            conn.close()
-            return
+            await conn.commit()
         
-        # 4. Actualizar las semanas del usuario
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET semanas = %s,
-                pago_semanal = %s,
-                fecha_configuracion = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
-        
-        conn.commit()
-        
-        # 5. Obtener productos para mostrar detalles
-        productos_lista = []
-        if productos_json:
-            if isinstance(productos_json, str):
-                productos_dict = json.loads(productos_json)
-            else:
-                productos_dict = productos_json
+            # 6. Obtener productos para mostrar detalles
+            productos_lista = []
+            if productos_json:
+                if isinstance(productos_json, str):
+                    productos_dict = json.loads(productos_json)
+                else:
+                    productos_dict = productos_json
             
-            for producto_id, cantidad in productos_dict.items():
-                cursor.execute("SELECT nombre, precio FROM productos WHERE id = %s", (int(producto_id),))
-                producto = cursor.fetchone()
-                if producto:
-                    nombre, precio = producto
-                    productos_lista.append(f"• {nombre} x{cantidad} - ${precio * cantidad:.2f}")
+                for producto_id, cantidad in productos_dict.items():
+                    await cursor.execute("SELECT nombre, precio FROM productos WHERE id = %s", (int(producto_id),))
+                    producto = await cursor.fetchone()
+                    if producto:
+                        nombre, precio = producto
+                        productos_lista.append(f"• {nombre} x{cantidad} - ${precio * cantidad:.2f}")
         
-        conn.close()
+        despertar_notificaciones()
         
-        # 6. Mostrar confirmación
+        # 7. Mostrar confirmación
         mensaje = f"✅ **SEMANAS CONFIGURADAS**\n\n"
         mensaje += f"👤 **Usuario:** {nombre_completo}\n"
         mensaje += f"🆔 **ID:** {user_id}\n\n"
@@ -4057,29 +5971,14 @@ async def configurar_semanas_usuario(update: Update, context: ContextTypes.DEFAU
             mensaje += "🛍️ **Productos asignados:**\n"
             mensaje += "\n".join(productos_lista) + "\n\n"
         
-        mensaje += f"📞 **El usuario ha sido notificado.**"
+        mensaje += f"📣 **El usuario será notificado.**"
         
         await update.message.reply_text(mensaje)
         
-        # 7. Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\n"
-                     f"El administrador ha modificado tu plan de pago:\n\n"
-                     f"📅 **Nuevas semanas totales:** {nuevas_semanas}\n"
-                     f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
-                     f"📊 **Progreso actual:** {semanas_comp}/{nuevas_semanas}\n\n"
-                     f"📋 Ver detalles: /misplanes\n"
-                     f"❓ Consultas: Contacta al administrador"
-            )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
-        
     except ValueError:
         await update.message.reply_text("❌ Formato incorrecto. Usa: /configurarsemanas_USERID cantidad")
     except Exception as e:
-        print(f"❌ Error en configurar_semanas_usuario: {e}")
+        logger.error(f"❌ Error en configurar_semanas_usuario: {e}")
         await update.message.reply_text("❌ Error al configurar las semanas")
 
 async def configurar_semanas_busqueda(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -4101,24 +6000,23 @@ async def configurar_semanas_busqueda(update: Update, context: ContextTypes.DEFA
     
     nombre_busqueda = ' '.join(context.args).lower()
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Buscar usuarios con planes activos
-    cursor.execute("""
-        SELECT u.user_id, u.first_name, u.last_name, 
-               p.semanas, p.semanas_completadas, p.pago_semanal, p.total
-        FROM usuarios u
-        INNER JOIN planes_pago p ON u.user_id = p.user_id
-        WHERE p.estado = 'activo'
-        AND (LOWER(CONCAT(u.first_name, ' ', u.last_name)) LIKE %s 
-             OR LOWER(u.first_name) LIKE %s 
-             OR LOWER(u.last_name) LIKE %s)
-        ORDER BY u.first_name, u.last_name
-    """, (f'%{nombre_busqueda}%', f'%{nombre_busqueda}%', f'%{nombre_busqueda}%'))
-    
-    usuarios = cursor.fetchall()
-    conn.close()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
+    
+        # Buscar usuarios con planes activos
+        await cursor.execute("""
+            SELECT u.user_id, u.first_name, u.last_name, 
+                   p.semanas, p.semanas_completadas, p.pago_semanal, p.total
+            FROM usuarios u
+            INNER JOIN planes_pago p ON u.user_id = p.user_id
+            WHERE p.estado = 'activo'
+            AND (LOWER(CONCAT(u.first_name, ' ', u.last_name)) LIKE %s 
+                 OR LOWER(u.first_name) LIKE %s 
+                 OR LOWER(u.last_name) LIKE %s)
+            ORDER BY u.first_name, u.last_name
+        """, (f'%{nombre_busqueda}%', f'%{nombre_busqueda}%', f'%{nombre_busqueda}%'))
+    
+        usuarios = await cursor.fetchall()
     
     if not usuarios:
         await update.message.reply_text(
@@ -4166,36 +6064,35 @@ async def ver_configuraciones_semanas(update: Update, context: ContextTypes.DEFA
         await update.message.reply_text("❌ No tienes permisos de administrador")
         return
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    # Obtener todas las configuraciones
-    cursor.execute("""
-        SELECT u.user_id, u.first_name, u.last_name,
-               p.semanas, p.semanas_completadas, p.pago_semanal, p.total,
-               p.fecha_configuracion, p.contador_pausado
-        FROM planes_pago p
-        LEFT JOIN usuarios u ON p.user_id = u.user_id
-        WHERE p.estado = 'activo'
-        ORDER BY p.semanas DESC, u.first_name
-    """)
-    
-    configuraciones = cursor.fetchall()
-    
-    # Estadísticas
-    cursor.execute("""
-        SELECT 
-            COUNT(*) as total_usuarios,
-            AVG(semanas) as promedio_semanas,
-            MIN(semanas) as minimo_semanas,
-            MAX(semanas) as maximo_semanas,
-            SUM(CASE WHEN contador_pausado THEN 1 ELSE 0 END) as pausados
-        FROM planes_pago 
-        WHERE estado = 'activo'
-    """)
+        # Obtener todas las configuraciones
+        await cursor.execute("""
+            SELECT u.user_id, u.first_name, u.last_name,
+                   p.semanas, p.semanas_completadas, p.pago_semanal, p.total,
+                   p.fecha_configuracion, p.contador_pausado
+            FROM planes_pago p
+            LEFT JOIN usuarios u ON p.user_id = u.user_id
+            WHERE p.estado = 'activo'
+            ORDER BY p.semanas DESC, u.first_name
+        """)
+    
+        configuraciones = await cursor.fetchall()
+    
+        # Estadísticas
+        await cursor.execute("""
+            SELECT 
+                COUNT(*) as total_usuarios,
+                AVG(semanas) as promedio_semanas,
+                MIN(semanas) as minimo_semanas,
+                MAX(semanas) as maximo_semanas,
+                SUM(CASE WHEN contador_pausado THEN 1 ELSE 0 END) as pausados
+            FROM planes_pago 
+            WHERE estado = 'activo'
+        """)
     
-    stats = cursor.fetchone()
-    conn.close()
+        stats = await cursor.fetchone()
     
     if not configuraciones:
         await update.message.reply_text("📭 No hay configuraciones activas")
@@ -4258,7 +6155,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    print(f"🟡 BOTÓN PRESIONADO: {query.data}")
+    logger.debug("Botón presionado: %s", query.data)
     user_id = query.from_user.id
     
     
@@ -4270,11 +6167,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
         user_id_seleccionado = query.data.split('_')[2]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id_seleccionado,))
-        usuario = cursor.fetchone()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("SELECT first_name, last_name FROM usuarios WHERE user_id = %s", (user_id_seleccionado,))
+            usuario = await cursor.fetchone()
         
         if usuario:
             first_name, last_name = usuario
@@ -4293,7 +6189,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             
         if query.data == "semanas_personalizado":
-            context.user_data['configurando_semanas'] = True
+            fijar_estado(context, EstadoChat.CONFIGURANDO_SEMANAS)
             await query.edit_message_text(
                 "🔢 **CONFIGURAR SEMANAS PERSONALIZADAS**\n\n"
                 "Envía el número de semanas deseado (ejemplo: 15):\n\n"
@@ -4304,51 +6200,51 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             semanas = int(query.data.split('_')[1])
             
-            conn = get_db_connection()
-            cursor = conn.cursor()
+            async with db_connection() as conn:
+                cursor = conn.cursor()
             
-            # 1. Actualizar configuración
-            cursor.execute("UPDATE config_pagos SET semanas = %s", (semanas,))
+                # 1. Actualizar configuración
+                await configuracion_pagos.guardar(cursor, semanas=semanas)
             
-            # 2. ✅ RECALCULAR TODOS LOS PLANES CON LAS NUEVAS SEMANAS
-            cursor.execute("SELECT id, productos_json FROM planes_pago WHERE estado = 'activo'")
-            planes = cursor.fetchall()
+                # 2. ✅ RECALCULAR TODOS LOS PLANES CON LAS NUEVAS SEMANAS
+                await cursor.execute("SELECT id, productos_json FROM planes_pago WHERE estado = 'activo'")
+                planes = await cursor.fetchall()
             
-            planes_actualizados = 0
-            for plan_id, productos_json in planes:
-                if productos_json:
-                    # Convertir JSON si es necesario
-                    if isinstance(productos_json, str):
-                        productos_dict = json.loads(productos_json)
-                    else:
-                        productos_dict = productos_json
+                planes_actualizados = 0
+                for plan_id, productos_json in planes:
+                    if productos_json:
+                        # Convertir JSON si es necesario
+                        if isinstance(productos_json, str):
+                            productos_dict = json.loads(productos_json)
+                        else:
+                            productos_dict = productos_json
                     
-                    # Calcular nuevo total
-                    total_nuevo = 0
-                    for producto_id, cantidad in productos_dict.items():
-                        cursor.execute("SELECT precio FROM productos WHERE id = %s", (int(producto_id),))
-                        producto = cursor.fetchone()
-                        if producto:
-                            total_nuevo += producto[0] * cantidad
+                        # Calcular nuevo total
+                        total_nuevo = 0
+                        for producto_id, cantidad in productos_dict.items():
+                            await cursor.execute("SELECT precio FROM productos WHERE id = %s", (int(producto_id),))
+                            producto = await cursor.fetchone()
+                            if producto:
+                                total_nuevo += producto[0] * cantidad
                     
-                    # Calcular nuevo pago semanal
-                    pago_semanal_nuevo = total_nuevo / semanas if semanas > 0 else 0
+                        # Calcular nuevo pago semanal
+                        pago_semanal_nuevo = total_nuevo / semanas if semanas > 0 else 0
                     
-                    # Actualizar el plan
-                    cursor.execute("""
-                        UPDATE planes_pago 
-                        SET semanas_completadas = 0,
-                            fecha_ultimo_pago = CURRENT_TIMESTAMP,
-                            total = %s,
-                            semanas = %s,
-                            pago_semanal = %s
-                        WHERE id = %s
-                    """, (total_nuevo, semanas, pago_semanal_nuevo, plan_id))
+                        # Actualizar el plan
+                        await cursor.execute("""
+                            UPDATE planes_pago 
+                            SET semanas_completadas = 0,
+                                fecha_ultimo_pago = CURRENT_TIMESTAMP,
+                                total = %s,
+                                semanas = %s,
+                                pago_semanal = %s
+                            WHERE id = %s
+                        """, (total_nuevo, semanas, pago_semanal_nuevo, plan_id))
                     
-                    planes_actualizados += 1
+                        planes_actualizados += 1
             
-            conn.commit()
-            conn.close()
+                await conn.commit()
+            configuracion_pagos.invalidar()
 
             await query.edit_message_text(
                 f"✅ **Configuración actualizada y planes recalculados**\n\n"
@@ -4362,7 +6258,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
         except Exception as e:
-            print(f"❌ Error al configurar semanas: {e}")
+            logger.error(f"❌ Error al configurar semanas: {e}")
             await query.edit_message_text("❌ Error al configurar las semanas")
 
     # EDITAR PRODUCTO (ADMIN)
@@ -4375,10 +6271,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         tipo = partes[1]
         producto_id = partes[2]
         
-        context.user_data['editando_campo'] = {
-            'tipo': tipo,
-            'producto_id': producto_id
-        }
+        fijar_estado(context, EstadoChat.EDITANDO_PRODUCTO, tipo=tipo, producto_id=producto_id)
         
         mensajes = {
             'nombre': "Envía el nuevo nombre del producto:",
@@ -4397,11 +6290,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
         producto_id = query.data.split('_')[2]
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE productos SET estado = 'inactivo' WHERE id = %s", (producto_id,))
-        conn.commit()
-        conn.close()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("UPDATE productos SET estado = 'inactivo' WHERE id = %s", (producto_id,))
+            await avisar_cambio_catalogo(cursor)
+            await conn.commit()
+        catalogo_cache.invalidar()
         
         await query.edit_message_text("✅ **Producto eliminado**\n\nEl producto ha sido marcado como inactivo.")
         
@@ -4425,25 +6319,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id_eliminar = query.data.split('_')[3]
         
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
+            async with db_connection() as conn:
+                cursor = conn.cursor()
             
-            # 1. Marcar planes como eliminados
-            cursor.execute("UPDATE planes_pago SET estado = 'eliminado' WHERE user_id = %s", (user_id_eliminar,))
+                # 1. Marcar planes como eliminados
+                await cursor.execute("UPDATE planes_pago SET estado = 'eliminado' WHERE user_id = %s", (user_id_eliminar,))
             
-            # 2. ELIMINAR DATOS DE PUNTOS (NUEVO)
-            cursor.execute("DELETE FROM usuarios_puntos WHERE user_id = %s", (user_id_eliminar,))
-            cursor.execute("DELETE FROM puntos_historial WHERE user_id = %s", (user_id_eliminar,))
+                # 2. ELIMINAR DATOS DE PUNTOS (NUEVO)
+                await cursor.execute("DELETE FROM usuarios_puntos WHERE user_id = %s", (user_id_eliminar,))
+                await cursor.execute("DELETE FROM puntos_historial WHERE user_id = %s", (user_id_eliminar,))
             
-            # 3. Actualizar referidos (marcar como eliminados o mantener según prefieras)
-            cursor.execute("UPDATE referidos SET estado = 'eliminado' WHERE user_id_referidor = %s OR user_id_referido = %s", 
-                        (user_id_eliminar, user_id_eliminar))
+                # 3. Actualizar referidos (marcar como eliminados o mantener según prefieras)
+                await cursor.execute("UPDATE referidos SET estado = 'eliminado' WHERE user_id_referidor = %s OR user_id_referido = %s", 
+                            (user_id_eliminar, user_id_eliminar))
             
-            # 4. Eliminar usuario
-            cursor.execute("DELETE FROM usuarios WHERE user_id = %s", (user_id_eliminar,))
+                # 4. Eliminar usuario
+                await cursor.execute("DELETE FROM usuarios WHERE user_id = %s", (user_id_eliminar,))
             
-            conn.commit()
-            conn.close()
+                await conn.commit()
             
             await query.edit_message_text(
                 f"✅ **Usuario eliminado completamente**\n\n"
@@ -4457,7 +6350,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
         except Exception as e:
-            print(f"❌ Error al eliminar usuario: {e}")
+            logger.error(f"❌ Error al eliminar usuario: {e}")
             await query.edit_message_text("❌ Error al eliminar el usuario")
 
     
@@ -4473,11 +6366,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pago_id = query.data.split('_')[2]
         
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM pagos WHERE id = %s", (pago_id,))
-            conn.commit()
-            conn.close()
+            async with db_connection() as conn:
+                cursor = conn.cursor()
+                await cursor.execute("DELETE FROM pagos WHERE id = %s", (pago_id,))
+                await conn.commit()
             
             await query.edit_message_text(
                 f"✅ **Pago eliminado correctamente**\n\n"
@@ -4486,7 +6378,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
         except Exception as e:
-            print(f"❌ Error al eliminar pago: {e}")
+            logger.error(f"❌ Error al eliminar pago: {e}")
             await query.edit_message_text("❌ Error al eliminar el pago")
     
     elif query.data.startswith("borrarpago_no_"):
@@ -4499,35 +6391,39 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
             
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
+            async with db_connection() as conn:
+                cursor = conn.cursor()
             
-            # 1. Vaciar tabla de usuarios_puntos
-            cursor.execute("DELETE FROM usuarios_puntos")
-            usuarios_eliminados = cursor.rowcount
+                # Conteos para el resumen (el historial, estimado)
+                await cursor.execute("""
+                    SELECT (SELECT COALESCE(SUM(usuarios), 0) FROM ranking_puntos),
+                           (SELECT COUNT(*) FROM referidos)
+                """)
+                usuarios_eliminados, referidos_eliminados = await cursor.fetchone()
+                historial_eliminado = await filas_estimadas(cursor, 'puntos_historial')
             
-            # 2. Vaciar historial de puntos
-            cursor.execute("DELETE FROM puntos_historial")
-            historial_eliminado = cursor.rowcount
+                # TRUNCATE en lugar de DELETE fila por fila: en puntos_historial
+                # vacía todas sus particiones de una vez. Incluye el conteo del
+                # ranking (TRUNCATE no dispara su trigger) y los beneficios
+                # desbloqueados, que con el saldo en cero vuelven a estar disponibles.
+                await cursor.execute("""
+                    TRUNCATE usuarios_puntos, puntos_historial, referidos,
+                             ranking_puntos, beneficios_usuarios
+                """)
             
-            # 3. Vaciar tabla de referidos
-            cursor.execute("DELETE FROM referidos")
-            referidos_eliminados = cursor.rowcount
-            
-            conn.commit()
-            conn.close()
+                await conn.commit()
             
             await query.edit_message_text(
                 f"✅ **Sistema de puntos vaciado completamente**\n\n"
                 f"🗑️ **Datos eliminados:**\n"
                 f"• 👥 {usuarios_eliminados} usuarios de puntos\n"
-                f"• 📊 {historial_eliminado} registros de historial\n"
+                f"• 📊 ~{historial_eliminado} registros de historial\n"
                 f"• 👥 {referidos_eliminados} referidos\n\n"
                 f"El sistema de puntos ha sido reiniciado a cero."
             )
             
         except Exception as e:
-            print(f"❌ Error al vaciar puntos: {e}")
+            logger.error(f"❌ Error al vaciar puntos: {e}")
             await query.edit_message_text("❌ Error al vaciar el sistema de puntos")
 
     # CANCELAR VACIADO DE PUNTOS
@@ -4541,117 +6437,60 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =============================================
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Maneja TODOS los mensajes de texto en el orden correcto"""
-    print(f"🔵 MENSAJE RECIBIDO: {update.message.text}")
-    print(f"🔵 USER DATA: {context.user_data}")
-    
-    user_id = update.effective_user.id
-    
-    # 1. Verificar si está registrando usuario
-    if context.user_data.get('registrando_usuario'):
-        await handle_phone_registration(update, context)
+    """Maneja TODOS los mensajes de texto según el estado del chat"""
+    estado, _ = obtener_estado(context)
+    logger.debug("Mensaje de %s en estado %s", update.effective_user.id, estado.value)
+    
+    # Un solo acceso al estado: el manejador correspondiente o mensaje normal
+    manejador = MANEJADORES_ESTADO.get(estado)
+    if manejador:
+        await manejador(update, context)
         return
     
-    # 2. Verificar si está agregando producto (admin)
-    if context.user_data.get('agregando_producto'):
-        await handle_agregar_producto(update, context)
-        return
-    
-    # 3. Verificar si está editando producto (admin)
-    if context.user_data.get('editando_campo'):
-        await handle_editar_producto(update, context)
-        return
-    
-    # 4. Verificar si está configurando semanas (admin)
-    if context.user_data.get('configurando_semanas'):
-        await handle_configurar_semanas(update, context)
-        return
-    
-    # 5. Verificar si es motivo de rechazo
-    if context.user_data.get('rechazando_pago'):
-        await handle_rechazo_motivo(update, context)
-        return
-    
-    # 6. Verificar si hay solicitud pendiente de puntos personalizados (solo admin)
-    if is_admin(user_id):
-        tiene_solicitud_puntos = False
-        for key in context.user_data.keys():
-            if key.startswith('esperando_puntos_personalizado_'):
-                tiene_solicitud_puntos = True
-                break
-        
-        if tiene_solicitud_puntos:
-            await handle_puntos_personalizados(update, context)
-            return
-    
-    # 7. Verificar si hay solicitud pendiente de semanas personalizadas (solo admin)
-    if is_admin(user_id):
-        tiene_solicitud_semanas = False
-        for key in context.user_data.keys():
-            if key.startswith('config_personalizado_'):
-                tiene_solicitud_semanas = True
-                break
-        
-        if tiene_solicitud_semanas:
-            await handle_semanas_personalizadas(update, context)
-            return
-    
-    # 8. Verificar si estamos esperando datos de pago (USUARIOS NORMALES)
-    if context.user_data.get('esperando_datos_pago'):
-        print("✅ SÍ estaba esperando datos de pago")
-        
-        # Procesar datos del pago
-        texto = update.message.text
-        lineas = texto.split('\n')
-        datos = {}
-        
-        print(f"📝 Líneas detectadas: {lineas}")
-        
-        for linea in lineas:
-            linea = linea.strip()
-            if ':' in linea:
-                partes = linea.split(':', 1)
-                clave = partes[0].strip().lower()
-                valor = partes[1].strip()
-                datos[clave] = valor
-                print(f"📋 Dato extraído: '{clave}' = '{valor}'")
-
-        # Verificar datos
-        if 'nombre' in datos and 'referencia' in datos and 'monto' in datos:
-            context.user_data['datos_pago'] = datos
-            await update.message.reply_text(
-                "✅ Datos recibidos. Ahora por favor envía la imagen del comprobante."
-            )
-            print("🎉 TODOS los datos completos - listo para imagen")
-            print(f"🎉 Datos guardados: {datos}")
-        else:
-            print(f"❌ Datos incompletos. Tenemos: {list(datos.keys())}")
-            await update.message.reply_text(
-                "❌ Formato incorrecto. Usa:\n\n"
-                "Nombre: Tu nombre completo\n"
-                "Referencia: Número de referencia\n"
-                "Monto: Cantidad pagada"
-            )
-        
-        context.user_data['esperando_datos_pago'] = False
-        context.user_data['esperando_imagen'] = True
-        print(f"🟡 USER DATA después de procesar texto: {context.user_data}")
-        
-        return
-    
-    # 9. Si no es nada de lo anterior, mensaje normal
-    print("❌ NO estaba esperando nada específico - mensaje normal")
     await update.message.reply_text(
         "Usa /pagarealizado para registrar un pago o /catalogo para ver productos\n"
         "Para ayuda usa /start"
     )
+
+async def handle_datos_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Recibe los datos del pago (nombre, referencia, monto) antes del comprobante"""
+    # Procesar datos del pago
+    texto = update.message.text
+    lineas = texto.split('\n')
+    datos = {}
+    
+    for linea in lineas:
+        linea = linea.strip()
+        if ':' in linea:
+            partes = linea.split(':', 1)
+            clave = partes[0].strip().lower()
+            valor = partes[1].strip()
+            datos[clave] = valor
+
+    # Verificar datos
+    if 'nombre' in datos and 'referencia' in datos and 'monto' in datos:
+        fijar_estado(context, EstadoChat.ESPERANDO_IMAGEN, datos_pago=datos)
+        await update.message.reply_text(
+            "✅ Datos recibidos. Ahora por favor envía la imagen del comprobante."
+        )
+        logger.debug("Datos de pago completos de %s", update.effective_user.id)
+    else:
+        # Se sigue esperando el texto para que el usuario pueda corregirlo
+        logger.debug("Datos de pago incompletos de %s: %s", update.effective_user.id, list(datos))
+        await update.message.reply_text(
+            "❌ Formato incorrecto. Usa:\n\n"
+            "Nombre: Tu nombre completo\n"
+            "Referencia: Número de referencia\n"
+            "Monto: Cantidad pagada"
+        )
 # =============================================
 # FUNCIONES DE MANEJO DE PRODUCTOS
 # =============================================
 
 async def handle_agregar_producto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja el proceso de agregar producto completo"""
-    if not context.user_data.get('agregando_producto'):
+    estado, _ = obtener_estado(context)
+    if estado != EstadoChat.AGREGANDO_PRODUCTO:
         return
     
     texto = update.message.text
@@ -4674,16 +6513,17 @@ async def handle_agregar_producto(update: Update, context: ContextTypes.DEFAULT_
             descripcion = datos.get('descripción', datos.get('descripcion', ''))
             categoria = datos.get('categoría', datos.get('categoria', 'General'))
             
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO productos (nombre, precio, descripcion, categoria) VALUES (%s, %s, %s, %s)",
-                (nombre, precio, descripcion, categoria)
-            )
-            conn.commit()
-            conn.close()
+            async with db_connection() as conn:
+                cursor = conn.cursor()
+                await cursor.execute(
+                    "INSERT INTO productos (nombre, precio, descripcion, categoria) VALUES (%s, %s, %s, %s)",
+                    (nombre, precio, descripcion, categoria)
+                )
+                await avisar_cambio_catalogo(cursor)
+                await conn.commit()
+            catalogo_cache.invalidar()
             
-            context.user_data['agregando_producto'] = False
+            limpiar_estado(context)
             
             await update.message.reply_text(
                 f"✅ **Producto agregado exitosamente**\n\n"
@@ -4693,12 +6533,12 @@ async def handle_agregar_producto(update: Update, context: ContextTypes.DEFAULT_
                 f"📂 **Categoría:** {categoria}\n\n"
                 f"Los usuarios ya pueden verlo en el catálogo con /catalogo"
             )
-            print(f"✅ Producto agregado: {nombre} - ${precio}")
+            logger.info(f"✅ Producto agregado: {nombre} - ${precio}")
             
         except ValueError:
             await update.message.reply_text("❌ El precio debe ser un número válido")
         except Exception as e:
-            print(f"❌ Error al agregar producto: {e}")
+            logger.error(f"❌ Error al agregar producto: {e}")
             await update.message.reply_text("❌ Error al agregar el producto")
     else:
         await update.message.reply_text(
@@ -4711,49 +6551,51 @@ async def handle_agregar_producto(update: Update, context: ContextTypes.DEFAULT_
 
 async def handle_editar_producto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja la edición de productos"""
-    if not context.user_data.get('editando_campo'):
+    estado, campo = obtener_estado(context)
+    if estado != EstadoChat.EDITANDO_PRODUCTO:
         return
     
-    campo = context.user_data['editando_campo']
     nuevo_valor = update.message.text.strip()
     producto_id = campo['producto_id']
     tipo = campo['tipo']
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        if tipo == 'precio':
-            nuevo_valor = float(nuevo_valor)
-            cursor.execute("UPDATE productos SET precio = %s WHERE id = %s", (nuevo_valor, producto_id))
-        elif tipo == 'nombre':
-            cursor.execute("UPDATE productos SET nombre = %s WHERE id = %s", (nuevo_valor, producto_id))
-        elif tipo == 'descripcion':
-            cursor.execute("UPDATE productos SET descripcion = %s WHERE id = %s", (nuevo_valor, producto_id))
-        elif tipo == 'categoria':
-            cursor.execute("UPDATE productos SET categoria = %s WHERE id = %s", (nuevo_valor, producto_id))
+            if tipo == 'precio':
+                nuevo_valor = float(nuevo_valor)
+                await cursor.execute("UPDATE productos SET precio = %s WHERE id = %s", (nuevo_valor, producto_id))
+            elif tipo == 'nombre':
+                await cursor.execute("UPDATE productos SET nombre = %s WHERE id = %s", (nuevo_valor, producto_id))
+            elif tipo == 'descripcion':
+                await cursor.execute("UPDATE productos SET descripcion = %s WHERE id = %s", (nuevo_valor, producto_id))
+            elif tipo == 'categoria':
+                await cursor.execute("UPDATE productos SET categoria = %s WHERE id = %s", (nuevo_valor, producto_id))
         
-        conn.commit()
-        conn.close()
+            await avisar_cambio_catalogo(cursor)
+            await conn.commit()
+        catalogo_cache.invalidar()
         
-        context.user_data['editando_campo'] = None
+        limpiar_estado(context)
         
         await update.message.reply_text(f"✅ **{tipo.capitalize()} actualizado correctamente**")
         
     except ValueError:
         await update.message.reply_text("❌ El precio debe ser un número válido")
     except Exception as e:
-        print(f"❌ Error al editar producto: {e}")
+        logger.error(f"❌ Error al editar producto: {e}")
         await update.message.reply_text("❌ Error al actualizar el producto")
 
 async def handle_configurar_semanas(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja la configuración personalizada de semanas con reinicio y recálculo automático"""
-    if not context.user_data.get('configurando_semanas'):
+    estado, _ = obtener_estado(context)
+    if estado != EstadoChat.CONFIGURANDO_SEMANAS:
         return
     
     if not is_admin(update.effective_user.id):  # ← ACTUALIZADO
         await update.message.reply_text("❌ No tienes permisos de administrador")
-        context.user_data['configurando_semanas'] = None
+        limpiar_estado(context)
         return
     
     try:
@@ -4763,53 +6605,53 @@ async def handle_configurar_semanas(update: Update, context: ContextTypes.DEFAUL
             await update.message.reply_text("❌ El número de semanas debe ser mayor a 0")
             return
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # 1. Actualizar configuración
-        cursor.execute("UPDATE config_pagos SET semanas = %s", (semanas,))
+            # 1. Actualizar configuración
+            await configuracion_pagos.guardar(cursor, semanas=semanas)
         
-        # 2. ✅ RECALCULAR TODOS LOS PLANES CON LAS NUEVAS SEMANAS
-        cursor.execute("SELECT id, productos_json FROM planes_pago WHERE estado = 'activo'")
-        planes = cursor.fetchall()
+            # 2. ✅ RECALCULAR TODOS LOS PLANES CON LAS NUEVAS SEMANAS
+            await cursor.execute("SELECT id, productos_json FROM planes_pago WHERE estado = 'activo'")
+            planes = await cursor.fetchall()
         
-        planes_actualizados = 0
-        for plan_id, productos_json in planes:
-            if productos_json:
-                # Convertir JSON si es necesario
-                if isinstance(productos_json, str):
-                    productos_dict = json.loads(productos_json)
-                else:
-                    productos_dict = productos_json
+            planes_actualizados = 0
+            for plan_id, productos_json in planes:
+                if productos_json:
+                    # Convertir JSON si es necesario
+                    if isinstance(productos_json, str):
+                        productos_dict = json.loads(productos_json)
+                    else:
+                        productos_dict = productos_json
                 
-                # Calcular nuevo total
-                total_nuevo = 0
-                for producto_id, cantidad in productos_dict.items():
-                    cursor.execute("SELECT precio FROM productos WHERE id = %s", (int(producto_id),))
-                    producto = cursor.fetchone()
-                    if producto:
-                        total_nuevo += producto[0] * cantidad
+                    # Calcular nuevo total
+                    total_nuevo = 0
+                    for producto_id, cantidad in productos_dict.items():
+                        await cursor.execute("SELECT precio FROM productos WHERE id = %s", (int(producto_id),))
+                        producto = await cursor.fetchone()
+                        if producto:
+                            total_nuevo += producto[0] * cantidad
                 
-                # Calcular nuevo pago semanal
-                pago_semanal_nuevo = total_nuevo / semanas if semanas > 0 else 0
+                    # Calcular nuevo pago semanal
+                    pago_semanal_nuevo = total_nuevo / semanas if semanas > 0 else 0
                 
-                # Actualizar el plan
-                cursor.execute("""
-                    UPDATE planes_pago 
-                    SET semanas_completadas = 0,
-                        fecha_ultimo_pago = CURRENT_TIMESTAMP,
-                        total = %s,
-                        semanas = %s,
-                        pago_semanal = %s
-                    WHERE id = %s
-                """, (total_nuevo, semanas, pago_semanal_nuevo, plan_id))
+                    # Actualizar el plan
+                    await cursor.execute("""
+                        UPDATE planes_pago 
+                        SET semanas_completadas = 0,
+                            fecha_ultimo_pago = CURRENT_TIMESTAMP,
+                            total = %s,
+                            semanas = %s,
+                            pago_semanal = %s
+                        WHERE id = %s
+                    """, (total_nuevo, semanas, pago_semanal_nuevo, plan_id))
                 
-                planes_actualizados += 1
+                    planes_actualizados += 1
         
-        conn.commit()
-        conn.close()
+            await conn.commit()
+        configuracion_pagos.invalidar()
         
-        context.user_data['configurando_semanas'] = None
+        limpiar_estado(context)
         
         await update.message.reply_text(
             f"✅ **Configuración actualizada y planes recalculados**\n\n"
@@ -4825,7 +6667,7 @@ async def handle_configurar_semanas(update: Update, context: ContextTypes.DEFAUL
     except ValueError:
         await update.message.reply_text("❌ El número de semanas debe ser un número válido")
     except Exception as e:
-        print(f"❌ Error al configurar semanas: {e}")
+        logger.error(f"❌ Error al configurar semanas: {e}")
         await update.message.reply_text("❌ Error al configurar las semanas")
 
 # =============================================
@@ -4835,7 +6677,7 @@ async def handle_configurar_semanas(update: Update, context: ContextTypes.DEFAUL
 async def handle_dynamic_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja comandos dinámicos"""
     command_text = update.message.text
-    print(f"🟡 COMANDO DINÁMICO DETECTADO: {command_text}")
+    logger.debug("Comando dinámico: %s", command_text)
     
     if command_text.startswith('/verimagen_'):
         await verimagen_admin(update, context)
@@ -4877,12 +6719,12 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     error = context.error
     
     if isinstance(error, telegram.error.TimedOut):
-        print("⏰ Timeout en conexión con Telegram - Reintentando...")
+        logger.warning("⏰ Timeout en conexión con Telegram - Reintentando...")
         # No hacer nada, el bot reintentará automáticamente
     elif isinstance(error, telegram.error.NetworkError):
-        print("🌐 Error de red - Reintentando...")
+        logger.warning("🌐 Error de red - Reintentando...")
     else:
-        print(f'❌ Error no manejado: {error}')
+        logger.error("❌ Error no manejado: %s", error, exc_info=error)
 
 
 
@@ -4968,23 +6810,19 @@ async def button_handler_config_semanas(update: Update, context: ContextTypes.DE
         user_id = int(data.split('_')[2])
         
         # Guardar en contexto que estamos esperando entrada personalizada
-        context.user_data[f'config_personalizado_{user_id}'] = {
-            'user_id': user_id,
-            'admin_id': query.from_user.id
-        }
+        fijar_estado(context, EstadoChat.SEMANAS_PERSONALIZADAS, user_id=user_id, admin_id=query.from_user.id)
         
         # Obtener información del usuario para mostrar
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT u.first_name, u.last_name, p.semanas, p.semanas_completadas, p.total
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
+        async with db_connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute("""
+                SELECT u.first_name, u.last_name, p.semanas, p.semanas_completadas, p.total
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        plan = cursor.fetchone()
-        conn.close()
+            plan = await cursor.fetchone()
         
         if not plan:
             await query.edit_message_text("❌ Usuario no encontrado")
@@ -5014,18 +6852,17 @@ async def button_handler_config_semanas(update: Update, context: ContextTypes.DE
 
 async def mostrar_configuracion_usuario(query, context, user_id):
     """Muestra opciones de configuración para un usuario"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    async with db_connection() as conn:
+        cursor = conn.cursor()
     
-    cursor.execute("""
-        SELECT u.first_name, u.last_name, p.semanas, p.semanas_completadas, p.total
-        FROM planes_pago p
-        LEFT JOIN usuarios u ON p.user_id = u.user_id
-        WHERE p.user_id = %s AND p.estado = 'activo'
-    """, (user_id,))
+        await cursor.execute("""
+            SELECT u.first_name, u.last_name, p.semanas, p.semanas_completadas, p.total
+            FROM planes_pago p
+            LEFT JOIN usuarios u ON p.user_id = u.user_id
+            WHERE p.user_id = %s AND p.estado = 'activo'
+        """, (user_id,))
     
-    plan = cursor.fetchone()
-    conn.close()
+        plan = await cursor.fetchone()
     
     if not plan:
         await query.edit_message_text("❌ Usuario no encontrado")
@@ -5064,138 +6901,130 @@ async def mostrar_configuracion_usuario(query, context, user_id):
 async def aplicar_configuracion_semanas_boton(query, context, user_id, nuevas_semanas):
     """Aplica configuración desde botón"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Obtener información actual
-        cursor.execute("""
-            SELECT p.id, p.semanas, p.semanas_completadas, p.total,
-                   u.first_name, u.last_name
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
+            # Obtener información actual
+            await cursor.execute("""
+                SELECT p.id, p.semanas, p.semanas_completadas, p.total,
+                       u.first_name, u.last_name
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        plan = cursor.fetchone()
+            plan = await cursor.fetchone()
         
-        if not plan:
-            await query.edit_message_text("❌ Usuario no encontrado")
-            return
+            if not plan:
+                await query.edit_message_text("❌ Usuario no encontrado")
+                return
         
-        plan_id, semanas_actuales, semanas_comp, total, first_name, last_name = plan
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            plan_id, semanas_actuales, semanas_comp, total, first_name, last_name = plan
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Verificar conflicto
-        if semanas_comp > nuevas_semanas:
-            keyboard = [
-                [InlineKeyboardButton("✅ Sí, reiniciar", callback_data=f"reiniciar_semanas_{user_id}_{nuevas_semanas}")],
-                [InlineKeyboardButton("🔄 Mantener", callback_data=f"mantener_semanas_{user_id}_{nuevas_semanas}_{semanas_comp}")],
-                [InlineKeyboardButton("❌ Cancelar", callback_data=f"cancelar_config_{user_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            # Verificar conflicto
+            if semanas_comp > nuevas_semanas:
+                keyboard = [
+                    [InlineKeyboardButton("✅ Sí, reiniciar", callback_data=f"reiniciar_semanas_{user_id}_{nuevas_semanas}")],
+                    [InlineKeyboardButton("🔄 Mantener", callback_data=f"mantener_semanas_{user_id}_{nuevas_semanas}_{semanas_comp}")],
+                    [InlineKeyboardButton("❌ Cancelar", callback_data=f"cancelar_config_{user_id}")]
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await query.edit_message_text(
-                f"⚠️ **CONFLICTO DETECTADO**\n\n"
-                f"El usuario ya completó {semanas_comp} semanas.\n"
-                f"Intentas configurar {nuevas_semanas} semanas totales.\n\n"
-                f"¿Qué deseas hacer con las semanas completadas?",
-                reply_markup=reply_markup
-            )
-            conn.close()
-            return
-        
-        # Calcular nuevo pago semanal
-        nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
-        
-        # Actualizar configuración
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET semanas = %s,
-                pago_semanal = %s,
-                fecha_configuracion = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
+                await query.edit_message_text(
+                    f"⚠️ **CONFLICTO DETECTADO**\n\n"
+                    f"El usuario ya completó {semanas_comp} semanas.\n"
+                    f"Intentas configurar {nuevas_semanas} semanas totales.\n\n"
+                    f"¿Qué deseas hacer con las semanas completadas?",
+                    reply_markup=reply_markup
+                )
+                return
         
-        conn.commit()
-        conn.close()
+            # Calcular nuevo pago semanal
+            nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
         
-        # Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\n"
-                     f"Tu plan ha sido configurado a {nuevas_semanas} semanas.\n\n"
-                     f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
-                     f"📊 **Progreso:** {semanas_comp}/{nuevas_semanas}\n\n"
-                     f"📋 Ver detalles: /misplanes"
+            # Actualizar configuración
+            await cursor.execute("""
+                UPDATE planes_pago 
+                SET semanas = %s,
+                    pago_semanal = %s,
+                    fecha_configuracion = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
+        
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\n"
+                f"Tu plan ha sido configurado a {nuevas_semanas} semanas.\n\n"
+                f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
+                f"📊 **Progreso:** {semanas_comp}/{nuevas_semanas}\n\n"
+                f"📋 Ver detalles: /misplanes",
+                'configurar_semanas'
             )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
+            await conn.commit()
+        despertar_notificaciones()
         
         await query.edit_message_text(
             f"✅ **CONFIGURACIÓN APLICADA**\n\n"
             f"👤 Usuario: {nombre_completo}\n"
             f"📅 Nuevas semanas: {nuevas_semanas}\n"
             f"💰 Pago semanal: ${nuevo_pago_semanal:.2f}\n\n"
-            f"📞 El usuario ha sido notificado."
+            f"📣 El usuario será notificado."
         )
         
     except Exception as e:
-        print(f"❌ Error en aplicar_configuracion: {e}")
+        logger.error(f"❌ Error en aplicar_configuracion: {e}")
         await query.edit_message_text("❌ Error al aplicar configuración")
 
 async def avanzar_usuario_forzado(query, context, user_id):
     """Avanza el contador de un usuario incluso si está pausado"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT p.id, p.semanas_completadas, p.semanas,
-                   u.first_name, u.last_name
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
+            await cursor.execute("""
+                SELECT p.id, p.semanas_completadas, p.semanas,
+                       u.first_name, u.last_name
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        plan = cursor.fetchone()
+            plan = await cursor.fetchone()
         
-        if not plan:
-            await query.edit_message_text("❌ Usuario no encontrado")
-            return
+            if not plan:
+                await query.edit_message_text("❌ Usuario no encontrado")
+                return
         
-        plan_id, semanas_comp, semanas_tot, first_name, last_name = plan
+            plan_id, semanas_comp, semanas_tot, first_name, last_name = plan
         
-        if semanas_comp >= semanas_tot:
-            await query.edit_message_text("✅ Este usuario ya completó su plan")
-            conn.close()
-            return
+            if semanas_comp >= semanas_tot:
+                await query.edit_message_text("✅ Este usuario ya completó su plan")
+                return
         
-        nuevas_semanas = semanas_comp + 1
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET semanas_completadas = %s,
-                fecha_ultimo_pago = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (nuevas_semanas, plan_id))
+            nuevas_semanas = semanas_comp + 1
+            await cursor.execute("""
+                UPDATE planes_pago 
+                SET semanas_completadas = %s,
+                    fecha_ultimo_pago = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (nuevas_semanas, plan_id))
         
-        conn.commit()
-        conn.close()
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"📅 **AVANCE FORZADO**\n\n"
+                f"Tu plan ha avanzado a la semana {nuevas_semanas}/{semanas_tot}\n\n"
+                f"⚠️ Este avance se realizó aunque tu contador estaba pausado.\n"
+                f"📞 Contacta al administrador para más información.",
+                'avance_forzado'
+            )
+            await conn.commit()
+        despertar_notificaciones()
         
         nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"📅 **AVANCE FORZADO**\n\n"
-                     f"Tu plan ha avanzado a la semana {nuevas_semanas}/{semanas_tot}\n\n"
-                     f"⚠️ Este avance se realizó aunque tu contador estaba pausado.\n"
-                     f"📞 Contacta al administrador para más información."
-            )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
-        
         await query.edit_message_text(
             f"🚀 **AVANCE FORZADO REALIZADO**\n\n"
             f"👤 Usuario: {nombre_completo}\n"
@@ -5204,65 +7033,61 @@ async def avanzar_usuario_forzado(query, context, user_id):
         )
         
     except Exception as e:
-        print(f"❌ Error en avance forzado: {e}")
+        logger.error(f"❌ Error en avance forzado: {e}")
         await query.edit_message_text("❌ Error en avance forzado")
 
 async def reanudar_y_avanzar_usuario(query, context, user_id):
     """Reanuda y avanza el contador de un usuario"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT p.id, p.semanas_completadas, p.semanas,
-                   u.first_name, u.last_name
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
+            await cursor.execute("""
+                SELECT p.id, p.semanas_completadas, p.semanas,
+                       u.first_name, u.last_name
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        plan = cursor.fetchone()
+            plan = await cursor.fetchone()
         
-        if not plan:
-            await query.edit_message_text("❌ Usuario no encontrado")
-            return
+            if not plan:
+                await query.edit_message_text("❌ Usuario no encontrado")
+                return
         
-        plan_id, semanas_comp, semanas_tot, first_name, last_name = plan
+            plan_id, semanas_comp, semanas_tot, first_name, last_name = plan
         
-        if semanas_comp >= semanas_tot:
-            await query.edit_message_text("✅ Este usuario ya completó su plan")
-            conn.close()
-            return
+            if semanas_comp >= semanas_tot:
+                await query.edit_message_text("✅ Este usuario ya completó su plan")
+                return
         
-        # Reanudar contador
-        cursor.execute("UPDATE planes_pago SET contador_pausado = FALSE WHERE id = %s", (plan_id,))
+            # Reanudar contador (el avance de abajo fija fecha_ultimo_pago)
+            await cursor.execute(f"UPDATE planes_pago SET {REANUDAR_CONTADOR} WHERE id = %s", (plan_id,))
         
-        # Avanzar contador
-        nuevas_semanas = semanas_comp + 1
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET semanas_completadas = %s,
-                fecha_ultimo_pago = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (nuevas_semanas, plan_id))
+            # Avanzar contador
+            nuevas_semanas = semanas_comp + 1
+            await cursor.execute("""
+                UPDATE planes_pago 
+                SET semanas_completadas = %s,
+                    fecha_ultimo_pago = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (nuevas_semanas, plan_id))
         
-        conn.commit()
-        conn.close()
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"📅 **CONTADOR REANUDADO Y AVANZADO**\n\n"
+                f"✅ Tu contador ha sido reanudado.\n"
+                f"📊 Progreso actual: {nuevas_semanas}/{semanas_tot}\n\n"
+                f"💳 Recuerda realizar tu pago semanal.",
+                'reanudar_y_avanzar'
+            )
+            await conn.commit()
+        despertar_notificaciones()
         
         nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"📅 **CONTADOR REANUDADO Y AVANZADO**\n\n"
-                     f"✅ Tu contador ha sido reanudado.\n"
-                     f"📊 Progreso actual: {nuevas_semanas}/{semanas_tot}\n\n"
-                     f"💳 Recuerda realizar tu pago semanal."
-            )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
-        
         await query.edit_message_text(
             f"✅ **CONTADOR REANUDADO Y AVANZADO**\n\n"
             f"👤 Usuario: {nombre_completo}\n"
@@ -5271,63 +7096,60 @@ async def reanudar_y_avanzar_usuario(query, context, user_id):
         )
         
     except Exception as e:
-        print(f"❌ Error en reanudar y avanzar: {e}")
+        logger.error(f"❌ Error en reanudar y avanzar: {e}")
         await query.edit_message_text("❌ Error en operación")
 
 async def reiniciar_semanas_completadas(query, context, user_id, nuevas_semanas):
     """Reinicia las semanas completadas a 0"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Obtener información
-        cursor.execute("""
-            SELECT p.id, p.total, u.first_name, u.last_name
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
-        
-        plan = cursor.fetchone()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        if not plan:
-            await query.edit_message_text("❌ Usuario no encontrado")
-            return
+            # Obtener información
+            await cursor.execute("""
+                SELECT p.id, p.total, u.first_name, u.last_name
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        plan_id, total, first_name, last_name = plan
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            plan = await cursor.fetchone()
         
-        # Calcular nuevo pago semanal
-        nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
+            if not plan:
+                await query.edit_message_text("❌ Usuario no encontrado")
+                return
         
-        # Actualizar (reiniciar semanas completadas)
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET semanas = %s,
-                pago_semanal = %s,
-                semanas_completadas = 0,
-                fecha_configuracion = CURRENT_TIMESTAMP,
-                fecha_ultimo_pago = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
+            plan_id, total, first_name, last_name = plan
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        conn.commit()
-        conn.close()
+            # Calcular nuevo pago semanal
+            nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
         
-        # Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"🔄 **PLAN REINICIADO**\n\n"
-                     f"Tu plan ha sido reiniciado:\n\n"
-                     f"📅 **Nuevas semanas totales:** {nuevas_semanas}\n"
-                     f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
-                     f"📊 **Progreso:** 0/{nuevas_semanas} (reiniciado)\n\n"
-                     f"⚠️ **Tu progreso anterior se perdió.**\n"
-                     f"📞 Contacta al administrador para más información."
+            # Actualizar (reiniciar semanas completadas)
+            await cursor.execute("""
+                UPDATE planes_pago 
+                SET semanas = %s,
+                    pago_semanal = %s,
+                    semanas_completadas = 0,
+                    fecha_configuracion = CURRENT_TIMESTAMP,
+                    fecha_ultimo_pago = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
+        
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"🔄 **PLAN REINICIADO**\n\n"
+                f"Tu plan ha sido reiniciado:\n\n"
+                f"📅 **Nuevas semanas totales:** {nuevas_semanas}\n"
+                f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
+                f"📊 **Progreso:** 0/{nuevas_semanas} (reiniciado)\n\n"
+                f"⚠️ **Tu progreso anterior se perdió.**\n"
+                f"📞 Contacta al administrador para más información.",
+                'reiniciar_semanas'
             )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
+            await conn.commit()
+        despertar_notificaciones()
         
         await query.edit_message_text(
             f"🔄 **PLAN REINICIADO COMPLETAMENTE**\n\n"
@@ -5335,50 +7157,56 @@ async def reiniciar_semanas_completadas(query, context, user_id, nuevas_semanas)
             f"📅 Nuevas semanas: {nuevas_semanas}\n"
             f"💰 Pago semanal: ${nuevo_pago_semanal:.2f}\n"
             f"📊 Progreso: REINICIADO A 0\n\n"
-            f"⚠️ El usuario ha sido notificado del reinicio."
+            f"📣 El usuario será notificado del reinicio."
         )
         
     except Exception as e:
-        print(f"❌ Error en reiniciar_semanas: {e}")
+        logger.error(f"❌ Error en reiniciar_semanas: {e}")
         await query.edit_message_text("❌ Error al reiniciar semanas")
 
 async def mantener_semanas_completadas(query, context, user_id, nuevas_semanas, semanas_comp):
     """Mantiene las semanas completadas existentes"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Obtener información
-        cursor.execute("""
-            SELECT p.id, p.total, u.first_name, u.last_name
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
+            # Obtener información
+            await cursor.execute("""
+                SELECT p.id, p.total, u.first_name, u.last_name
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        plan = cursor.fetchone()
+            plan = await cursor.fetchone()
         
-        if not plan:
-            await query.edit_message_text("❌ Usuario no encontrado")
-            return
+            if not plan:
+                await query.edit_message_text("❌ Usuario no encontrado")
+                return
         
-        plan_id, total, first_name, last_name = plan
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            plan_id, total, first_name, last_name = plan
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Calcular nuevo pago semanal
-        nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
+            # Calcular nuevo pago semanal
+            nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
         
-        # Actualizar (mantener semanas completadas)
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET semanas = %s,
-                pago_semanal = %s,
-                fecha_configuracion = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
+            # Actualizar (mantener semanas completadas)
+            await cursor.execute("""
+                UPDATE planes_pago 
+                SET semanas = %s,
+                    pago_semanal = %s,
+                    fecha_configuracion = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
         
-        conn.commit()
-        conn.close()
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            if semanas_comp >= nuevas_semanas:
+                mensaje = f"🎉 **¡PLAN COMPLETADO!**\n\nYa completaste las {nuevas_semanas} semanas.\n📞 Contacta al administrador."
+            else:
+                mensaje = f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\nTu plan ahora es de {nuevas_semanas} semanas.\n📊 Progreso: {semanas_comp}/{nuevas_semanas}"
+            await encolar_notificacion(cursor, user_id, mensaje, 'configurar_semanas')
+            await conn.commit()
+        despertar_notificaciones()
         
         # Verificar si ya completó el plan con nuevas semanas
         if semanas_comp >= nuevas_semanas:
@@ -5386,28 +7214,17 @@ async def mantener_semanas_completadas(query, context, user_id, nuevas_semanas,
         else:
             estado_progreso = f"{semanas_comp}/{nuevas_semanas}"
         
-        # Notificar al usuario
-        try:
-            if semanas_comp >= nuevas_semanas:
-                mensaje = f"🎉 **¡PLAN COMPLETADO!**\n\nYa completaste las {nuevas_semanas} semanas.\n📞 Contacta al administrador."
-            else:
-                mensaje = f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\nTu plan ahora es de {nuevas_semanas} semanas.\n📊 Progreso: {semanas_comp}/{nuevas_semanas}"
-            
-            await context.bot.send_message(chat_id=user_id, text=mensaje)
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
-        
         await query.edit_message_text(
             f"✅ **CONFIGURACIÓN APLICADA (MANTENIENDO PROGRESO)**\n\n"
             f"👤 Usuario: {nombre_completo}\n"
             f"📅 Nuevas semanas: {nuevas_semanas}\n"
             f"💰 Pago semanal: ${nuevo_pago_semanal:.2f}\n"
             f"📊 Progreso mantiene: {estado_progreso}\n\n"
-            f"📞 El usuario ha sido notificado."
+            f"📣 El usuario será notificado."
         )
         
     except Exception as e:
-        print(f"❌ Error en mantener_semanas: {e}")
+        logger.error(f"❌ Error en mantener_semanas: {e}")
         await query.edit_message_text("❌ Error al mantener semanas")
 
 async def handle_semanas_personalizadas(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -5417,18 +7234,11 @@ async def handle_semanas_personalizadas(update: Update, context: ContextTypes.DE
     if not is_admin(user_id):
         return
     
-    # Buscar si hay solicitud pendiente de configuración personalizada
-    tiene_solicitud = False
-    usuario_target = None
-    
-    for key in context.user_data.keys():
-        if key.startswith('config_personalizado_'):
-            tiene_solicitud = True
-            usuario_target = int(key.split('_')[2])
-            break
-    
-    if not tiene_solicitud:
+    # Verificar si hay solicitud pendiente de configuración personalizada
+    estado, datos_estado = obtener_estado(context)
+    if estado != EstadoChat.SEMANAS_PERSONALIZADAS:
         return
+    usuario_target = datos_estado['user_id']
     
     try:
         semanas = int(update.message.text.strip())
@@ -5441,7 +7251,7 @@ async def handle_semanas_personalizadas(update: Update, context: ContextTypes.DE
         await aplicar_configuracion_semanas_directa(update, context, usuario_target, semanas)
         
         # Limpiar datos temporales
-        del context.user_data[f'config_personalizado_{usuario_target}']
+        limpiar_estado(context)
         
     except ValueError:
         await update.message.reply_text("❌ Por favor envía un número válido (ej: 15, 18, 22)")
@@ -5449,82 +7259,78 @@ async def handle_semanas_personalizadas(update: Update, context: ContextTypes.DE
 async def aplicar_configuracion_semanas_directa(update, context, user_id, nuevas_semanas):
     """Aplica configuración directa desde entrada de texto"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT p.id, p.semanas, p.semanas_completadas, p.total,
-                   u.first_name, u.last_name
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
+            await cursor.execute("""
+                SELECT p.id, p.semanas, p.semanas_completadas, p.total,
+                       u.first_name, u.last_name
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        plan = cursor.fetchone()
+            plan = await cursor.fetchone()
         
-        if not plan:
-            await update.message.reply_text("❌ Usuario no encontrado")
-            return
+            if not plan:
+                await update.message.reply_text("❌ Usuario no encontrado")
+                return
         
-        plan_id, semanas_actuales, semanas_comp, total, first_name, last_name = plan
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            plan_id, semanas_actuales, semanas_comp, total, first_name, last_name = plan
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Verificar conflicto
-        if semanas_comp > nuevas_semanas:
-            keyboard = [
-                [InlineKeyboardButton("✅ Sí, reiniciar", callback_data=f"reiniciar_semanas_{user_id}_{nuevas_semanas}")],
-                [InlineKeyboardButton("🔄 Mantener", callback_data=f"mantener_semanas_{user_id}_{nuevas_semanas}_{semanas_comp}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            # Verificar conflicto
+            if semanas_comp > nuevas_semanas:
+                keyboard = [
+                    [InlineKeyboardButton("✅ Sí, reiniciar", callback_data=f"reiniciar_semanas_{user_id}_{nuevas_semanas}")],
+                    [InlineKeyboardButton("🔄 Mantener", callback_data=f"mantener_semanas_{user_id}_{nuevas_semanas}_{semanas_comp}")]
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await update.message.reply_text(
-                f"⚠️ **CONFLICTO DETECTADO**\n\n"
-                f"El usuario ya completó {semanas_comp} semanas.\n"
-                f"Intentas configurar {nuevas_semanas} semanas totales.\n\n"
-                f"¿Qué deseas hacer con las semanas completadas?",
-                reply_markup=reply_markup
-            )
-            conn.close()
-            return
-        
-        # Calcular nuevo pago semanal
-        nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
-        
-        # Actualizar configuración
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET semanas = %s,
-                pago_semanal = %s,
-                fecha_configuracion = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
+                await update.message.reply_text(
+                    f"⚠️ **CONFLICTO DETECTADO**\n\n"
+                    f"El usuario ya completó {semanas_comp} semanas.\n"
+                    f"Intentas configurar {nuevas_semanas} semanas totales.\n\n"
+                    f"¿Qué deseas hacer con las semanas completadas?",
+                    reply_markup=reply_markup
+                )
+                return
         
-        conn.commit()
-        conn.close()
+            # Calcular nuevo pago semanal
+            nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
         
-        # Notificar al usuario
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\n"
-                     f"Tu plan ahora es de {nuevas_semanas} semanas.\n\n"
-                     f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
-                     f"📊 **Progreso:** {semanas_comp}/{nuevas_semanas}\n\n"
-                     f"📋 Ver detalles: /misplanes"
+            # Actualizar configuración
+            await cursor.execute("""
+                UPDATE planes_pago 
+                SET semanas = %s,
+                    pago_semanal = %s,
+                    fecha_configuracion = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
+        
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            await encolar_notificacion(
+                cursor, user_id,
+                f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\n"
+                f"Tu plan ahora es de {nuevas_semanas} semanas.\n\n"
+                f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
+                f"📊 **Progreso:** {semanas_comp}/{nuevas_semanas}\n\n"
+                f"📋 Ver detalles: /misplanes",
+                'configurar_semanas'
             )
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario: {e}")
+            await conn.commit()
+        despertar_notificaciones()
         
         await update.message.reply_text(
             f"✅ **CONFIGURACIÓN PERSONALIZADA APLICADA**\n\n"
             f"👤 Usuario: {nombre_completo}\n"
             f"📅 Nuevas semanas: {nuevas_semanas}\n"
             f"💰 Pago semanal: ${nuevo_pago_semanal:.2f}\n\n"
-            f"📞 El usuario ha sido notificado."
+            f"📣 El usuario será notificado."
         )
         
     except Exception as e:
-        print(f"❌ Error en configuración personalizada: {e}")
+        logger.error(f"❌ Error en configuración personalizada: {e}")
         await update.message.reply_text("❌ Error al aplicar configuración")
 
 
@@ -5567,66 +7373,77 @@ async def mostrar_opciones_semanas(update: Update, context: ContextTypes.DEFAULT
 async def aplicar_configuracion_semanas_directa(update, context, user_id, nuevas_semanas):
     """Aplica configuración directa desde entrada de texto"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        async with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Obtener información actual del usuario
-        cursor.execute("""
-            SELECT p.id, p.semanas, p.semanas_completadas, p.total,
-                   u.first_name, u.last_name, p.contador_pausado
-            FROM planes_pago p
-            LEFT JOIN usuarios u ON p.user_id = u.user_id
-            WHERE p.user_id = %s AND p.estado = 'activo'
-        """, (user_id,))
+            # Obtener información actual del usuario
+            await cursor.execute("""
+                SELECT p.id, p.semanas, p.semanas_completadas, p.total,
+                       u.first_name, u.last_name, p.contador_pausado
+                FROM planes_pago p
+                LEFT JOIN usuarios u ON p.user_id = u.user_id
+                WHERE p.user_id = %s AND p.estado = 'activo'
+            """, (user_id,))
         
-        plan = cursor.fetchone()
+            plan = await cursor.fetchone()
         
-        if not plan:
-            await update.message.reply_text("❌ Usuario no encontrado o no tiene plan activo")
-            conn.close()
-            return
+            if not plan:
+                await update.message.reply_text("❌ Usuario no encontrado o no tiene plan activo")
+                return
         
-        plan_id, semanas_actuales, semanas_comp, total, first_name, last_name, contador_pausado = plan
-        nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
+            plan_id, semanas_actuales, semanas_comp, total, first_name, last_name, contador_pausado = plan
+            nombre_completo = f"{first_name or ''} {last_name or ''}".strip()
         
-        # Verificar conflicto (semanas completadas > nuevas semanas)
-        if semanas_comp > nuevas_semanas:
-            # Necesitamos manejar este conflicto
-            keyboard = [
-                [InlineKeyboardButton("✅ Sí, reiniciar progreso a 0", 
-                    callback_data=f"reiniciar_semanas_{user_id}_{nuevas_semanas}")],
-                [InlineKeyboardButton("🔄 Mantener progreso actual", 
-                    callback_data=f"mantener_semanas_{user_id}_{nuevas_semanas}_{semanas_comp}")],
-                [InlineKeyboardButton("❌ Cancelar configuración", 
-                    callback_data=f"cancelar_config_{user_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            # Verificar conflicto (semanas completadas > nuevas semanas)
+            if semanas_comp > nuevas_semanas:
+                # Necesitamos manejar este conflicto
+                keyboard = [
+                    [InlineKeyboardButton("✅ Sí, reiniciar progreso a 0", 
+                        callback_data=f"reiniciar_semanas_{user_id}_{nuevas_semanas}")],
+                    [InlineKeyboardButton("🔄 Mantener progreso actual", 
+                        callback_data=f"mantener_semanas_{user_id}_{nuevas_semanas}_{semanas_comp}")],
+                    [InlineKeyboardButton("❌ Cancelar configuración", 
+                        callback_data=f"cancelar_config_{user_id}")]
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
             
-            mensaje = f"⚠️ **CONFLICTO DE PROGRESO**\n\n"
-            mensaje += f"👤 **Usuario:** {nombre_completo}\n"
-            mensaje += f"📊 **Progreso actual:** {semanas_comp}/{semanas_actuales}\n"
-            mensaje += f"🎯 **Nuevas semanas totales:** {nuevas_semanas}\n\n"
-            mensaje += f"❌ **El usuario ya completó más semanas ({semanas_comp}) de las que intentas configurar ({nuevas_semanas}).**\n\n"
-            mensaje += f"¿Qué deseas hacer?"
+                mensaje = f"⚠️ **CONFLICTO DE PROGRESO**\n\n"
+                mensaje += f"👤 **Usuario:** {nombre_completo}\n"
+                mensaje += f"📊 **Progreso actual:** {semanas_comp}/{semanas_actuales}\n"
+                mensaje += f"🎯 **Nuevas semanas totales:** {nuevas_semanas}\n\n"
+                mensaje += f"❌ **El usuario ya completó más semanas ({semanas_comp}) de las que intentas configurar ({nuevas_semanas}).**\n\n"
+                mensaje += f"¿Qué deseas hacer?"
             
-            await update.message.reply_text(mensaje, reply_markup=reply_markup)
-            conn.close()
-            return
+                await update.message.reply_text(mensaje, reply_markup=reply_markup)
+                return
         
-        # Calcular nuevo pago semanal
-        nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
+            # Calcular nuevo pago semanal
+            nuevo_pago_semanal = total / nuevas_semanas if nuevas_semanas > 0 else 0
         
-        # Actualizar configuración
-        cursor.execute("""
-            UPDATE planes_pago 
-            SET semanas = %s,
-                pago_semanal = %s,
-                fecha_configuracion = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
+            # Actualizar configuración
+            await cursor.execute("""
+                UPDATE planes_pago 
+                SET semanas = %s,
+                    pago_semanal = %s,
+                    fecha_configuracion = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (nuevas_semanas, nuevo_pago_semanal, plan_id))
         
-        conn.commit()
-        conn.close()
+            # Notificar al usuario (bandeja de salida, misma transacción)
+            estado_contador = "⏸️ PAUSADO" if contador_pausado else "🟢 ACTIVO"
+            
+            mensaje_usuario = f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\n"
+            mensaje_usuario += f"El administrador ha modificado tu plan de pago:\n\n"
+            mensaje_usuario += f"📅 **Nuevas semanas totales:** {nuevas_semanas}\n"
+            mensaje_usuario += f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
+            mensaje_usuario += f"📊 **Progreso actual:** {semanas_comp}/{nuevas_semanas}\n"
+            mensaje_usuario += f"⏰ **Estado contador:** {estado_contador}\n\n"
+            mensaje_usuario += f"📋 Ver detalles: /misplanes\n"
+            mensaje_usuario += f"❓ Consultas: Contacta al administrador"
+            
+            await encolar_notificacion(cursor, user_id, mensaje_usuario, 'configurar_semanas')
+            await conn.commit()
+        despertar_notificaciones()
         
         # Construir mensaje de confirmación
         mensaje = f"✅ **CONFIGURACIÓN PERSONALIZADA APLICADA**\n\n"
@@ -5642,57 +7459,365 @@ async def aplicar_configuracion_semanas_directa(update, context, user_id, nuevas
         if contador_pausado:
             mensaje += f"• ⏸️ **Estado contador:** PAUSADO\n"
         
-        mensaje += f"\n📞 **El usuario ha sido notificado.**"
+        mensaje += f"\n📣 **El usuario será notificado.**"
         
         await update.message.reply_text(mensaje)
         
-        # Notificar al usuario
-        try:
-            estado_contador = "⏸️ PAUSADO" if contador_pausado else "🟢 ACTIVO"
-            
-            mensaje_usuario = f"⚙️ **CONFIGURACIÓN ACTUALIZADA**\n\n"
-            mensaje_usuario += f"El administrador ha modificado tu plan de pago:\n\n"
-            mensaje_usuario += f"📅 **Nuevas semanas totales:** {nuevas_semanas}\n"
-            mensaje_usuario += f"💰 **Nuevo pago semanal:** ${nuevo_pago_semanal:.2f}\n"
-            mensaje_usuario += f"📊 **Progreso actual:** {semanas_comp}/{nuevas_semanas}\n"
-            mensaje_usuario += f"⏰ **Estado contador:** {estado_contador}\n\n"
-            mensaje_usuario += f"📋 Ver detalles: /misplanes\n"
-            mensaje_usuario += f"❓ Consultas: Contacta al administrador"
-            
-            await context.bot.send_message(chat_id=user_id, text=mensaje_usuario)
-        except Exception as e:
-            print(f"❌ No se pudo notificar al usuario {user_id}: {e}")
-        
     except Exception as e:
-        print(f"❌ Error en aplicar_configuracion_semanas_directa: {e}")
+        logger.error(f"❌ Error en aplicar_configuracion_semanas_directa: {e}")
         await update.message.reply_text("❌ Error al aplicar la configuración personalizada")
 
 # =============================================
-# FUNCIÓN MAIN
+# 📤 EXPORTACIÓN DE PAGOS Y PLANES (ADMIN)
 # =============================================
 
+# Las filas llegan por lotes desde un cursor del servidor y se escriben
+# comprimidas a un archivo temporal: la memoria no crece con la tabla.
+EXPORT_LOTE = int(os.getenv('EXPORT_LOTE', '2000'))  # filas por viaje a la base
+LIMITE_DOCUMENTO = 50 * 1024 * 1024  # máximo que acepta la Bot API en send_document
+# Excel interpreta como fórmula una celda que empieza con alguno de estos
+PREFIJOS_FORMULA = ('=', '+', '-', '@', '\t', '\r')
+
+AYUDA_EXPORTAR = (
+    "📤 **EXPORTAR A CSV (.csv.gz)**\n\n"
+    "/exportarpagos [filtro=valor ...]\n"
+    "• estado=pendiente|aprobado|rechazado\n"
+    "• usuario=ID | desde=DD/MM/AAAA | hasta=DD/MM/AAAA\n"
+    "• min=monto | max=monto | ref=inicio de la referencia\n"
+    "• archivados=si incluye los pagos de particiones archivadas\n\n"
+    "/exportarplanes [filtro=valor ...]\n"
+    "• estado=activo|eliminado|...\n"
+    "• usuario=ID | desde=DD/MM/AAAA | hasta=DD/MM/AAAA (fecha de inicio)\n"
+    "• pausado=si|no\n\n"
+    "Ejemplo:\n"
+    "/exportarpagos estado=aprobado desde=01/01/2024 hasta=31/12/2024"
+)
+
+def celda_segura(valor):
+    """Neutralizar texto que una hoja de cálculo tomaría como fórmula
+    (nombres y referencias los escribe el usuario)"""
+    if isinstance(valor, str) and valor.startswith(PREFIJOS_FORMULA):
+        return "'" + valor
+    return valor
+
+def escribir_lote(escritor, lote: list):
+    escritor.writerows([celda_segura(valor) for valor in fila] for fila in lote)
+
+def parsear_filtros_planes(argumentos: list) -> dict:
+    """Validar los filtros de /exportarplanes; lanza ValueError con un mensaje para el admin"""
+    filtros = {}
+    for argumento in argumentos:
+        clave, _, valor = argumento.partition('=')
+        clave = clave.lower()
+        if clave == 'estado':
+            if not valor.isalpha():
+                raise ValueError(f"Estado inválido: {valor}")
+            filtros[clave] = valor.lower()
+        elif clave == 'pausado':
+            if valor.lower() not in ('si', 'sí', 'no'):
+                raise ValueError(f"pausado debe ser si o no: {valor}")
+            filtros[clave] = valor.lower() != 'no'
+        elif clave in ('usuario', 'desde', 'hasta'):
+            # Mismo formato que en los filtros de pagos
+            filtros.update(parsear_filtros_pagos([argumento]))
+        else:
+            raise ValueError(f"Filtro desconocido: {clave}")
+    return filtros
+
+def condiciones_planes(filtros: dict) -> tuple:
+    """Traducir los filtros de planes a condiciones SQL con parámetros"""
+    condiciones = []
+    parametros = []
+    if 'estado' in filtros:
+        condiciones.append("p.estado = %s")
+        parametros.append(filtros['estado'])
+    if 'usuario' in filtros:
+        condiciones.append("p.user_id = %s")
+        parametros.append(filtros['usuario'])
+    if 'desde' in filtros:
+        condiciones.append("p.fecha_inicio >= %s")
+        parametros.append(datetime.strptime(filtros['desde'], '%d/%m/%Y'))
+    if 'hasta' in filtros:
+        condiciones.append("p.fecha_inicio < %s")
+        parametros.append(datetime.strptime(filtros['hasta'], '%d/%m/%Y') + timedelta(days=1))
+    if 'pausado' in filtros:
+        condiciones.append("p.contador_pausado = %s")
+        parametros.append(filtros['pausado'])
+    return condiciones, parametros
+
+async def exportar_csv(nombre: str, consulta: str, parametros: list, encabezados: tuple) -> tuple:
+    """Volcar una consulta a un CSV comprimido en un archivo temporal.
+
+    Usa un cursor con nombre (del lado del servidor) y trae EXPORT_LOTE filas
+    por vez; la escritura y compresión de cada lote corre en un hilo para no
+    frenar el event loop. Devuelve (ruta, filas); quien llama borra el archivo.
+    """
+    descriptor, ruta = tempfile.mkstemp(prefix=f"{nombre}_", suffix=".csv.gz")
+    os.close(descriptor)
+    filas = 0
+    try:
+        # utf-8-sig: Excel reconoce los acentos al abrir el CSV
+        with gzip.open(ruta, 'wt', encoding='utf-8-sig', newline='') as archivo:
+            escritor = csv.writer(archivo)
+            escritor.writerow(encabezados)
+            async with db_connection() as conn:
+                async with conn.cursor(name=f"exportar_{nombre}_{uuid.uuid4().hex[:8]}") as cursor:
+                    await cursor.execute(consulta, parametros)
+                    while True:
+                        lote = await cursor.fetchmany(EXPORT_LOTE)
+                        if not lote:
+                            break
+                        await asyncio.to_thread(escribir_lote, escritor, lote)
+                        filas += len(lote)
+    except BaseException:
+        os.remove(ruta)
+        raise
+    return ruta, filas
+
+async def enviar_exportacion(update: Update, context: ContextTypes.DEFAULT_TYPE, nombre: str,
+                             consulta: str, parametros: list, encabezados: tuple, filtros: dict,
+                             nota: str = ''):
+    """Generar la exportación y subirla al chat del admin con send_document"""
+    await update.message.reply_text("⏳ Generando exportación...")
+    
+    try:
+        ruta, filas = await exportar_csv(nombre, consulta, parametros, encabezados)
+    except Exception as e:
+        logger.exception("❌ Error al exportar %s: %s", nombre, e)
+        await update.message.reply_text(f"❌ Error al generar la exportación: {str(e)[:100]}")
+        return
+    
+    try:
+        tamano = os.path.getsize(ruta)
+        if tamano > LIMITE_DOCUMENTO:
+            await update.message.reply_text(
+                f"❌ El archivo ocupa {tamano / 1024 / 1024:.1f} MB y Telegram acepta hasta "
+                f"{LIMITE_DOCUMENTO // 1024 // 1024} MB.\n\nUsa filtros (desde=, hasta=) para dividirlo."
+            )
+            return
+        
+        filtros_texto = ", ".join(f"{clave}={valor}" for clave, valor in filtros.items()) or "ninguno"
+        with open(ruta, 'rb') as archivo:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=archivo,
+                filename=f"{nombre}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv.gz",
+                caption=f"📤 {nombre}: {filas} filas ({tamano / 1024:.0f} KB)\n🔎 Filtros: {filtros_texto}{nota}",
+                write_timeout=300,
+            )
+        logger.info(f"📤 Exportación de {nombre}: {filas} filas, {tamano} bytes")
+    except Exception as e:
+        logger.exception("❌ Error al enviar la exportación de %s: %s", nombre, e)
+        await update.message.reply_text(f"❌ Error al enviar el archivo: {str(e)[:100]}")
+    finally:
+        os.remove(ruta)
+
+async def exportar_pagos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Exportar pagos a CSV comprimido, con filtros opcionales (solo admin)"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ No tienes permisos de administrador")
+        return
+    
+    if context.args and context.args[0].lower() == 'ayuda':
+        await update.message.reply_text(AYUDA_EXPORTAR)
+        return
+    
+    # archivados=si lee la vista con las particiones archivadas; el resto
+    # de los filtros es el mismo de /verpagostodos
+    argumentos = context.args or []
+    archivados = any(a.lower() in ('archivados=si', 'archivados=sí') for a in argumentos)
+    argumentos = [a for a in argumentos if not a.lower().startswith('archivados=')]
+    
+    try:
+        filtros = parsear_filtros_pagos(argumentos)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{AYUDA_EXPORTAR}")
+        return
+    
+    async with db_connection() as conn:
+        corte = await corte_archivo(conn.cursor(), 'pagos')
+    
+    condiciones, parametros = condiciones_pagos(filtros)
+    donde = ("WHERE " + " AND ".join(condiciones)) if condiciones else ""
+    consulta = f"""
+        SELECT p.id, p.user_id, u.first_name, u.last_name, p.referencia, p.monto, p.estado, p.fecha
+        FROM {'archivo.pagos_completo' if archivados and corte else 'pagos'} p
+        LEFT JOIN usuarios u ON p.user_id = u.user_id
+        {donde}
+        ORDER BY p.fecha, p.id
+    """
+    encabezados = ('id', 'user_id', 'nombre', 'apellido', 'referencia', 'monto', 'estado', 'fecha')
+    if not corte:
+        nota = ''
+    elif archivados:
+        nota = "\n📦 Incluye los pagos archivados"
+        filtros['archivados'] = 'si'
+    else:
+        nota = f"\n📦 Sin pagos anteriores al {corte.strftime('%d/%m/%Y')} (archivados): agrega archivados=si"
+    await enviar_exportacion(update, context, 'pagos', consulta, parametros, encabezados, filtros, nota)
 
-def main():
-    """Función principal - BOT EN HILO PRINCIPAL"""
-    print("🎯 INICIANDO BOT DE TELEGRAM EN RENDER...")
+async def exportar_planes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Exportar planes de pago a CSV comprimido, con filtros opcionales (solo admin)"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ No tienes permisos de administrador")
+        return
+    
+    if context.args and context.args[0].lower() == 'ayuda':
+        await update.message.reply_text(AYUDA_EXPORTAR)
+        return
+    
+    try:
+        filtros = parsear_filtros_planes(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{AYUDA_EXPORTAR}")
+        return
+    
+    condiciones, parametros = condiciones_planes(filtros)
+    donde = ("WHERE " + " AND ".join(condiciones)) if condiciones else ""
+    consulta = f"""
+        SELECT p.id, p.user_id, u.first_name, u.last_name, p.estado, p.total, p.semanas,
+               p.pago_semanal, p.semanas_completadas, p.contador_pausado,
+               p.fecha_inicio, p.fecha_ultimo_pago, p.productos_json::TEXT
+        FROM planes_pago p
+        LEFT JOIN usuarios u ON p.user_id = u.user_id
+        {donde}
+        ORDER BY p.id
+    """
+    encabezados = ('id', 'user_id', 'nombre', 'apellido', 'estado', 'total', 'semanas', 'pago_semanal',
+                   'semanas_completadas', 'contador_pausado', 'fecha_inicio', 'fecha_ultimo_pago', 'productos')
+    await enviar_exportacion(update, context, 'planes', consulta, parametros, encabezados, filtros)
+
+# =============================================
+# 🗄️ ESTADO DEL POOL DE CONEXIONES (ADMIN)
+# =============================================
+
+async def estado_pool(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mostrar estadísticas del pool de conexiones (admin)"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ No tienes permisos de administrador")
+        return
+    
+    datos = obtener_estadisticas_pool()
+    
+    mensaje = "🗄️ **ESTADO DEL POOL DE CONEXIONES**\n\n"
+    mensaje += f"📏 **Límites:** min {DB_POOL_MIN_SIZE} / max {DB_POOL_MAX_SIZE}\n"
+    mensaje += f"🔢 **Conexiones abiertas:** {datos['tamano']}\n"
+    mensaje += f"🟢 **En uso:** {datos['en_uso']}\n"
+    mensaje += f"⚪ **Disponibles:** {datos['disponibles']}\n"
+    mensaje += f"⏳ **En espera:** {datos['en_espera']}\n\n"
+    mensaje += "⏱️ **LATENCIA AL OBTENER CONEXIÓN:**\n"
+    mensaje += f"• Solicitudes: {datos['solicitudes']}\n"
+    mensaje += f"• Promedio: {datos['promedio_ms']:.2f} ms\n"
+    mensaje += f"• Máximo: {datos['maximo_ms']:.2f} ms\n"
+    mensaje += f"• Timeouts: {datos['timeouts']}\n"
+    if 'errores' in datos:
+        mensaje += f"\n⚠️ Errores de conexión: {datos['errores']} | Perdidas: {datos['perdidas']}"
+    
+    await update.message.reply_text(mensaje)
+
+# =============================================
+# ⏱️ LATENCIA DE COMANDOS (ADMIN)
+# =============================================
+
+async def ver_latencias(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mostrar p50/p95/p99 de los handlers medidos (admin)"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ No tienes permisos de administrador")
+        return
     
-    # 1. Inicializar base de datos
-    print("🗄️ Inicializando base de datos...")
-    init_db()
-    verificar_base_datos()
+    if not latencias_comandos:
+        await update.message.reply_text("📭 Aún no hay mediciones de latencia")
+        return
     
-    # 2. Configurar el bot de Telegram
-    print("🤖 Configurando bot de Telegram...")
+    mensaje = "⏱️ **LATENCIA POR COMANDO**\n\n"
+    for comando, histograma in sorted(latencias_comandos.items()):
+        promedio = histograma.suma_ms / histograma.total
+        mensaje += f"📍 **{comando}** ({histograma.total} llamadas)\n"
+        mensaje += f"   p50: {histograma.percentil(50):.0f} ms | p95: {histograma.percentil(95):.0f} ms | p99: {histograma.percentil(99):.0f} ms\n"
+        mensaje += f"   promedio: {promedio:.0f} ms | máx: {histograma.maximo_ms:.0f} ms\n\n"
     
-    application = (
+    await update.message.reply_text(mensaje)
+
+# =============================================
+# 💬 MANEJADORES POR ESTADO DEL CHAT
+# =============================================
+
+# Qué handler recibe el texto según el estado del chat (usado por handle_message)
+MANEJADORES_ESTADO = {
+    EstadoChat.REGISTRANDO_USUARIO: handle_phone_registration,
+    EstadoChat.ESPERANDO_DATOS_PAGO: handle_datos_pago,
+    EstadoChat.AGREGANDO_PRODUCTO: handle_agregar_producto,
+    EstadoChat.EDITANDO_PRODUCTO: handle_editar_producto,
+    EstadoChat.CONFIGURANDO_SEMANAS: handle_configurar_semanas,
+    EstadoChat.RECHAZANDO_PAGO: handle_rechazo_motivo,
+    EstadoChat.PUNTOS_PERSONALIZADOS: handle_puntos_personalizados,
+    EstadoChat.SEMANAS_PERSONALIZADAS: handle_semanas_personalizadas,
+}
+
+# =============================================
+# FUNCIÓN MAIN
+# =============================================
+
+tareas_fondo = []
+
+async def preparar_base_datos():
+    """Abrir el pool y aplicar migraciones; va antes de initialize() porque
+    ahí la Application carga la persistencia desde la base de datos"""
+    logger.info("🗄️ Inicializando base de datos...")
+    await iniciar_pool()
+    await init_db()
+    await verificar_base_datos()
+
+async def inicializar_recursos(application: Application):
+    """Arrancar las tareas de fondo una vez inicializada la aplicación"""
+    if CATALOGO_LISTEN:
+        tareas_fondo.append(asyncio.create_task(escuchar_invalidaciones()))
+    # Siempre activo: también retoma los avisos que quedaron pendientes al reiniciar
+    tareas_fondo.append(asyncio.create_task(despachar_notificaciones(application.bot)))
+    if AVANCE_AUTOMATICO:
+        programar_avance_automatico(application)
+    programar_archivo(application)
+
+async def liberar_recursos(application: Application):
+    """Detener tareas de fondo y cerrar el pool al detener el bot"""
+    for tarea in tareas_fondo:
+        tarea.cancel()
+    await asyncio.gather(*tareas_fondo, return_exceptions=True)
+    tareas_fondo.clear()
+    await cerrar_pool()
+
+
+def construir_aplicacion(base_url: str = None) -> Application:
+    """Crear la Application de Telegram con todos sus handlers.
+
+    base_url permite apuntar a otro servidor de la Bot API (p. ej. el falso
+    de benchmark_bot.py) en lugar de api.telegram.org.
+    """
+    logger.info("🤖 Configurando bot de Telegram...")
+    
+    builder = (
         Application.builder()
         .token(TOKEN)
-        .read_timeout(30)
-        .write_timeout(30) 
-        .connect_timeout(30)
-        .pool_timeout(30)
-        .build()
+        .request(RequestInstrumentado(  # Mide cada llamada a la Bot API
+            read_timeout=30,
+            write_timeout=30,
+            connect_timeout=30,
+            pool_timeout=30,
+        ))
+        .concurrent_updates(ProcesadorPorChat(UPDATES_CONCURRENTES))  # Chats distintos en paralelo, cada chat en orden
+        .post_init(inicializar_recursos)
+        .post_shutdown(liberar_recursos)
     )
+    if base_url:
+        builder = builder.base_url(base_url)
+    persistencia = crear_persistencia()
+    if persistencia:
+        builder = builder.persistence(persistencia)
+        logger.info(f"💾 Persistencia de estado: {PERSISTENCIA}")
+    if WEBHOOK_URL:
+        # En modo webhook no hace falta el Updater (long polling)
+        builder = builder.updater(None)
+    application = builder.build()
     
     # =============================================
     # 🎯 ORDEN CORREGIDO - ¡IMPORTANTE!
@@ -5704,6 +7829,7 @@ def main():
     application.add_handler(CallbackQueryHandler(button_handler_puntos, pattern=r'^(compartir_codigo|ver_mis_puntos|ir_a_referidos|actualizar_puntos)$'))
     application.add_handler(CallbackQueryHandler(button_handler_contadores, pattern=r'^(avanzar_forzar|reanudar_y_avanzar)_'))
     application.add_handler(CallbackQueryHandler(button_handler_config_semanas, pattern=r'^(config_usuario|config_semanas|config_personalizado|reiniciar_semanas|mantener_semanas|cancelar_config)'))
+    application.add_handler(CallbackQueryHandler(navegar_listado, pattern=r'^pag_\d+_\d+$'))
     application.add_handler(CallbackQueryHandler(button_handler))
     
     # 🚨 2. SEGUNDO: TODOS los CommandHandler
@@ -5729,6 +7855,8 @@ def main():
     application.add_handler(CommandHandler("verpagostodos", verpagostodos))
     application.add_handler(CommandHandler("verpago", verpago_detalle))
     application.add_handler(CommandHandler("verusuarios", verusuarios))
+    application.add_handler(CommandHandler("exportarpagos", exportar_pagos))
+    application.add_handler(CommandHandler("exportarplanes", exportar_planes))
     
     # Comandos de admin - Contadores
     application.add_handler(CommandHandler("vercontadores", control_contador_usuario))
@@ -5748,6 +7876,11 @@ def main():
     application.add_handler(CommandHandler("agregarpuntos", agregar_puntos_admin))
     application.add_handler(CommandHandler("quitarpuntos", quitar_puntos_admin))
     application.add_handler(CommandHandler("establecerpuntos", establecer_puntos_admin))
+    application.add_handler(CommandHandler("beneficios", ver_beneficios))
+    application.add_handler(CommandHandler("guardarbeneficio", guardar_beneficio))
+    application.add_handler(CommandHandler("quitarbeneficio", quitar_beneficio))
+    application.add_handler(CommandHandler("estadopool", estado_pool))
+    application.add_handler(CommandHandler("latencias", ver_latencias))
     
     # 🚨 3. TERCERO: Handlers dinámicos (SOLO después de CommandHandler)
     application.add_handler(MessageHandler(
@@ -5779,102 +7912,171 @@ def main():
     # ✅ Manejo de errores
     application.add_error_handler(error_handler)
     
+    # 📈 Latencia, consultas y errores de cada handler para /metrics
+    instrumentar_handlers(application)
+    
+    
+    logger.info("✅ BOT CONFIGURADO CORRECTAMENTE CON SISTEMA INDIVIDUAL")
+    return application
+
+# =============================================
+# 🌐 SERVIDOR WEB (WEBHOOK + SALUD)
+# =============================================
+
+def crear_app_web(application: Application) -> Starlette:
+    """App ASGI que comparte el event loop con el bot: salud, readiness, métricas y webhook"""
+    
+    async def salud(request: Request):
+        return PlainTextResponse("Bot is running")
     
-    print("✅ BOT CONFIGURADO CORRECTAMENTE CON SISTEMA INDIVIDUAL")
-    
-    # 3. Iniciar Flask en un hilo separado (para Render)
-    print("🌐 Iniciando servidor web Flask en segundo plano...")
-    
-    def run_flask():
-        port = int(os.environ.get('PORT', 10000))
-        print(f"🌐 Flask ejecutándose en puerto {port}")
-        app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
-    
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    
-    # 4. Iniciar el bot en el HILO PRINCIPAL
-    print("\n" + "="*60)
-    print("🤖 BOT DE PLANES DE PAGO - SISTEMA INDIVIDUAL POR USUARIO")
-    print("="*60)
-    print("📍 COMANDOS PARA USUARIOS:")
-    print("   /start - Registrarse en el sistema")
-    print("   /catalogo - Ver productos (solo lectura)")
-    print("   /misplanes - Ver plan asignado con contador individual")
-    print("   /miperfil - Información personal")
-    print("   /mispuntos - Sistema de puntos")
-    print("   /referidos - Invitar amigos")
-    print("   /pagarealizado - Registrar pago")
-    print("   /mistatus - Estado de mis pagos")
-    print("\n📍 COMANDOS PARA ADMIN (5908252094, 7228946245, 1074083869):")
-    print("   🔄 CONTROL DE CONTADORES:")
-    print("   /vercontadores - Ver todos los contadores")
-    print("   /avanzar_ID - Avanzar usuario específico")
-    print("   /pausar_ID - Pausar usuario específico")
-    print("   /reanudar_ID - Reanudar usuario específico")
-    print("   /avanzartodos - Avanzar TODOS los activos")
-    print("   /pausartodos - Pausar TODOS")
-    print("   /reanudartodos - Reanudar TODOS")
-    print("\n   ⚙️ CONFIGURACIÓN DE SEMANAS:")
-    print("   /configurarbusqueda - Buscar usuario para configurar")
-    print("   /configurarsemanas_ID N - Cambiar semanas de usuario")
-    print("   /verconfiguraciones - Ver todas las configuraciones")
-    print("   /configurarsemanasdefault - Semanas por defecto")
-    print("\n   📊 ADMINISTRACIÓN GENERAL:")
-    print("   /verasignaciones - Ver todas las asignaciones")
-    print("   /asignar - Buscar usuario para asignar productos")
-    print("   /adminverproductos - Ver catálogo completo")
-    print("   /adminagregarproducto - Agregar producto")
-    print("   /verpagos - Ver pagos pendientes")
-    print("   /verpagostodos - Ver TODOS los pagos")
-    print("   /verusuarios - Ver todos los usuarios")
-    print("   /rankingpuntos - Ranking de puntos")
-    print("   /verreferidos - Referidos pendientes")
-    print("   /verpuntosusuario_ID - Puntos de usuario")
-    print("   /vaciarranking - Vaciar sistema de puntos")
-    print("="*60 + "\n")
-    
-    print("🟢 BOT INICIADO - Escuchando mensajes...")
-    print("\n📍 Sistema: Contadores INDIVIDUALES por usuario")
-    print("📍 Admin controla manualmente los avances individuales")
-    print("📍 Servicio web activo en: https://bot-sususemanal.onrender.com")
-    print("\n📌 USO: /avanzartodos - Avanzar a TODOS los usuarios activos")
+    async def listo(request: Request):
+        """Readiness: el bot está corriendo y la base de datos responde"""
+        estado = {'bot': application.running, 'base_datos': False}
+        if db_pool is not None:
+            try:
+                async with db_connection() as conn:
+                    await conn.execute("SELECT 1")
+                estado['base_datos'] = True
+            except Exception as e:
+                logger.warning(f"⚠️ Readiness: base de datos no disponible: {e}")
+        listo_ok = estado['bot'] and estado['base_datos']
+        return JSONResponse(estado, status_code=200 if listo_ok else 503)
+    
+    async def exponer_metricas(request: Request):
+        """Métricas en formato de texto de Prometheus"""
+        return PlainTextResponse(exportar_metricas(), media_type="text/plain; version=0.0.4")
+    
+    async def recibir_update(request: Request):
+        """Recibir un update de Telegram y encolarlo para la Application"""
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return Response(status_code=403)
+        datos = await request.json()
+        await application.update_queue.put(Update.de_json(datos, application.bot))
+        return Response()
+    
+    rutas = [
+        Route("/", salud, methods=["GET"]),
+        Route("/ready", listo, methods=["GET"]),
+        Route("/metrics", exponer_metricas, methods=["GET"]),
+    ]
+    if WEBHOOK_URL:
+        rutas.append(Route(WEBHOOK_PATH, recibir_update, methods=["POST"]))
+    return Starlette(routes=rutas)
+
+async def ejecutar_bot(application: Application):
+    """Ejecutar bot y servidor web en el mismo event loop (webhook o polling)"""
+    servidor = uvicorn.Server(uvicorn.Config(
+        app=crear_app_web(application),
+        host="0.0.0.0",
+        port=PORT,
+        log_level="warning",
+        use_colors=False,
+    ))
+    
+    await preparar_base_datos()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info(f"🔗 Webhook registrado en {WEBHOOK_URL + WEBHOOK_PATH}")
+        else:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            logger.info("🔄 Polling iniciado")
+        
+        await application.start()
+        logger.info(f"🌐 Servidor web escuchando en el puerto {PORT}")
+        # uvicorn atiende SIGINT/SIGTERM y termina serve() para apagar ordenadamente
+        await servidor.serve()
+    finally:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        # shutdown() vuelca la persistencia: el pool se cierra después
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def main():
+    """Función principal - bot y servidor web en un único event loop"""
+    listener_logs = configurar_logging()
+    logger.info("🚀 INICIANDO SISTEMA COMPLETO...")
+    logger.info("🎯 INICIANDO BOT DE TELEGRAM EN RENDER...")
+    
+    # La base de datos se inicializa en ejecutar_bot (pool asíncrono)
+    application = construir_aplicacion()
+    
+    # Resumen de arranque en un solo registro
+    logger.info("\n".join([
+        "\n" + "="*60,
+        "🤖 BOT DE PLANES DE PAGO - SISTEMA INDIVIDUAL POR USUARIO",
+        "="*60,
+        "📍 COMANDOS PARA USUARIOS:",
+        "   /start - Registrarse en el sistema",
+        "   /catalogo - Ver productos (solo lectura)",
+        "   /misplanes - Ver plan asignado con contador individual",
+        "   /miperfil - Información personal",
+        "   /mispuntos - Sistema de puntos",
+        "   /referidos - Invitar amigos",
+        "   /pagarealizado - Registrar pago",
+        "   /mistatus - Estado de mis pagos",
+        "\n📍 COMANDOS PARA ADMIN (5908252094, 7228946245, 1074083869):",
+        "   🔄 CONTROL DE CONTADORES:",
+        "   /vercontadores - Ver todos los contadores",
+        "   /avanzar_ID - Avanzar usuario específico",
+        "   /pausar_ID - Pausar usuario específico",
+        "   /reanudar_ID - Reanudar usuario específico",
+        "   /avanzartodos - Avanzar TODOS los activos",
+        "   /pausartodos - Pausar TODOS",
+        "   /reanudartodos - Reanudar TODOS",
+        "\n   ⚙️ CONFIGURACIÓN DE SEMANAS:",
+        "   /configurarbusqueda - Buscar usuario para configurar",
+        "   /configurarsemanas_ID N - Cambiar semanas de usuario",
+        "   /verconfiguraciones - Ver todas las configuraciones",
+        "   /configurarsemanasdefault - Semanas por defecto",
+        "\n   📊 ADMINISTRACIÓN GENERAL:",
+        "   /verasignaciones - Ver todas las asignaciones",
+        "   /asignar - Buscar usuario para asignar productos",
+        "   /adminverproductos - Ver catálogo completo",
+        "   /adminagregarproducto - Agregar producto",
+        "   /verpagos - Ver pagos pendientes",
+        "   /verpagostodos - Ver TODOS los pagos",
+        "   /verusuarios - Ver todos los usuarios",
+        "   /exportarpagos - Exportar pagos a CSV (ayuda: /exportarpagos ayuda)",
+        "   /exportarplanes - Exportar planes a CSV",
+        "   /rankingpuntos - Ranking de puntos",
+        "   /verreferidos - Referidos pendientes",
+        "   /verpuntosusuario_ID - Puntos de usuario",
+        "   /vaciarranking - Vaciar sistema de puntos",
+        "   /beneficios - Niveles de beneficios por puntos",
+        "   /estadopool - Estado del pool de conexiones",
+        "   /latencias - Latencia p50/p95/p99 por comando",
+        "="*60 + "\n",
+        "🟢 BOT INICIADO - Escuchando mensajes...",
+        "\n📍 Sistema: Contadores INDIVIDUALES por usuario",
+        "📍 Admin controla manualmente los avances individuales",
+        "📍 Servicio web activo en: https://bot-sususemanal.onrender.com",
+        f"📍 Modo: {'WEBHOOK ' + WEBHOOK_URL + WEBHOOK_PATH if WEBHOOK_URL else 'POLLING'} | Puerto web: {PORT}",
+        f"📍 Avance automático: {'ACTIVO cada ' + str(int(AVANCE_INTERVALO)) + 's' if AVANCE_AUTOMATICO else 'DESACTIVADO (usar /avanzartodos)'}",
+        f"📍 Archivo: pagos > {MESES_ACTIVOS['pagos']} meses, historial de puntos > {MESES_ACTIVOS['puntos_historial']} meses (0 = nunca)",
+        "\n📌 USO: /avanzartodos - Avanzar a TODOS los usuarios activos",
+    ]))
         
     try:
-        application.run_polling()
+        asyncio.run(ejecutar_bot(application))
     except KeyboardInterrupt:
-        print("⏹️ Bot detenido por el usuario")
+        logger.info("⏹️ Bot detenido por el usuario")
     except Exception as e:
-        print(f"❌ Error en el bot: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Error en el bot: %s", e)
+    finally:
+        # Vaciar la cola de logs antes de salir
+        listener_logs.stop()
 
 if __name__ == "__main__":
-    print("🚀 INICIANDO SISTEMA COMPLETO...")
-    
-    # SOLUCIÓN: Ejecutar el bot en el hilo principal y Flask en segundo plano
-    def run_flask():
-        """Ejecutar Flask en puerto diferente"""
-        try:
-            port = int(os.environ.get('PORT', 10000))
-            print(f"🌐 Flask ejecutándose en puerto {port}")
-            app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
-        except Exception as e:
-            print(f"❌ Error en Flask: {e}")
-    
-    # Iniciar Flask en segundo plano
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    
-    # Esperar un momento para que Flask se inicie
-    import time
-    time.sleep(2)
-    
-    # Ejecutar el bot en el HILO PRINCIPAL (esto es crucial)
-    print("🤖 Iniciando bot en hilo principal...")
     main()
-
-
-
-
-
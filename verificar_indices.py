@@ -0,0 +1,295 @@
+"""Verificación de índices: comprueba con EXPLAIN que las consultas más
+frecuentes del bot usan un índice sobre un conjunto de datos grande.
+
+Crea un esquema temporal, aplica las migraciones de main.py, carga ~100k
+usuarios con sus planes, pagos, puntos, referidos y avisos, y revisa el plan
+de cada consulta. Termina con código 1 si alguna consulta cae en un Seq Scan o si el
+JOIN con usuarios no se resuelve por índice.
+
+Uso (contra una base de datos de pruebas, NO producción):
+    DATABASE_URL=postgres://... python verificar_indices.py --usuarios 100000
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+import psycopg
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from main import (
+    AVANCE_LOTE, CONSULTA_AVANCE_VENCIDO, CONSULTA_HISTORIAL_PUNTOS, CONSULTA_PAGOS_USUARIO,
+    CONSULTA_PLAN_ACTIVO, CONSULTA_PUNTOS_Y_POSICION, CONSULTA_REFERIDOS_APROBADOS,
+    CONSULTA_REFERIDOS_PENDIENTES, CONSULTA_REFERIDOS_USUARIO, CONSULTA_RESERVAR_NOTIFICACIONES,
+    LISTADO_PAGOS, LISTADO_PAGOS_PENDIENTES, LISTADO_RANKING, LISTADO_USUARIOS,
+    MIGRACIONES, NOTIF_LOTE, NOTIF_RESERVA_SEGUNDOS,
+)
+
+ESQUEMA = "verificacion_indices"
+USUARIO_PRUEBA = 4242
+# Clave de orden de la última fila de una página ya mostrada (paginación por keyset)
+CLAVE_FECHA = datetime.now() - timedelta(days=30)
+CLAVE_ID = 50_000
+PAGINA_SIGUIENTE = (CLAVE_FECHA, CLAVE_ID)
+
+# Tablas que se pueden recorrer enteras: el catálogo de productos tiene decenas
+# de filas y ranking_puntos una por (saldo, franja), así que la posición en
+# /mispuntos cuesta O(saldos distintos × 16) y no depende de cuántos usuarios haya
+TABLAS_PEQUENAS = {"productos", "ranking_puntos"}
+
+# (descripción, consulta, parámetros, índice esperado) - la misma SQL que ejecuta
+# main.py: sus constantes CONSULTA_* y la página de cada Listado
+CONSULTAS_FRECUENTES = [
+    (
+        "Plan activo del usuario (/misplanes)",
+        CONSULTA_PLAN_ACTIVO,
+        (USUARIO_PRUEBA,),
+        "idx_planes_pago_user_estado",
+    ),
+    (
+        "Pagos pendientes, página siguiente (/verpagos)",
+        *LISTADO_PAGOS_PENDIENTES.sql(PAGINA_SIGUIENTE),
+        "idx_pagos_pendientes_fecha_id",
+    ),
+    (
+        "Todos los pagos, página siguiente (/verpagostodos)",
+        *LISTADO_PAGOS.sql(PAGINA_SIGUIENTE),
+        "idx_pagos_fecha_id",
+    ),
+    (
+        "Pagos filtrados por estado (/verpagostodos estado=aprobado)",
+        *LISTADO_PAGOS.sql(PAGINA_SIGUIENTE, {'estado': 'aprobado'}),
+        "idx_pagos_estado_fecha_id",
+    ),
+    (
+        "Pagos filtrados por usuario (/verpagostodos usuario=ID)",
+        *LISTADO_PAGOS.sql(None, {'usuario': USUARIO_PRUEBA}),
+        "idx_pagos_user_fecha_id",
+    ),
+    (
+        "Pagos filtrados por referencia (/verpagostodos ref=...)",
+        *LISTADO_PAGOS.sql(None, {'ref': f'REF{USUARIO_PRUEBA}'}),
+        "idx_pagos_referencia_prefijo",
+    ),
+    (
+        "Usuarios, página siguiente (/verusuarios)",
+        *LISTADO_USUARIOS.sql(PAGINA_SIGUIENTE),
+        "idx_usuarios_fecha_registro",
+    ),
+    (
+        "Ranking de puntos, página siguiente (/rankingpuntos)",
+        *LISTADO_RANKING.sql((5, CLAVE_ID)),
+        "idx_usuarios_puntos_ranking",
+    ),
+    (
+        "Saldo y posición en el ranking (/mispuntos)",
+        CONSULTA_PUNTOS_Y_POSICION,
+        (USUARIO_PRUEBA,),
+        "usuarios_puntos_pkey",
+    ),
+    (
+        "Pagos del usuario (/mistatus)",
+        CONSULTA_PAGOS_USUARIO,
+        (USUARIO_PRUEBA,),
+        "idx_pagos_user_fecha_id",
+    ),
+    (
+        "Historial de puntos (/mispuntos)",
+        CONSULTA_HISTORIAL_PUNTOS,
+        (USUARIO_PRUEBA,),
+        "idx_puntos_historial_user_fecha",
+    ),
+    (
+        "Referidos del usuario (/referidos)",
+        CONSULTA_REFERIDOS_USUARIO,
+        (USUARIO_PRUEBA,),
+        "idx_referidos_referidor_estado",
+    ),
+    (
+        "Referidos aprobados del usuario (/miperfil)",
+        CONSULTA_REFERIDOS_APROBADOS,
+        (USUARIO_PRUEBA,),
+        "idx_referidos_referidor_estado",
+    ),
+    (
+        "Referidos pendientes (/verreferidos)",
+        CONSULTA_REFERIDOS_PENDIENTES,
+        None,
+        "idx_referidos_pendientes",
+    ),
+    (
+        "Planes con aniversario vencido (avance automático)",
+        CONSULTA_AVANCE_VENCIDO,
+        (AVANCE_LOTE, "verificacion"),
+        "idx_planes_pago_aniversario",
+    ),
+    (
+        "Reserva de avisos pendientes (bandeja de salida)",
+        CONSULTA_RESERVAR_NOTIFICACIONES,
+        (NOTIF_RESERVA_SEGUNDOS, NOTIF_LOTE),
+        "idx_notificaciones_pendientes",
+    ),
+]
+
+
+def cargar_datos(cursor, usuarios: int):
+    """Cargar datos sintéticos con una distribución parecida a producción"""
+    print(f"🌱 Cargando {usuarios} usuarios y datos relacionados...")
+    # Particiones mensuales para las fechas pasadas que se van a generar
+    for tabla in ("pagos", "puntos_historial"):
+        cursor.execute(
+            "SELECT crear_particiones_mensuales(%s, (CURRENT_DATE - INTERVAL '1 year')::date, CURRENT_DATE)",
+            (tabla,),
+        )
+    cursor.execute("""
+        INSERT INTO productos (nombre, precio)
+        SELECT 'Producto' || g, 10 * g FROM generate_series(1, 30) g
+    """)
+    cursor.execute("""
+        INSERT INTO usuarios (user_id, user_name, first_name, last_name, phone, fecha_registro)
+        SELECT g, 'usuario' || g, 'Nombre' || g, 'Apellido' || g, '+58' || g,
+               NOW() - (g %% 365) * INTERVAL '1 day'
+        FROM generate_series(1, %s) g
+    """, (usuarios,))
+    # 60% con plan activo, 1 de cada 10 pausado; el resto con planes completados
+    cursor.execute("""
+        INSERT INTO planes_pago (user_id, productos_json, total, semanas, pago_semanal,
+                                 semanas_completadas, estado, contador_pausado)
+        SELECT g, '{"1": 1}'::jsonb, 100, 10, 10, g %% 10,
+               CASE WHEN g %% 5 < 3 THEN 'activo' ELSE 'completado' END,
+               g %% 10 = 0
+        FROM generate_series(1, %s) g
+    """, (usuarios,))
+    # 3 pagos por usuario, ~2% pendientes
+    cursor.execute("""
+        INSERT INTO pagos (user_id, user_name, referencia, monto, estado, fecha)
+        SELECT (g %% %s) + 1, 'usuario', 'REF' || g, 10,
+               CASE WHEN g %% 50 = 0 THEN 'pendiente' ELSE 'aprobado' END,
+               NOW() - (g %% 1000) * INTERVAL '1 hour'
+        FROM generate_series(1, %s) g
+    """, (usuarios, usuarios * 3))
+    # 5 movimientos de puntos por usuario
+    cursor.execute("""
+        INSERT INTO puntos_historial (user_id, tipo, puntos, descripcion, fecha)
+        SELECT (g %% %s) + 1, 'pago_manual', 1, 'Pago aprobado',
+               NOW() - (g %% 2000) * INTERVAL '1 hour'
+        FROM generate_series(1, %s) g
+    """, (usuarios, usuarios * 5))
+    cursor.execute("""
+        INSERT INTO usuarios_puntos (user_id, puntos_totales, puntos_disponibles)
+        SELECT g, g %% 50 + 5, g %% 50 FROM generate_series(1, %s) g
+    """, (usuarios,))
+    # Medio referido por usuario, ~5% pendientes
+    cursor.execute("""
+        INSERT INTO referidos (user_id_referidor, user_id_referido, nombre_referido, estado, fecha_registro)
+        SELECT (g %% %s) + 1, g + %s, 'Referido' || g,
+               CASE WHEN g %% 20 = 0 THEN 'pendiente' ELSE 'aprobado' END,
+               NOW() - (g %% 500) * INTERVAL '1 hour'
+        FROM generate_series(1, %s) g
+    """, (usuarios, usuarios, usuarios // 2))
+    # Un avance registrado por usuario y dos avisos, ~1% todavía pendientes
+    cursor.execute("""
+        INSERT INTO avances (run_id, plan_id, user_id, semana, semanas, tipo, notificado)
+        SELECT 'carga', g, g, g %% 10, 10, 'automatico', TRUE
+        FROM generate_series(1, %s) g
+    """, (usuarios,))
+    cursor.execute("""
+        INSERT INTO notificaciones (user_id, texto, origen, avance_id, estado, fecha_envio)
+        SELECT (g %% %s) + 1,
+               CASE WHEN g %% 2 = 0 THEN 'Aviso' || g END,
+               CASE WHEN g %% 2 = 0 THEN 'pausa_masiva' ELSE 'avance_automatico' END,
+               CASE WHEN g %% 2 = 1 THEN (g %% %s) + 1 END,
+               CASE WHEN g %% 100 = 0 THEN 'pendiente' ELSE 'enviado' END,
+               NOW() - (g %% 1000) * INTERVAL '1 hour'
+        FROM generate_series(1, %s) g
+    """, (usuarios, usuarios, usuarios * 2))
+    cursor.execute("ANALYZE")
+
+
+def indices_del_plan(nodo: dict, encontrados: list):
+    """Recorrer el plan JSON y acumular (tipo de nodo, índice, tabla)"""
+    encontrados.append((nodo.get("Node Type"), nodo.get("Index Name"), nodo.get("Relation Name")))
+    for hijo in nodo.get("Plans", []):
+        indices_del_plan(hijo, encontrados)
+    return encontrados
+
+
+def indices_validos(cursor, indice: str) -> set:
+    """El índice esperado y, si es de una tabla particionada, los de cada partición"""
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    """, (indice,))
+    return {indice} | {fila[0] for fila in cursor.fetchall()}
+
+
+def usuarios_por_indice(nodos: list) -> bool:
+    """Si el plan lee usuarios, que sea por su clave primaria o un idx_usuarios_*
+    (un Hash Join que recorre los 100k usuarios no pasa)"""
+    if not any(tabla == "usuarios" for _, _, tabla in nodos):
+        return True
+    return any(nombre == "usuarios_pkey" or (tabla == "usuarios" and nombre)
+               for _, nombre, tabla in nodos)
+
+
+def verificar_consultas(cursor) -> int:
+    fallos = 0
+    for descripcion, consulta, parametros, indice in CONSULTAS_FRECUENTES:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + consulta, parametros)
+        plan = cursor.fetchone()[0][0]["Plan"]
+        nodos = indices_del_plan(plan, [])
+        validos = indices_validos(cursor, indice)
+        usa_indice = any(nombre in validos for _, nombre, _ in nodos)
+        # La partición por defecto queda vacía: recorrerla no cuesta nada
+        seq_scans = [tabla for tipo, _, tabla in nodos
+                     if tipo == "Seq Scan" and not tabla.endswith("_default")
+                     and tabla not in TABLAS_PEQUENAS]
+
+        if usa_indice and not seq_scans and usuarios_por_indice(nodos):
+            print(f"✅ {descripcion}: {indice}")
+        else:
+            fallos += 1
+            detalle = ", ".join(f"{tipo}({nombre or tabla})" for tipo, nombre, tabla in nodos if tipo)
+            print(f"❌ {descripcion}: se esperaba {indice} -> {detalle}")
+    return fallos
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verificar que las consultas frecuentes usan índices")
+    parser.add_argument("--usuarios", type=int, default=100_000)
+    parser.add_argument("--conservar", action="store_true", help="No borrar el esquema de prueba al terminar")
+    args = parser.parse_args()
+
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        raise SystemExit("❌ Define DATABASE_URL (base de datos de pruebas)")
+
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {ESQUEMA} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {ESQUEMA}")
+        try:
+            cursor.execute(f"SET search_path TO {ESQUEMA}")
+            for version, descripcion, sentencias in MIGRACIONES:
+                for sentencia in sentencias:
+                    cursor.execute(sentencia)
+
+            cargar_datos(cursor, args.usuarios)
+            fallos = verificar_consultas(cursor)
+        finally:
+            if not args.conservar:
+                cursor.execute("SET search_path TO public")
+                cursor.execute(f"DROP SCHEMA IF EXISTS {ESQUEMA} CASCADE")
+
+    if fallos:
+        print(f"\n❌ {fallos} consulta(s) sin índice")
+        sys.exit(1)
+    print("\n🎉 Todas las consultas frecuentes usan índices")
+
+
+if __name__ == "__main__":
+    main()